@@ -1,5 +1,8 @@
 from django.contrib import admin
-from .models import Contact, Inbox, Conversation, Message, TeamMember, Team, RecoverySettings, RecoveryAttempt
+from .models import (
+    Contact, Inbox, Conversation, Message, TeamMember, Team, RecoverySettings, RecoveryAttempt,
+    MediaRetentionPolicy,
+)
 
 
 @admin.register(Contact)
@@ -60,3 +63,9 @@ class RecoveryAttemptAdmin(admin.ModelAdmin):
     list_filter = ('status', 'attempt_number', 'sent_at')
     search_fields = ('conversation__contact__name',)
 
+
+@admin.register(MediaRetentionPolicy)
+class MediaRetentionPolicyAdmin(admin.ModelAdmin):
+    list_display = ('provedor', 'enabled', 'retention_days', 'days_by_type', 'statuses', 'last_run_at')
+    list_filter = ('enabled',)
+    search_fields = ('provedor__nome',)
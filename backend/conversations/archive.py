@@ -0,0 +1,247 @@
+"""
+Arquivo de mensagens
+
+Conversas fechadas sem atividade há MESSAGE_ARCHIVE_AFTER_DAYS dias têm suas
+mensagens movidas da tabela quente (conversations_message) para
+MessageArchive: um registro por conversa e mês, com o JSON das mensagens
+comprimido (zlib). Assim o tamanho da tabela quente e de seus índices acompanha
+apenas o histórico recente. A mídia continua referenciada pelas mensagens
+arquivadas (media_blob_id) até a retenção expirá-la.
+
+A leitura é transparente: conversation_messages_page e messages_for_conversation
+juntam o arquivo com a tabela quente quando a conversa tem mensagens arquivadas
+(Conversation.has_archive). A paginação começa pela tabela quente e só
+descomprime os meses arquivados que a página alcança. O resumo da conversa (contadores, last_message_at)
+é mantido; apenas last_message fica vazio, já que a linha saiu da tabela quente.
+Os payloads brutos do provedor (MessagePayload) não são arquivados.
+"""
+
+import json
+import zlib
+from contextlib import contextmanager
+from datetime import timedelta, timezone as dt_timezone
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from core.logging_utils import get_logger
+from . import models
+from .models import Conversation, Message, MessageArchive
+from .pagination import decode_cursor, keyset_page, page_result, window_size
+
+logger = get_logger('messages')
+
+# media_blob_id mantém a referência ao blob (MediaBlob.ref_count) enquanto a
+# mensagem está arquivada; a retenção de mídia a libera (retention.expire_archived)
+ARCHIVED_FIELDS = (
+    'id', 'content', 'message_type', 'is_from_customer', 'created_at', 'updated_at',
+    'external_id', 'additional_attributes', 'media_blob_id',
+)
+
+
+def _encode(rows):
+    return zlib.compress(json.dumps(rows, ensure_ascii=False, default=str).encode(), 6)
+
+
+def _decode(payload):
+    return json.loads(zlib.decompress(bytes(payload)).decode())
+
+
+def archive_rows(archive):
+    """Linhas (dicionários, formato de ARCHIVED_FIELDS) de um MessageArchive"""
+    return _decode(archive.payload)
+
+
+def encode_rows(rows):
+    return _encode(rows)
+
+
+def media_rows(rows):
+    return sum(1 for row in rows if row.get('media_blob_id'))
+
+
+def archived_blob_refs(payload):
+    """{blob_id: referências} das mensagens de um MessageArchive"""
+    refs = {}
+    for row in _decode(payload):
+        if row.get('media_blob_id'):
+            refs[row['media_blob_id']] = refs.get(row['media_blob_id'], 0) + 1
+    return refs
+
+
+def _serialize(message):
+    row = {field: getattr(message, field) for field in ARCHIVED_FIELDS}
+    row['created_at'] = message.created_at.isoformat()
+    row['updated_at'] = message.updated_at.isoformat()
+    return row
+
+
+def _deserialize(row, conversation):
+    data = dict(row)
+    data['created_at'] = parse_datetime(data['created_at'])
+    data['updated_at'] = parse_datetime(data['updated_at'])
+    message = Message(conversation_id=conversation.pk, **data)
+    message.conversation = conversation
+    # Instância somente leitura: não existe na tabela quente
+    message._state.adding = False
+    return message
+
+
+@contextmanager
+def _summary_hook_suspended():
+    models._summary_hook.suspended = True
+    try:
+        yield
+    finally:
+        models._summary_hook.suspended = False
+
+
+def archive_conversation(conversation):
+    """Move as mensagens da conversa para o arquivo. Retorna quantas foram movidas."""
+    with transaction.atomic():
+        messages = list(conversation.messages.order_by('created_at', 'id'))
+        if not messages:
+            return 0
+
+        by_month = {}
+        for message in messages:
+            month = message.created_at.date().replace(day=1)
+            by_month.setdefault(month, []).append(_serialize(message))
+
+        existing = {
+            archive.month: archive
+            for archive in MessageArchive.objects.filter(conversation=conversation, month__in=list(by_month))
+        }
+        for month, rows in by_month.items():
+            archive = existing.get(month)
+            if archive:
+                # Conversa reaberta e arquivada de novo: junta ao mês já arquivado
+                rows = _decode(archive.payload) + rows
+            else:
+                archive = MessageArchive(conversation=conversation, month=month)
+            archive.payload = _encode(rows)
+            archive.message_count = len(rows)
+            archive.media_count = media_rows(rows)
+            archive.save()
+
+        with _summary_hook_suspended():
+            Message.objects.filter(pk__in=[message.pk for message in messages]).delete()
+        Conversation.objects.filter(pk=conversation.pk).update(has_archive=True)
+        conversation.has_archive = True
+    return len(messages)
+
+
+def archivable_conversations(older_than_days=None):
+    days = older_than_days if older_than_days is not None else settings.MESSAGE_ARCHIVE_AFTER_DAYS
+    cutoff = timezone.now() - timedelta(days=days)
+    return Conversation.objects.filter(
+        Exists(Message.objects.filter(conversation=OuterRef('pk'))),
+        status='closed',
+        last_message_at__lt=cutoff,
+    ).order_by('id')
+
+
+def archive_old_conversations(older_than_days=None, batch_size=None, limit=None):
+    """Arquiva as conversas elegíveis em lotes. Retorna (conversas, mensagens)."""
+    batch_size = batch_size or settings.MESSAGE_ARCHIVE_BATCH_SIZE
+    conversations = total_messages = 0
+    last_id = 0
+    while limit is None or conversations < limit:
+        size = batch_size if limit is None else min(batch_size, limit - conversations)
+        batch = list(archivable_conversations(older_than_days).filter(id__gt=last_id)[:size])
+        if not batch:
+            break
+        for conversation in batch:
+            try:
+                total_messages += archive_conversation(conversation)
+                conversations += 1
+            except Exception as e:
+                logger.warning("Erro ao arquivar conversa %s: %s", conversation.id, e)
+        last_id = batch[-1].id
+    return conversations, total_messages
+
+
+def archived_messages(conversation):
+    """Mensagens arquivadas da conversa, em ordem cronológica"""
+    if not conversation.has_archive:
+        return []
+    messages = []
+    for archive in conversation.message_archives.order_by('month'):
+        messages.extend(_deserialize(row, conversation) for row in _decode(archive.payload))
+    messages.sort(key=lambda message: (message.created_at, message.id))
+    return messages
+
+
+def messages_for_conversation(conversation, queryset=None):
+    """Arquivo + tabela quente; ``queryset`` restringe a parte quente"""
+    if queryset is None:
+        queryset = conversation.messages.all()
+    return archived_messages(conversation) + list(queryset.order_by('created_at', 'id'))
+
+
+def _key(message):
+    return (message.created_at, message.id)
+
+
+def _month(key):
+    created_at = key[0]
+    if timezone.is_aware(created_at):
+        created_at = created_at.astimezone(dt_timezone.utc)
+    return created_at.date().replace(day=1)
+
+
+def _archived_before(conversation, key=None):
+    """Mensagens arquivadas anteriores a ``key``, da mais nova para a mais antiga; descomprime um mês por vez"""
+    archives = conversation.message_archives.defer('payload').order_by('-month')
+    if key:
+        archives = archives.filter(month__lte=_month(key))
+    for archive in archives:
+        messages = [_deserialize(row, conversation) for row in _decode(archive.payload)]
+        messages = sorted((m for m in messages if not key or _key(m) < key), key=_key, reverse=True)
+        yield from messages
+
+
+def _archived_after(conversation, key):
+    """Mensagens arquivadas posteriores a ``key``, em ordem cronológica; descomprime um mês por vez"""
+    archives = conversation.message_archives.defer('payload').filter(month__gte=_month(key)).order_by('month')
+    for archive in archives:
+        messages = [_deserialize(row, conversation) for row in _decode(archive.payload)]
+        yield from sorted((m for m in messages if _key(m) > key), key=_key)
+
+
+def conversation_messages_page(conversation, before=None, after=None, limit=None):
+    """
+    keyset_page que também enxerga as mensagens arquivadas. A tabela quente é
+    paginada primeiro; o arquivo só é lido quando a página passa da mensagem
+    quente mais antiga, e apenas os meses necessários para completar ``limit``.
+    """
+    hot = conversation.messages.all()
+    if not conversation.has_archive:
+        return keyset_page(hot, before=before, after=after, limit=limit)
+    limit = window_size(limit)
+
+    if after:
+        key = decode_cursor(after)
+        oldest_hot = hot.order_by('created_at', 'id').values_list('created_at', 'id').first()
+        if oldest_hot and key >= tuple(oldest_hot):
+            return keyset_page(hot, after=after, limit=limit)
+        page = list(islice(_archived_after(conversation, key), limit + 1))
+        if len(page) <= limit:
+            hot_key = _key(page[-1]) if page else key
+            page += list(hot.filter(
+                Q(created_at__gt=hot_key[0]) | Q(created_at=hot_key[0], id__gt=hot_key[1])
+            ).order_by('created_at', 'id')[:limit + 1 - len(page)])
+        return page_result(page[:limit], len(page) > limit)
+
+    result = keyset_page(hot, before=before, limit=limit)
+    if result['has_more']:
+        return result
+    page = result['results']
+    key = _key(page[0]) if page else (decode_cursor(before) if before else None)
+    missing = limit - len(page)
+    older = list(islice(_archived_before(conversation, key), missing + 1))
+    return page_result(older[:missing][::-1] + page, len(older) > missing)
@@ -4,14 +4,18 @@ from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 
+from core.logging_utils import get_logger, log_payload
+
+logger = get_logger('websocket')
+
 
 class ConversationConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
         self.room_group_name = f'conversation_{self.conversation_id}'
 
-        print(f"🔌 WebSocket: Tentando conectar para conversa {self.conversation_id}")
-        print(f"🔌 WebSocket: Room group name: {self.room_group_name}")
+        logger.debug("Tentando conectar para conversa %s", self.conversation_id)
+        logger.debug("Room group name: %s", self.room_group_name)
 
         # Join room group
         await self.channel_layer.group_add(
@@ -20,7 +24,7 @@ class ConversationConsumer(AsyncWebsocketConsumer):
         )
 
         await self.accept()
-        print(f"✅ WebSocket: Conectado com sucesso para conversa {self.conversation_id}")
+        logger.debug("Conectado com sucesso para conversa %s", self.conversation_id)
 
     async def disconnect(self, close_code):
         # Leave room group
@@ -73,8 +77,8 @@ class ConversationConsumer(AsyncWebsocketConsumer):
         sender = event['sender']
         timestamp = event['timestamp']
 
-        print(f"📨 WebSocket: Enviando mensagem para conversa {self.conversation_id}")
-        print(f"📨 WebSocket: Mensagem: {message}")
+        logger.debug("Enviando mensagem para conversa %s", self.conversation_id)
+        log_payload(logger, "Mensagem", message)
 
         # Send message to WebSocket
         await self.send(text_data=json.dumps({
@@ -83,7 +87,7 @@ class ConversationConsumer(AsyncWebsocketConsumer):
             'sender': sender,
             'timestamp': timestamp
         }))
-        print(f"✅ WebSocket: Mensagem enviada com sucesso")
+        logger.debug("Mensagem enviada com sucesso")
 
     # Handle typing indicator
     async def typing_indicator(self, event):
@@ -93,6 +97,14 @@ class ConversationConsumer(AsyncWebsocketConsumer):
             'is_typing': event['is_typing']
         }))
 
+    # Andamento de envio de mídia em partes (conversations/uploads.py)
+    async def upload_progress(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'upload_progress',
+            'upload': event['upload'],
+            'timestamp': event['timestamp']
+        }))
+
 
 class NotificationConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -177,6 +189,13 @@ class PainelConsumer(AsyncWebsocketConsumer):
     async def dashboard_event(self, event):
         await self.send(text_data=json.dumps(event['data']))
 
+    # Andamento dos e-mails enviados (integrations/outbound_mail.py)
+    async def email_status(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'email_status',
+            'email': event['email']
+        }))
+
 
 class UserStatusConsumer(AsyncWebsocketConsumer):
     async def connect(self):
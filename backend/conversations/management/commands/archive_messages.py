@@ -0,0 +1,52 @@
+"""
+Comando Django para mover mensagens antigas para o arquivo
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from conversations.archive import archivable_conversations, archive_old_conversations
+
+
+class Command(BaseCommand):
+    help = 'Arquivar as mensagens de conversas fechadas sem atividade recente'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-days',
+            type=int,
+            help='Idade mínima da última mensagem em dias (padrão: MESSAGE_ARCHIVE_AFTER_DAYS)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Conversas por lote (padrão: MESSAGE_ARCHIVE_BATCH_SIZE)'
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            help='Número máximo de conversas arquivadas nesta execução'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Apenas mostrar quantas conversas seriam arquivadas'
+        )
+
+    def handle(self, *args, **options):
+        days = options['older_than_days']
+        if days is None:
+            days = settings.MESSAGE_ARCHIVE_AFTER_DAYS
+
+        if options['dry_run']:
+            total = archivable_conversations(days).count()
+            self.stdout.write(f'{total} conversas seriam arquivadas (sem atividade há {days} dias)')
+            return
+
+        conversations, messages = archive_old_conversations(
+            older_than_days=days,
+            batch_size=options['batch_size'],
+            limit=options['limit'],
+        )
+        self.stdout.write(
+            self.style.SUCCESS(f'{conversations} conversas arquivadas ({messages} mensagens)')
+        )
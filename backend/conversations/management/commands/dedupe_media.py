@@ -0,0 +1,43 @@
+"""
+Comando Django para mover a mídia antiga de MEDIA_ROOT/messages para o
+armazenamento por conteúdo (conversations.media_store)
+"""
+
+import os
+
+from django.core.management.base import BaseCommand
+from conversations.media_store import legacy_files, migrate_legacy_media
+
+
+class Command(BaseCommand):
+    help = 'Deduplicar a mídia antiga das conversas no armazenamento por conteúdo'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--conversation',
+            type=int,
+            action='append',
+            help='Migrar apenas esta conversa (pode ser repetido)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Apenas mostrar quantos arquivos seriam migrados'
+        )
+
+    def handle(self, *args, **options):
+        conversation_ids = set(options['conversation'] or [])
+
+        if options['dry_run']:
+            files = [
+                path for conversation_id, _, path in legacy_files()
+                if not conversation_ids or conversation_id in conversation_ids
+            ]
+            total_bytes = sum(os.path.getsize(path) for path in files)
+            self.stdout.write(f'{len(files)} arquivos seriam migrados ({total_bytes} bytes)')
+            return
+
+        migrated, reclaimed = migrate_legacy_media(conversation_ids)
+        self.stdout.write(
+            self.style.SUCCESS(f'{migrated} arquivos migrados ({reclaimed} bytes liberados por duplicidade)')
+        )
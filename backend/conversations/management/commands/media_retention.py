@@ -0,0 +1,53 @@
+"""
+Comando Django para executar a retenção de mídia
+"""
+
+import signal
+import sys
+from django.core.management.base import BaseCommand
+from conversations.retention import MediaRetentionEngine, run_cycle
+
+
+class Command(BaseCommand):
+    help = 'Remover a mídia expirada pelas políticas de retenção e os arquivos sem referência'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=int,
+            help='Intervalo entre ciclos em segundos (padrão: MEDIA_RETENTION_INTERVAL)'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Executar um único ciclo e sair'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Apenas mostrar o que seria removido'
+        )
+
+    def handle(self, *args, **options):
+        if options['once'] or options['dry_run']:
+            totals = run_cycle(dry_run=options['dry_run'])
+            prefixo = 'Seriam' if options['dry_run'] else 'Foram'
+            self.stdout.write(self.style.SUCCESS(
+                f"{prefixo} expiradas {totals['expired']} mídias de mensagens e removidos "
+                f"{totals['blobs_deleted']} arquivos e {totals['uploads_purged']} envios abandonados "
+                f"({totals['bytes_reclaimed']} bytes)"
+            ))
+            return
+
+        engine = MediaRetentionEngine(interval=options.get('interval'))
+
+        def signal_handler(signum, frame):
+            self.stdout.write("Recebido sinal de parada...")
+            engine.stop()
+            sys.exit(0)
+
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
+
+        self.stdout.write(self.style.SUCCESS(f"Retenção de mídia iniciada (intervalo: {engine.interval}s)"))
+        engine.run_forever()
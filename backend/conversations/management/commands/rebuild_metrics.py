@@ -0,0 +1,30 @@
+"""
+Comando Django para reconstruir as métricas agregadas (MetricRollup)
+"""
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from conversations.metrics import rebuild_metrics
+
+
+class Command(BaseCommand):
+    help = 'Recalcular as métricas por hora a partir das mensagens e conversas'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--provedor',
+            type=int,
+            help='ID do provedor (padrão: todos)'
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            help='Recalcular apenas os últimos N dias (padrão: todo o histórico)'
+        )
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(days=options['days']) if options['days'] else None
+        total = rebuild_metrics(provedor_id=options['provedor'], since=since)
+        self.stdout.write(self.style.SUCCESS(f'{total} linhas de métricas gravadas'))
@@ -0,0 +1,46 @@
+"""
+Comando Django para executar o recuperador de conversas
+"""
+
+import signal
+import sys
+from django.core.management.base import BaseCommand
+from conversations.recovery import RecoveryEngine, run_cycle
+
+
+class Command(BaseCommand):
+    help = 'Enviar mensagens de recuperação para conversas ociosas'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=int,
+            help='Intervalo entre ciclos em segundos (padrão: RECOVERY_ENGINE_INTERVAL)'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Executar um único ciclo e sair'
+        )
+
+    def handle(self, *args, **options):
+        if options['once']:
+            totals = run_cycle()
+            self.stdout.write(self.style.SUCCESS(
+                f"{totals['enrolled']} conversas agendadas, {totals['sent']} processadas, "
+                f"{totals['recovered']} recuperadas"
+            ))
+            return
+
+        engine = RecoveryEngine(interval=options.get('interval'))
+
+        def signal_handler(signum, frame):
+            self.stdout.write("Recebido sinal de parada...")
+            engine.stop()
+            sys.exit(0)
+
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
+
+        self.stdout.write(self.style.SUCCESS(f"Recuperador iniciado (intervalo: {engine.interval}s)"))
+        engine.run_forever()
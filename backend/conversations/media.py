@@ -0,0 +1,219 @@
+"""
+Download de mídia fora da requisição
+
+O webhook salva a mensagem com a URL remota do arquivo (file_url) e agenda o
+download aqui. O arquivo é baixado em streaming para um temporário, com SHA-256
+e tamanho calculados durante a cópia e limite de MEDIA_DOWNLOAD_MAX_BYTES, e
+renomeado atomicamente para o destino (o armazenamento por conteúdo,
+media_store): nunca fica um arquivo pela metade no caminho final, e a memória
+usada não depende do tamanho da mídia.
+
+Os downloads rodam num pool de MEDIA_DOWNLOAD_WORKERS threads; no máximo
+MEDIA_DOWNLOAD_QUEUE_SIZE ficam em espera. Quando o arquivo chega, a mensagem
+ganha file_path/local_file_url/file_size/sha256 e um evento ``chat_message`` é
+emitido na conversa; áudio que não veio em MP3 segue para a conversão
+(conversations.transcode) e imagens e vídeos ganham miniatura
+(conversations.previews).
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+from urllib.parse import urlparse
+
+import requests
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from core.logging_utils import get_logger
+from .models import Message
+
+logger = get_logger('media')
+
+CHUNK_SIZE = 64 * 1024
+MEDIA_URL_PREFIX = '/api/media/messages/'
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+class DownloadResult(NamedTuple):
+    path: str
+    size: int
+    sha256: str
+
+
+def _max_bytes():
+    return getattr(settings, 'MEDIA_DOWNLOAD_MAX_BYTES', 100 * 1024 * 1024)
+
+
+def message_media_dir(conversation_id):
+    return os.path.join(settings.MEDIA_ROOT, 'messages', str(conversation_id))
+
+
+def local_media_path(file_url):
+    """
+    Caminho em disco de uma URL de mídia nossa (/api/media/messages/<conversa>/<arquivo>,
+    relativa ou absoluta) ou None
+    """
+    from .media_store import resolve
+
+    path = urlparse(file_url or '').path
+    if not path.startswith(MEDIA_URL_PREFIX):
+        return None
+    conversation_id, _, filename = path[len(MEDIA_URL_PREFIX):].rstrip('/').partition('/')
+    if not conversation_id.isdigit():
+        return None
+    return resolve(int(conversation_id), filename)
+
+
+def copy_stream(chunks, dest_path, max_bytes=None):
+    """
+    Grava ``chunks`` num temporário ao lado de ``dest_path`` e renomeia no fim.
+    Levanta MediaTooLarge (sem deixar arquivo) se passar de ``max_bytes``.
+    """
+    max_bytes = _max_bytes() if max_bytes is None else max_bytes
+    directory = os.path.dirname(dest_path)
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.part-')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise MediaTooLarge(f'Arquivo maior que {max_bytes} bytes')
+                digest.update(chunk)
+                tmp.write(chunk)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return DownloadResult(dest_path, size, digest.hexdigest())
+
+
+def stream_download(url, dest_path, max_bytes=None, timeout=None, headers=None):
+    """Baixa ``url`` em streaming para ``dest_path`` (ver copy_stream)"""
+    max_bytes = _max_bytes() if max_bytes is None else max_bytes
+    timeout = timeout or getattr(settings, 'MEDIA_DOWNLOAD_TIMEOUT', 30)
+    with requests.get(url, stream=True, timeout=timeout, headers=headers) as response:
+        response.raise_for_status()
+        declared = response.headers.get('Content-Length')
+        if max_bytes and declared and declared.isdigit() and int(declared) > max_bytes:
+            raise MediaTooLarge(f'Content-Length {declared} maior que {max_bytes} bytes')
+        return copy_stream(response.iter_content(CHUNK_SIZE), dest_path, max_bytes)
+
+
+def notify_message_updated(message):
+    """Reenvia a mensagem atualizada para quem está com a conversa aberta"""
+    from .serializers import MessageSerializer
+
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            f'conversation_{message.conversation_id}',
+            {
+                'type': 'chat_message',
+                'message': MessageSerializer(message).data,
+                'sender': None,
+                'timestamp': message.updated_at.isoformat(),
+            }
+        )
+    except Exception as e:
+        logger.warning("Erro ao notificar atualização da mensagem %s: %s", message.id, e)
+
+
+def _update_attributes(message_id, **attrs):
+    message = Message.objects.filter(id=message_id).first()
+    if message is None:
+        return None
+    message.additional_attributes = {**(message.additional_attributes or {}), **attrs}
+    message.save(update_fields=['additional_attributes', 'updated_at'])
+    return message
+
+
+def download_message_media(message_id, url, filename):
+    """Baixa a mídia da mensagem para o armazenamento por conteúdo e atualiza a mensagem"""
+    from .media_store import attach, ingest_url
+    from .previews import schedule_preview
+    from .transcode import needs_mp3, schedule_inbound_audio
+
+    message = Message.objects.filter(id=message_id).first()
+    if message is None:
+        return None
+    try:
+        blob = ingest_url(url)
+    except Exception as e:
+        logger.warning("Erro ao baixar mídia da mensagem %s: %s", message_id, e)
+        message = _update_attributes(message_id, media_status='failed')
+    else:
+        logger.debug("Mídia da mensagem %s baixada (%s bytes)", message_id, blob.size)
+        attach(message, blob, filename)
+        convert = needs_mp3(message, blob)
+        message.additional_attributes['media_status'] = 'transcoding' if convert else 'ready'
+        message.save(update_fields=['additional_attributes', 'updated_at'])
+        if convert:
+            schedule_inbound_audio(message)
+        else:
+            schedule_preview(message)
+    if message is not None:
+        notify_message_updated(message)
+    return message
+
+
+class MediaDownloader:
+    """Pool limitado de downloads: ``workers`` simultâneos e até ``queue_size`` em espera"""
+
+    def __init__(self, workers=None, queue_size=None):
+        self.workers = workers or getattr(settings, 'MEDIA_DOWNLOAD_WORKERS', 4)
+        queue_size = queue_size if queue_size is not None else getattr(settings, 'MEDIA_DOWNLOAD_QUEUE_SIZE', 100)
+        self._slots = threading.BoundedSemaphore(self.workers + queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            logger.warning("Erro no download de mídia: %s", e)
+        finally:
+            close_old_connections()
+            self._slots.release()
+
+    def submit(self, func, *args):
+        """Agenda ``func(*args)``; False se o pool e a fila estiverem cheios"""
+        if not self._slots.acquire(blocking=False):
+            return False
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='media-download')
+        self._executor.submit(self._run, func, args)
+        return True
+
+
+downloader = MediaDownloader()
+
+
+def _submit_message_download(message_id, url, filename):
+    if downloader.submit(download_message_media, message_id, url, filename):
+        return True
+    logger.warning("Fila de downloads cheia, mídia da mensagem %s mantida na URL remota", message_id)
+    _update_attributes(message_id, media_status='remote')
+    return False
+
+
+def schedule_message_media_download(message, url, filename):
+    """
+    Agenda o download da mídia da mensagem assim que a transação confirmar;
+    sem vaga no pool a mensagem fica só com a URL remota
+    """
+    transaction.on_commit(lambda: _submit_message_download(message.id, url, filename))
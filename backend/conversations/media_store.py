@@ -0,0 +1,218 @@
+"""
+Armazenamento de mídia por conteúdo
+
+Cada arquivo é gravado uma única vez em MEDIA_ROOT/cas/<aa>/<bb>/<sha256>
+(MediaBlob), não importa quantas mensagens o usem: a mesma figurinha ou o
+mesmo boleto encaminhado para centenas de clientes ocupa o disco (e o cache de
+páginas do sistema) uma vez só.
+
+As URLs continuam no formato /api/media/messages/<conversa>/<arquivo>: cada uma
+é um MediaAlias para o blob. Arquivos antigos que ainda estão em
+MEDIA_ROOT/messages/ são servidos do caminho original até serem migrados pelo
+comando ``dedupe_media``.
+
+Message.media_blob liga a mensagem ao blob e MediaBlob.ref_count conta essas
+ligações (decrementado quando a mensagem é excluída; o arquivamento mantém a
+referência). Blobs sem referência são removidos pela retenção
+(conversations.retention).
+"""
+
+import hashlib
+import os
+import shutil
+import uuid
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+
+from .media import CHUNK_SIZE, MEDIA_URL_PREFIX, copy_stream, message_media_dir, stream_download
+from .models import MediaAlias, MediaBlob, Message
+
+
+def temp_path(suffix=''):
+    """Caminho temporário no mesmo sistema de arquivos do armazenamento"""
+    directory = os.path.join(settings.MEDIA_ROOT, 'cas', 'tmp')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, uuid.uuid4().hex + suffix)
+
+
+def _store(tmp_path, size, sha256):
+    """Move o temporário para o caminho do blob (ou descarta, se o conteúdo já existe)"""
+    blob = MediaBlob.objects.filter(sha256=sha256).first()
+    created = False
+    if blob is None:
+        try:
+            with transaction.atomic():
+                blob = MediaBlob.objects.create(sha256=sha256, size=size)
+            created = True
+        except IntegrityError:
+            # Mesmo conteúdo gravado em paralelo
+            blob = MediaBlob.objects.get(sha256=sha256)
+    # Indica se o conteúdo já estava armazenado (o temporário foi descartado).
+    # Blob novo sempre grava: o arquivo pode ser de um blob recém-removido pela retenção
+    blob.deduplicated = not created and os.path.exists(blob.path)
+    if blob.deduplicated:
+        os.unlink(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(blob.path), exist_ok=True)
+        os.replace(tmp_path, blob.path)
+    return blob
+
+
+def ingest_hashed(path, size, sha256):
+    """Guarda um arquivo já em disco cujo hash é conhecido, sem relê-lo (move o arquivo)"""
+    tmp_path = temp_path()
+    os.replace(path, tmp_path)
+    return _store(tmp_path, size, sha256)
+
+
+def ingest_chunks(chunks, max_bytes=None):
+    """Grava um fluxo de bytes no armazenamento e devolve o MediaBlob"""
+    result = copy_stream(chunks, temp_path(), max_bytes)
+    return _store(result.path, result.size, result.sha256)
+
+
+def ingest_url(url, max_bytes=None, timeout=None):
+    """Baixa ``url`` em streaming direto para o armazenamento"""
+    result = stream_download(url, temp_path(), max_bytes, timeout)
+    return _store(result.path, result.size, result.sha256)
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def ingest_file(path, move=True):
+    """Guarda um arquivo já em disco (removendo o original quando ``move``)"""
+    sha256, size = file_digest(path)
+    tmp_path = temp_path()
+    if move:
+        os.replace(path, tmp_path)
+    else:
+        shutil.copyfile(path, tmp_path)
+    return _store(tmp_path, size, sha256)
+
+
+def media_url(conversation_id, filename):
+    return f'{MEDIA_URL_PREFIX}{conversation_id}/{filename}'
+
+
+def _alias_name(conversation_id, filename, blob):
+    """``filename`` se estiver livre (ou já apontar para o blob); senão com sufixo do hash"""
+    existing = MediaAlias.objects.filter(conversation_id=conversation_id, filename=filename).first()
+    legacy = os.path.exists(os.path.join(message_media_dir(conversation_id), filename))
+    if (existing is None and not legacy) or (existing is not None and existing.blob_id == blob.id):
+        return filename
+    stem, ext = os.path.splitext(filename)
+    return f'{stem}_{blob.sha256[:12]}{ext}'
+
+
+def alias(conversation_id, blob, filename):
+    """URL de ``blob`` com o nome ``filename`` (ou variação livre) na conversa"""
+    with transaction.atomic():
+        filename = _alias_name(conversation_id, filename, blob)
+        MediaAlias.objects.get_or_create(conversation_id=conversation_id, filename=filename, defaults={'blob': blob})
+    return media_url(conversation_id, filename)
+
+
+def attach(message, blob, filename):
+    """
+    Liga a mensagem ao blob com o nome ``filename`` na conversa e devolve a
+    URL. Atualiza file_path/local_file_url/file_size/sha256 na mensagem (sem salvar).
+    """
+    with transaction.atomic():
+        url = alias(message.conversation_id, blob, filename)
+        if message.media_blob_id != blob.id:
+            if message.media_blob_id:
+                MediaBlob.objects.filter(pk=message.media_blob_id, ref_count__gt=0).update(
+                    ref_count=F('ref_count') - 1
+                )
+            MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+            if message.pk:
+                Message.objects.filter(pk=message.pk).update(media_blob=blob)
+            message.media_blob = blob
+    message.additional_attributes = {
+        **(message.additional_attributes or {}),
+        'file_path': blob.path,
+        'file_name': url.rsplit('/', 1)[-1],
+        'file_size': blob.size,
+        'sha256': blob.sha256,
+        'local_file_url': url,
+    }
+    return url
+
+
+def resolve(conversation_id, filename):
+    """Caminho em disco de /api/media/messages/<conversa>/<arquivo> ou None"""
+    if not filename or '/' in filename or '\\' in filename or filename.startswith('.'):
+        return None
+    legacy = os.path.join(message_media_dir(conversation_id), filename)
+    if os.path.isfile(legacy):
+        return legacy
+    alias = MediaAlias.objects.filter(
+        conversation_id=conversation_id, filename=filename
+    ).select_related('blob').first()
+    if alias and os.path.isfile(alias.blob.path):
+        return alias.blob.path
+    return None
+
+
+def legacy_files():
+    """(conversa, arquivo, caminho) dos arquivos ainda em MEDIA_ROOT/messages"""
+    root = os.path.join(settings.MEDIA_ROOT, 'messages')
+    if not os.path.isdir(root):
+        return
+    with os.scandir(root) as conversations:
+        for conversation_dir in conversations:
+            if not conversation_dir.is_dir() or not conversation_dir.name.isdigit():
+                continue
+            with os.scandir(conversation_dir.path) as files:
+                for entry in files:
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        yield int(conversation_dir.name), entry.name, entry.path
+
+
+def migrate_legacy_file(conversation_id, filename, path):
+    """
+    Move um arquivo de MEDIA_ROOT/messages para o armazenamento, mantendo a
+    mesma URL (alias) e ligando as mensagens que a usam. Devolve o blob ou None
+    se o nome já existe como alias de outro conteúdo.
+    """
+    if MediaAlias.objects.filter(conversation_id=conversation_id, filename=filename).exists():
+        return None
+    blob = ingest_file(path)
+    url = media_url(conversation_id, filename)
+    with transaction.atomic():
+        MediaAlias.objects.get_or_create(
+            conversation_id=conversation_id, filename=filename, defaults={'blob': blob}
+        )
+        messages = Message.objects.filter(conversation_id=conversation_id, media_blob__isnull=True).filter(
+            Q(additional_attributes__local_file_url=url) | Q(additional_attributes__file_url=url)
+        )
+        for message in messages:
+            attach(message, blob, filename)
+            message.save(update_fields=['additional_attributes', 'updated_at'])
+    return blob
+
+
+def migrate_legacy_media(conversation_ids=None):
+    """Migra todos os arquivos antigos; devolve (arquivos, bytes liberados)"""
+    migrated = 0
+    reclaimed = 0
+    for conversation_id, filename, path in legacy_files():
+        if conversation_ids and conversation_id not in conversation_ids:
+            continue
+        blob = migrate_legacy_file(conversation_id, filename, path)
+        if blob is None:
+            continue
+        migrated += 1
+        if blob.deduplicated:
+            reclaimed += blob.size
+    return migrated, reclaimed
@@ -0,0 +1,174 @@
+"""
+Métricas agregadas por hora (rollup)
+
+MetricRollup guarda contadores por provedor, inbox (canal), atendente e hora:
+mensagens recebidas/enviadas, respostas da IA e humanas, conversas iniciadas e
+tempos de primeira resposta. Os contadores são incrementados pelos hooks de
+Message e Conversation (conversations/models.py), e as séries temporais são
+lidas daqui: o custo depende do número de horas do período, não do volume de
+mensagens.
+
+Para reconstruir o histórico a partir das tabelas brutas: comando
+``rebuild_metrics``.
+"""
+
+from datetime import timezone as dt_timezone
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, DurationField, ExpressionWrapper, F, Q, Sum
+from django.db.models.functions import TruncDay, TruncHour
+
+from .models import Conversation, Message, MetricRollup
+
+COUNTERS = (
+    'messages_received', 'messages_sent', 'ai_replies', 'human_replies',
+    'conversations_started', 'first_responses', 'first_response_seconds',
+)
+BUCKETS = {'hour': TruncHour, 'day': TruncDay}
+BATCH_SIZE = 500
+
+
+def _hour(value):
+    return value.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def is_ai_message(message):
+    # As respostas da IA são gravadas como 'outgoing' (ver fix_ai_messages);
+    # as do atendente usam o tipo do conteúdo (text, image, ...)
+    return not message.is_from_customer and message.message_type == 'outgoing'
+
+
+def increment(provedor_id, inbox_id, agent_id, hour, **deltas):
+    """Soma ``deltas`` ao contador da hora, criando a linha se necessário"""
+    if not provedor_id or not inbox_id:
+        return
+    key = {'provedor_id': provedor_id, 'inbox_id': inbox_id, 'agent_id': agent_id or 0, 'hour': hour}
+    updates = {field: F(field) + value for field, value in deltas.items()}
+    if MetricRollup.objects.filter(**key).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            MetricRollup.objects.create(**key, **deltas)
+    except IntegrityError:
+        # Outro processo criou a linha entre o UPDATE e o INSERT
+        MetricRollup.objects.filter(**key).update(**updates)
+
+
+def record_message_metrics(message, context, first_response_seconds=None):
+    if message.is_from_customer:
+        deltas = {'messages_received': 1}
+    else:
+        deltas = {'messages_sent': 1, 'ai_replies' if is_ai_message(message) else 'human_replies': 1}
+    if first_response_seconds is not None:
+        deltas['first_responses'] = 1
+        deltas['first_response_seconds'] = first_response_seconds
+    increment(context['provedor_id'], context['inbox_id'], context['assignee_id'], _hour(message.created_at), **deltas)
+
+
+def record_conversation_started(conversation, context):
+    increment(
+        context['provedor_id'], context['inbox_id'], context['assignee_id'],
+        _hour(conversation.created_at), conversations_started=1,
+    )
+
+
+def metrics_series(provedor_id, start, end, bucket='day', inbox_id=None, agent_id=None):
+    """
+    Série temporal [start, end) agrupada por hora ou dia, opcionalmente
+    filtrada por inbox ou atendente
+    """
+    queryset = MetricRollup.objects.filter(provedor_id=provedor_id, hour__gte=start, hour__lt=end)
+    if inbox_id:
+        queryset = queryset.filter(inbox_id=inbox_id)
+    if agent_id is not None:
+        queryset = queryset.filter(agent_id=agent_id)
+
+    rows = queryset.annotate(bucket=BUCKETS[bucket]('hour')).values('bucket').annotate(
+        **{f'total_{field}': Sum(field) for field in COUNTERS}
+    ).order_by('bucket')
+
+    series = []
+    for row in rows:
+        point = {field: row[f'total_{field}'] or 0 for field in COUNTERS}
+        point['bucket'] = row['bucket']
+        point['avg_first_response_seconds'] = (
+            point['first_response_seconds'] / point['first_responses'] if point['first_responses'] else None
+        )
+        series.append(point)
+    return series
+
+
+def rebuild_metrics(provedor_id=None, since=None):
+    """
+    Recalcula MetricRollup a partir de Message/Conversation com consultas
+    agrupadas. O atendente usado é o responsável atual da conversa.
+    Retorna o número de linhas gravadas.
+    """
+    utc = dt_timezone.utc
+    messages = Message.objects.all()
+    conversations = Conversation.objects.all()
+    rollups = MetricRollup.objects.all()
+    if provedor_id:
+        messages = messages.filter(conversation__inbox__provedor_id=provedor_id)
+        conversations = conversations.filter(inbox__provedor_id=provedor_id)
+        rollups = rollups.filter(provedor_id=provedor_id)
+    if since:
+        since = _hour(since)
+        messages = messages.filter(created_at__gte=since)
+        rollups = rollups.filter(hour__gte=since)
+
+    totals = {}
+
+    def add(row, **values):
+        key = (row['dim_provedor'], row['dim_inbox'], row['dim_agent'] or 0, row['dim_hour'])
+        if not key[0]:
+            return
+        counters = totals.setdefault(key, dict.fromkeys(COUNTERS, 0))
+        for field, value in values.items():
+            counters[field] += value or 0
+
+    # Nomes com prefixo para não colidir com campos dos modelos
+    def grouped(queryset, prefix, timestamp, **aggregates):
+        return queryset.annotate(
+            dim_provedor=F(f'{prefix}inbox__provedor_id'),
+            dim_inbox=F(f'{prefix}inbox_id'),
+            dim_agent=F(f'{prefix}assignee_id'),
+            dim_hour=TruncHour(timestamp, tzinfo=utc),
+        ).values('dim_provedor', 'dim_inbox', 'dim_agent', 'dim_hour').annotate(**aggregates).order_by()
+
+    for row in grouped(
+        messages, 'conversation__', 'created_at',
+        received=Count('id', filter=Q(is_from_customer=True)),
+        ai=Count('id', filter=Q(is_from_customer=False, message_type='outgoing')),
+        human=Count('id', filter=Q(is_from_customer=False) & ~Q(message_type='outgoing')),
+    ):
+        add(row, messages_received=row['received'], messages_sent=row['ai'] + row['human'],
+            ai_replies=row['ai'], human_replies=row['human'])
+
+    started = conversations.filter(created_at__gte=since) if since else conversations
+    for row in grouped(started, '', 'created_at', total=Count('id')):
+        add(row, conversations_started=row['total'])
+
+    responded = conversations.filter(first_response_at__isnull=False, first_customer_message_at__isnull=False)
+    if since:
+        responded = responded.filter(first_response_at__gte=since)
+    for row in grouped(
+        responded, '', 'first_response_at',
+        total=Count('id'),
+        duration=Sum(ExpressionWrapper(
+            F('first_response_at') - F('first_customer_message_at'), output_field=DurationField()
+        )),
+    ):
+        add(row, first_responses=row['total'],
+            first_response_seconds=row['duration'].total_seconds() if row['duration'] else 0)
+
+    with transaction.atomic():
+        rollups.delete()
+        MetricRollup.objects.bulk_create(
+            [
+                MetricRollup(provedor_id=key[0], inbox_id=key[1], agent_id=key[2], hour=key[3], **counters)
+                for key, counters in totals.items()
+            ],
+            batch_size=BATCH_SIZE,
+        )
+    return len(totals)
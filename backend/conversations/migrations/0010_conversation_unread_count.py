@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0009_message_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:11
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+
+BATCH_SIZE = 1000
+
+
+def backfill_last_message_at(apps, schema_editor):
+    # last_message_at nunca era preenchido; agora é a chave de ordenação da listagem
+    Conversation = apps.get_model('conversations', 'Conversation')
+    Message = apps.get_model('conversations', 'Message')
+    ultima = Message.objects.filter(conversation=OuterRef('pk')).values('conversation').annotate(
+        ultima=Max('created_at')
+    ).values('ultima')
+    pendentes = Conversation.objects.filter(last_message_at__isnull=True)
+    ultimo_id = 0
+    while True:
+        ids = list(pendentes.filter(id__gt=ultimo_id).order_by('id').values_list('id', flat=True)[:BATCH_SIZE])
+        if not ids:
+            break
+        Conversation.objects.filter(id__in=ids).update(last_message_at=Subquery(ultima))
+        ultimo_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0010_conversation_unread_count'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_last_message_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['inbox', 'status'], name='conv_inbox_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(condition=models.Q(('assignee__isnull', False)), fields=['assignee', 'status'], name='conv_assignee_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['-last_message_at', '-id'], name='conv_last_message_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'created_at', 'id'], name='msg_conv_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'is_from_customer', 'created_at'], name='msg_conv_customer_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('external_id__isnull', False)), fields=['external_id'], name='msg_external_id_idx'),
+        ),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:14
+
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+
+def _backfill(model, queryset, fields, derive):
+    ultimo_id = 0
+    while True:
+        lote = list(queryset.filter(id__gt=ultimo_id).order_by('id')[:BATCH_SIZE])
+        if not lote:
+            break
+        for obj in lote:
+            derive(obj, obj.additional_attributes or {})
+        model.objects.bulk_update(lote, fields)
+        ultimo_id = lote[-1].id
+
+
+def backfill_columns(apps, schema_editor):
+    Contact = apps.get_model('conversations', 'Contact')
+    Conversation = apps.get_model('conversations', 'Conversation')
+    Message = apps.get_model('conversations', 'Message')
+
+    def contact(obj, attrs):
+        obj.chatid = attrs.get('chatid') or ''
+        obj.sender_lid = attrs.get('sender_lid') or ''
+
+    def conversation(obj, attrs):
+        obj.recovery_status = attrs.get('recovery_status') or ''
+        obj.ai_assisted = 'ai_assisted' in attrs
+
+    def message(obj, attrs):
+        obj.external_id = attrs.get('external_id')
+
+    _backfill(Contact, Contact.objects.all(), ['chatid', 'sender_lid'], contact)
+    _backfill(Conversation, Conversation.objects.all(), ['recovery_status', 'ai_assisted'], conversation)
+    _backfill(
+        Message,
+        Message.objects.filter(external_id__isnull=True, additional_attributes__has_key='external_id'),
+        ['external_id'],
+        message,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0011_conversations_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contact',
+            name='chatid',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='contact',
+            name='sender_lid',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='ai_assisted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='recovery_status',
+            field=models.CharField(blank=True, default='', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(condition=models.Q(('recovery_status', ''), _negated=True), fields=['recovery_status'], name='conv_recovery_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(condition=models.Q(('ai_assisted', True)), fields=['ai_assisted'], name='conv_ai_assisted_idx'),
+        ),
+        migrations.RunPython(backfill_columns, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+BATCH_SIZE = 1000
+
+
+def backfill_summary(apps, schema_editor):
+    Conversation = apps.get_model('conversations', 'Conversation')
+    Message = apps.get_model('conversations', 'Message')
+
+    messages = Message.objects.filter(conversation=OuterRef('pk'))
+    latest = messages.order_by('-created_at', '-id')
+    customer = messages.filter(is_from_customer=True).order_by('-created_at', '-id')
+    count = messages.order_by().values('conversation').annotate(total=Count('pk')).values('total')
+    summary = {
+        'last_message_id': Subquery(latest.values('id')[:1]),
+        'last_message_at': Subquery(latest.values('created_at')[:1]),
+        'last_customer_message_at': Subquery(customer.values('created_at')[:1]),
+        'message_count': Coalesce(Subquery(count, output_field=IntegerField()), 0),
+    }
+
+    ultimo_id = 0
+    while True:
+        ids = list(Conversation.objects.filter(id__gt=ultimo_id).order_by('id').values_list('id', flat=True)[:BATCH_SIZE])
+        if not ids:
+            break
+        Conversation.objects.filter(id__in=ids).update(**summary)
+        ultimo_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0012_promote_json_attributes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_customer_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='conversations.message'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_summary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0013_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='has_archive',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('payload', models.BinaryField()),
+                ('archived_at', models.DateTimeField(auto_now=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='message_archives', to='conversations.conversation')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['month'], name='msg_archive_month_idx')],
+                'unique_together': {('conversation', 'month')},
+            },
+        ),
+    ]
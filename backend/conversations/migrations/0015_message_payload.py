@@ -0,0 +1,50 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Q
+
+BATCH_SIZE = 500
+RAW_KEYS = ('whatsapp_response', 'uazapi_response')
+
+
+def move_raw_payloads(apps, schema_editor):
+    Message = apps.get_model('conversations', 'Message')
+    MessagePayload = apps.get_model('conversations', 'MessagePayload')
+
+    com_payload = Q()
+    for key in RAW_KEYS:
+        com_payload |= Q(additional_attributes__has_key=key)
+    pendentes = Message.objects.filter(com_payload)
+
+    ultimo_id = 0
+    while True:
+        lote = list(pendentes.filter(id__gt=ultimo_id).order_by('id')[:BATCH_SIZE])
+        if not lote:
+            break
+        payloads = []
+        for message in lote:
+            raw = {key: message.additional_attributes.pop(key) for key in RAW_KEYS if key in message.additional_attributes}
+            payloads.append(MessagePayload(message_id=message.id, data=raw))
+        MessagePayload.objects.bulk_create(payloads, ignore_conflicts=True)
+        Message.objects.bulk_update(lote, ['additional_attributes'])
+        ultimo_id = lote[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0014_message_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessagePayload',
+            fields=[
+                ('message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='raw_payload', serialize=False, to='conversations.message')),
+                ('data', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(move_raw_payloads, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+BATCH_SIZE = 1000
+
+
+def backfill_first_response(apps, schema_editor):
+    Conversation = apps.get_model('conversations', 'Conversation')
+    Message = apps.get_model('conversations', 'Message')
+
+    messages = Message.objects.filter(conversation=OuterRef('pk')).order_by('created_at', 'id').values('created_at')
+    first_customer = messages.filter(is_from_customer=True)[:1]
+    first_response = messages.filter(
+        is_from_customer=False, created_at__gte=OuterRef('first_customer_message_at')
+    )[:1]
+
+    ultimo_id = 0
+    while True:
+        ids = list(Conversation.objects.filter(id__gt=ultimo_id).order_by('id').values_list('id', flat=True)[:BATCH_SIZE])
+        if not ids:
+            break
+        lote = Conversation.objects.filter(id__in=ids)
+        lote.update(first_customer_message_at=Subquery(first_customer))
+        lote.filter(first_customer_message_at__isnull=False).update(first_response_at=Subquery(first_response))
+        ultimo_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0015_message_payload'),
+        ('core', '0028_provedor_ferramentas_ia_provedor_fluxo_atendimento_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='first_customer_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='first_response_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='MetricRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('agent_id', models.IntegerField(default=0)),
+                ('hour', models.DateTimeField()),
+                ('messages_received', models.PositiveIntegerField(default=0)),
+                ('messages_sent', models.PositiveIntegerField(default=0)),
+                ('ai_replies', models.PositiveIntegerField(default=0)),
+                ('human_replies', models.PositiveIntegerField(default=0)),
+                ('conversations_started', models.PositiveIntegerField(default=0)),
+                ('first_responses', models.PositiveIntegerField(default=0)),
+                ('first_response_seconds', models.FloatField(default=0)),
+                ('inbox', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='metric_rollups', to='conversations.inbox')),
+                ('provedor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='metric_rollups', to='core.provedor')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['provedor', 'hour'], name='metric_provedor_hour_idx')],
+                'unique_together': {('provedor', 'inbox', 'agent_id', 'hour')},
+            },
+        ),
+        migrations.RunPython(backfill_first_response, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:26
+
+from django.db import migrations, models
+from django.db.models import Q
+
+from conversations.models import parse_timestamp
+
+BATCH_SIZE = 500
+
+
+def backfill_recovery_timestamps(apps, schema_editor):
+    Conversation = apps.get_model('conversations', 'Conversation')
+    queryset = Conversation.objects.filter(
+        Q(additional_attributes__has_key='recovery_last_attempt')
+        | Q(additional_attributes__has_key='recovery_response_time')
+    )
+    ultimo_id = 0
+    while True:
+        lote = list(queryset.filter(id__gt=ultimo_id).order_by('id')[:BATCH_SIZE])
+        if not lote:
+            break
+        for obj in lote:
+            attrs = obj.additional_attributes or {}
+            obj.recovery_last_attempt_at = parse_timestamp(attrs.get('recovery_last_attempt'))
+            obj.recovery_response_at = parse_timestamp(attrs.get('recovery_response_time'))
+        Conversation.objects.bulk_update(lote, ['recovery_last_attempt_at', 'recovery_response_at'])
+        ultimo_id = lote[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0016_metric_rollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='recovery_last_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='recovery_response_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_recovery_timestamps, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:29
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0017_recovery_timestamps'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='recovery_next_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='recoverysettings',
+            name='scanned_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['last_customer_message_at', 'id'], name='conv_last_customer_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(condition=models.Q(('recovery_next_at__isnull', False)), fields=['recovery_next_at'], name='conv_recovery_next_idx'),
+        ),
+    ]
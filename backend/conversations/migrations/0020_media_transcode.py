@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0019_media_store'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaTranscode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('format', models.CharField(max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('output', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='conversations.mediablob')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='transcodes', to='conversations.mediablob')),
+            ],
+            options={
+                'unique_together': {('source', 'format')},
+            },
+        ),
+    ]
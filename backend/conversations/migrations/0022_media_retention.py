@@ -0,0 +1,41 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0021_media_upload'),
+        ('core', '0029_provedor_intencoes_ia'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaRetentionPolicy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('enabled', models.BooleanField(default=True)),
+                ('retention_days', models.PositiveIntegerField(default=90)),
+                ('days_by_type', models.JSONField(blank=True, default=dict)),
+                ('statuses', models.JSONField(blank=True, default=list, help_text='Status das conversas; vazio = fechadas')),
+                ('last_run_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='mediablob',
+            index=models.Index(condition=models.Q(('ref_count', 0)), fields=['created_at'], name='blob_unreferenced_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('media_blob__isnull', False)), fields=['created_at', 'id'], name='msg_media_created_idx'),
+        ),
+        migrations.AddField(
+            model_name='mediaretentionpolicy',
+            name='provedor',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='media_retention', to='core.provedor'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.4 on 2026-10-19 14:27
+
+import json
+import zlib
+
+from django.db import migrations, models
+
+BATCH_SIZE = 100
+
+
+def link_archived_media(apps, schema_editor):
+    """
+    Arquivos gravados antes de media_blob_id fazer parte do JSON: a referência
+    ao blob (que o arquivamento não liberou) é recuperada pelo sha256 que o
+    attach grava em additional_attributes.
+    """
+    MessageArchive = apps.get_model('conversations', 'MessageArchive')
+    MediaBlob = apps.get_model('conversations', 'MediaBlob')
+    ultimo_id = 0
+    while True:
+        lote = list(MessageArchive.objects.filter(id__gt=ultimo_id).order_by('id')[:BATCH_SIZE])
+        if not lote:
+            break
+        for archive in lote:
+            rows = json.loads(zlib.decompress(bytes(archive.payload)).decode())
+            hashes = {
+                (row.get('additional_attributes') or {}).get('sha256')
+                for row in rows
+                if not row.get('media_blob_id') and (row.get('additional_attributes') or {}).get('media_status') != 'expired'
+            } - {None, ''}
+            blobs = dict(MediaBlob.objects.filter(sha256__in=hashes).values_list('sha256', 'id')) if hashes else {}
+            for row in rows:
+                if not row.get('media_blob_id'):
+                    row['media_blob_id'] = blobs.get((row.get('additional_attributes') or {}).get('sha256'))
+            archive.payload = zlib.compress(json.dumps(rows, ensure_ascii=False, default=str).encode(), 6)
+            archive.media_count = sum(1 for row in rows if row.get('media_blob_id'))
+            if archive.media_count:
+                archive.save(update_fields=['payload', 'media_count'])
+        ultimo_id = lote[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0022_media_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagearchive',
+            name='media_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='messagearchive',
+            index=models.Index(condition=models.Q(('media_count__gt', 0)), fields=['month'], name='msg_archive_media_idx'),
+        ),
+        migrations.RunPython(link_archived_media, migrations.RunPython.noop),
+    ]
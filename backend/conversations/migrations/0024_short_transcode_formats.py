@@ -0,0 +1,32 @@
+# Generated by Django 5.2.4 on 2026-10-19 16:05
+
+from django.db import migrations
+
+# Chaves antigas das miniaturas -> chaves que cabem em MediaTranscode.format
+FORMATS = {
+    'thumb.webp': 'thumb',
+    'poster.webp': 'poster',
+}
+
+
+def shorten_formats(apps, schema_editor):
+    MediaTranscode = apps.get_model('conversations', 'MediaTranscode')
+    for old, new in FORMATS.items():
+        MediaTranscode.objects.filter(format=old).update(format=new)
+
+
+def restore_formats(apps, schema_editor):
+    MediaTranscode = apps.get_model('conversations', 'MediaTranscode')
+    for old, new in FORMATS.items():
+        MediaTranscode.objects.filter(format=new).update(format=old)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0023_archive_media'),
+    ]
+
+    operations = [
+        migrations.RunPython(shorten_formats, restore_formats),
+    ]
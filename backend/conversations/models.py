@@ -1,10 +1,41 @@
+import os
+import threading
+import uuid
+
+from django.conf import settings
 from django.db import models
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
 from core.models import Provedor
 
 
+def _sync_update_fields(kwargs, columns):
+    """Inclui as colunas promovidas num save(update_fields=...) que grava additional_attributes"""
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and 'additional_attributes' in update_fields:
+        kwargs['update_fields'] = set(update_fields) | set(columns)
+
+
+def parse_timestamp(value):
+    """Converte um timestamp ISO gravado em additional_attributes; None se inválido"""
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        parsed = parse_datetime(value.strip())
+    except ValueError:
+        return None
+    if parsed is not None and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
 class Contact(models.Model):
     name = models.CharField(max_length=255)
     phone = models.CharField(max_length=20, default='')
@@ -13,11 +44,21 @@ class Contact(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     provedor = models.ForeignKey(Provedor, on_delete=models.CASCADE, related_name='contacts', null=True, blank=True)
+    # Cópias indexadas de additional_attributes['chatid'/'sender_lid'], usadas na busca do webhook
+    chatid = models.CharField(max_length=255, blank=True, default='', db_index=True)
+    sender_lid = models.CharField(max_length=255, blank=True, default='', db_index=True)
     additional_attributes = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return f"{self.name} ({self.phone})"
 
+    def save(self, *args, **kwargs):
+        attrs = self.additional_attributes or {}
+        self.chatid = attrs.get('chatid') or ''
+        self.sender_lid = attrs.get('sender_lid') or ''
+        _sync_update_fields(kwargs, ['chatid', 'sender_lid'])
+        super().save(*args, **kwargs)
+
     class Meta:
         unique_together = ['phone', 'provedor']
 
@@ -50,11 +91,102 @@ class Conversation(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     last_message_at = models.DateTimeField(null=True, blank=True)
+    # Resumo mantido por update_conversation_summary; nunca gravado pelo save()
+    last_message = models.ForeignKey(
+        'Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    last_customer_message_at = models.DateTimeField(null=True, blank=True)
+    # Primeira mensagem do cliente e primeira resposta a ela (tempo de primeira resposta)
+    first_customer_message_at = models.DateTimeField(null=True, blank=True)
+    first_response_at = models.DateTimeField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+    message_count = models.PositiveIntegerField(default=0)
+    # Há mensagens desta conversa em MessageArchive
+    has_archive = models.BooleanField(default=False)
+    # Cópias indexadas de additional_attributes['recovery_status'] e da chave 'ai_assisted'
+    recovery_status = models.CharField(max_length=20, blank=True, default='')
+    ai_assisted = models.BooleanField(default=False)
+    # Cópias tipadas de 'recovery_last_attempt'/'recovery_response_time' (recovery_stats)
+    recovery_last_attempt_at = models.DateTimeField(null=True, blank=True)
+    recovery_response_at = models.DateTimeField(null=True, blank=True)
+    # Próxima tentativa agendada pelo recuperador (conversations/recovery.py)
+    recovery_next_at = models.DateTimeField(null=True, blank=True)
     additional_attributes = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return f"Conversa com {self.contact.name}"
 
+    SUMMARY_FIELDS = (
+        'last_message', 'last_message_at', 'last_customer_message_at', 'first_customer_message_at',
+        'first_response_at', 'unread_count', 'message_count',
+    )
+    # Colunas mantidas fora do save(): resumo e agenda do recuperador
+    MANAGED_FIELDS = SUMMARY_FIELDS + ('recovery_next_at',)
+
+    def save(self, *args, **kwargs):
+        attrs = self.additional_attributes or {}
+        self.recovery_status = attrs.get('recovery_status') or ''
+        self.ai_assisted = 'ai_assisted' in attrs
+        self.recovery_last_attempt_at = parse_timestamp(attrs.get('recovery_last_attempt'))
+        self.recovery_response_at = parse_timestamp(attrs.get('recovery_response_time'))
+        _sync_update_fields(kwargs, [
+            'recovery_status', 'ai_assisted', 'recovery_last_attempt_at', 'recovery_response_at',
+        ])
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # Uma instância carregada antes de novas mensagens não pode
+            # sobrescrever o resumo mantido pelo hook de Message
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.MANAGED_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def summary_from_messages():
+        """Expressões que recalculam o resumo a partir de Message (exclusões e backfill)"""
+        from django.db.models import Count, IntegerField, OuterRef, Subquery
+
+        messages = Message.objects.filter(conversation=OuterRef('pk'))
+        latest = messages.order_by('-created_at', '-id')
+        customer = messages.filter(is_from_customer=True).order_by('-created_at', '-id')
+        count = messages.order_by().values('conversation').annotate(total=Count('pk')).values('total')
+        return {
+            'last_message_id': Subquery(latest.values('id')[:1]),
+            'last_message_at': Subquery(latest.values('created_at')[:1]),
+            'last_customer_message_at': Subquery(customer.values('created_at')[:1]),
+            'message_count': Coalesce(Subquery(count, output_field=IntegerField()), 0),
+        }
+
+    class Meta:
+        indexes = [
+            # Listagem por provedor/status (inbox__provedor resolve pela inbox)
+            models.Index(fields=['inbox', 'status'], name='conv_inbox_status_idx'),
+            models.Index(
+                fields=['assignee', 'status'], name='conv_assignee_status_idx',
+                condition=models.Q(assignee__isnull=False),
+            ),
+            # Ordenação da listagem: mais recentes primeiro
+            models.Index(fields=['-last_message_at', '-id'], name='conv_last_message_at_idx'),
+            models.Index(
+                fields=['recovery_status'], name='conv_recovery_status_idx',
+                condition=~models.Q(recovery_status=''),
+            ),
+            models.Index(
+                fields=['ai_assisted'], name='conv_ai_assisted_idx',
+                condition=models.Q(ai_assisted=True),
+            ),
+            # Recuperador: conversas que ficaram ociosas e fila de tentativas
+            models.Index(fields=['last_customer_message_at', 'id'], name='conv_last_customer_idx'),
+            models.Index(
+                fields=['recovery_next_at'], name='conv_recovery_next_idx',
+                condition=models.Q(recovery_next_at__isnull=False),
+            ),
+        ]
+
+    def mark_read(self):
+        Conversation.objects.filter(pk=self.pk).update(unread_count=0)
+        self.unread_count = 0
+
 
 class Message(models.Model):
     MESSAGE_TYPES = [
@@ -74,10 +206,211 @@ class Message(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     external_id = models.CharField(max_length=255, blank=True, null=True)
     additional_attributes = models.JSONField(default=dict, blank=True)
+    # Arquivo no armazenamento por conteúdo (conversations/media_store.py)
+    media_blob = models.ForeignKey(
+        'MediaBlob', on_delete=models.SET_NULL, null=True, blank=True, related_name='messages'
+    )
+
+    class Meta:
+        indexes = [
+            # Paginação keyset e última mensagem: (conversation, created_at, id)
+            models.Index(fields=['conversation', 'created_at', 'id'], name='msg_conv_created_idx'),
+            models.Index(
+                fields=['conversation', 'is_from_customer', 'created_at'], name='msg_conv_customer_idx'
+            ),
+            models.Index(
+                fields=['external_id'], name='msg_external_id_idx',
+                condition=models.Q(external_id__isnull=False),
+            ),
+            # Manifesto de mídia da retenção (conversations/retention.py)
+            models.Index(
+                fields=['created_at', 'id'], name='msg_media_created_idx',
+                condition=models.Q(media_blob__isnull=False),
+            ),
+        ]
 
     def __str__(self):
         return f"Mensagem de {self.conversation.contact.name}"
 
+    def save(self, *args, **kwargs):
+        # O id do provedor (Uazapi) chega em additional_attributes; a coluna é a indexada
+        external_id = (self.additional_attributes or {}).get('external_id')
+        if external_id and self.external_id != external_id:
+            self.external_id = external_id
+            _sync_update_fields(kwargs, ['external_id'])
+        # Respostas brutas do provedor não ficam na linha da mensagem
+        raw = {
+            key: self.additional_attributes.pop(key)
+            for key in MessagePayload.RAW_KEYS if key in (self.additional_attributes or {})
+        }
+        super().save(*args, **kwargs)
+        if raw:
+            MessagePayload.store(self, raw)
+
+
+class MessagePayload(models.Model):
+    """
+    Payloads brutos do provedor (resposta da Uazapi no envio, resposta do
+    download de mídia), fora de Message.additional_attributes. Só é lido sob
+    demanda em /messages/<id>/raw/.
+    """
+    RAW_KEYS = ('whatsapp_response', 'uazapi_response')
+
+    message = models.OneToOneField(Message, on_delete=models.CASCADE, primary_key=True, related_name='raw_payload')
+    data = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Payload da mensagem {self.message_id}"
+
+    @classmethod
+    def store(cls, message, raw):
+        payload, created = cls.objects.get_or_create(message=message, defaults={'data': raw})
+        if not created:
+            payload.data.update(raw)
+            payload.save(update_fields=['data', 'updated_at'])
+        return payload
+
+
+class MediaBlob(models.Model):
+    """
+    Arquivo de mídia guardado uma única vez, pelo SHA-256 do conteúdo, em
+    MEDIA_ROOT/cas/<aa>/<bb>/<sha256>. ref_count conta as mensagens que o usam.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Blobs sem referência, removidos pela retenção
+            models.Index(fields=['created_at'], name='blob_unreferenced_idx', condition=models.Q(ref_count=0)),
+        ]
+
+    def __str__(self):
+        return self.sha256
+
+    @property
+    def relative_path(self):
+        return os.path.join('cas', self.sha256[:2], self.sha256[2:4], self.sha256)
+
+    @property
+    def path(self):
+        return os.path.join(settings.MEDIA_ROOT, self.relative_path)
+
+
+class MediaAlias(models.Model):
+    """Nome /api/media/messages/<conversa>/<arquivo> de um MediaBlob"""
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='media_aliases')
+    filename = models.CharField(max_length=255)
+    blob = models.ForeignKey(MediaBlob, on_delete=models.CASCADE, related_name='aliases')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['conversation', 'filename']
+
+    def __str__(self):
+        return f"{self.conversation_id}/{self.filename}"
+
+
+class MediaTranscode(models.Model):
+    """Cache de conversões: ``source`` convertido para ``format`` resulta em ``output``"""
+    source = models.ForeignKey(MediaBlob, on_delete=models.CASCADE, related_name='transcodes')
+    format = models.CharField(max_length=10)
+    output = models.ForeignKey(MediaBlob, on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['source', 'format']
+
+    def __str__(self):
+        return f"{self.source_id} -> {self.format}"
+
+
+class MediaUpload(models.Model):
+    """
+    Envio de mídia em partes (conversations/uploads.py): ``offset`` bytes de
+    ``size`` já recebidos em MEDIA_ROOT/cas/tmp/uploads/<id>
+    """
+    STATUS_CHOICES = [
+        ('uploading', 'Recebendo'),
+        ('processing', 'Processando'),
+        ('sent', 'Enviada'),
+        ('failed', 'Falhou'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='media_uploads')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    filename = models.CharField(max_length=255)
+    media_type = models.CharField(max_length=20)
+    caption = models.TextField(blank=True, default='')
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='uploading')
+    message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Upload {self.id} ({self.offset}/{self.size})"
+
+    @property
+    def part_path(self):
+        return os.path.join(settings.MEDIA_ROOT, 'cas', 'tmp', 'uploads', str(self.id))
+
+
+class MetricRollup(models.Model):
+    """
+    Contadores por provedor, inbox (canal), atendente e hora, atualizados
+    incrementalmente pelo hook de Message/Conversation (conversations/metrics.py).
+    agent_id é o responsável pela conversa no momento do evento; 0 = sem responsável.
+    """
+    provedor = models.ForeignKey(Provedor, on_delete=models.CASCADE, related_name='metric_rollups')
+    inbox = models.ForeignKey(Inbox, on_delete=models.CASCADE, related_name='metric_rollups')
+    agent_id = models.IntegerField(default=0)
+    hour = models.DateTimeField()
+    messages_received = models.PositiveIntegerField(default=0)
+    messages_sent = models.PositiveIntegerField(default=0)
+    ai_replies = models.PositiveIntegerField(default=0)
+    human_replies = models.PositiveIntegerField(default=0)
+    conversations_started = models.PositiveIntegerField(default=0)
+    first_responses = models.PositiveIntegerField(default=0)
+    first_response_seconds = models.FloatField(default=0)
+
+    def __str__(self):
+        return f"Métricas {self.provedor_id}/{self.inbox_id}/{self.agent_id} - {self.hour:%Y-%m-%d %H}h"
+
+    class Meta:
+        unique_together = ['provedor', 'inbox', 'agent_id', 'hour']
+        indexes = [models.Index(fields=['provedor', 'hour'], name='metric_provedor_hour_idx')]
+
+
+class MessageArchive(models.Model):
+    """
+    Mensagens arquivadas de uma conversa, um registro por mês (partição
+    lógica). O conteúdo é o JSON das mensagens comprimido com zlib; veja
+    conversations/archive.py.
+    """
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='message_archives')
+    month = models.DateField()
+    message_count = models.PositiveIntegerField(default=0)
+    # Mensagens arquivadas que ainda referenciam um MediaBlob (retenção de mídia)
+    media_count = models.PositiveIntegerField(default=0)
+    payload = models.BinaryField()
+    archived_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Arquivo {self.month:%Y-%m} - conversa {self.conversation_id}"
+
+    class Meta:
+        unique_together = ['conversation', 'month']
+        indexes = [
+            models.Index(fields=['month'], name='msg_archive_month_idx'),
+            models.Index(fields=['month'], name='msg_archive_media_idx', condition=models.Q(media_count__gt=0)),
+        ]
+
 
 class Team(models.Model):
     name = models.CharField(max_length=255)
@@ -118,6 +451,8 @@ class RecoverySettings(models.Model):
     auto_discount = models.BooleanField(default=False, help_text="Aplicar desconto automático")
     discount_percentage = models.IntegerField(default=10, help_text="Percentual de desconto")
     keywords = models.JSONField(default=list, help_text="Palavras-chave para identificar interesse em planos")
+    # Até onde o recuperador já varreu last_customer_message_at
+    scanned_until = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -125,6 +460,26 @@ class RecoverySettings(models.Model):
         return f"Configurações de recuperação - {self.provedor.name}"
 
 
+class MediaRetentionPolicy(models.Model):
+    """
+    Retenção de mídia do provedor (conversations/retention.py): arquivos de
+    mensagens mais antigas que ``retention_days`` (ou o prazo do tipo em
+    ``days_by_type``, ex.: ``{"video": 30}``) em conversas com status em
+    ``statuses`` são descartados. 0 dias = manter.
+    """
+    provedor = models.OneToOneField(Provedor, on_delete=models.CASCADE, related_name='media_retention')
+    enabled = models.BooleanField(default=True)
+    retention_days = models.PositiveIntegerField(default=90)
+    days_by_type = models.JSONField(default=dict, blank=True)
+    statuses = models.JSONField(default=list, blank=True, help_text="Status das conversas; vazio = fechadas")
+    last_run_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Retenção de mídia - {self.provedor.nome}"
+
+
 class RecoveryAttempt(models.Model):
     """Registro de tentativas de recuperação"""
     STATUS_CHOICES = [
@@ -149,3 +504,123 @@ class RecoveryAttempt(models.Model):
     class Meta:
         unique_together = ['conversation', 'attempt_number']
 
+
+
+_summary_hook = threading.local()
+
+
+def summary_hook_suspended():
+    """True enquanto o arquivamento remove mensagens da tabela quente"""
+    return getattr(_summary_hook, 'suspended', False)
+
+
+@receiver(post_save, sender=Message)
+def update_conversation_summary(sender, instance, created, **kwargs):
+    """
+    Único ponto de escrita do resumo da conversa. Toda mensagem nova (webhook,
+    send_text, send_media, e-mail, Telegram, FastAPI) passa por aqui e o resumo
+    é atualizado num só UPDATE atômico: última mensagem, contadores e, para
+    mensagens do cliente, last_customer_message_at e não lidas (zeradas na resposta).
+    """
+    if not created:
+        return
+    summary = {
+        'last_message_id': instance.pk,
+        'last_message_at': instance.created_at,
+        'message_count': F('message_count') + 1,
+    }
+    if instance.is_from_customer:
+        summary['unread_count'] = F('unread_count') + 1
+        summary['last_customer_message_at'] = instance.created_at
+        summary['first_customer_message_at'] = Coalesce(
+            F('first_customer_message_at'), Value(instance.created_at, output_field=models.DateTimeField())
+        )
+    else:
+        summary['unread_count'] = 0
+    Conversation.objects.filter(pk=instance.conversation_id).update(**summary)
+
+    first_response_seconds = None if instance.is_from_customer else _record_first_response(instance)
+    context = _conversation_context(
+        instance.conversation if Message.conversation.is_cached(instance) else None, instance.conversation_id
+    )
+    from .metrics import record_message_metrics
+    record_message_metrics(instance, context, first_response_seconds)
+    _invalidate_dashboard(context)
+
+
+def _record_first_response(message):
+    """Marca a primeira resposta da conversa; retorna o tempo em segundos (ou None)"""
+    updated = Conversation.objects.filter(
+        pk=message.conversation_id, first_response_at__isnull=True, first_customer_message_at__isnull=False
+    ).update(first_response_at=message.created_at)
+    if not updated:
+        return None
+    first_customer_at = Conversation.objects.filter(
+        pk=message.conversation_id
+    ).values_list('first_customer_message_at', flat=True).first()
+    return max(0.0, (message.created_at - first_customer_at).total_seconds())
+
+
+@receiver(post_delete, sender=Message)
+def rebuild_conversation_summary(sender, instance, **kwargs):
+    """Exclusões são raras: recalcula o resumo a partir das mensagens restantes"""
+    if summary_hook_suspended():
+        # Arquivamento: as mensagens continuam existindo, o resumo não muda
+        return
+    Conversation.objects.filter(pk=instance.conversation_id).update(
+        **Conversation.summary_from_messages()
+    )
+    if instance.media_blob_id:
+        MediaBlob.objects.filter(pk=instance.media_blob_id, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+
+
+def _conversation_context(conversation, conversation_id=None):
+    """provedor, inbox e responsável da conversa, sem query quando já estão carregados"""
+    if conversation is not None and Conversation.inbox.is_cached(conversation):
+        provedor_id = conversation.inbox.provedor_id
+    elif conversation is not None:
+        provedor_id = Inbox.objects.filter(pk=conversation.inbox_id).values_list('provedor_id', flat=True).first()
+    else:
+        row = Conversation.objects.filter(pk=conversation_id).values(
+            'inbox_id', 'assignee_id', 'inbox__provedor_id'
+        ).first() or {}
+        return {
+            'provedor_id': row.get('inbox__provedor_id'),
+            'inbox_id': row.get('inbox_id'),
+            'assignee_id': row.get('assignee_id'),
+        }
+    return {
+        'provedor_id': provedor_id,
+        'inbox_id': conversation.inbox_id,
+        'assignee_id': conversation.assignee_id,
+    }
+
+
+def _invalidate_dashboard(context):
+    """Descarta o cache do dashboard do provedor da conversa"""
+    from core.dashboard import invalidate_dashboard_stats
+    invalidate_dashboard_stats(context['provedor_id'])
+
+
+@receiver(post_delete, sender=MessageArchive)
+def release_archived_media(sender, instance, **kwargs):
+    """As mensagens arquivadas também contam em MediaBlob.ref_count"""
+    if not instance.media_count:
+        return
+    from .archive import archived_blob_refs
+    for blob_id, count in archived_blob_refs(instance.payload).items():
+        MediaBlob.objects.filter(pk=blob_id).update(ref_count=Greatest(F('ref_count') - count, 0))
+
+
+@receiver(post_save, sender=Conversation)
+def conversation_saved(sender, instance, created, **kwargs):
+    context = _conversation_context(instance)
+    if created:
+        from .metrics import record_conversation_started
+        record_conversation_started(instance, context)
+    _invalidate_dashboard(context)
+
+
+@receiver(post_delete, sender=Conversation)
+def conversation_deleted(sender, instance, **kwargs):
+    _invalidate_dashboard(_conversation_context(instance))
@@ -0,0 +1,84 @@
+"""
+Paginação keyset de mensagens
+
+As mensagens são ordenadas por (created_at, id). O cursor é a posição de uma
+mensagem codificada em base64, e cada página é buscada com um WHERE sobre essa
+posição (sem OFFSET). O custo não depende de quantas mensagens a conversa tem.
+"""
+
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(message):
+    raw = f'{message.created_at.isoformat()}|{message.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, message_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(message_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f'Cursor inválido: {cursor}') from e
+
+
+def window_size(limit=None):
+    default = getattr(settings, 'CONVERSATION_MESSAGES_WINDOW', 50)
+    maximum = getattr(settings, 'CONVERSATION_MESSAGES_MAX_PAGE', 200)
+    try:
+        limit = int(limit) if limit else default
+    except (TypeError, ValueError):
+        limit = default
+    return max(1, min(limit, maximum))
+
+
+def keyset_page(queryset, before=None, after=None, limit=None):
+    """
+    Retorna uma página de mensagens em ordem cronológica.
+
+    - sem cursor: as ``limit`` mensagens mais recentes
+    - ``before``: as ``limit`` mensagens imediatamente anteriores ao cursor
+    - ``after``: as ``limit`` mensagens imediatamente posteriores ao cursor
+
+    Resultado: {'results': [...], 'has_more': bool, 'before': cursor, 'after': cursor}
+    onde ``before``/``after`` apontam para a mensagem mais antiga/mais nova da página.
+    """
+    limit = window_size(limit)
+
+    if after:
+        created_at, message_id = decode_cursor(after)
+        queryset = queryset.filter(
+            Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=message_id)
+        ).order_by('created_at', 'id')
+        page = list(queryset[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
+    else:
+        if before:
+            created_at, message_id = decode_cursor(before)
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+            )
+        page = list(queryset.order_by('-created_at', '-id')[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit][::-1]
+
+    return page_result(page, has_more)
+
+
+def page_result(page, has_more):
+    return {
+        'results': page,
+        'has_more': has_more,
+        'before': encode_cursor(page[0]) if page else None,
+        'after': encode_cursor(page[-1]) if page else None,
+    }
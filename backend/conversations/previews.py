@@ -0,0 +1,110 @@
+"""
+Miniaturas de imagens e capas de vídeos
+
+Quando a mídia de uma mensagem chega ao armazenamento (download do webhook ou
+envio pelo painel), uma miniatura WebP de até PREVIEW_MAX_SIZE pixels é gerada
+na fila de conversões (conversations.transcode, prioridade mais baixa): imagens
+e figurinhas pelo Pillow, vídeos por um quadro extraído com ffmpeg. O painel
+mostra a miniatura e só baixa o original quando a mídia é aberta.
+
+As miniaturas usam o mesmo cache de conversões (MediaTranscode) e ficam em
+additional_attributes (thumbnail_url/poster_url), expostas pelo
+MessageSerializer.
+"""
+
+import os
+import subprocess
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+from core.logging_utils import get_logger
+from .media import notify_message_updated
+from .media_store import alias, temp_path
+from .models import Message
+from .transcode import PRIORITY_PREVIEW, TranscodeError, transcode, transcoder
+
+logger = get_logger('media')
+
+# Chaves de MediaTranscode.format (até 10 caracteres); o arquivo é sempre WebP
+THUMBNAIL = 'thumb'
+POSTER = 'poster'
+# Tipo de mensagem -> (miniatura, atributo com a URL)
+PREVIEWS = {
+    'image': (THUMBNAIL, 'thumbnail_url'),
+    'sticker': (THUMBNAIL, 'thumbnail_url'),
+    'video': (POSTER, 'poster_url'),
+}
+
+
+def make_thumbnail(source_path):
+    """WebP reduzido de uma imagem; devolve o caminho do temporário"""
+    size = getattr(settings, 'PREVIEW_MAX_SIZE', 320)
+    output_path = temp_path('.webp')
+    try:
+        with Image.open(source_path) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size))
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+            image.save(output_path, 'WEBP', quality=getattr(settings, 'PREVIEW_QUALITY', 75))
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        if os.path.exists(output_path):
+            os.unlink(output_path)
+        raise TranscodeError(str(e)) from e
+    return output_path
+
+
+def make_poster(source_path):
+    """Quadro representativo do início do vídeo, reduzido como miniatura"""
+    frame_path = temp_path('.png')
+    try:
+        result = subprocess.run(
+            [
+                'ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', source_path,
+                '-vf', 'thumbnail', '-frames:v', '1', frame_path,
+            ],
+            capture_output=True, text=True, timeout=getattr(settings, 'TRANSCODE_TIMEOUT', 120),
+        )
+        if result.returncode != 0:
+            raise TranscodeError(result.stderr.strip()[-500:])
+        return make_thumbnail(frame_path)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise TranscodeError(str(e)) from e
+    finally:
+        if os.path.exists(frame_path):
+            os.unlink(frame_path)
+
+
+CONVERTERS = {
+    THUMBNAIL: make_thumbnail,
+    POSTER: make_poster,
+}
+
+
+def generate_preview(message_id):
+    """Gera a miniatura da mídia da mensagem e avisa o painel"""
+    message = Message.objects.select_related('media_blob').filter(id=message_id).first()
+    if message is None or message.media_blob is None or message.message_type not in PREVIEWS:
+        return None
+    kind, attribute = PREVIEWS[message.message_type]
+    try:
+        output = transcode(message.media_blob, kind, CONVERTERS[kind])
+    except TranscodeError as e:
+        logger.warning("Erro ao gerar miniatura da mensagem %s: %s", message_id, e)
+        return None
+    stem = os.path.splitext(message.additional_attributes.get('file_name') or str(message.id))[0]
+    message.additional_attributes[attribute] = alias(message.conversation_id, output, f'{stem}_{kind}.webp')
+    message.save(update_fields=['additional_attributes', 'updated_at'])
+    notify_message_updated(message)
+    return message
+
+
+def schedule_preview(message):
+    """Agenda a miniatura se o tipo da mensagem tiver uma; com a fila cheia fica sem"""
+    if message.message_type not in PREVIEWS or not message.media_blob_id:
+        return False
+    if transcoder.submit(PRIORITY_PREVIEW, generate_preview, message.id):
+        return True
+    logger.debug("Fila de conversões cheia, mensagem %s sem miniatura", message.id)
+    return False
@@ -0,0 +1,314 @@
+"""
+Recuperador de conversas
+
+Conversas do WhatsApp em que o cliente demonstrou interesse (palavras-chave de
+RecoverySettings.keywords) e parou de responder recebem até ``max_attempts``
+mensagens de recuperação, espaçadas de ``delay_minutes``. O motor não percorre
+todas as conversas a cada ciclo:
+
+- entrada: para cada provedor, apenas as conversas cuja última mensagem do
+  cliente caiu na janela (scanned_until, agora - delay] são examinadas
+  (índice conv_last_customer_idx); a janela avança a cada ciclo
+- palavras-chave: uma única regex pré-compilada por provedor, aplicada às
+  mensagens recentes do cliente
+- agenda: Conversation.recovery_next_at funciona como fila de atraso
+  (índice parcial conv_recovery_next_idx); cada ciclo busca só o que venceu
+- envio: em lotes pelo send_via_uazapi, limitado por provedor
+  (RECOVERY_RATE_PER_MINUTE); o que não couber fica para o próximo ciclo
+
+O estado da recuperação fica em additional_attributes (recovery_status,
+recovery_attempts, recovery_last_attempt, ...), lido por recovery_stats, e cada
+envio gera um RecoveryAttempt. Deve rodar uma única instância do motor
+(comando ``recovery_engine``).
+"""
+
+import re
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from core.intents import keyword_pattern, normalize
+from core.logging_utils import get_logger
+from .models import Conversation, Message, RecoveryAttempt, RecoverySettings
+
+logger = get_logger('messages')
+
+# 'snoozed' é o status que o webhook da Uazapi dá às conversas atendidas pela IA
+ELIGIBLE_STATUSES = ('open', 'pending', 'snoozed')
+WHATSAPP_CHANNELS = ('whatsapp', 'whatsapp_beta')
+# Mensagens do cliente consideradas na busca de palavras-chave
+MATCH_WINDOW = timedelta(hours=24)
+
+DEFAULT_MESSAGE = (
+    "Olá, {nome}! Vimos que você se interessou pelos nossos planos. "
+    "Ainda podemos ajudar a concluir o seu atendimento?"
+)
+DISCOUNT_MESSAGE = " Temos {percentual}% de desconto para você fechar agora."
+
+
+_matchers = {}
+
+
+def keyword_matcher(keywords):
+    """
+    Regex única das palavras-chave (core.intents.keyword_pattern: sem acento,
+    sem caixa, aceita plural), compilada uma vez por conjunto de palavras.
+    None quando não há palavras: sem palavras-chave nenhuma conversa entra na
+    recuperação.
+    """
+    key = tuple(sorted({normalize(str(keyword)).strip() for keyword in keywords or []} - {''}))
+    if not key:
+        return None
+    if key not in _matchers:
+        _matchers[key] = re.compile(keyword_pattern(key))
+    return _matchers[key]
+
+
+def matches(matcher, text):
+    return bool(matcher and matcher.search(normalize(text)))
+
+
+class RateLimiter:
+    """Token bucket por provedor: ``rate`` envios por minuto"""
+
+    def __init__(self, rate=None):
+        self.rate = rate if rate is not None else getattr(settings, 'RECOVERY_RATE_PER_MINUTE', 30)
+        self._buckets = {}
+
+    def available(self, provedor_id):
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(provedor_id, (self.rate, now))
+        tokens = min(self.rate, tokens + (now - updated) * self.rate / 60)
+        self._buckets[provedor_id] = (tokens, now)
+        return int(tokens)
+
+    def consume(self, provedor_id, amount=1):
+        self.available(provedor_id)
+        tokens, updated = self._buckets[provedor_id]
+        self._buckets[provedor_id] = (tokens - amount, updated)
+
+
+def _save_state(conversation, **attrs):
+    conversation.additional_attributes = {**(conversation.additional_attributes or {}), **attrs}
+    conversation.save(update_fields=['additional_attributes', 'recovery_next_at'])
+
+
+def idle_conversations(recovery_settings, start, end):
+    """Conversas do provedor que ficaram sem mensagem do cliente dentro de (start, end]"""
+    return Conversation.objects.filter(
+        inbox__provedor_id=recovery_settings.provedor_id,
+        inbox__channel_type__in=WHATSAPP_CHANNELS,
+        status__in=ELIGIBLE_STATUSES,
+        last_customer_message_at__gt=start,
+        last_customer_message_at__lte=end,
+        # Alguém respondeu depois do cliente: o silêncio é do cliente
+        last_message_at__gt=F('last_customer_message_at'),
+        recovery_next_at__isnull=True,
+    ).order_by('last_customer_message_at', 'id')
+
+
+def enroll_idle_conversations(recovery_settings, now=None):
+    """Avança a janela do provedor e agenda as conversas que casam com as palavras-chave"""
+    now = now or timezone.now()
+    end = now - timedelta(minutes=recovery_settings.delay_minutes)
+    lookback = timedelta(hours=getattr(settings, 'RECOVERY_LOOKBACK_HOURS', 24))
+    start = recovery_settings.scanned_until or end - lookback
+    if start >= end:
+        return 0
+
+    matcher = keyword_matcher(recovery_settings.keywords)
+    batch_size = getattr(settings, 'RECOVERY_BATCH_SIZE', 100)
+    enrolled = 0
+    cursor = None
+    while matcher:
+        queryset = idle_conversations(recovery_settings, start, end)
+        if cursor:
+            queryset = queryset.filter(
+                last_customer_message_at__gte=cursor[0]
+            ).exclude(last_customer_message_at=cursor[0], id__lte=cursor[1])
+        batch = list(queryset[:batch_size])
+        if not batch:
+            break
+        cursor = (batch[-1].last_customer_message_at, batch[-1].id)
+
+        texts = {}
+        for conversation_id, content in Message.objects.filter(
+            conversation_id__in=[conversation.id for conversation in batch],
+            is_from_customer=True,
+            created_at__gt=min(conversation.last_customer_message_at for conversation in batch) - MATCH_WINDOW,
+        ).values_list('conversation_id', 'content'):
+            texts.setdefault(conversation_id, []).append(content)
+
+        for conversation in batch:
+            if not any(matches(matcher, text) for text in texts.get(conversation.id, [])):
+                continue
+            conversation.recovery_next_at = now
+            # Novo ciclo: a tentativa anterior (se houve) não conta como resposta
+            _save_state(
+                conversation, recovery_status='pending', recovery_attempts=0,
+                recovery_last_attempt=None, recovery_response_time=None,
+            )
+            enrolled += 1
+
+    RecoverySettings.objects.filter(pk=recovery_settings.pk).update(scanned_until=end)
+    recovery_settings.scanned_until = end
+    return enrolled
+
+
+def mark_recovered(conversation):
+    """O cliente respondeu depois da última tentativa"""
+    responded_at = conversation.last_customer_message_at
+    RecoveryAttempt.objects.filter(conversation=conversation, status='sent').update(
+        status='recovered', response_received_at=responded_at
+    )
+    conversation.recovery_next_at = None
+    _save_state(conversation, recovery_status='recovered', recovery_response_time=responded_at.isoformat())
+
+
+def detect_replies(provedor_id):
+    """Conversas em recuperação com mensagem do cliente posterior à última tentativa"""
+    replied = Conversation.objects.filter(
+        inbox__provedor_id=provedor_id,
+        recovery_status='pending',
+        recovery_last_attempt_at__isnull=False,
+        last_customer_message_at__gt=F('recovery_last_attempt_at'),
+    )
+    total = 0
+    for conversation in replied:
+        mark_recovered(conversation)
+        total += 1
+    return total
+
+
+def recovery_message(recovery_settings, conversation):
+    content = DEFAULT_MESSAGE.format(nome=conversation.contact.name)
+    if recovery_settings.auto_discount and recovery_settings.discount_percentage:
+        content += DISCOUNT_MESSAGE.format(percentual=recovery_settings.discount_percentage)
+    return content
+
+
+def send_attempt(recovery_settings, conversation, now=None):
+    """Envia a próxima tentativa e agenda a seguinte (ou encerra a recuperação)"""
+    from .views import send_via_uazapi
+
+    now = now or timezone.now()
+    attrs = conversation.additional_attributes or {}
+    attempts = int(attrs.get('recovery_attempts') or 0)
+
+    if conversation.status not in ELIGIBLE_STATUSES:
+        conversation.recovery_next_at = None
+        return _save_state(conversation, recovery_status='')
+    if attempts and conversation.recovery_last_attempt_at and conversation.last_customer_message_at and (
+        conversation.last_customer_message_at > conversation.recovery_last_attempt_at
+    ):
+        return mark_recovered(conversation)
+    if not attempts and conversation.last_customer_message_at and (
+        conversation.last_customer_message_at > now - timedelta(minutes=recovery_settings.delay_minutes)
+    ):
+        # O cliente voltou antes da primeira tentativa: sai da fila e só volta
+        # a entrar quando ficar ocioso de novo
+        conversation.recovery_next_at = None
+        return _save_state(conversation, recovery_status='')
+    if attempts >= recovery_settings.max_attempts:
+        RecoveryAttempt.objects.filter(conversation=conversation, status='sent').update(status='failed')
+        conversation.recovery_next_at = None
+        return _save_state(conversation, recovery_status='failed')
+
+    content = recovery_message(recovery_settings, conversation)
+    success, response = send_via_uazapi(conversation, content, 'text', None)
+    last_number = conversation.recovery_attempts.order_by('-attempt_number').values_list(
+        'attempt_number', flat=True
+    ).first() or 0
+    RecoveryAttempt.objects.create(
+        conversation=conversation,
+        attempt_number=last_number + 1,
+        status='sent' if success else 'failed',
+        message_sent=content,
+        additional_attributes={'response': str(response)[:500]},
+    )
+    if success:
+        Message.objects.create(
+            conversation=conversation,
+            content=content,
+            message_type='outgoing',
+            is_from_customer=False,
+            additional_attributes={'recovery_attempt': attempts + 1},
+        )
+    else:
+        logger.warning("Falha na tentativa de recuperação da conversa %s: %s", conversation.id, response)
+
+    # Ao fim das tentativas ainda espera um intervalo pela resposta antes de encerrar
+    conversation.recovery_next_at = now + timedelta(minutes=recovery_settings.delay_minutes)
+    _save_state(
+        conversation,
+        recovery_attempts=attempts + 1,
+        recovery_last_attempt=now.isoformat(),
+        recovery_last_message=content,
+    )
+    return success
+
+
+def dispatch_due(recovery_settings, limiter, now=None):
+    """Processa as tentativas vencidas do provedor, até o limite de envio disponível"""
+    now = now or timezone.now()
+    available = min(limiter.available(recovery_settings.provedor_id), getattr(settings, 'RECOVERY_BATCH_SIZE', 100))
+    if available <= 0:
+        return 0
+    due = Conversation.objects.filter(
+        inbox__provedor_id=recovery_settings.provedor_id,
+        recovery_next_at__lte=now,
+    ).select_related('contact', 'inbox__provedor').order_by('recovery_next_at', 'id')[:available]
+
+    sent = 0
+    for conversation in due:
+        try:
+            if send_attempt(recovery_settings, conversation, now) is not None:
+                limiter.consume(recovery_settings.provedor_id)
+                sent += 1
+        except Exception as e:
+            logger.warning("Erro na recuperação da conversa %s: %s", conversation.id, e)
+    return sent
+
+
+def run_cycle(limiter=None, now=None):
+    """Um ciclo do motor para todos os provedores com recuperação ativa"""
+    limiter = limiter or RateLimiter()
+    now = now or timezone.now()
+    totals = {'enrolled': 0, 'recovered': 0, 'sent': 0}
+    for recovery_settings in RecoverySettings.objects.filter(enabled=True):
+        try:
+            totals['recovered'] += detect_replies(recovery_settings.provedor_id)
+            totals['enrolled'] += enroll_idle_conversations(recovery_settings, now)
+            totals['sent'] += dispatch_due(recovery_settings, limiter, now)
+        except Exception as e:
+            logger.warning("Erro no recuperador do provedor %s: %s", recovery_settings.provedor_id, e)
+    return totals
+
+
+class RecoveryEngine:
+    """Executa run_cycle periodicamente"""
+
+    def __init__(self, interval=None):
+        self.interval = interval or getattr(settings, 'RECOVERY_ENGINE_INTERVAL', 60)
+        self.limiter = RateLimiter()
+        self._stop_event = threading.Event()
+
+    def run_forever(self):
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            try:
+                totals = run_cycle(self.limiter)
+                logger.debug("Ciclo do recuperador em %.2fs: %s", time.monotonic() - started, totals)
+            except Exception as e:
+                logger.warning("Erro no recuperador: %s", e)
+            finally:
+                close_old_connections()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
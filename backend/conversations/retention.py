@@ -0,0 +1,282 @@
+"""
+Retenção de mídia
+
+A retenção trabalha sobre o manifesto no banco (Message.media_blob, MediaBlob e
+MediaUpload), sem percorrer MEDIA_ROOT. Cada ciclo:
+
+1. expira, por provedor (MediaRetentionPolicy), a mídia das mensagens mais
+   antigas que o prazo do tipo em conversas com os status da política: a
+   mensagem perde o arquivo (media_status=expired) e o blob perde uma referência.
+   A busca usa o índice parcial msg_media_created_idx e mensagens já expiradas
+   saem dele, então cada lote começa de onde o anterior parou;
+2. remove os blobs sem referência há mais de MEDIA_RETENTION_GRACE_MINUTES
+   (índice blob_unreferenced_idx), mantendo conversões e miniaturas de blobs
+   ainda em uso;
+3. descarta envios em partes abandonados há MEDIA_UPLOAD_EXPIRE_HOURS.
+
+As remoções são feitas em lotes de MEDIA_RETENTION_BATCH_SIZE, com pausa de
+MEDIA_RETENTION_PAUSE segundos entre lotes e no máximo
+MEDIA_RETENTION_MAX_DELETES arquivos por ciclo. Mensagens arquivadas
+(MessageArchive) mantêm a referência ao blob e seguem a mesma política: os
+arquivos com mídia (media_count > 0) de meses já vencidos são descomprimidos e
+regravados sem a referência. Arquivos antigos fora do armazenamento por
+conteúdo entram no manifesto pelo comando ``dedupe_media``.
+"""
+
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q, Sum
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from core.logging_utils import get_logger
+from .archive import archive_rows, encode_rows, media_rows
+from .media import MEDIA_URL_PREFIX
+from .models import MediaBlob, MediaRetentionPolicy, MediaTranscode, MediaUpload, Message, MessageArchive
+
+logger = get_logger('media')
+
+DEFAULT_STATUSES = ('closed',)
+# Atributos que apontam para o arquivo local
+FILE_ATTRIBUTES = ('file_path', 'local_file_url', 'thumbnail_url', 'poster_url')
+
+
+def _batch_size():
+    return getattr(settings, 'MEDIA_RETENTION_BATCH_SIZE', 500)
+
+
+def _pause():
+    time.sleep(getattr(settings, 'MEDIA_RETENTION_PAUSE', 0.5))
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _days_by_type(policy):
+    return {
+        str(message_type): int(days)
+        for message_type, days in (policy.days_by_type or {}).items()
+        if str(days).isdigit()
+    }
+
+
+def expires_before(policy, now, message_type):
+    """Data a partir da qual a mídia do tipo expira (None = manter)"""
+    days = _days_by_type(policy).get(str(message_type), policy.retention_days)
+    return now - timedelta(days=days) if days else None
+
+
+def _expired_attributes(attrs):
+    attrs = dict(attrs or {})
+    for key in FILE_ATTRIBUTES:
+        attrs.pop(key, None)
+    if str(attrs.get('file_url') or '').startswith(MEDIA_URL_PREFIX):
+        attrs.pop('file_url')
+    attrs['media_status'] = 'expired'
+    return attrs
+
+
+def expirable_messages(policy, now=None):
+    """Mensagens do provedor com mídia além do prazo da política"""
+    now = now or timezone.now()
+    days_by_type = _days_by_type(policy)
+    conditions = Q()
+    for message_type, days in days_by_type.items():
+        if days:
+            conditions |= Q(message_type=message_type, created_at__lt=now - timedelta(days=days))
+    if policy.retention_days:
+        conditions |= Q(created_at__lt=now - timedelta(days=policy.retention_days)) & ~Q(
+            message_type__in=list(days_by_type)
+        )
+    if not conditions:
+        return Message.objects.none()
+    return Message.objects.filter(
+        conditions,
+        media_blob__isnull=False,
+        conversation__inbox__provedor_id=policy.provedor_id,
+        conversation__status__in=policy.statuses or DEFAULT_STATUSES,
+    ).order_by('created_at', 'id')
+
+
+def expire_messages(messages):
+    """Desliga as mensagens dos seus blobs; devolve quantas foram expiradas"""
+    released = {}
+    for message in messages:
+        released[message.media_blob_id] = released.get(message.media_blob_id, 0) + 1
+        message.additional_attributes = _expired_attributes(message.additional_attributes)
+        message.media_blob = None
+    with transaction.atomic():
+        Message.objects.bulk_update(messages, ['additional_attributes', 'media_blob'])
+        for blob_id, count in released.items():
+            MediaBlob.objects.filter(pk=blob_id).update(ref_count=Greatest(F('ref_count') - count, 0))
+    return len(messages)
+
+
+def expire_archive(archive, policy, now, dry_run=False):
+    """Expira a mídia vencida de um MessageArchive; devolve o número de mensagens"""
+    rows = archive_rows(archive)
+    released = {}
+    for row in rows:
+        blob_id = row.get('media_blob_id')
+        cutoff = expires_before(policy, now, row.get('message_type')) if blob_id else None
+        if cutoff is None or parse_datetime(row['created_at']) >= cutoff:
+            continue
+        released[blob_id] = released.get(blob_id, 0) + 1
+        row['additional_attributes'] = _expired_attributes(row.get('additional_attributes'))
+        row['media_blob_id'] = None
+    if released and not dry_run:
+        with transaction.atomic():
+            MessageArchive.objects.filter(pk=archive.pk).update(payload=encode_rows(rows), media_count=media_rows(rows))
+            for blob_id, count in released.items():
+                MediaBlob.objects.filter(pk=blob_id).update(ref_count=Greatest(F('ref_count') - count, 0))
+    return sum(released.values())
+
+
+def expire_archived(policy, now=None, limit=None, dry_run=False):
+    """
+    Mesma expiração para as mensagens arquivadas: lê apenas os arquivos com
+    mídia (índice parcial msg_archive_media_idx) de meses que podem ter vencido.
+    """
+    now = now or timezone.now()
+    days = [days for days in [policy.retention_days, *_days_by_type(policy).values()] if days]
+    if not days:
+        return 0
+    oldest_cutoff = (now - timedelta(days=min(days))).date()
+    archives = MessageArchive.objects.filter(
+        media_count__gt=0,
+        month__lte=oldest_cutoff,
+        conversation__inbox__provedor_id=policy.provedor_id,
+        conversation__status__in=policy.statuses or DEFAULT_STATUSES,
+    ).order_by('id')
+    limit = limit or getattr(settings, 'MEDIA_RETENTION_MAX_DELETES', 5000)
+    total = last_id = 0
+    while total < limit:
+        # Arquivos com mídia ainda no prazo continuam no índice: avança por id
+        batch = list(archives.filter(id__gt=last_id)[:_batch_size()])
+        if not batch:
+            break
+        for archive in batch:
+            total += expire_archive(archive, policy, now, dry_run)
+        last_id = batch[-1].id
+        _pause()
+    return total
+
+
+def expire_policy(policy, now=None, limit=None, dry_run=False):
+    """Expira a mídia do provedor (tabela quente e arquivo) em lotes; devolve o número de mensagens"""
+    queryset = expirable_messages(policy, now)
+    if dry_run:
+        return queryset.count() + expire_archived(policy, now, dry_run=True)
+    limit = limit or getattr(settings, 'MEDIA_RETENTION_MAX_DELETES', 5000)
+    total = 0
+    while total < limit:
+        batch = list(queryset.only('id', 'media_blob_id', 'additional_attributes')[:min(_batch_size(), limit - total)])
+        if not batch:
+            break
+        total += expire_messages(batch)
+        _pause()
+    if total < limit:
+        total += expire_archived(policy, now, limit - total)
+    MediaRetentionPolicy.objects.filter(pk=policy.pk).update(last_run_at=now or timezone.now())
+    return total
+
+
+def unreferenced_blobs(now=None):
+    """Blobs sem mensagens, fora do período de carência e que não são derivados de blobs em uso"""
+    now = now or timezone.now()
+    grace = timedelta(minutes=getattr(settings, 'MEDIA_RETENTION_GRACE_MINUTES', 60))
+    in_use = MediaTranscode.objects.filter(source__ref_count__gt=0).values('output_id')
+    return MediaBlob.objects.filter(
+        ref_count=0, created_at__lt=now - grace, messages__isnull=True,
+    ).exclude(pk__in=in_use).order_by('created_at')
+
+
+def collect_garbage(now=None, limit=None, dry_run=False):
+    """Remove blobs sem referência; devolve (blobs, bytes)"""
+    queryset = unreferenced_blobs(now)
+    if dry_run:
+        return queryset.count(), queryset.aggregate(total=Sum('size'))['total'] or 0
+    limit = limit or getattr(settings, 'MEDIA_RETENTION_MAX_DELETES', 5000)
+    deleted = reclaimed = 0
+    while deleted < limit:
+        batch = list(queryset[:min(_batch_size(), limit - deleted)])
+        if not batch:
+            break
+        for blob in batch:
+            # Revalida: o blob pode ter ganho uma referência depois da busca
+            removed, _ = MediaBlob.objects.filter(pk=blob.pk, ref_count=0, messages__isnull=True).delete()
+            if removed:
+                _unlink(blob.path)
+                deleted += 1
+                reclaimed += blob.size
+        _pause()
+    return deleted, reclaimed
+
+
+def purge_stale_uploads(now=None):
+    """Descarta envios em partes parados há MEDIA_UPLOAD_EXPIRE_HOURS; devolve (envios, bytes)"""
+    now = now or timezone.now()
+    cutoff = now - timedelta(hours=getattr(settings, 'MEDIA_UPLOAD_EXPIRE_HOURS', 24))
+    purged = reclaimed = 0
+    for upload in MediaUpload.objects.filter(status='uploading', updated_at__lt=cutoff)[:_batch_size()]:
+        if os.path.exists(upload.part_path):
+            reclaimed += os.path.getsize(upload.part_path)
+            _unlink(upload.part_path)
+        upload.delete()
+        purged += 1
+    return purged, reclaimed
+
+
+def run_cycle(now=None, dry_run=False):
+    """Um ciclo de retenção para todos os provedores com política ativa"""
+    now = now or timezone.now()
+    totals = {'expired': 0, 'blobs_deleted': 0, 'uploads_purged': 0, 'bytes_reclaimed': 0}
+    for policy in MediaRetentionPolicy.objects.filter(enabled=True):
+        try:
+            totals['expired'] += expire_policy(policy, now, dry_run=dry_run)
+        except Exception as e:
+            logger.warning("Erro na retenção de mídia do provedor %s: %s", policy.provedor_id, e)
+    blobs, reclaimed = collect_garbage(now, dry_run=dry_run)
+    totals['blobs_deleted'] += blobs
+    totals['bytes_reclaimed'] += reclaimed
+    if not dry_run:
+        uploads, reclaimed = purge_stale_uploads(now)
+        totals['uploads_purged'] += uploads
+        totals['bytes_reclaimed'] += reclaimed
+    return totals
+
+
+class MediaRetentionEngine:
+    """Executa run_cycle periodicamente"""
+
+    def __init__(self, interval=None):
+        self.interval = interval or getattr(settings, 'MEDIA_RETENTION_INTERVAL', 3600)
+        self._stop_event = threading.Event()
+
+    def run_forever(self):
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            try:
+                totals = run_cycle()
+                logger.info(
+                    "Retenção de mídia em %.2fs: %s mensagens expiradas, %s arquivos removidos, %s bytes liberados",
+                    time.monotonic() - started, totals['expired'], totals['blobs_deleted'], totals['bytes_reclaimed'],
+                )
+            except Exception as e:
+                logger.warning("Erro na retenção de mídia: %s", e)
+            finally:
+                close_old_connections()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
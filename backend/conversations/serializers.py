@@ -1,6 +1,8 @@
+from django.db.models import Prefetch
 from rest_framework import serializers
 from .models import Contact, Inbox, Conversation, Message, Team, TeamMember
 from core.serializers import UserSerializer, LabelSerializer
+from .archive import conversation_messages_page
 
 
 class ContactSerializer(serializers.ModelSerializer):
@@ -15,8 +17,12 @@ class ContactSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at', 'updated_at']
     
     def get_inbox(self, obj):
-        # Buscar a conversa mais recente do contato
-        latest_conversation = obj.conversations.order_by('-created_at').first()
+        # Buscar a conversa mais recente do contato (pré-carregada na listagem)
+        latest = getattr(obj, 'latest_conversations', None)
+        if latest is not None:
+            latest_conversation = latest[0] if latest else None
+        else:
+            latest_conversation = obj.conversations.select_related('inbox').order_by('-created_at').first()
         if latest_conversation and latest_conversation.inbox:
             return InboxSerializer(latest_conversation.inbox).data
         return None
@@ -35,12 +41,14 @@ class InboxSerializer(serializers.ModelSerializer):
 class MessageSerializer(serializers.ModelSerializer):
     media_type = serializers.SerializerMethodField()
     file_url = serializers.SerializerMethodField()
+    thumbnail_url = serializers.SerializerMethodField()
+    poster_url = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
         fields = [
             'id', 'conversation', 'message_type',
-            'media_type', 'file_url',
+            'media_type', 'file_url', 'thumbnail_url', 'poster_url',
             'content', 'is_from_customer', 'created_at', 'external_id', 'additional_attributes'
         ]
         read_only_fields = ['id', 'created_at']
@@ -61,6 +69,14 @@ class MessageSerializer(serializers.ModelSerializer):
             return obj.additional_attributes.get('file_url')
         return None
 
+    def get_thumbnail_url(self, obj):
+        # Miniatura WebP de imagens (conversations/previews.py)
+        return (obj.additional_attributes or {}).get('thumbnail_url')
+
+    def get_poster_url(self, obj):
+        # Capa de vídeos (conversations/previews.py)
+        return (obj.additional_attributes or {}).get('poster_url')
+
     def create(self, validated_data):
         validated_data['is_from_customer'] = False
         return super().create(validated_data)
@@ -71,17 +87,40 @@ class ConversationSerializer(serializers.ModelSerializer):
     inbox = InboxSerializer(read_only=True)
     assignee = UserSerializer(read_only=True)
     labels = LabelSerializer(many=True, read_only=True)
-    messages = MessageSerializer(many=True, read_only=True)
+    messages = serializers.SerializerMethodField()
+    messages_cursor = serializers.SerializerMethodField()
+    has_more_messages = serializers.SerializerMethodField()
     
     class Meta:
         model = Conversation
         fields = [
             'id', 'contact', 'inbox', 'assignee', 'status',
             'labels', 'additional_attributes',
-            'last_message_at', 'created_at', 'messages'
+            'last_message_at', 'created_at', 'messages',
+            'messages_cursor', 'has_more_messages'
         ]
         read_only_fields = ['id', 'last_message_at', 'created_at']
 
+    def _messages_page(self, obj):
+        """
+        Apenas as últimas N mensagens (CONVERSATION_MESSAGES_WINDOW). As anteriores
+        são carregadas por /conversations/<id>/messages/?before=<messages_cursor>.
+        """
+        pages = self.context.setdefault('_messages_pages', {})
+        if obj.pk not in pages:
+            pages[obj.pk] = conversation_messages_page(obj, limit=self.context.get('messages_window'))
+        return pages[obj.pk]
+
+    def get_messages(self, obj):
+        return MessageSerializer(self._messages_page(obj)['results'], many=True).data
+
+    def get_messages_cursor(self, obj):
+        page = self._messages_page(obj)
+        return page['before'] if page['has_more'] else None
+
+    def get_has_more_messages(self, obj):
+        return self._messages_page(obj)['has_more']
+
 
 class ConversationUpdateSerializer(serializers.ModelSerializer):
     """Serializer para atualização de conversas, permitindo modificar assignee e status"""
@@ -91,6 +130,22 @@ class ConversationUpdateSerializer(serializers.ModelSerializer):
         fields = ['assignee', 'status']
 
 
+def prefetch_conversation_list(queryset):
+    """
+    Carrega de uma vez tudo o que o ConversationListSerializer usa: contato,
+    inbox, responsável (com seus provedores), última mensagem (coluna de resumo)
+    e a conversa mais recente de cada contato.
+    """
+    return queryset.select_related('contact', 'inbox', 'assignee', 'last_message').prefetch_related(
+        'assignee__provedores_admin',
+        Prefetch(
+            'contact__conversations',
+            queryset=Conversation.objects.select_related('inbox').order_by('-created_at')[:1],
+            to_attr='latest_conversations',
+        ),
+    )
+
+
 class ConversationListSerializer(serializers.ModelSerializer):
     """Serializer simplificado para listagem de conversas"""
     contact = ContactSerializer(read_only=True)
@@ -98,26 +153,22 @@ class ConversationListSerializer(serializers.ModelSerializer):
     assignee = UserSerializer(read_only=True)
     labels = LabelSerializer(many=True, read_only=True)
     last_message = serializers.SerializerMethodField()
-    unread_count = serializers.SerializerMethodField()
     
     class Meta:
         model = Conversation
         fields = [
             'id', 'contact', 'inbox', 'assignee', 'status',
             'labels', 'last_message_at', 'created_at',
-            'last_message', 'unread_count'
+            'last_message', 'unread_count', 'message_count', 'last_customer_message_at'
+        ]
+        read_only_fields = [
+            'id', 'last_message_at', 'created_at', 'unread_count', 'message_count', 'last_customer_message_at'
         ]
-        read_only_fields = ['id', 'last_message_at', 'created_at']
     
     def get_last_message(self, obj):
-        last_message = obj.messages.last()
-        if last_message:
-            return MessageSerializer(last_message).data
+        if obj.last_message_id:
+            return MessageSerializer(obj.last_message).data
         return None
-    
-    def get_unread_count(self, obj):
-        # Implementar lógica de contagem de mensagens não lidas
-        return 0
 
 
 class TeamMemberSerializer(serializers.ModelSerializer):
@@ -1,3 +1,1249 @@
-from django.test import TestCase
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from core.models import Provedor, User
+from .archive import archive_conversation, archive_old_conversations, conversation_messages_page
+from .models import (
+    Contact, Conversation, Inbox, MediaAlias, MediaBlob, Message, MessageArchive, MessagePayload, MetricRollup,
+    RecoveryAttempt, RecoverySettings,
+)
+from .pagination import encode_cursor, keyset_page
+from .serializers import ConversationSerializer, MessageSerializer
+
+
+class ConversationTestMixin:
+    def setUp(self):
+        self.provedor = Provedor.objects.create(nome='Provedor Teste')
+        self.inbox = Inbox.objects.create(name='WhatsApp', channel_type='whatsapp', provedor=self.provedor)
+        self.contact = Contact.objects.create(name='Cliente', phone='5511999999999', provedor=self.provedor)
+        self.conversation = Conversation.objects.create(contact=self.contact, inbox=self.inbox)
+        self.user = User.objects.create_user(username='super', password='x', user_type='superadmin')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def criar_mensagens(self, total, conversation=None, mesmo_instante=False):
+        conversation = conversation or self.conversation
+        base = timezone.now() - timedelta(days=1)
+        mensagens = [
+            Message(conversation=conversation, content=f'msg {i}', message_type='text')
+            for i in range(total)
+        ]
+        Message.objects.bulk_create(mensagens)
+        # created_at é auto_now_add: ajustar depois para controlar a ordem
+        for i, mensagem in enumerate(conversation.messages.order_by('id')):
+            instante = base if mesmo_instante else base + timedelta(seconds=i)
+            Message.objects.filter(pk=mensagem.pk).update(created_at=instante)
+        # bulk_create não dispara o hook de resumo
+        Conversation.objects.filter(pk=conversation.pk).update(**Conversation.summary_from_messages())
+        return list(conversation.messages.order_by('created_at', 'id'))
+
+
+@override_settings(CONVERSATION_MESSAGES_WINDOW=5)
+class MessageWindowTests(ConversationTestMixin, TestCase):
+    def test_serializer_traz_apenas_a_janela(self):
+        mensagens = self.criar_mensagens(12)
+        data = ConversationSerializer(self.conversation).data
+        self.assertEqual([m['id'] for m in data['messages']], [m.id for m in mensagens[-5:]])
+        self.assertTrue(data['has_more_messages'])
+        self.assertIsNotNone(data['messages_cursor'])
+
+    def test_conversa_curta_sem_cursor(self):
+        self.criar_mensagens(3)
+        data = ConversationSerializer(self.conversation).data
+        self.assertEqual(len(data['messages']), 3)
+        self.assertFalse(data['has_more_messages'])
+        self.assertIsNone(data['messages_cursor'])
+
+    def test_keyset_percorre_historico_com_empates(self):
+        # Todas no mesmo instante: a ordem depende apenas do id
+        mensagens = self.criar_mensagens(12, mesmo_instante=True)
+        page = keyset_page(self.conversation.messages.all(), limit=5)
+        vistos = [m.id for m in page['results']]
+        while page['has_more']:
+            page = keyset_page(self.conversation.messages.all(), before=page['before'], limit=5)
+            vistos = [m.id for m in page['results']] + vistos
+        self.assertEqual(vistos, [m.id for m in mensagens])
+
+        page = keyset_page(self.conversation.messages.all(), after=encode_cursor(mensagens[0]), limit=3)
+        self.assertEqual([m.id for m in page['results']], [m.id for m in mensagens[1:4]])
+
+    def test_endpoint_de_mensagens(self):
+        mensagens = self.criar_mensagens(8)
+        url = f'/api/conversations/{self.conversation.id}/messages/'
+        response = self.client.get(url, {'limit': 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['id'] for m in response.data['results']], [m.id for m in mensagens[-3:]])
+
+        response = self.client.get(url, {'limit': 3, 'before': response.data['before']})
+        self.assertEqual([m['id'] for m in response.data['results']], [m.id for m in mensagens[-6:-3]])
+
+        response = self.client.get(url, {'before': 'invalido'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_detalhe_independente_do_tamanho_da_conversa(self):
+        url = f'/api/conversations/{self.conversation.id}/'
+        self.criar_mensagens(3)
+        with CaptureQueriesContext(connection) as poucas:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.criar_mensagens(40)
+        with CaptureQueriesContext(connection) as muitas:
+            response = self.client.get(url)
+        self.assertEqual(len(response.data['messages']), 5)
+        self.assertEqual(len(poucas.captured_queries), len(muitas.captured_queries))
+
+
+class ConversationListTests(ConversationTestMixin, TestCase):
+    def _criar_conversa(self, indice):
+        agente = User.objects.create_user(username=f'agente{indice}', password='x', user_type='agent')
+        self.provedor.admins.add(agente)
+        contact = Contact.objects.create(name=f'Cliente {indice}', phone=f'55{indice}', provedor=self.provedor)
+        conversation = Conversation.objects.create(contact=contact, inbox=self.inbox, assignee=agente)
+        self.criar_mensagens(3, conversation=conversation)
+        return conversation
+
+    def _listar(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/conversations/')
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response.data['results']
+
+    def test_queries_independentes_da_quantidade(self):
+        self._criar_conversa(1)
+        poucas, _ = self._listar()
+        for indice in range(2, 7):
+            self._criar_conversa(indice)
+        muitas, results = self._listar()
+        self.assertEqual(len(results), 7)
+        self.assertEqual(poucas, muitas)
+
+    def test_ultima_mensagem_inbox_e_responsavel(self):
+        conversation = self._criar_conversa(1)
+        ultima = conversation.messages.order_by('created_at', 'id').last()
+        _, results = self._listar()
+        item = next(r for r in results if r['id'] == conversation.id)
+        self.assertEqual(item['last_message']['id'], ultima.id)
+        self.assertEqual(item['contact']['inbox']['id'], self.inbox.id)
+        self.assertEqual(item['assignee']['provedor_id'], self.provedor.id)
+        vazia = next(r for r in results if r['id'] == self.conversation.id)
+        self.assertIsNone(vazia['last_message'])
+
+    def test_contador_de_nao_lidas(self):
+        for i in range(3):
+            Message.objects.create(conversation=self.conversation, content=f'oi {i}')
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.unread_count, 3)
+
+        Message.objects.create(conversation=self.conversation, content='resposta', is_from_customer=False)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.unread_count, 0)
+
+        Message.objects.create(conversation=self.conversation, content='de novo')
+        response = self.client.post(f'/api/conversations/{self.conversation.id}/mark-read/')
+        self.assertEqual(response.status_code, 200)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.unread_count, 0)
+
+
+class QueryPlanTests(ConversationTestMixin, TestCase):
+    """Garante que os acessos mais frequentes continuam usando os índices"""
+
+    def assertUsaIndice(self, queryset, indice):
+        if connection.vendor == 'postgresql':
+            # Tabelas de teste são pequenas; sem isto o planner prefere seq scan
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        elif connection.vendor != 'sqlite':
+            self.skipTest(f'Plano não verificado para {connection.vendor}')
+        plano = queryset.explain()
+        self.assertIn(indice, plano, f'Índice {indice} não usado:\n{plano}')
+
+    def test_mensagens_da_conversa(self):
+        mensagens = self.conversation.messages.order_by('-created_at', '-id')[:50]
+        self.assertUsaIndice(mensagens, 'msg_conv_created_idx')
+
+    def test_mensagens_do_cliente(self):
+        # Ex.: primeira/última mensagem do cliente (tempo de resposta, recuperação)
+        mensagens = self.conversation.messages.filter(is_from_customer=True).values_list('created_at', flat=True)
+        self.assertUsaIndice(mensagens, 'msg_conv_customer_idx')
+
+    def test_mensagem_por_external_id(self):
+        self.assertUsaIndice(Message.objects.filter(external_id='ABC123'), 'msg_external_id_idx')
+
+    def test_conversas_por_inbox_e_status(self):
+        conversas = Conversation.objects.filter(inbox=self.inbox, status='open')
+        self.assertUsaIndice(conversas, 'conv_inbox_status_idx')
+
+    def test_conversas_por_responsavel_e_status(self):
+        conversas = Conversation.objects.filter(assignee=self.user, status='open')
+        self.assertUsaIndice(conversas, 'conv_assignee_status_idx')
+
+    def test_ordenacao_da_listagem(self):
+        conversas = Conversation.objects.order_by('-last_message_at', '-id')[:20]
+        self.assertUsaIndice(conversas, 'conv_last_message_at_idx')
+
+    def test_queries_dos_endpoints_principais(self):
+        self.criar_mensagens(10)
+        base = f'/api/conversations/{self.conversation.id}'
+        esperado = {
+            '/api/conversations/': 3,
+            f'{base}/': 5,
+            f'{base}/messages/': 2,
+        }
+        for url, total in esperado.items():
+            with self.subTest(url=url), self.assertNumQueries(total):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_listagem_ordenada_pela_ultima_mensagem(self):
+        outra = Conversation.objects.create(contact=self.contact, inbox=self.inbox)
+        Message.objects.create(conversation=self.conversation, content='antiga')
+        Message.objects.create(conversation=outra, content='nova')
+        ids = [c['id'] for c in self.client.get('/api/conversations/').data['results']]
+        self.assertEqual(ids, [outra.id, self.conversation.id])
+
+
+class PromotedColumnsTests(ConversationTestMixin, TestCase):
+    def test_save_sincroniza_colunas(self):
+        self.contact.additional_attributes = {'chatid': '5511999999999@s.whatsapp.net', 'sender_lid': 'lid-1'}
+        self.contact.save(update_fields=['additional_attributes'])
+        self.contact.refresh_from_db()
+        self.assertEqual(self.contact.chatid, '5511999999999@s.whatsapp.net')
+        self.assertEqual(self.contact.sender_lid, 'lid-1')
+
+        self.conversation.additional_attributes = {'recovery_status': 'pending', 'ai_assisted': True}
+        self.conversation.save()
+        self.assertEqual(Conversation.objects.filter(recovery_status='pending', ai_assisted=True).count(), 1)
+
+        message = Message.objects.create(
+            conversation=self.conversation, content='oi', additional_attributes={'external_id': 'ABC'}
+        )
+        self.assertEqual(Message.objects.get(external_id='ABC'), message)
+
+    def test_backfill_em_lotes(self):
+        from importlib import import_module
+        from django.apps import apps
+        migration = import_module('conversations.migrations.0012_promote_json_attributes')
+
+        message = Message.objects.create(conversation=self.conversation, content='oi')
+        # update() não passa pelo save(): simula linhas anteriores às colunas
+        Contact.objects.filter(pk=self.contact.pk).update(additional_attributes={'chatid': 'c@s', 'sender_lid': 'l'})
+        Conversation.objects.filter(pk=self.conversation.pk).update(additional_attributes={'ai_assisted': False})
+        Message.objects.filter(pk=message.pk).update(additional_attributes={'external_id': 'XYZ'})
+
+        with mock.patch.object(migration, 'BATCH_SIZE', 1):
+            migration.backfill_columns(apps, None)
+
+        self.contact.refresh_from_db()
+        self.conversation.refresh_from_db()
+        message.refresh_from_db()
+        self.assertEqual((self.contact.chatid, self.contact.sender_lid), ('c@s', 'l'))
+        self.assertTrue(self.conversation.ai_assisted)
+        self.assertEqual(message.external_id, 'XYZ')
+
+
+class ConversationSummaryTests(ConversationTestMixin, TestCase):
+    def test_resumo_atualizado_na_escrita(self):
+        cliente = Message.objects.create(conversation=self.conversation, content='oi')
+        Message.objects.create(conversation=self.conversation, content='tudo bem?')
+        resposta = Message.objects.create(conversation=self.conversation, content='olá', is_from_customer=False)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 3)
+        self.assertEqual(self.conversation.last_message_id, resposta.id)
+        self.assertEqual(self.conversation.last_message_at, resposta.created_at)
+        self.assertGreaterEqual(self.conversation.last_customer_message_at, cliente.created_at)
+        self.assertLess(self.conversation.last_customer_message_at, resposta.created_at)
+        self.assertEqual(self.conversation.unread_count, 0)
+
+    def test_save_com_instancia_antiga_nao_sobrescreve_resumo(self):
+        antiga = Conversation.objects.get(pk=self.conversation.pk)
+        Message.objects.create(conversation=self.conversation, content='oi')
+        antiga.status = 'pending'
+        antiga.save()
+        atual = Conversation.objects.get(pk=self.conversation.pk)
+        self.assertEqual(atual.status, 'pending')
+        self.assertEqual(atual.message_count, 1)
+        self.assertEqual(atual.unread_count, 1)
+
+    def test_exclusao_recalcula_resumo(self):
+        primeira = Message.objects.create(conversation=self.conversation, content='1')
+        ultima = Message.objects.create(conversation=self.conversation, content='2')
+        ultima.delete()
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 1)
+        self.assertEqual(self.conversation.last_message_id, primeira.id)
+
+    def test_listagem_nao_agrega_mensagens(self):
+        Message.objects.create(conversation=self.conversation, content='oi')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/conversations/')
+        self.assertEqual(response.data['results'][0]['message_count'], 1)
+        self.assertFalse(any('conversations_message"."conversation_id" IN' in q['sql'] for q in ctx.captured_queries))
+
+
+class MessageArchiveTests(ConversationTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.mensagens = self.criar_mensagens(8)
+        Conversation.objects.filter(pk=self.conversation.pk).update(
+            status='closed', last_message_at=timezone.now() - timedelta(days=400)
+        )
+        self.conversation.refresh_from_db()
+
+    def test_arquiva_conversas_antigas_fechadas(self):
+        recente = Conversation.objects.create(contact=self.contact, inbox=self.inbox, status='closed')
+        Message.objects.create(conversation=recente, content='recente')
+
+        conversas, mensagens = archive_old_conversations(older_than_days=180)
+        self.assertEqual((conversas, mensagens), (1, 8))
+        self.assertFalse(self.conversation.messages.exists())
+        self.assertEqual(recente.messages.count(), 1)
+
+        self.conversation.refresh_from_db()
+        self.assertTrue(self.conversation.has_archive)
+        self.assertEqual(self.conversation.message_count, 8)
+        self.assertEqual(MessageArchive.objects.filter(conversation=self.conversation).count(), 1)
+
+    def test_leitura_transparente(self):
+        archive_conversation(self.conversation)
+        novas = [Message.objects.create(conversation=self.conversation, content=f'nova {i}') for i in range(2)]
+        esperado = [m.id for m in self.mensagens] + [m.id for m in novas]
+
+        page = conversation_messages_page(self.conversation, limit=4)
+        vistos = [m.id for m in page['results']]
+        while page['has_more']:
+            page = conversation_messages_page(self.conversation, before=page['before'], limit=4)
+            vistos = [m.id for m in page['results']] + vistos
+        self.assertEqual(vistos, esperado)
+
+        page = conversation_messages_page(self.conversation, after=encode_cursor(self.mensagens[5]), limit=3)
+        self.assertEqual([m.id for m in page['results']], esperado[6:9])
+
+        response = self.client.get('/api/messages/', {'conversation': self.conversation.id})
+        self.assertEqual([m['id'] for m in response.data['results']], esperado)
+        self.assertEqual(response.data['results'][0]['content'], 'msg 0')
+
+        response = self.client.get(f'/api/conversations/{self.conversation.id}/messages/', {'limit': 3})
+        self.assertEqual([m['id'] for m in response.data['results']], esperado[-3:])
+
+    def test_arquivo_so_e_lido_quando_a_pagina_passa_da_tabela_quente(self):
+        from . import archive
+        # Duas partições: as 4 primeiras mensagens num mês anterior
+        for mensagem in self.mensagens[:4]:
+            Message.objects.filter(pk=mensagem.pk).update(created_at=mensagem.created_at - timedelta(days=62))
+        self.mensagens = list(self.conversation.messages.order_by('created_at', 'id'))
+        archive_conversation(self.conversation)
+        self.assertEqual(self.conversation.message_archives.count(), 2)
+        novas = [Message.objects.create(conversation=self.conversation, content=f'nova {i}') for i in range(5)]
+        esperado = [m.id for m in self.mensagens] + [m.id for m in novas]
+
+        with mock.patch.object(archive, '_decode', wraps=archive._decode) as decode:
+            page = conversation_messages_page(self.conversation, limit=4)
+            self.assertEqual([m.id for m in page['results']], esperado[-4:])
+            self.assertTrue(page['has_more'])
+            self.assertEqual(decode.call_count, 0)
+
+            primeira = page
+            page = conversation_messages_page(self.conversation, after=encode_cursor(novas[0]), limit=2)
+            self.assertEqual([m.id for m in page['results']], esperado[-4:-2])
+            self.assertEqual(decode.call_count, 0)
+
+            # 1 mensagem quente + 3 do mês arquivado mais recente: só esse mês é lido
+            page = conversation_messages_page(self.conversation, before=primeira['before'], limit=4)
+            self.assertEqual([m.id for m in page['results']], esperado[-8:-4])
+            self.assertTrue(page['has_more'])
+            self.assertEqual(decode.call_count, 1)
+
+            page = conversation_messages_page(self.conversation, before=page['before'], limit=4)
+            self.assertEqual([m.id for m in page['results']], esperado[1:5])
+            self.assertTrue(page['has_more'])
+
+            decode.reset_mock()
+            page = conversation_messages_page(self.conversation, after=encode_cursor(self.mensagens[5]), limit=3)
+            self.assertEqual([m.id for m in page['results']], esperado[6:9])
+            self.assertEqual(decode.call_count, 1)
+
+
+class MessagePayloadTests(ConversationTestMixin, TestCase):
+    def test_payload_bruto_fora_da_mensagem(self):
+        message = Message.objects.create(
+            conversation=self.conversation, content='oi', is_from_customer=False,
+            additional_attributes={'whatsapp_sent': True, 'whatsapp_response': '{"id": "ABC"}'},
+        )
+        message.additional_attributes['uazapi_response'] = {'fileURL': 'https://f'}
+        message.save()
+
+        message.refresh_from_db()
+        self.assertEqual(message.additional_attributes, {'whatsapp_sent': True})
+        self.assertNotIn('whatsapp_response', MessageSerializer(message).data['additional_attributes'])
+
+        response = self.client.get(f'/api/messages/{message.id}/raw/')
+        self.assertEqual(response.data['data'], {'whatsapp_response': '{"id": "ABC"}', 'uazapi_response': {'fileURL': 'https://f'}})
+
+    def test_migracao_move_payloads_existentes(self):
+        from importlib import import_module
+        from django.apps import apps
+        migration = import_module('conversations.migrations.0015_message_payload')
+
+        message = Message.objects.create(conversation=self.conversation, content='oi')
+        Message.objects.filter(pk=message.pk).update(
+            additional_attributes={'file_url': 'https://f', 'uazapi_response': {'mimetype': 'image/png'}}
+        )
+        migration.move_raw_payloads(apps, None)
+
+        message.refresh_from_db()
+        self.assertEqual(message.additional_attributes, {'file_url': 'https://f'})
+        self.assertEqual(MessagePayload.objects.get(message=message).data, {'uazapi_response': {'mimetype': 'image/png'}})
+
+
+class MetricRollupTests(ConversationTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.agente = User.objects.create_user(username='agente', password='x', user_type='agent')
+        self.provedor.admins.add(self.agente)
+        self.conversa = Conversation.objects.create(contact=self.contact, inbox=self.inbox, assignee=self.agente)
+        Message.objects.create(conversation=self.conversa, content='oi')
+        Message.objects.create(conversation=self.conversa, content='olá', is_from_customer=False, message_type='outgoing')
+        Message.objects.create(conversation=self.conversa, content='quero falar com alguém')
+        Message.objects.create(conversation=self.conversa, content='claro', is_from_customer=False)
+
+    def _totais(self, **filtros):
+        from django.db.models import Sum
+        from .metrics import COUNTERS
+        return MetricRollup.objects.filter(**filtros).aggregate(**{f: Sum(f) for f in COUNTERS})
+
+    def test_contadores_incrementais(self):
+        totais = self._totais(agent_id=self.agente.id)
+        self.assertEqual(totais['messages_received'], 2)
+        self.assertEqual(totais['messages_sent'], 2)
+        self.assertEqual(totais['ai_replies'], 1)
+        self.assertEqual(totais['human_replies'], 1)
+        self.assertEqual(totais['conversations_started'], 1)
+        self.assertEqual(totais['first_responses'], 1)
+        # self.conversation (do mixin) não tem responsável
+        self.assertEqual(self._totais(agent_id=0)['conversations_started'], 1)
+
+        self.conversa.refresh_from_db()
+        self.assertIsNotNone(self.conversa.first_customer_message_at)
+        self.assertGreaterEqual(self.conversa.first_response_at, self.conversa.first_customer_message_at)
+
+    def test_rebuild_reproduz_incremental(self):
+        from .metrics import rebuild_metrics
+        antes = self._totais()
+        MetricRollup.objects.all().delete()
+        rebuild_metrics()
+        self.assertEqual(self._totais(), antes)
+
+    def test_serie_temporal(self):
+        agora = timezone.now()
+        response = self.client.get('/api/dashboard/metrics/', {'bucket': 'hour'})
+        self.assertEqual(response.status_code, 400)  # superadmin sem provedor
+
+        self.provedor.admins.add(self.user)
+        response = self.client.get('/api/dashboard/metrics/', {
+            'bucket': 'day', 'start': (agora - timedelta(days=1)).isoformat(), 'end': (agora + timedelta(hours=1)).isoformat(),
+        })
+        self.assertEqual(response.status_code, 200)
+        serie = response.data['series']
+        self.assertEqual(sum(p['messages_received'] for p in serie), 2)
+        self.assertEqual(sum(p['conversations_started'] for p in serie), 2)
+
+        response = self.client.get('/api/dashboard/metrics/', {'agent': self.agente.id})
+        self.assertEqual(sum(p['ai_replies'] for p in response.data['series']), 1)
+        self.assertEqual(self.client.get('/api/dashboard/metrics/', {'bucket': 'week'}).status_code, 400)
+
+
+class RecoveryStatsTests(ConversationTestMixin, TestCase):
+    def criar_recuperacao(self, status, tentativa=None, resposta=None):
+        attrs = {'recovery_status': status}
+        if tentativa:
+            attrs['recovery_last_attempt'] = tentativa
+        if resposta:
+            attrs['recovery_response_time'] = resposta
+        return Conversation.objects.create(contact=self.contact, inbox=self.inbox, additional_attributes=attrs)
+
+    def test_colunas_tipadas_sincronizadas(self):
+        conversa = self.criar_recuperacao('recovered', '2025-01-10 10:00:00', '2025-01-10T10:30:00')
+        self.assertEqual(conversa.recovery_response_at - conversa.recovery_last_attempt_at, timedelta(minutes=30))
+        conversa.additional_attributes['recovery_response_time'] = 'invalido'
+        conversa.save(update_fields=['additional_attributes'])
+        conversa.refresh_from_db()
+        self.assertIsNone(conversa.recovery_response_at)
+
+    def test_estatisticas_em_numero_constante_de_queries(self):
+        self.criar_recuperacao('recovered', '2025-01-10 10:00:00', '2025-01-10 10:30:00')
+        self.criar_recuperacao('recovered', '2025-01-10 10:00:00', '2025-01-10 12:00:00')
+        self.criar_recuperacao('recovered')
+        self.criar_recuperacao('pending', '2025-01-10 10:00:00')
+        url = '/api/conversations/recovery_stats/'
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'provedor_id': self.provedor.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['stats'], {
+            'totalAttempts': 5,
+            'successfulRecoveries': 3,
+            'pendingRecoveries': 1,
+            'conversionRate': 60.0,
+            'averageResponseTime': '1h 15min',
+        })
+        self.assertEqual(len(response.data['conversations']), 4)
+
+        for _ in range(5):
+            self.criar_recuperacao('recovered', '2025-01-10 10:00:00', '2025-01-10 11:15:00')
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(url, {'provedor_id': self.provedor.id})
+        self.assertEqual(response.data['stats']['successfulRecoveries'], 8)
+
+
+@mock.patch('conversations.views.send_via_uazapi', return_value=(True, 'ok'))
+class RecoveryEngineTests(ConversationTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.settings = RecoverySettings.objects.create(
+            provedor=self.provedor, delay_minutes=30, max_attempts=2, keywords=['Plano', 'fibra óptica'],
+        )
+        self.agora = timezone.now()
+
+    def conversa_ociosa(self, texto, minutos=60):
+        contato = Contact.objects.create(
+            name='Maria', phone=f'55119888{Contact.objects.count():05d}', provedor=self.provedor
+        )
+        conversa = Conversation.objects.create(contact=contato, inbox=self.inbox)
+        cliente = Message.objects.create(conversation=conversa, content=texto)
+        resposta = Message.objects.create(conversation=conversa, content='Temos vários planos', is_from_customer=False)
+        instante = self.agora - timedelta(minutes=minutos)
+        Message.objects.filter(pk=cliente.pk).update(created_at=instante)
+        Message.objects.filter(pk=resposta.pk).update(created_at=instante + timedelta(seconds=5))
+        Conversation.objects.filter(pk=conversa.pk).update(**Conversation.summary_from_messages())
+        return conversa
+
+    def test_matcher_ignora_acento_e_caixa(self, send):
+        from .recovery import keyword_matcher, matches
+        matcher = keyword_matcher(['Plano', 'fibra óptica'])
+        self.assertIs(matcher, keyword_matcher(['fibra óptica', 'plano']))
+        self.assertTrue(matches(matcher, 'Quais PLANOS vocês têm?'))
+        self.assertTrue(matches(matcher, 'tem FIBRA OPTICA aqui?'))
+        self.assertFalse(matches(matcher, 'meu aplanamento'))
+        self.assertIsNone(keyword_matcher([]))
+
+    def test_ciclo_agenda_envia_e_detecta_resposta(self, send):
+        from .recovery import run_cycle
+        interessada = self.conversa_ociosa('Quero saber do plano de 500MB')
+        outra = self.conversa_ociosa('Minha internet caiu')
+        recente = self.conversa_ociosa('Qual o valor do plano?', minutos=10)
+
+        totais = run_cycle(now=self.agora)
+        self.assertEqual((totais['enrolled'], totais['sent']), (1, 1))
+        send.assert_called_once()
+        interessada.refresh_from_db()
+        self.assertEqual(interessada.recovery_status, 'pending')
+        self.assertEqual(interessada.additional_attributes['recovery_attempts'], 1)
+        self.assertEqual(interessada.recovery_next_at, self.agora + timedelta(minutes=30))
+        self.assertEqual(RecoveryAttempt.objects.get(conversation=interessada).status, 'sent')
+        self.assertEqual(interessada.messages.filter(is_from_customer=False).count(), 2)
+        for conversa in (outra, recente):
+            conversa.refresh_from_db()
+            self.assertEqual(conversa.recovery_status, '')
+
+        # Nada venceu: o segundo ciclo não envia
+        self.assertEqual(run_cycle(now=self.agora + timedelta(minutes=1))['sent'], 0)
+
+        Message.objects.create(conversation=interessada, content='Quero sim!')
+        totais = run_cycle(now=self.agora + timedelta(minutes=2))
+        self.assertEqual(totais['recovered'], 1)
+        interessada.refresh_from_db()
+        self.assertEqual(interessada.recovery_status, 'recovered')
+        self.assertIsNone(interessada.recovery_next_at)
+        tentativa = RecoveryAttempt.objects.get(conversation=interessada)
+        self.assertEqual(tentativa.status, 'recovered')
+        self.assertEqual(tentativa.response_received_at, interessada.last_customer_message_at)
+
+    def test_encerra_apos_max_tentativas(self, send):
+        from .recovery import run_cycle
+        conversa = self.conversa_ociosa('tem fibra óptica no meu bairro?')
+        for minutos in (0, 31, 62):
+            run_cycle(now=self.agora + timedelta(minutes=minutos))
+        self.assertEqual(send.call_count, 2)
+        conversa.refresh_from_db()
+        self.assertEqual(conversa.recovery_status, 'failed')
+        self.assertIsNone(conversa.recovery_next_at)
+        self.assertEqual(
+            list(conversa.recovery_attempts.order_by('attempt_number').values_list('status', flat=True)),
+            ['failed', 'failed'],
+        )
+
+    def test_conversa_criada_pelo_webhook_entra_na_recuperacao(self, send):
+        from django.urls import reverse
+        from .recovery import run_cycle
+        self.provedor.integracoes_externas = {'whatsapp_token': 'tok', 'whatsapp_url': 'https://uazapi.test'}
+        self.provedor.save()
+        resposta_http = mock.Mock(status_code=200, content=b'{}', text='{}')
+        resposta_http.json.return_value = {}
+        with mock.patch('integrations.views.verify_and_normalize_number', side_effect=lambda chatid, *args: chatid), \
+                mock.patch('requests.post', return_value=resposta_http), \
+                mock.patch('integrations.views.openai_service.generate_response_sync',
+                           return_value={'success': True, 'resposta': 'Temos vários planos'}):
+            response = self.client.post(
+                reverse('webhook_evolution_uazapi'),
+                {
+                    'event': 'message',
+                    'instance': '5511000000000',
+                    'data': {'chatid': '5511977776666@s.whatsapp.net', 'id': 'MSG1',
+                             'content': 'Quero saber do plano de 500MB', 'senderName': 'Maria'},
+                },
+                format='json',
+            )
+        self.assertEqual(response.status_code, 200, response.content)
+        conversa = Message.objects.get(external_id='MSG1').conversation
+        self.assertEqual(conversa.status, 'snoozed')
+        self.assertEqual(conversa.messages.filter(is_from_customer=False).count(), 1)
+
+        totais = run_cycle(now=timezone.now() + timedelta(minutes=31))
+        self.assertEqual((totais['enrolled'], totais['sent']), (1, 1))
+        conversa.refresh_from_db()
+        self.assertEqual(conversa.recovery_status, 'pending')
+
+    def test_limite_de_envio_por_provedor(self, send):
+        from .recovery import RateLimiter, run_cycle
+        conversas = [self.conversa_ociosa(f'plano {i}') for i in range(3)]
+        limiter = RateLimiter(rate=2)
+        self.assertEqual(run_cycle(limiter, now=self.agora)['sent'], 2)
+        self.assertEqual(run_cycle(limiter, now=self.agora)['sent'], 0)
+        pendentes = Conversation.objects.filter(pk__in=[c.pk for c in conversas], recovery_next_at__lte=self.agora)
+        self.assertEqual(pendentes.count(), 1)
+
+
+class FakeDownload:
+    def __init__(self, body, status_code=200, headers=None):
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers or {'Content-Length': str(len(body))}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+
+class MediaDownloadTests(ConversationTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        override = override_settings(MEDIA_ROOT=self.media_root, MEDIA_DOWNLOAD_MAX_BYTES=1000)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def arquivos(self):
+        return sorted(
+            os.path.relpath(os.path.join(raiz, nome), self.media_root)
+            for raiz, _, nomes in os.walk(self.media_root) for nome in nomes
+        )
+
+    def test_copia_em_streaming_com_hash_e_limite(self):
+        from .media import MediaTooLarge, copy_stream
+        destino = os.path.join(self.media_root, 'messages', '1', 'a.bin')
+        resultado = copy_stream([b'abc', b'', b'def'], destino)
+        self.assertEqual((resultado.size, resultado.sha256), (6, hashlib.sha256(b'abcdef').hexdigest()))
+        self.assertEqual(self.arquivos(), ['messages/1/a.bin'])
+
+        with self.assertRaises(MediaTooLarge):
+            copy_stream([b'x' * 600, b'x' * 600], os.path.join(self.media_root, 'messages', '1', 'b.bin'))
+        # Nem o destino nem o temporário ficam para trás
+        self.assertEqual(self.arquivos(), ['messages/1/a.bin'])
+
+    def test_content_length_acima_do_limite(self):
+        from .media import MediaTooLarge, stream_download
+        resposta = FakeDownload(b'', headers={'Content-Length': '5000'})
+        with mock.patch('conversations.media.requests.get', return_value=resposta):
+            with self.assertRaises(MediaTooLarge):
+                stream_download('https://cdn.test/x', os.path.join(self.media_root, 'x'))
+
+    def test_download_atualiza_mensagem(self):
+        from .media import download_message_media
+        mensagem = Message.objects.create(
+            conversation=self.conversation, content='', message_type='image',
+            additional_attributes={'file_url': 'https://cdn.test/img.jpg', 'media_status': 'downloading'},
+        )
+        self.assertEqual(MessageSerializer(mensagem).data['file_url'], 'https://cdn.test/img.jpg')
+        with mock.patch('conversations.media.requests.get', return_value=FakeDownload(b'imagem')) as get, \
+                mock.patch('conversations.transcode.transcoder.submit', return_value=True):
+            download_message_media(mensagem.id, 'https://cdn.test/img.jpg', 'image_1.jpg')
+        self.assertTrue(get.call_args.kwargs['stream'])
+
+        mensagem.refresh_from_db()
+        attrs = mensagem.additional_attributes
+        self.assertEqual(attrs['media_status'], 'ready')
+        self.assertEqual(attrs['file_size'], 6)
+        self.assertEqual(attrs['sha256'], hashlib.sha256(b'imagem').hexdigest())
+        url = f'/api/media/messages/{self.conversation.id}/image_1.jpg'
+        self.assertEqual(MessageSerializer(mensagem).data['file_url'], url)
+
+        with mock.patch('conversations.media.requests.get', return_value=FakeDownload(b'', status_code=404)):
+            download_message_media(mensagem.id, 'https://cdn.test/img.jpg', 'image_2.jpg')
+        mensagem.refresh_from_db()
+        self.assertEqual(mensagem.additional_attributes['media_status'], 'failed')
+
+    def test_pool_limita_downloads_em_andamento(self):
+        from .media import MediaDownloader
+        pool = MediaDownloader(workers=1, queue_size=1)
+        liberar = threading.Event()
+        self.assertTrue(pool.submit(liberar.wait, 5))
+        self.assertTrue(pool.submit(liberar.wait, 5))
+        self.assertFalse(pool.submit(liberar.wait, 5))
+        liberar.set()
+        # As vagas voltam quando os downloads terminam
+        for _ in range(500):
+            if pool.submit(lambda: None):
+                break
+            time.sleep(0.01)
+        else:
+            self.fail('vaga não liberada')
+
+    def test_caminho_local_da_url(self):
+        from .media import local_media_path
+        esperado = os.path.join(self.media_root, 'messages', '7', 'a.mp3')
+        os.makedirs(os.path.dirname(esperado))
+        open(esperado, 'wb').close()
+        self.assertEqual(local_media_path('/api/media/messages/7/a.mp3'), esperado)
+        self.assertEqual(local_media_path('https://app.test/api/media/messages/7/a.mp3'), esperado)
+        self.assertIsNone(local_media_path('/api/media/messages/7/../../settings.py'))
+        self.assertIsNone(local_media_path('https://cdn.test/a.mp3'))
+
+
+class MediaStoreTests(ConversationTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def blobs_em_disco(self):
+        return sorted(
+            nome for raiz, _, nomes in os.walk(os.path.join(self.media_root, 'cas'))
+            for nome in nomes if os.path.basename(raiz) != 'tmp'
+        )
+
+    def mensagem_com_midia(self, blob, nome):
+        from .media_store import attach
+        mensagem = Message(conversation=self.conversation, content='', message_type='image')
+        attach(mensagem, blob, nome)
+        mensagem.save()
+        return mensagem
+
+    def test_mesmo_conteudo_grava_um_arquivo(self):
+        from .media_store import ingest_chunks
+        primeiro = ingest_chunks([b'boleto', b'.pdf'])
+        segundo = ingest_chunks([b'boleto.pdf'])
+        self.assertEqual(primeiro.pk, segundo.pk)
+        self.assertTrue(segundo.deduplicated)
+        self.assertEqual(MediaBlob.objects.count(), 1)
+        self.assertEqual(self.blobs_em_disco(), [hashlib.sha256(b'boleto.pdf').hexdigest()])
+
+    def test_referencias_e_nomes_por_conversa(self):
+        from .media_store import ingest_chunks
+        blob = ingest_chunks([b'figurinha'])
+        outro = ingest_chunks([b'outra figurinha'])
+        a = self.mensagem_com_midia(blob, 'sticker.webp')
+        b = self.mensagem_com_midia(blob, 'sticker.webp')
+        c = self.mensagem_com_midia(outro, 'sticker.webp')
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(a.additional_attributes['local_file_url'], b.additional_attributes['local_file_url'])
+        # Nome já usado por outro conteúdo ganha sufixo do hash
+        self.assertEqual(c.additional_attributes['file_name'], f'sticker_{outro.sha256[:12]}.webp')
+        self.assertEqual(MediaAlias.objects.filter(conversation=self.conversation).count(), 2)
+
+        a.delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+
+    def test_serve_pelo_alias_e_pelo_arquivo_antigo(self):
+        from .media_store import ingest_chunks
+        mensagem = self.mensagem_com_midia(ingest_chunks([b'conteudo']), 'foto.jpg')
+        resposta = self.client.get(mensagem.additional_attributes['local_file_url'] + '/')
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(b''.join(resposta.streaming_content), b'conteudo')
+
+        pasta = os.path.join(self.media_root, 'messages', str(self.conversation.id))
+        os.makedirs(pasta)
+        with open(os.path.join(pasta, 'antigo.jpg'), 'wb') as arquivo:
+            arquivo.write(b'antigo')
+        resposta = self.client.get(f'/api/media/messages/{self.conversation.id}/antigo.jpg/')
+        self.assertEqual(b''.join(resposta.streaming_content), b'antigo')
+        self.assertEqual(
+            self.client.get(f'/api/media/messages/{self.conversation.id}/nada.jpg/').status_code, 404
+        )
+
+    def test_envio_de_midia_guarda_no_armazenamento(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        with mock.patch('conversations.views.send_media_via_uazapi', return_value=(True, {})):
+            resposta = self.client.post('/api/messages/send_media/', {
+                'conversation_id': self.conversation.id,
+                'media_type': 'image',
+                'file': SimpleUploadedFile('foto.jpg', b'jpeg', content_type='image/jpeg'),
+            }, format='multipart')
+        self.assertEqual(resposta.status_code, 201, resposta.content)
+        mensagem = Message.objects.get(conversation=self.conversation, message_type='image')
+        self.assertEqual(mensagem.media_blob.sha256, hashlib.sha256(b'jpeg').hexdigest())
+        self.assertEqual(
+            mensagem.additional_attributes['file_url'], f'/api/media/messages/{self.conversation.id}/foto.jpg'
+        )
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'messages')))
+
+    def test_comando_migra_arquivos_antigos(self):
+        from django.core.management import call_command
+        outra = Conversation.objects.create(contact=self.contact, inbox=self.inbox)
+        mensagens = []
+        for conversa in (self.conversation, outra):
+            pasta = os.path.join(self.media_root, 'messages', str(conversa.id))
+            os.makedirs(pasta)
+            with open(os.path.join(pasta, 'boleto.pdf'), 'wb') as arquivo:
+                arquivo.write(b'%PDF boleto')
+            url = f'/api/media/messages/{conversa.id}/boleto.pdf'
+            mensagens.append(Message.objects.create(
+                conversation=conversa, content='', message_type='document',
+                additional_attributes={'file_url': url, 'local_file_url': url},
+            ))
+
+        call_command('dedupe_media', stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(MediaBlob.objects.get().ref_count, 2)
+        self.assertEqual(len(self.blobs_em_disco()), 1)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'messages', str(outra.id))), [])
+        for mensagem in mensagens:
+            mensagem.refresh_from_db()
+            self.assertIsNotNone(mensagem.media_blob_id)
+            resposta = self.client.get(mensagem.additional_attributes['local_file_url'] + '/')
+            self.assertEqual(b''.join(resposta.streaming_content), b'%PDF boleto')
+
+
+class TranscodeTests(ConversationTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def ffmpeg_falso(self, source_path, fmt, timeout=None):
+        from .media_store import temp_path
+        destino = temp_path(f'.{fmt}')
+        with open(source_path, 'rb') as origem, open(destino, 'wb') as saida:
+            saida.write(b'ID3' + origem.read())
+        return destino
+
+    def test_fila_atende_envio_antes_de_recebido(self):
+        from .transcode import PRIORITY_INBOUND, PRIORITY_OUTBOUND, Transcoder
+        fila = Transcoder(workers=1)
+        liberar = threading.Event()
+        ordem = []
+        fila.submit(PRIORITY_INBOUND, liberar.wait, 5)
+        fila.submit(PRIORITY_INBOUND, ordem.append, 'recebido')
+        fila.submit(PRIORITY_OUTBOUND, ordem.append, 'envio')
+        liberar.set()
+        fila.join()
+        self.assertEqual(ordem, ['envio', 'recebido'])
+
+    def test_nucleos_divididos_entre_processos_web(self):
+        from .transcode import Transcoder
+        with mock.patch('conversations.transcode.os.cpu_count', return_value=8):
+            with override_settings(TRANSCODE_WORKERS=0, WEB_PROCESSES=4):
+                self.assertEqual(Transcoder().workers, 2)
+            with override_settings(TRANSCODE_WORKERS=0, WEB_PROCESSES=16):
+                self.assertEqual(Transcoder().workers, 1)
+            with override_settings(TRANSCODE_WORKERS=3, WEB_PROCESSES=4):
+                self.assertEqual(Transcoder().workers, 3)
+
+    def test_mesmo_conteudo_convertido_uma_vez(self):
+        from .media_store import ingest_chunks
+        from .transcode import MP3, transcode
+        blob = ingest_chunks([b'webm'])
+        with mock.patch('conversations.transcode.run_ffmpeg', side_effect=self.ffmpeg_falso) as ffmpeg:
+            primeiro = transcode(blob, MP3)
+            segundo = transcode(blob, MP3)
+        self.assertEqual(ffmpeg.call_count, 1)
+        self.assertEqual(primeiro.pk, segundo.pk)
+        with open(primeiro.path, 'rb') as arquivo:
+            self.assertEqual(arquivo.read(), b'ID3webm')
+
+    def test_erro_no_cache_descarta_a_conversao(self):
+        from django.db import DataError
+        from .media_store import ingest_chunks
+        from .transcode import MP3, TranscodeError, transcode
+        blob = ingest_chunks([b'webm'])
+        with mock.patch('conversations.transcode.run_ffmpeg', side_effect=self.ffmpeg_falso), \
+                mock.patch('conversations.transcode.MediaTranscode.objects.update_or_create',
+                           side_effect=DataError('value too long')):
+            with self.assertRaises(TranscodeError):
+                transcode(blob, MP3)
+        self.assertEqual(list(MediaBlob.objects.values_list('pk', flat=True)), [blob.pk])
+        self.assertFalse(os.listdir(os.path.join(self.media_root, 'cas', 'tmp')))
+
+    def test_chaves_das_miniaturas_cabem_no_cache(self):
+        from .models import MediaTranscode
+        from .previews import PREVIEWS
+        max_length = MediaTranscode._meta.get_field('format').max_length
+        for kind, _ in PREVIEWS.values():
+            self.assertLessEqual(len(kind), max_length, kind)
+
+    def enviar_ptt(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        return self.client.post('/api/messages/send_media/', {
+            'conversation_id': self.conversation.id,
+            'media_type': 'ptt',
+            'file': SimpleUploadedFile('gravacao.webm', b'webm', content_type='audio/webm'),
+        }, format='multipart')
+
+    def test_ptt_convertido_fora_da_requisicao(self):
+        from .transcode import transcode_outbound_ptt
+        with mock.patch('conversations.views.send_media_via_uazapi', return_value=(True, {})) as enviar, \
+                mock.patch('conversations.transcode.transcoder.submit', return_value=True) as submit, \
+                self.captureOnCommitCallbacks(execute=True):
+            resposta = self.enviar_ptt()
+        self.assertEqual(resposta.status_code, 201, resposta.content)
+        self.assertFalse(enviar.called)
+        self.assertEqual(resposta.data['additional_attributes']['media_status'], 'transcoding')
+        _, funcao, mensagem_id, _ = submit.call_args.args
+        self.assertIs(funcao, transcode_outbound_ptt)
+
+        with mock.patch('conversations.views.send_media_via_uazapi', return_value=(True, {})) as enviar, \
+                mock.patch('conversations.transcode.run_ffmpeg', side_effect=self.ffmpeg_falso):
+            transcode_outbound_ptt(mensagem_id)
+        url = f'/api/media/messages/{self.conversation.id}/gravacao.mp3'
+        self.assertEqual(enviar.call_args.args[1:3], (url, 'ptt'))
+        attrs = Message.objects.get(pk=mensagem_id).additional_attributes
+        self.assertEqual((attrs['file_url'], attrs['media_status'], attrs['whatsapp_sent']), (url, 'ready', True))
+
+        # O mesmo áudio de novo: MP3 do cache, enviado na hora
+        with mock.patch('conversations.views.send_media_via_uazapi', return_value=(True, {})) as enviar, \
+                mock.patch('conversations.transcode.run_ffmpeg') as ffmpeg:
+            resposta = self.enviar_ptt()
+        self.assertFalse(ffmpeg.called)
+        self.assertEqual(enviar.call_args.args[1], url)
+
+    def test_audio_recebido_fora_de_mp3_vai_para_conversao(self):
+        from .media import download_message_media
+        for conteudo, convertido in ((b'OggS', True), (b'ID3mp3', False)):
+            mensagem = Message.objects.create(conversation=self.conversation, content='', message_type='audio')
+            with mock.patch('conversations.media.requests.get', return_value=FakeDownload(conteudo)), \
+                    mock.patch('conversations.transcode.transcoder.submit', return_value=True) as submit:
+                download_message_media(mensagem.id, 'https://cdn.test/a', f'audio_{mensagem.id}.mp3')
+            self.assertEqual(submit.called, convertido)
+            mensagem.refresh_from_db()
+            self.assertEqual(mensagem.additional_attributes['media_status'], 'transcoding' if convertido else 'ready')
+
+
+class PreviewTests(ConversationTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        override = override_settings(MEDIA_ROOT=self.media_root, PREVIEW_MAX_SIZE=64)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def png(self, largura=400, altura=200):
+        import io
+        from PIL import Image
+        saida = io.BytesIO()
+        Image.new('RGB', (largura, altura), 'red').save(saida, 'PNG')
+        return saida.getvalue()
+
+    def mensagem(self, conteudo, tipo='image', nome='foto.png'):
+        from .media_store import attach, ingest_chunks
+        mensagem = Message(conversation=self.conversation, content='', message_type=tipo)
+        attach(mensagem, ingest_chunks([conteudo]), nome)
+        mensagem.save()
+        return mensagem
+
+    def abrir(self, url):
+        from PIL import Image
+        from .media import local_media_path
+        return Image.open(local_media_path(url))
+
+    def test_miniatura_webp_reduzida_e_em_cache(self):
+        from . import previews
+        primeira = self.mensagem(self.png())
+        segunda = self.mensagem(self.png())
+        with mock.patch.dict(previews.CONVERTERS, {previews.THUMBNAIL: mock.Mock(wraps=previews.make_thumbnail)}):
+            previews.generate_preview(primeira.id)
+            previews.generate_preview(segunda.id)
+            self.assertEqual(previews.CONVERTERS[previews.THUMBNAIL].call_count, 1)
+
+        primeira.refresh_from_db()
+        url = MessageSerializer(primeira).data['thumbnail_url']
+        self.assertEqual(url, f'/api/media/messages/{self.conversation.id}/foto_thumb.webp')
+        with self.abrir(url) as imagem:
+            self.assertEqual((imagem.format, imagem.size), ('WEBP', (64, 32)))
+        self.assertEqual(self.client.get(url + '/')['Content-Type'], 'image/webp')
+
+    def test_capa_de_video(self):
+        from .previews import generate_preview
+
+        def ffmpeg_falso(args, **kwargs):
+            with open(args[-1], 'wb') as quadro:
+                quadro.write(self.png(160, 90))
+            return mock.Mock(returncode=0)
+
+        mensagem = self.mensagem(b'mp4', tipo='video', nome='video.mp4')
+        with mock.patch('conversations.previews.subprocess.run', side_effect=ffmpeg_falso):
+            generate_preview(mensagem.id)
+        mensagem.refresh_from_db()
+        dados = MessageSerializer(mensagem).data
+        self.assertIsNone(dados['thumbnail_url'])
+        with self.abrir(dados['poster_url']) as imagem:
+            self.assertEqual(imagem.size, (64, 36))
+
+    def test_imagem_invalida_fica_sem_miniatura(self):
+        from .previews import generate_preview
+        mensagem = self.mensagem(b'nao e imagem')
+        self.assertIsNone(generate_preview(mensagem.id))
+        mensagem.refresh_from_db()
+        self.assertNotIn('thumbnail_url', mensagem.additional_attributes)
+
+    def test_download_agenda_miniatura(self):
+        from .media import download_message_media
+        from .previews import generate_preview
+        mensagem = Message.objects.create(conversation=self.conversation, content='', message_type='image')
+        with mock.patch('conversations.media.requests.get', return_value=FakeDownload(self.png())), \
+                mock.patch('conversations.transcode.transcoder.submit', return_value=True) as submit:
+            download_message_media(mensagem.id, 'https://cdn.test/a.jpg', 'image_1.jpg')
+        self.assertEqual(submit.call_args.args[1:], (generate_preview, mensagem.id))
+
+
+@override_settings(MEDIA_UPLOAD_MAX_BYTES=100, MEDIA_UPLOAD_CHUNK_MAX_BYTES=8)
+class ChunkedUploadTests(ConversationTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def iniciar(self, tamanho=10, tipo='document', nome='contrato.pdf'):
+        resposta = self.client.post('/api/messages/uploads/', {
+            'conversation_id': self.conversation.id, 'media_type': tipo, 'filename': nome, 'size': tamanho,
+        }, format='json')
+        self.assertEqual(resposta.status_code, 201, resposta.content)
+        return f"/api/messages/uploads/{resposta.data['id']}/"
+
+    def parte(self, url, offset, dados):
+        return self.client.put(f'{url}?offset={offset}', data=dados, content_type='application/offset+octet-stream')
+
+    def test_envio_retomado_e_concluido(self):
+        from .models import MediaUpload
+        from .uploads import process_upload
+        url = self.iniciar()
+        self.assertEqual(self.parte(url, 0, b'0123').data['offset'], 4)
+        # Parte repetida depois de uma queda: 409 com o offset atual
+        resposta = self.parte(url, 0, b'0123')
+        self.assertEqual((resposta.status_code, resposta['Upload-Offset']), (409, '4'))
+        self.assertEqual(self.client.get(url).data['offset'], 4)
+
+        with mock.patch('conversations.transcode.transcoder.submit', return_value=True) as submit, \
+                self.captureOnCommitCallbacks(execute=True):
+            resposta = self.parte(url, 4, b'456789')
+        self.assertEqual(resposta.data['status'], 'processing')
+        upload = MediaUpload.objects.get()
+        self.assertIn(mock.call(0, process_upload, upload.id), submit.call_args_list)
+
+        mensagem = upload.message
+        self.assertEqual(mensagem.media_blob.sha256, hashlib.sha256(b'0123456789').hexdigest())
+        with open(mensagem.media_blob.path, 'rb') as arquivo:
+            self.assertEqual(arquivo.read(), b'0123456789')
+        self.assertFalse(os.path.exists(upload.part_path))
+
+        with mock.patch('conversations.views.send_media_via_uazapi', return_value=(True, {})) as enviar:
+            process_upload(upload.id)
+        self.assertEqual(enviar.call_args.args[1:3], (mensagem.additional_attributes['local_file_url'], 'document'))
+        upload.refresh_from_db()
+        mensagem.refresh_from_db()
+        self.assertEqual(upload.status, 'sent')
+        self.assertTrue(mensagem.additional_attributes['whatsapp_sent'])
+
+    def test_hash_refeito_sem_estado_em_memoria(self):
+        from . import uploads
+        url = self.iniciar(tamanho=6)
+        self.parte(url, 0, b'abc')
+        uploads._digests.clear()
+        with mock.patch('conversations.transcode.transcoder.submit', return_value=True):
+            self.parte(url, 3, b'def')
+        self.assertEqual(Message.objects.get(message_type='document').media_blob.sha256,
+                         hashlib.sha256(b'abcdef').hexdigest())
+
+    def test_limites(self):
+        from .models import MediaUpload
+        self.assertEqual(self.client.post('/api/messages/uploads/', {
+            'conversation_id': self.conversation.id, 'media_type': 'video', 'filename': 'a.mp4', 'size': 101,
+        }, format='json').status_code, 413)
+
+        url = self.iniciar()
+        self.assertEqual(self.parte(url, 0, b'x' * 9).status_code, 413)
+        self.assertEqual(self.parte(url, 0, b'x' * 8).data['offset'], 8)
+        # Além do tamanho declarado
+        self.assertEqual(self.parte(url, 8, b'xxx').status_code, 413)
+        self.assertEqual(os.path.getsize(MediaUpload.objects.get().part_path), 8)
+
+        outro = User.objects.create_user(username='outro', password='x', user_type='agent')
+        self.client.force_authenticate(outro)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+@override_settings(MEDIA_RETENTION_PAUSE=0, MEDIA_RETENTION_GRACE_MINUTES=0)
+class MediaRetentionTests(ConversationTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        from .models import MediaRetentionPolicy
+        self.policy = MediaRetentionPolicy.objects.create(
+            provedor=self.provedor, retention_days=30, days_by_type={'video': 7}
+        )
+        self.conversation.status = 'closed'
+        self.conversation.save()
+
+    def mensagem(self, conteudo, dias, tipo='image', conversa=None):
+        from .media_store import attach, ingest_chunks
+        conversa = conversa or self.conversation
+        mensagem = Message(conversation=conversa, content='', message_type=tipo, is_from_customer=False)
+        url = attach(mensagem, ingest_chunks([conteudo]), f'{tipo}.bin')
+        mensagem.additional_attributes['file_url'] = url
+        mensagem.save()
+        Message.objects.filter(pk=mensagem.pk).update(created_at=timezone.now() - timedelta(days=dias))
+        return mensagem
+
+    def ciclo(self, **kwargs):
+        from .retention import run_cycle
+        return run_cycle(now=timezone.now() + timedelta(seconds=1), **kwargs)
+
+    def test_expira_por_idade_tipo_e_status(self):
+        aberta = Conversation.objects.create(contact=self.contact, inbox=self.inbox, status='open')
+        antiga = self.mensagem(b'antiga', 40)
+        recente = self.mensagem(b'recente', 10)
+        video = self.mensagem(b'video', 10, tipo='video')
+        em_aberto = self.mensagem(b'aberta', 40, conversa=aberta)
+        compartilhada = self.mensagem(b'recente', 40)
+
+        self.assertEqual(self.ciclo(dry_run=True)['expired'], 3)
+        self.assertEqual(Message.objects.filter(media_blob__isnull=False).count(), 5)
+
+        totais = self.ciclo()
+        self.assertEqual(totais['expired'], 3)
+        self.assertEqual(totais['blobs_deleted'], 2)
+        self.assertEqual(totais['bytes_reclaimed'], len(b'antiga') + len(b'video'))
+
+        for mensagem in (antiga, video, compartilhada):
+            mensagem.refresh_from_db()
+            self.assertIsNone(mensagem.media_blob_id)
+            self.assertEqual(mensagem.additional_attributes['media_status'], 'expired')
+            self.assertIsNone(MessageSerializer(mensagem).data['file_url'])
+        for mensagem in (recente, em_aberto):
+            mensagem.refresh_from_db()
+            self.assertTrue(os.path.exists(mensagem.media_blob.path))
+        # O conteúdo compartilhado continua com a mensagem recente
+        self.assertEqual(recente.media_blob.ref_count, 1)
+        self.assertEqual(MediaBlob.objects.count(), 2)
+
+        # Nada novo no ciclo seguinte
+        self.assertEqual(self.ciclo()['expired'], 0)
+
+    def test_midia_arquivada_mantem_referencia_ate_expirar(self):
+        antiga = self.mensagem(b'antiga', 40)
+        recente = self.mensagem(b'recente', 10)
+        blob_antigo, blob_recente = antiga.media_blob, recente.media_blob
+        archive_conversation(self.conversation)
+        midia = lambda: sum(MessageArchive.objects.values_list('media_count', flat=True))
+        self.assertEqual(midia(), 2)
+        # O arquivamento não libera os blobs
+        for blob in (blob_antigo, blob_recente):
+            blob.refresh_from_db()
+            self.assertEqual(blob.ref_count, 1)
+
+        self.assertEqual(self.ciclo(dry_run=True)['expired'], 1)
+        totais = self.ciclo()
+        self.assertEqual((totais['expired'], totais['blobs_deleted']), (1, 1))
+        self.assertFalse(os.path.exists(blob_antigo.path))
+        self.assertTrue(os.path.exists(blob_recente.path))
+        self.assertEqual(midia(), 1)
+
+        self.conversation.refresh_from_db()
+        page = conversation_messages_page(self.conversation)
+        expirada, mantida = page['results']
+        self.assertIsNone(expirada.media_blob_id)
+        self.assertEqual(expirada.additional_attributes['media_status'], 'expired')
+        self.assertEqual(mantida.media_blob_id, blob_recente.id)
+        self.assertEqual(self.ciclo()['expired'], 0)
+
+        # Excluir a conversa libera a referência que ficou no arquivo
+        self.conversation.delete()
+        blob_recente.refresh_from_db()
+        self.assertEqual(blob_recente.ref_count, 0)
+
+    def test_migracao_religa_midia_arquivada_pelo_sha256(self):
+        from importlib import import_module
+        from django.apps import apps
+        from .archive import archive_rows, encode_rows
+        migration = import_module('conversations.migrations.0023_archive_media')
+
+        mensagem = self.mensagem(b'antiga', 40)
+        archive_conversation(self.conversation)
+        arquivo = MessageArchive.objects.get()
+        # Formato anterior: sem media_blob_id no JSON
+        linhas = [{k: v for k, v in linha.items() if k != 'media_blob_id'} for linha in archive_rows(arquivo)]
+        MessageArchive.objects.filter(pk=arquivo.pk).update(payload=encode_rows(linhas), media_count=0)
+
+        migration.link_archived_media(apps, None)
+        arquivo.refresh_from_db()
+        self.assertEqual(arquivo.media_count, 1)
+        self.assertEqual(archive_rows(arquivo)[0]['media_blob_id'], mensagem.media_blob_id)
+
+    def test_miniatura_de_blob_em_uso_e_mantida(self):
+        from .media_store import ingest_chunks
+        from .models import MediaTranscode
+        mensagem = self.mensagem(b'foto', 1)
+        miniatura = ingest_chunks([b'miniatura'])
+        MediaTranscode.objects.create(source=mensagem.media_blob, format='thumb', output=miniatura)
+        self.assertEqual(self.ciclo()['blobs_deleted'], 0)
+
+        Message.objects.filter(pk=mensagem.pk).update(created_at=timezone.now() - timedelta(days=40))
+        # Original no primeiro lote; sem a origem, a miniatura sai no lote seguinte
+        self.assertEqual(self.ciclo()['blobs_deleted'], 2)
+        self.assertFalse(os.path.exists(miniatura.path))
+
+    def test_envio_abandonado_e_descartado(self):
+        from .models import MediaUpload
+        from .uploads import create_upload
+        upload = create_upload(self.conversation, self.user, 'video.mp4', 'video', 50)
+        with open(upload.part_path, 'wb') as parte:
+            parte.write(b'x' * 20)
+        MediaUpload.objects.filter(pk=upload.pk).update(updated_at=timezone.now() - timedelta(hours=25))
+        totais = self.ciclo()
+        self.assertEqual((totais['uploads_purged'], totais['bytes_reclaimed']), (1, 20))
+        self.assertFalse(os.path.exists(upload.part_path))
+
+    def test_listagem_de_midia_pelo_manifesto(self):
+        self.mensagem(b'arquivo', 1)
+        dados = self.client.get(f'/api/media/test/{self.conversation.id}/').json()
+        self.assertEqual([(f['name'], f['size']) for f in dados['files']], [('image.bin', 7)])
+        self.assertEqual(dados['total_size'], 7)
@@ -0,0 +1,257 @@
+"""
+Conversão de mídia (ffmpeg) fora da requisição
+
+Áudio gravado no painel (WebM) precisa virar MP3 antes de ir para o WhatsApp, e
+áudio recebido que não chegou em MP3 é convertido para tocar no navegador. O
+ffmpeg não roda mais dentro da requisição nem do webhook: os trabalhos entram
+numa fila com prioridade (envio de PTT antes da conversão de áudio recebido),
+atendida por TRANSCODE_WORKERS threads, cada uma com no máximo um processo
+ffmpeg por vez. A fila existe em cada processo web/ASGI; sem TRANSCODE_WORKERS
+os núcleos são divididos entre os WEB_PROCESSES processos da máquina, para que
+o total de ffmpeg simultâneos não passe do número de núcleos.
+
+O resultado fica no armazenamento por conteúdo e em MediaTranscode, indexado
+pelo blob de origem: o mesmo arquivo nunca é convertido duas vezes. Quando a
+conversão termina a mensagem é atualizada e um evento ``chat_message`` é
+emitido na conversa.
+"""
+
+import itertools
+import os
+import queue
+import subprocess
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+
+from core.logging_utils import get_logger
+from .media import notify_message_updated
+from .media_store import attach, ingest_file, temp_path
+from .models import MediaBlob, MediaTranscode, Message
+
+logger = get_logger('media')
+
+# Menor valor sai primeiro da fila
+PRIORITY_OUTBOUND = 0
+PRIORITY_INBOUND = 10
+PRIORITY_PREVIEW = 20
+
+MP3 = 'mp3'
+FFMPEG_ARGS = {
+    MP3: ['-vn', '-acodec', 'libmp3lame', '-ab', '128k'],
+}
+AUDIO_MESSAGE_TYPES = ('audio', 'ptt')
+
+
+class TranscodeError(Exception):
+    pass
+
+
+# Uma conversão por vez para o mesmo conteúdo (as seguintes encontram o cache)
+_stripes = [threading.Lock() for _ in range(64)]
+
+
+def _discard(path):
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+def is_mp3(path):
+    """Verifica pelo cabeçalho (ID3 ou sincronismo de quadro MPEG)"""
+    with open(path, 'rb') as source:
+        header = source.read(3)
+    return header == b'ID3' or (len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0)
+
+
+def _release(output):
+    """Descarta o blob recém-gravado de uma conversão que não entrou no cache, se ninguém o usa"""
+    if output.deduplicated:
+        return
+    in_use = MediaTranscode.objects.values('output_id')
+    removed, _ = MediaBlob.objects.filter(
+        pk=output.pk, ref_count=0, messages__isnull=True, transcodes__isnull=True,
+    ).exclude(pk__in=in_use).delete()
+    if removed:
+        _discard(output.path)
+
+
+def cached_output(blob, fmt):
+    """Conversão já feita de ``blob`` para ``fmt`` ou None"""
+    transcode = MediaTranscode.objects.filter(source=blob, format=fmt).select_related('output').first()
+    if transcode and os.path.exists(transcode.output.path):
+        return transcode.output
+    return None
+
+
+def run_ffmpeg(source_path, fmt, timeout=None):
+    """Converte ``source_path`` para ``fmt`` e devolve o caminho do temporário gerado"""
+    output_path = temp_path(f'.{fmt}')
+    timeout = timeout or getattr(settings, 'TRANSCODE_TIMEOUT', 120)
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', source_path, *FFMPEG_ARGS[fmt], output_path],
+            capture_output=True, text=True, timeout=timeout,
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        _discard(output_path)
+        raise TranscodeError(str(e)) from e
+    if result.returncode != 0:
+        _discard(output_path)
+        raise TranscodeError(result.stderr.strip()[-500:])
+    return output_path
+
+
+def transcode(blob, fmt, convert=None):
+    """
+    MediaBlob de ``blob`` convertido para ``fmt``; a conversão (ffmpeg, ou
+    ``convert(caminho)`` que devolve o temporário gerado) só roda se não houver no cache
+    """
+    convert = convert or (lambda path: run_ffmpeg(path, fmt))
+    with _stripes[int(blob.sha256[:8], 16) % len(_stripes)]:
+        output = cached_output(blob, fmt)
+        if output is not None:
+            return output
+        output = ingest_file(convert(blob.path))
+        try:
+            with transaction.atomic():
+                MediaTranscode.objects.update_or_create(source=blob, format=fmt, defaults={'output': output})
+        except DatabaseError as e:
+            try:
+                _release(output)
+            except DatabaseError as release_error:
+                # Sem referências, o blob é removido pela retenção depois da carência
+                logger.warning("Erro ao descartar a conversão do blob %s: %s", output.pk, release_error)
+            raise TranscodeError(str(e)) from e
+        return output
+
+
+def default_workers():
+    """TRANSCODE_WORKERS ou a parte dos núcleos que cabe a cada processo web (ao menos 1)"""
+    workers = getattr(settings, 'TRANSCODE_WORKERS', 0)
+    if workers:
+        return workers
+    processes = max(getattr(settings, 'WEB_PROCESSES', 1), 1)
+    return max((os.cpu_count() or 1) // processes, 1)
+
+
+class Transcoder:
+    """Fila com prioridade atendida por ``workers`` threads; até ``queue_size`` trabalhos em espera"""
+
+    def __init__(self, workers=None, queue_size=None):
+        self.workers = workers or default_workers()
+        queue_size = queue_size if queue_size is not None else getattr(settings, 'TRANSCODE_QUEUE_SIZE', 100)
+        self._queue = queue.PriorityQueue(maxsize=queue_size)
+        # Desempate: mesma prioridade, ordem de chegada
+        self._counter = itertools.count()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'transcode-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            _, _, func, args = self._queue.get()
+            try:
+                func(*args)
+            except Exception as e:
+                logger.warning("Erro na conversão de mídia: %s", e)
+            finally:
+                close_old_connections()
+                self._queue.task_done()
+
+    def submit(self, priority, func, *args):
+        """Agenda ``func(*args)``; False se a fila estiver cheia"""
+        self._start()
+        try:
+            self._queue.put_nowait((priority, next(self._counter), func, args))
+        except queue.Full:
+            return False
+        return True
+
+    def join(self):
+        """Espera a fila esvaziar"""
+        self._queue.join()
+
+
+transcoder = Transcoder()
+
+
+def _mp3_name(message):
+    stem = os.path.splitext(message.additional_attributes.get('file_name') or f'audio_{message.id}')[0]
+    return f'{stem}.mp3'
+
+
+def transcode_outbound_ptt(message_id, caption=None):
+    """Converte o áudio gravado no painel para MP3 e então envia ao WhatsApp"""
+    from .views import send_media_via_uazapi
+
+    message = Message.objects.select_related('conversation__inbox__provedor', 'media_blob').filter(
+        id=message_id
+    ).first()
+    if message is None or message.media_blob is None:
+        return None
+    try:
+        attach(message, transcode(message.media_blob, MP3), _mp3_name(message))
+    except TranscodeError as e:
+        # Sem conversão o arquivo original é enviado, como antes
+        logger.warning("Erro ao converter áudio da mensagem %s para MP3: %s", message_id, e)
+    file_url = message.additional_attributes['local_file_url']
+    success, response = send_media_via_uazapi(message.conversation, file_url, 'ptt', caption)
+    if not success:
+        logger.warning("Erro ao enviar áudio da mensagem %s: %s", message_id, response)
+    message.additional_attributes.update(file_url=file_url, media_status='ready', whatsapp_sent=success)
+    message.save(update_fields=['additional_attributes', 'updated_at'])
+    notify_message_updated(message)
+    return success
+
+
+def transcode_inbound_audio(message_id):
+    """Converte para MP3 o áudio recebido em outro formato"""
+    message = Message.objects.select_related('media_blob').filter(id=message_id).first()
+    if message is None or message.media_blob is None:
+        return None
+    try:
+        attach(message, transcode(message.media_blob, MP3), _mp3_name(message))
+    except TranscodeError as e:
+        # O arquivo original continua disponível
+        logger.warning("Erro ao converter áudio da mensagem %s para MP3: %s", message_id, e)
+    message.additional_attributes['media_status'] = 'ready'
+    message.save(update_fields=['additional_attributes', 'updated_at'])
+    notify_message_updated(message)
+    return message
+
+
+def needs_mp3(message, blob):
+    """Áudio recebido que não está em MP3"""
+    return message.message_type in AUDIO_MESSAGE_TYPES and not is_mp3(blob.path)
+
+
+def schedule_outbound_ptt(message, caption=None):
+    """
+    Agenda conversão e envio do PTT assim que a transação confirmar; com a fila
+    cheia roda na hora, para o áudio não ficar sem envio
+    """
+    def submit():
+        if not transcoder.submit(PRIORITY_OUTBOUND, transcode_outbound_ptt, message.id, caption):
+            logger.warning("Fila de conversão cheia, convertendo áudio da mensagem %s na requisição", message.id)
+            transcode_outbound_ptt(message.id, caption)
+
+    transaction.on_commit(submit)
+
+
+def schedule_inbound_audio(message):
+    """Agenda a conversão do áudio recebido; com a fila cheia mantém o original"""
+    if transcoder.submit(PRIORITY_INBOUND, transcode_inbound_audio, message.id):
+        return True
+    logger.warning("Fila de conversão cheia, áudio da mensagem %s mantido no formato original", message.id)
+    message.additional_attributes['media_status'] = 'ready'
+    message.save(update_fields=['additional_attributes', 'updated_at'])
+    return False
@@ -0,0 +1,218 @@
+"""
+Envio de mídia em partes, com retomada
+
+O painel cria o envio (POST /api/messages/uploads/ com nome, tipo e tamanho) e
+manda o arquivo em partes com PUT /api/messages/uploads/<id>/?offset=N. Cada
+parte é gravada direto no arquivo parcial, na posição informada; se a conexão
+cair, GET no mesmo endereço devolve o offset já recebido e o envio continua
+dali. Um offset diferente do esperado é recusado com 409 (e o offset atual).
+
+O SHA-256 é calculado enquanto as partes chegam, então ao receber o último byte
+o arquivo parcial é só renomeado para o armazenamento por conteúdo, sem
+releitura. A conversão (PTT) e o envio ao WhatsApp rodam na fila de conversões
+(conversations.transcode); o andamento é publicado na conversa como eventos
+``upload_progress`` e a mensagem, quando pronta, como ``chat_message``.
+"""
+
+import hashlib
+import os
+import threading
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from core.logging_utils import get_logger
+from .media import CHUNK_SIZE, notify_message_updated
+from .media_store import attach, file_digest, ingest_hashed
+from .models import MediaUpload, Message
+from .previews import schedule_preview
+from .transcode import PRIORITY_OUTBOUND, transcode_outbound_ptt, transcoder
+
+logger = get_logger('media')
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+# SHA-256 parcial por envio: (offset, hash) do que já foi gravado. Se o
+# processo reiniciar no meio do envio o hash é refeito a partir do arquivo.
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def _max_bytes():
+    return getattr(settings, 'MEDIA_UPLOAD_MAX_BYTES', 200 * 1024 * 1024)
+
+
+def upload_data(upload):
+    return {
+        'id': str(upload.id),
+        'conversation_id': upload.conversation_id,
+        'filename': upload.filename,
+        'media_type': upload.media_type,
+        'size': upload.size,
+        'offset': upload.offset,
+        'status': upload.status,
+        'message_id': upload.message_id,
+    }
+
+
+def notify_progress(upload):
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            f'conversation_{upload.conversation_id}',
+            {'type': 'upload_progress', 'upload': upload_data(upload), 'timestamp': timezone.now().isoformat()}
+        )
+    except Exception as e:
+        logger.warning("Erro ao notificar andamento do envio %s: %s", upload.id, e)
+
+
+def create_upload(conversation, user, filename, media_type, size, caption=''):
+    filename = os.path.basename(str(filename or '').replace('\\', '/')).strip()
+    if not filename or filename.startswith('.'):
+        raise UploadError('Nome de arquivo inválido')
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError('size deve ser um número')
+    if size <= 0 or size > _max_bytes():
+        raise UploadError(f'size deve estar entre 1 e {_max_bytes()} bytes', status=413)
+
+    upload = MediaUpload.objects.create(
+        conversation=conversation,
+        created_by=user if getattr(user, 'is_authenticated', False) else None,
+        filename=filename,
+        media_type=media_type,
+        caption=caption or '',
+        size=size,
+    )
+    os.makedirs(os.path.dirname(upload.part_path), exist_ok=True)
+    open(upload.part_path, 'wb').close()
+    with _digests_lock:
+        _digests[upload.id] = (0, hashlib.sha256())
+    return upload
+
+
+def write_chunk(upload, offset, stream):
+    """Grava a parte que começa em ``offset``; conclui o envio no último byte"""
+    if upload.status != 'uploading':
+        raise UploadError('Envio já concluído', status=409, offset=upload.offset)
+    if offset != upload.offset:
+        raise UploadError('Offset diferente do esperado', status=409, offset=upload.offset)
+
+    with _digests_lock:
+        known_offset, digest = _digests.get(upload.id, (None, None))
+    digest = digest.copy() if known_offset == offset else None
+    max_chunk = getattr(settings, 'MEDIA_UPLOAD_CHUNK_MAX_BYTES', 8 * 1024 * 1024)
+    written = 0
+    with open(upload.part_path, 'r+b') as part:
+        part.seek(offset)
+        try:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b'') if stream else ():
+                written += len(chunk)
+                if written > max_chunk or offset + written > upload.size:
+                    raise UploadError('Parte maior que o permitido', status=413, offset=offset)
+                if digest is not None:
+                    digest.update(chunk)
+                part.write(chunk)
+        except BaseException:
+            # Descarta a parte incompleta
+            part.truncate(offset)
+            raise
+        part.truncate(offset + written)
+
+    new_offset = offset + written
+    updated = MediaUpload.objects.filter(pk=upload.pk, offset=offset, status='uploading').update(
+        offset=new_offset, updated_at=timezone.now()
+    )
+    if not updated:
+        upload.refresh_from_db()
+        raise UploadError('Envio alterado por outra requisição', status=409, offset=upload.offset)
+    with _digests_lock:
+        if digest is not None:
+            _digests[upload.id] = (new_offset, digest)
+        else:
+            _digests.pop(upload.id, None)
+    upload.offset = new_offset
+
+    if new_offset == upload.size:
+        complete_upload(upload)
+    else:
+        notify_progress(upload)
+    return upload
+
+
+def _message_content(upload):
+    if upload.caption:
+        return upload.caption
+    # PTT (mensagem de voz) não usa o nome do arquivo, como no send_media
+    return 'Mensagem de voz' if upload.media_type == 'ptt' else f'Arquivo: {upload.filename}'
+
+
+def complete_upload(upload):
+    """Move o arquivo para o armazenamento, cria a mensagem e agenda conversão e envio"""
+    with _digests_lock:
+        known_offset, digest = _digests.pop(upload.id, (None, None))
+    if digest is not None and known_offset == upload.size:
+        sha256 = digest.hexdigest()
+    else:
+        sha256, _ = file_digest(upload.part_path)
+    blob = ingest_hashed(upload.part_path, upload.size, sha256)
+
+    with transaction.atomic():
+        message = Message(
+            conversation=upload.conversation,
+            content=_message_content(upload),
+            message_type=upload.media_type,
+            is_from_customer=False,
+        )
+        file_url = attach(message, blob, upload.filename)
+        message.additional_attributes.update(file_url=file_url, media_status='processing', upload_id=str(upload.id))
+        message.save()
+        upload.message = message
+        upload.status = 'processing'
+        upload.save(update_fields=['message', 'status', 'updated_at'])
+        transaction.on_commit(lambda: _submit(upload, message))
+    notify_message_updated(message)
+    notify_progress(upload)
+    return message
+
+
+def _submit(upload, message):
+    schedule_preview(message)
+    if not transcoder.submit(PRIORITY_OUTBOUND, process_upload, upload.id):
+        logger.warning("Fila de conversão cheia, enviando a mídia do upload %s na requisição", upload.id)
+        process_upload(upload.id)
+
+
+def process_upload(upload_id):
+    """Converte (PTT gravado em WebM) e envia ao WhatsApp a mídia de um envio concluído"""
+    from .views import send_media_via_uazapi
+
+    upload = MediaUpload.objects.select_related('conversation__inbox__provedor', 'message').filter(
+        pk=upload_id
+    ).first()
+    if upload is None or upload.message is None:
+        return None
+    message = upload.message
+    if upload.media_type == 'ptt' and upload.filename.lower().endswith('.webm'):
+        success = transcode_outbound_ptt(message.id, upload.caption)
+    else:
+        file_url = message.additional_attributes['local_file_url']
+        success, response = send_media_via_uazapi(upload.conversation, file_url, upload.media_type, upload.caption)
+        if not success:
+            logger.warning("Erro ao enviar mídia do upload %s: %s", upload_id, response)
+        message.additional_attributes.update(media_status='ready', whatsapp_sent=success)
+        message.save(update_fields=['additional_attributes', 'updated_at'])
+        notify_message_updated(message)
+    upload.status = 'sent' if success else 'failed'
+    upload.save(update_fields=['status', 'updated_at'])
+    notify_progress(upload)
+    return success
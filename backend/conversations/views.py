@@ -1,12 +1,14 @@
 from rest_framework import viewsets, permissions, status, serializers
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F, Q
 from core.models import Provedor, User, AuditLog
-from .models import Contact, Inbox, Conversation, Message, Team, TeamMember
+from .models import Contact, Inbox, Conversation, MediaUpload, Message, MessagePayload, Team, TeamMember
 from .serializers import (
     ContactSerializer, InboxSerializer, ConversationSerializer,
-    ConversationListSerializer, ConversationUpdateSerializer, MessageSerializer, TeamSerializer, TeamMemberSerializer
+    ConversationListSerializer, ConversationUpdateSerializer, MessageSerializer, TeamSerializer, TeamMemberSerializer,
+    prefetch_conversation_list
 )
 from rest_framework.permissions import AllowAny
 from integrations.models import WhatsAppIntegration
@@ -15,11 +17,24 @@ from asgiref.sync import async_to_sync
 import requests
 import json
 import base64
-from django.http import FileResponse, Http404, JsonResponse
+from django.http import Http404, JsonResponse
 from django.conf import settings
 from django.utils import timezone
 import os
+import time
 from datetime import datetime
+from core.logging_utils import get_logger, log_payload
+from core.media_serving import serve_file
+from .archive import conversation_messages_page, messages_for_conversation
+from .media import local_media_path, stream_download
+from .media_store import attach, ingest_chunks
+from .media_store import resolve as resolve_media
+from .pagination import InvalidCursor
+from .previews import schedule_preview
+from .transcode import MP3, cached_output, schedule_outbound_ptt
+from .uploads import UploadError, create_upload, upload_data, write_chunk
+
+logger = get_logger('messages')
 
 
 class ContactViewSet(viewsets.ModelViewSet):
@@ -88,6 +103,12 @@ class ConversationViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
     
     def get_queryset(self):
+        queryset = self._conversas_visiveis()
+        if self.action == 'list':
+            queryset = prefetch_conversation_list(queryset).order_by('-last_message_at', '-id')
+        return queryset
+    
+    def _conversas_visiveis(self):
         user = self.request.user
         
         # Superadmin vê todas as conversas
@@ -128,7 +149,7 @@ class ConversationViewSet(viewsets.ModelViewSet):
             if 'view_ai_conversations' in user_permissions:
                 # Pode ver conversas com IA (identificadas por algum campo ou atributo)
                 ai_conversations = base_queryset.filter(
-                    additional_attributes__has_key='ai_assisted'
+                    ai_assisted=True
                 )
             else:
                 # Não pode ver conversas com IA
@@ -216,42 +237,38 @@ class ConversationViewSet(viewsets.ModelViewSet):
             return Response({'error': 'Provedor não encontrado'}, status=404)
         
         # Verificar permissão
-        if user.user_type != 'superadmin' and provedor not in Provedor.objects.filter(admins=user):
+        if user.user_type != 'superadmin' and not Provedor.objects.filter(id=provedor.id, admins=user).exists():
             return Response({'error': 'Sem permissão'}, status=403)
         
         # Buscar conversas do provedor
         conversations = Conversation.objects.filter(inbox__provedor=provedor)
         
-        # Calcular estatísticas
-        total_conversations = conversations.count()
-        recovered_conversations = conversations.filter(
-            additional_attributes__recovery_status='recovered'
-        ).count()
-        pending_recoveries = conversations.filter(
-            additional_attributes__recovery_status='pending'
-        ).count()
+        # Contagens e tempo médio de resposta numa única query, sobre as
+        # colunas recovery_status/recovery_*_at (cópias de additional_attributes)
+        respondidas = Q(
+            recovery_status='recovered',
+            recovery_last_attempt_at__isnull=False,
+            recovery_response_at__isnull=False,
+        )
+        stats = conversations.aggregate(
+            total=Count('id'),
+            recovered=Count('id', filter=Q(recovery_status='recovered')),
+            pending=Count('id', filter=Q(recovery_status='pending')),
+            avg_response=Avg(
+                ExpressionWrapper(
+                    F('recovery_response_at') - F('recovery_last_attempt_at'), output_field=DurationField()
+                ),
+                filter=respondidas,
+            ),
+        )
+        total_conversations = stats['total']
+        recovered_conversations = stats['recovered']
+        pending_recoveries = stats['pending']
         
         conversion_rate = (recovered_conversations / total_conversations * 100) if total_conversations > 0 else 0
         
-        # Calcular tempo médio de resposta (real)
-        # Exemplo: calcular diferença entre lastAttempt e response_received_at das conversas recuperadas
-        response_times = []
-        for conv in conversations.filter(additional_attributes__recovery_status='recovered'):
-            last_attempt = conv.additional_attributes.get('recovery_last_attempt')
-            response_time = conv.additional_attributes.get('recovery_response_time')
-            if last_attempt and response_time:
-                try:
-                    from datetime import datetime
-                    fmt = '%Y-%m-%dT%H:%M:%S' if 'T' in last_attempt else '%Y-%m-%d %H:%M:%S'
-                    t1 = datetime.strptime(last_attempt[:19], fmt)
-                    t2 = datetime.strptime(response_time[:19], fmt)
-                    diff = (t2 - t1).total_seconds()
-                    response_times.append(diff)
-                except Exception:
-                    pass
-        if response_times:
-            avg_seconds = sum(response_times) / len(response_times)
-            avg_min = int(avg_seconds // 60)
+        if stats['avg_response'] is not None:
+            avg_min = int(stats['avg_response'].total_seconds() // 60)
             avg_h = avg_min // 60
             avg_min = avg_min % 60
             average_response_time = f"{avg_h}h {avg_min}min" if avg_h else f"{avg_min}min"
@@ -260,7 +277,7 @@ class ConversationViewSet(viewsets.ModelViewSet):
         
         # Buscar conversas em recuperação
         recovery_conversations = conversations.filter(
-            additional_attributes__recovery_status__in=['pending', 'recovered']
+            recovery_status__in=['pending', 'recovered']
         ).select_related('contact')[:10]
         
         recovery_data = []
@@ -272,7 +289,7 @@ class ConversationViewSet(viewsets.ModelViewSet):
                     'phone': conv.contact.phone
                 },
                 'lastMessage': conv.additional_attributes.get('recovery_last_message', ''),
-                'status': conv.additional_attributes.get('recovery_status', 'pending'),
+                'status': conv.recovery_status or 'pending',
                 'attempts': conv.additional_attributes.get('recovery_attempts', 0),
                 'lastAttempt': conv.additional_attributes.get('recovery_last_attempt'),
                 'potentialValue': conv.additional_attributes.get('recovery_potential_value', 0)
@@ -320,6 +337,37 @@ class ConversationViewSet(viewsets.ModelViewSet):
         # Por enquanto, apenas retorna sucesso
         return Response({'message': 'Configurações salvas com sucesso'})
 
+    @action(detail=True, methods=['get'], url_path='messages')
+    def messages_page(self, request, pk=None):
+        """
+        Mensagens da conversa com paginação keyset por (created_at, id).
+        ?before=<cursor> carrega as anteriores, ?after=<cursor> as posteriores,
+        ?limit=N define o tamanho da página.
+        """
+        conversation = self.get_object()
+        try:
+            page = conversation_messages_page(
+                conversation,
+                before=request.query_params.get('before'),
+                after=request.query_params.get('after'),
+                limit=request.query_params.get('limit'),
+            )
+        except InvalidCursor as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'results': MessageSerializer(page['results'], many=True).data,
+            'has_more': page['has_more'],
+            'before': page['before'],
+            'after': page['after'],
+        })
+
+    @action(detail=True, methods=['post'], url_path='mark-read')
+    def mark_read(self, request, pk=None):
+        """Zera o contador de mensagens não lidas da conversa"""
+        conversation = self.get_object()
+        conversation.mark_read()
+        return Response({'success': True, 'unread_count': 0})
+
     @action(detail=True, methods=['post'])
     def transfer(self, request, pk=None):
         conversation = self.get_object()
@@ -408,32 +456,30 @@ def send_media_via_uazapi(conversation, file_url, media_type, caption):
                 # Converter URL para base64 se necessário
                 file_base64 = None
                 
-                # Se file_url é uma URL local, ler o arquivo e converter para base64
-                if file_url.startswith('/api/media/'):
-                    # Construir caminho completo do arquivo
-                    file_path = file_url.replace('/api/media/messages/', '')
-                    conversation_id, filename = file_path.split('/', 1)
-                    full_path = os.path.join(settings.MEDIA_ROOT, 'messages', conversation_id, filename)
-                    
-                    if os.path.exists(full_path):
-                        with open(full_path, 'rb') as f:
-                            file_data = f.read()
-                            file_base64 = base64.b64encode(file_data).decode('utf-8')
-                    else:
-                        return False, f"Arquivo não encontrado: {full_path}"
+                # Mídia nossa (URL relativa ou absoluta): ler do disco
+                local_path = local_media_path(file_url)
+                if local_path:
+                    if not os.path.exists(local_path):
+                        return False, f"Arquivo não encontrado: {local_path}"
+                    with open(local_path, 'rb') as f:
+                        file_base64 = base64.b64encode(f.read()).decode('utf-8')
                 elif file_url.startswith('data:'):
                     # Já é base64
                     file_base64 = file_url
                 else:
-                    # URL externa, tentar baixar
+                    # URL externa: baixar em streaming para um temporário, com limite de tamanho
+                    tmp_path = os.path.join(
+                        settings.MEDIA_ROOT, 'tmp', f'send_{conversation.id}_{int(time.time() * 1000)}'
+                    )
                     try:
-                        response = requests.get(file_url, timeout=30)
-                        if response.status_code == 200:
-                            file_base64 = base64.b64encode(response.content).decode('utf-8')
-                        else:
-                            return False, f"Erro ao baixar arquivo: {response.status_code}"
+                        stream_download(file_url, tmp_path)
+                        with open(tmp_path, 'rb') as f:
+                            file_base64 = base64.b64encode(f.read()).decode('utf-8')
                     except Exception as e:
                         return False, f"Erro ao baixar arquivo: {str(e)}"
+                    finally:
+                        if os.path.exists(tmp_path):
+                            os.unlink(tmp_path)
                 
                 # Formato correto da API Uazapi para mídia
                 payload = {
@@ -453,20 +499,20 @@ def send_media_via_uazapi(conversation, file_url, media_type, caption):
                     timeout=30  # Timeout maior para upload de mídia
                 )
                 
-                print(f"DEBUG: Status code = {response.status_code}")
-                print(f"DEBUG: Response = {response.text}")
+                logger.debug("Status code = %s", response.status_code)
+                log_payload(logger, "Response", response.text)
                 
                 if response.status_code == 200:
                     send_result = response.json() if response.content else response.status_code
                     success = True
-                    print(f"DEBUG: Mídia enviada com sucesso para {chatid}")
+                    logger.debug("Mídia enviada com sucesso para %s", chatid)
                 else:
-                    print(f"DEBUG: Erro na API Uazapi - Status: {response.status_code}, Response: {response.text}")
+                    logger.warning("Erro na API Uazapi - Status: %s, Response: %s", response.status_code, response.text)
                     
             except Exception as e:
-                print(f' DEBUG: Erro ao enviar mídia para {chatid}: {e}')
+                logger.warning('Erro ao enviar mídia para %s: %s', chatid, e)
         else:
-            print(f"DEBUG: Nenhum chatid encontrado para envio")
+            logger.debug("Nenhum chatid encontrado para envio")
         
         if success:
             return True, f"Mídia enviada com sucesso: {send_result}"
@@ -474,7 +520,7 @@ def send_media_via_uazapi(conversation, file_url, media_type, caption):
             return False, f"Erro na Uazapi: Falha ao enviar mídia para chatid"
             
     except Exception as e:
-        print(f"DEBUG: Erro geral: {e}")
+        logger.warning("Erro geral: %s", e)
         return False, f"Erro ao enviar mídia via Uazapi: {str(e)}"
 
 
@@ -515,8 +561,7 @@ def send_via_uazapi(conversation, content, message_type, instance, reply_to_mess
         if uazapi_url and not uazapi_url.endswith('/send/text'):
             uazapi_url = uazapi_url.rstrip('/') + '/send/text'
         
-        print(f"DEBUG: Token final: {uazapi_token[:10] if uazapi_token else 'None'}...")
-        print(f"DEBUG: URL final: {uazapi_url}")
+        logger.debug("URL final: %s", uazapi_url)
         
         # Obter número do contato (mesma lógica da IA)
         contact = conversation.contact
@@ -548,7 +593,7 @@ def send_via_uazapi(conversation, content, message_type, instance, reply_to_mess
                 # Adicionar informações de resposta se existir
                 if reply_to_message_id:
                     # Formato correto para Uazapi - usar replyid conforme documentação
-                    print(f"DEBUG: Tentando enviar resposta com replyid: {reply_to_message_id}")
+                    logger.debug("Tentando enviar resposta com replyid: %s", reply_to_message_id)
                     
                     # Formato correto para Uazapi - usar apenas o ID da mensagem
                     if isinstance(reply_to_message_id, str):
@@ -556,27 +601,22 @@ def send_via_uazapi(conversation, content, message_type, instance, reply_to_mess
                         if ':' in reply_to_message_id:
                             short_id = reply_to_message_id.split(':', 1)[1]
                             payload['replyid'] = short_id
-                            print(f"DEBUG: Usando short_id para replyid: {short_id}")
+                            logger.debug("Usando short_id para replyid: %s", short_id)
                         else:
                             payload['replyid'] = reply_to_message_id
-                            print(f"DEBUG: Usando ID completo para replyid: {reply_to_message_id}")
+                            logger.debug("Usando ID completo para replyid: %s", reply_to_message_id)
                     
                     # Log do payload completo para debug
-                    print(f"DEBUG: Payload completo: {payload}")
-                    
-                    # Log adicional para debug do formato
-                    print(f"DEBUG: Tipo do reply_to_message_id: {type(reply_to_message_id)}")
-                    print(f"DEBUG: Valor do reply_to_message_id: {repr(reply_to_message_id)}")
+                    log_payload(logger, "Payload completo", payload)
                     
                     # Tentar formato alternativo se o primeiro falhar
                     # Algumas APIs esperam um objeto com mais informações
                     if isinstance(reply_to_message_id, str) and ':' in reply_to_message_id:
                         # Se o ID contém ":", pode ser necessário apenas a parte após ":"
                         short_id = reply_to_message_id.split(':', 1)[1]
-                        print(f"DEBUG: Tentando formato alternativo com short_id: {short_id}")
+                        logger.debug("Tentando formato alternativo com short_id: %s", short_id)
                         # Não alterar o payload ainda, apenas log para debug
-                print(f"DEBUG: Enviando para URL: {uazapi_url}")
-                print(f"DEBUG: Token: {uazapi_token[:10] if uazapi_token else 'None'}...")
+                logger.debug("Enviando para URL: %s", uazapi_url)
                 
                 response = requests.post(
                     uazapi_url,
@@ -585,16 +625,16 @@ def send_via_uazapi(conversation, content, message_type, instance, reply_to_mess
                     timeout=10
                 )
                 
-                print(f"DEBUG: Status code: {response.status_code}")
-                print(f"DEBUG: Response text: {response.text}")
+                logger.debug("Status code: %s", response.status_code)
+                log_payload(logger, "Response text", response.text)
                 
                 if response.status_code == 200:
                     send_result = response.json() if response.content else response.status_code
                     success = True
-                    print(f"DEBUG: Mensagem enviada com sucesso: {send_result}")
+                    log_payload(logger, "Mensagem enviada com sucesso", send_result)
                 else:
                     send_result = f"Erro na API Uazapi: {response.status_code} - {response.text}"
-                    print(f"DEBUG: Erro ao enviar mensagem: {send_result}")
+                    logger.warning("Erro ao enviar mensagem: %s", send_result)
             except Exception as e:
                 send_result = f"Erro ao enviar: {str(e)}"
         else:
@@ -646,13 +686,11 @@ def send_presence_via_uazapi(conversation, presence_type):
         if uazapi_url and not uazapi_url.endswith('/message/presence'):
             uazapi_url = uazapi_url.rstrip('/') + '/message/presence'
         
-        print(f"DEBUG: URL da Uazapi para presença: {uazapi_url}")
-        print(f"DEBUG: Token da Uazapi: {uazapi_token[:10] if uazapi_token else 'None'}...")
-        print(f"DEBUG: sender_lid: {sender_lid}")
-        print(f"DEBUG: chatid: {chatid}")
-        print(f"DEBUG: URL base original: {whatsapp_integration.webhook_url if whatsapp_integration else 'None'}")
-        print(f"DEBUG: Provedor: {provedor.nome if provedor else 'None'}")
-        print(f"DEBUG: Integrações externas: {provedor.integracoes_externas if provedor else 'None'}")
+        logger.debug("URL da Uazapi para presença: %s", uazapi_url)
+        logger.debug("sender_lid: %s", sender_lid)
+        logger.debug("chatid: %s", chatid)
+        logger.debug("URL base original: %s", whatsapp_integration.webhook_url if whatsapp_integration else 'None')
+        logger.debug("Provedor: %s", provedor.nome if provedor else 'None')
         
         # Obter número do contato (mesma lógica da IA)
         contact = conversation.contact
@@ -685,12 +723,12 @@ def send_presence_via_uazapi(conversation, presence_type):
                 if response.status_code == 200:
                     send_result = response.json() if response.content else response.status_code
                     success = True
-                    print(f"DEBUG: Presença enviada com sucesso para {destino}: {presence_type}")
+                    logger.debug("Presença enviada com sucesso para %s: %s", destino, presence_type)
                     break
                 else:
-                    print(f"DEBUG: Erro na API Uazapi (presença) - Status: {response.status_code}, Response: {response.text}")
+                    logger.warning("Erro na API Uazapi (presença) - Status: %s, Response: %s", response.status_code, response.text)
             except Exception as e:
-                print(f'[ERRO] Erro ao enviar presença para {destino}: {e}')
+                logger.warning('Erro ao enviar presença para %s: %s', destino, e)
                 continue
         
         if success:
@@ -749,7 +787,7 @@ class MessageViewSet(viewsets.ModelViewSet):
                     if 'view_ai_conversations' in user_permissions:
                         # Pode ver mensagens de conversas com IA
                         ai_messages = base_queryset.filter(
-                            conversation__additional_attributes__has_key='ai_assisted'
+                            conversation__ai_assisted=True
                         )
                     else:
                         ai_messages = Message.objects.none()
@@ -773,12 +811,31 @@ class MessageViewSet(viewsets.ModelViewSet):
                     if not user_permissions:
                         queryset = base_queryset.filter(conversation__assignee=user)
         
-        # Ordenar por data de criação (mais antigas primeiro)
-        return queryset.order_by('created_at')
+        # Ordenar por data de criação (mais antigas primeiro); id desempata
+        return queryset.order_by('created_at', 'id')
+    
+    def list(self, request, *args, **kwargs):
+        conversation_id = request.query_params.get('conversation')
+        conversation = Conversation.objects.filter(id=conversation_id, has_archive=True).first() if conversation_id else None
+        if not conversation:
+            return super().list(request, *args, **kwargs)
+        # Conversa com mensagens arquivadas: pagina sobre arquivo + tabela quente
+        messages = messages_for_conversation(conversation, self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(messages)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        return Response(self.get_serializer(messages, many=True).data)
     
     def perform_create(self, serializer):
         serializer.save(is_from_customer=False)
 
+    @action(detail=True, methods=['get'], url_path='raw')
+    def raw_payload(self, request, pk=None):
+        """Payload bruto do provedor, carregado apenas quando solicitado"""
+        message = self.get_object()
+        payload = MessagePayload.objects.filter(message=message).first()
+        return Response({'id': message.id, 'data': payload.data if payload else {}})
+
     @action(detail=False, methods=['post'])
     def send_text(self, request):
         """Enviar mensagem de texto"""
@@ -830,7 +887,7 @@ class MessageViewSet(viewsets.ModelViewSet):
                         match = re.search(pattern, whatsapp_response)
                         if match:
                             external_id = match.group(1)
-                            print(f"DEBUG: External ID extraído: {external_id}")
+                            logger.debug("External ID extraído: %s", external_id)
                             
                             # Atualizar a mensagem com o external_id
                             additional_attrs = message.additional_attributes or {}
@@ -840,10 +897,10 @@ class MessageViewSet(viewsets.ModelViewSet):
                             message.additional_attributes = additional_attrs
                             message.save()
                             
-                            print(f"DEBUG: External ID salvo na mensagem: {external_id}")
+                            logger.debug("External ID salvo na mensagem: %s", external_id)
                             break
                     else:
-                        print(f"DEBUG: Não foi possível extrair external_id da resposta")
+                        logger.debug("Não foi possível extrair external_id da resposta")
                         # Salvar apenas a resposta do WhatsApp
                         additional_attrs = message.additional_attributes or {}
                         additional_attrs['whatsapp_sent'] = success
@@ -852,7 +909,7 @@ class MessageViewSet(viewsets.ModelViewSet):
                         message.save()
                         
                 except Exception as e:
-                    print(f"DEBUG: Erro ao extrair external_id: {e}")
+                    logger.warning("Erro ao extrair external_id: %s", e)
                     # Salvar apenas a resposta do WhatsApp
                     additional_attrs = message.additional_attributes or {}
                     additional_attrs['whatsapp_sent'] = success
@@ -887,23 +944,74 @@ class MessageViewSet(viewsets.ModelViewSet):
         except Conversation.DoesNotExist:
             return Response({'error': 'Conversa não encontrada'}, status=status.HTTP_404_NOT_FOUND)
 
+    @action(detail=False, methods=['post'], url_path='uploads')
+    def create_upload(self, request):
+        """Iniciar envio de mídia em partes (conversations/uploads.py)"""
+        conversation_id = request.data.get('conversation_id')
+        media_type = request.data.get('media_type')
+        filename = request.data.get('filename')
+        size = request.data.get('size')
+        
+        if not conversation_id or not media_type or not filename or not size:
+            return Response(
+                {'error': 'conversation_id, media_type, filename e size são obrigatórios'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            conversation = Conversation.objects.get(id=conversation_id)
+        except Conversation.DoesNotExist:
+            return Response({'error': 'Conversa não encontrada'}, status=status.HTTP_404_NOT_FOUND)
+        
+        try:
+            upload = create_upload(
+                conversation, request.user, filename, media_type, size, request.data.get('caption', '')
+            )
+        except UploadError as e:
+            return Response({'error': str(e)}, status=e.status)
+        
+        return Response(
+            upload_data(upload), status=status.HTTP_201_CREATED,
+            headers={'Upload-Offset': str(upload.offset)}
+        )
+
+    @action(detail=False, methods=['get', 'put'], url_path=r'uploads/(?P<upload_id>[0-9a-f-]{36})')
+    def upload_chunk(self, request, upload_id=None):
+        """GET: offset já recebido; PUT ?offset=N: gravar a próxima parte (corpo da requisição)"""
+        upload = MediaUpload.objects.filter(pk=upload_id).select_related('conversation').first()
+        if upload is None or (upload.created_by_id and upload.created_by_id != request.user.id):
+            return Response({'error': 'Envio não encontrado'}, status=status.HTTP_404_NOT_FOUND)
+        
+        if request.method == 'PUT':
+            try:
+                offset = int(request.query_params.get('offset', ''))
+            except ValueError:
+                return Response({'error': 'offset é obrigatório'}, status=status.HTTP_400_BAD_REQUEST)
+            try:
+                upload = write_chunk(upload, offset, request.stream)
+            except UploadError as e:
+                return Response(
+                    {'error': str(e), 'offset': e.offset}, status=e.status,
+                    headers={'Upload-Offset': str(e.offset if e.offset is not None else upload.offset)}
+                )
+        
+        return Response(upload_data(upload), headers={'Upload-Offset': str(upload.offset)})
+
     @action(detail=False, methods=['post'])
     def send_media(self, request):
         """Enviar mídia (imagem, vídeo, documento, áudio)"""
-        print("🔥🔥🔥 ENDPOINT SEND_MEDIA CHAMADO! 🔥🔥🔥")
         
         conversation_id = request.data.get('conversation_id')
         media_type = request.data.get('media_type')  # image, video, document, audio, myaudio, ptt, sticker
         file = request.FILES.get('file')
         caption = request.data.get('caption', '')
         
-        print(f"DEBUG: Recebido no endpoint send_media:")
-        print(f"   - conversation_id: {conversation_id}")
-        print(f"   - media_type: {media_type}")
-        print(f"   - file: {file.name if file else 'None'}")
-        print(f"   - file.size: {file.size if file else 'None'}")
-        print(f"   - file.type: {file.content_type if file else 'None'}")
-        print(f"   - caption: {caption}")
+        logger.debug(
+            "send_media: conversation_id=%s media_type=%s file=%s size=%s type=%s caption=%s",
+            conversation_id, media_type,
+            file.name if file else None, file.size if file else None,
+            file.content_type if file else None, caption,
+        )
         
         if not conversation_id or not media_type or not file:
             return Response({'error': 'conversation_id, media_type e file são obrigatórios'}, status=status.HTTP_400_BAD_REQUEST)
@@ -911,91 +1019,61 @@ class MessageViewSet(viewsets.ModelViewSet):
         try:
             conversation = Conversation.objects.get(id=conversation_id)
             
-            # Criar diretório se não existir
-            import os
-            from django.conf import settings
-            media_dir = os.path.join(settings.MEDIA_ROOT, 'messages', str(conversation_id))
-            os.makedirs(media_dir, exist_ok=True)
-            
-            # Salvar o arquivo
-            file_path = os.path.join(media_dir, file.name)
-            with open(file_path, 'wb+') as destination:
-                for chunk in file.chunks():
-                    destination.write(chunk)
+            # Guardar o arquivo no armazenamento por conteúdo (conversations.media_store)
+            blob = ingest_chunks(file.chunks())
             
-            # Para áudios enviados (PTT), converter WebM para MP3 para garantir compatibilidade
+            # Para áudios enviados (PTT), converter WebM para MP3 para garantir compatibilidade.
+            # A conversão roda fora da requisição (conversations.transcode), a não ser que
+            # o mesmo áudio já tenha sido convertido
             final_filename = file.name
-            final_file_path = file_path
+            final_blob = blob
+            pending_transcode = False
             
             if media_type == 'ptt' and file.name.lower().endswith('.webm'):
-                try:
-                    import subprocess
-                    mp3_filename = file.name.replace('.webm', '.mp3')
-                    mp3_path = os.path.join(media_dir, mp3_filename)
-                    
-                    print(f"DEBUG: Convertendo WebM para MP3 para PTT")
-                    
-                    # Converter usando ffmpeg
-                    result = subprocess.run([
-                        'ffmpeg', '-i', file_path, 
-                        '-acodec', 'libmp3lame', 
-                        '-ab', '128k', 
-                        '-y', mp3_path
-                    ], capture_output=True, text=True, timeout=30)
-                    
-                    if result.returncode == 0:
-                        print(f"DEBUG: Conversão para MP3 bem-sucedida")
-                        # Usar o arquivo MP3 em vez do WebM
-                        final_filename = mp3_filename
-                        final_file_path = mp3_path
-                        print(f"DEBUG: Arquivo MP3 criado: {mp3_filename}")
-                    else:
-                        print(f"DEBUG: Erro na conversão para MP3: {result.stderr}")
-                except Exception as e:
-                    print(f"DEBUG: Erro ao converter para MP3: {e}")
-            
-            # Gerar URL pública para o arquivo
-            file_url = f"/api/media/messages/{conversation_id}/{final_filename}"
-            
-            # Preparar atributos adicionais
-            additional_attrs = {
-                'file_path': final_file_path,
-                'file_url': file_url,
-                'file_name': final_filename,
-                'file_size': os.path.getsize(final_file_path),
-                'local_file_url': file_url  # Adicionar URL local para compatibilidade
-            }
+                mp3_blob = cached_output(blob, MP3)
+                if mp3_blob is not None:
+                    final_filename = os.path.splitext(file.name)[0] + '.mp3'
+                    final_blob = mp3_blob
+                else:
+                    pending_transcode = True
             
-            print(f"DEBUG: file_url final = {file_url}")
-            print(f"DEBUG: file_path = {file_path}")
-            print(f"DEBUG: file.name = {file.name}")
-            print(f"DEBUG: file.size = {file.size}")
+            logger.debug("file_name=%s sha256=%s size=%s", final_filename, final_blob.sha256, file.size)
             
             # Salvar mensagem no banco
             # Para PTT (mensagens de voz), não usar caption automático
             if media_type == 'ptt':
                 content_to_save = caption if caption else "Mensagem de voz"
-                print(f"DEBUG: PTT detectado - usando content: {content_to_save}")
+                logger.debug("PTT detectado - usando content: %s", content_to_save)
             else:
                 # Para outros tipos de mídia, usar o nome do arquivo como conteúdo
                 content_to_save = caption if caption else f"Arquivo: {file.name}"
-                print(f"DEBUG: Outro tipo de mídia ({media_type}) - usando content: {content_to_save}")
+                logger.debug("Outro tipo de mídia (%s) - usando content: %s", media_type, content_to_save)
             
-            print(f"DEBUG: Salvando mensagem no banco:")
-            print(f"   - content_to_save: {content_to_save}")
-            print(f"   - message_type: {media_type}")
-            print(f"   - is_from_customer: False")
+            logger.debug("Salvando mensagem no banco: content=%s message_type=%s", content_to_save, media_type)
             
-            message = Message.objects.create(
+            message = Message(
                 conversation=conversation,
                 content=content_to_save,
                 message_type=media_type,
-                additional_attributes=additional_attrs,
                 is_from_customer=False
             )
+            # Nome da mídia na conversa (file_path, local_file_url, ...)
+            file_url = attach(message, final_blob, final_filename)
+            message.additional_attributes['file_url'] = file_url
+            if pending_transcode:
+                message.additional_attributes['media_status'] = 'transcoding'
+            message.save()
             
-            # Enviar para o WhatsApp via Uazapi com a URL da mídia
-            success, whatsapp_response = send_media_via_uazapi(conversation, file_url, media_type, caption)
+            # Miniatura de imagens e vídeos em background (conversations.previews)
+            transaction.on_commit(lambda: schedule_preview(message))
+            
+            if pending_transcode:
+                # Envio feito quando o MP3 ficar pronto; a mensagem é atualizada via WebSocket
+                schedule_outbound_ptt(message, caption)
+                success, whatsapp_response = False, 'Áudio em conversão, será enviado em seguida'
+            else:
+                # Enviar para o WhatsApp via Uazapi com a URL da mídia
+                success, whatsapp_response = send_media_via_uazapi(conversation, file_url, media_type, caption)
             
             # Emitir evento WebSocket para mensagem enviada
             channel_layer = get_channel_layer()
@@ -1064,7 +1142,7 @@ class MessageViewSet(viewsets.ModelViewSet):
                     return Response({'error': 'Sem permissão para esta mensagem'}, status=status.HTTP_403_FORBIDDEN)
             
             # Verificar se a mensagem tem ID externo (para WhatsApp)
-            external_id = message.additional_attributes.get('external_id') if message.additional_attributes else None
+            external_id = message.external_id
             if not external_id:
                 return Response({'error': 'Mensagem não possui ID externo para reação'}, status=status.HTTP_400_BAD_REQUEST)
             
@@ -1087,9 +1165,8 @@ class MessageViewSet(viewsets.ModelViewSet):
                 'id': external_id
             }
             
-            print(f"DEBUG: Enviando reação para Uazapi: {payload}")
-            print(f"DEBUG: URL Uazapi: {uazapi_url.rstrip('/')}/message/react")
-            print(f"DEBUG: Token Uazapi: {uazapi_token[:10]}...")
+            log_payload(logger, "Enviando reação para Uazapi", payload)
+            logger.debug("URL Uazapi: %s/message/react", uazapi_url.rstrip('/'))
             
             # Enviar reação via Uazapi
             response = requests.post(
@@ -1099,7 +1176,8 @@ class MessageViewSet(viewsets.ModelViewSet):
                 timeout=10
             )
             
-            print(f"DEBUG: Resposta Uazapi: {response.status_code} - {response.text}")
+            logger.debug("Resposta Uazapi: %s", response.status_code)
+            log_payload(logger, "Resposta Uazapi", response.text)
             
             if response.status_code == 200:
                 result = response.json()
@@ -1161,7 +1239,7 @@ class MessageViewSet(viewsets.ModelViewSet):
         except Message.DoesNotExist:
             return Response({'error': 'Mensagem não encontrada'}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
-            print(f"DEBUG: Erro ao enviar reação: {e}")
+            logger.warning("Erro ao enviar reação: %s", e)
             return Response({'error': f'Erro interno: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     @action(detail=False, methods=['post'])
@@ -1185,7 +1263,7 @@ class MessageViewSet(viewsets.ModelViewSet):
                     return Response({'error': 'Sem permissão para esta mensagem'}, status=status.HTTP_403_FORBIDDEN)
             
             # Verificar se a mensagem tem ID externo (para WhatsApp)
-            external_id = message.additional_attributes.get('external_id') if message.additional_attributes else None
+            external_id = message.external_id
             
             # Se tem external_id, tentar excluir via Uazapi
             if external_id:
@@ -1222,7 +1300,7 @@ class MessageViewSet(viewsets.ModelViewSet):
                             full_id = f"{provedor_number}:{external_id}"
                             id_formats.append(full_id)
                     
-                    print(f"DEBUG: Tentando formatos de ID: {id_formats}")
+                    logger.debug("Tentando formatos de ID: %s", id_formats)
                     
                     success = False
                     for msg_id in id_formats:
@@ -1231,9 +1309,8 @@ class MessageViewSet(viewsets.ModelViewSet):
                             'id': msg_id
                         }
                         
-                        print(f"DEBUG: Tentando apagar com ID: {msg_id}")
-                        print(f"DEBUG: URL Uazapi: {uazapi_url.rstrip('/')}/message/delete")
-                        print(f"DEBUG: Token Uazapi: {uazapi_token[:10]}...")
+                        logger.debug("Tentando apagar com ID: %s", msg_id)
+                        logger.debug("URL Uazapi: %s/message/delete", uazapi_url.rstrip('/'))
                         
                         # Apagar mensagem via Uazapi
                         response = requests.post(
@@ -1243,21 +1320,22 @@ class MessageViewSet(viewsets.ModelViewSet):
                             timeout=10
                         )
                         
-                        print(f"DEBUG: Resposta Uazapi: {response.status_code} - {response.text}")
+                        logger.debug("Resposta Uazapi: %s", response.status_code)
+                        log_payload(logger, "Resposta Uazapi", response.text)
                         
                         if response.status_code == 200:
                             result = response.json()
-                            print(f"DEBUG: Mensagem apagada via Uazapi com sucesso usando ID: {msg_id}")
+                            logger.debug("Mensagem apagada via Uazapi com sucesso usando ID: %s", msg_id)
                             success = True
                             break
                         else:
-                            print(f"DEBUG: Erro ao apagar via Uazapi com ID {msg_id}: {response.status_code}")
+                            logger.warning("Erro ao apagar via Uazapi com ID %s: %s", msg_id, response.status_code)
                     
                     if success:
                         # Se conseguiu apagar via Uazapi, verificar se é mensagem da IA
                         if not message.is_from_customer:
                             # Mensagem da IA: apagar apenas do WhatsApp, manter no sistema
-                            print(f"DEBUG: Mensagem da IA apagada do WhatsApp, mantendo no sistema")
+                            logger.debug("Mensagem da IA apagada do WhatsApp, mantendo no sistema")
                             return Response({
                                 'success': True,
                                 'message': 'Mensagem apagada do WhatsApp com sucesso',
@@ -1265,14 +1343,14 @@ class MessageViewSet(viewsets.ModelViewSet):
                             })
                         else:
                             # Mensagem do cliente: marcar como deletada no sistema também
-                            print(f"DEBUG: Mensagem do cliente apagada, marcando como deletada no sistema")
+                            logger.debug("Mensagem do cliente apagada, marcando como deletada no sistema")
                             additional_attrs = message.additional_attributes or {}
                             additional_attrs['status'] = 'deleted'
                             additional_attrs['deleted_at'] = str(datetime.now())
                             message.additional_attributes = additional_attrs
                             message.save()
                     else:
-                        print(f"DEBUG: Todos os formatos de ID falharam")
+                        logger.warning("Todos os formatos de ID falharam")
                         result = {'error': f'Erro Uazapi: todos os formatos falharam'}
                         return Response({
                             'success': False,
@@ -1280,7 +1358,7 @@ class MessageViewSet(viewsets.ModelViewSet):
                             'data': result
                         })
                 else:
-                    print(f"DEBUG: Configuração Uazapi não encontrada")
+                    logger.debug("Configuração Uazapi não encontrada")
                     result = {'warning': 'Configuração Uazapi não encontrada'}
                     return Response({
                         'success': False,
@@ -1288,7 +1366,7 @@ class MessageViewSet(viewsets.ModelViewSet):
                         'data': result
                     })
             else:
-                print(f"DEBUG: Mensagem não possui external_id")
+                logger.debug("Mensagem não possui external_id")
                 result = {'warning': 'Mensagem não possui ID externo'}
                 return Response({
                     'success': False,
@@ -1333,7 +1411,7 @@ class MessageViewSet(viewsets.ModelViewSet):
         except Message.DoesNotExist:
             return Response({'error': 'Mensagem não encontrada'}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
-            print(f"DEBUG: Erro ao apagar mensagem: {e}")
+            logger.warning("Erro ao apagar mensagem: %s", e)
             return Response({'error': f'Erro interno: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
@@ -1482,36 +1560,18 @@ def serve_media_file(request, conversation_id, filename):
     Serve media files for conversations
     """
     try:
-        # Verificar se a conversa existe
-        conversation = Conversation.objects.get(id=conversation_id)
-        
-        # Construir caminho do arquivo
-        media_dir = os.path.join(settings.MEDIA_ROOT, 'messages', str(conversation_id))
-        file_path = os.path.join(media_dir, filename)
-        
-        # Verificar se o arquivo existe
-        if not os.path.exists(file_path):
+        # Arquivo antigo em MEDIA_ROOT/messages ou alias do armazenamento por conteúdo
+        file_path = resolve_media(conversation_id, filename)
+        if not file_path:
             raise Http404("Arquivo não encontrado")
         
-        # Verificar se o arquivo está dentro do diretório de mídia (segurança)
-        if not file_path.startswith(settings.MEDIA_ROOT):
-            raise Http404("Acesso negado")
+        # Range, ETag e cache (core/media_serving.py)
+        return serve_file(request, file_path, filename)
         
-        # Determinar o tipo MIME baseado na extensão
-        import mimetypes
-        content_type, _ = mimetypes.guess_type(file_path)
-        if not content_type:
-            content_type = 'application/octet-stream'
-        
-        # Servir o arquivo
-        response = FileResponse(open(file_path, 'rb'), content_type=content_type)
-        response['Content-Disposition'] = f'inline; filename="{filename}"'
-        return response
-        
-    except Conversation.DoesNotExist:
-        raise Http404("Conversa não encontrada")
+    except Http404:
+        raise
     except Exception as e:
-        print(f"Erro ao servir arquivo de mídia: {e}")
+        logger.warning("Erro ao servir arquivo de mídia: %s", e)
         raise Http404("Erro ao servir arquivo")
 
 
@@ -1522,31 +1582,22 @@ def test_media_access(request, conversation_id):
     try:
         conversation = Conversation.objects.get(id=conversation_id)
         
-        # Listar arquivos de mídia da conversa
-        media_dir = os.path.join(settings.MEDIA_ROOT, 'messages', str(conversation_id))
-        
-        if not os.path.exists(media_dir):
-            return JsonResponse({
-                'success': False,
-                'error': 'Diretório de mídia não existe',
-                'media_dir': media_dir
-            })
-        
-        files = []
-        for filename in os.listdir(media_dir):
-            file_path = os.path.join(media_dir, filename)
-            if os.path.isfile(file_path):
-                files.append({
-                    'name': filename,
-                    'size': os.path.getsize(file_path),
-                    'url': f'/api/media/messages/{conversation_id}/{filename}/'
-                })
+        # Listar arquivos de mídia da conversa pelo manifesto no banco (MediaAlias)
+        files = [
+            {
+                'name': alias.filename,
+                'size': alias.blob.size,
+                'sha256': alias.blob.sha256,
+                'url': f'/api/media/messages/{conversation_id}/{alias.filename}/'
+            }
+            for alias in conversation.media_aliases.select_related('blob').order_by('filename')
+        ]
         
         return JsonResponse({
             'success': True,
             'conversation_id': conversation_id,
-            'media_dir': media_dir,
-            'files': files
+            'files': files,
+            'total_size': sum(file['size'] for file in files)
         })
         
     except Conversation.DoesNotExist:
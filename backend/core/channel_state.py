@@ -0,0 +1,289 @@
+"""
+Estado de conexão dos canais WhatsApp em cache
+
+O CanalSerializer não faz mais chamadas HTTP: ele lê o estado (state,
+profile_pic e betaStatus) deste cache. O cache é mantido por:
+
+- ChannelStatePoller / comando ``channel_state_poller`` (atualização periódica)
+- eventos ``connection`` recebidos via SSE da Uazapi (apply_connection_event)
+- endpoints que já consultam o status da instância (ex.: whatsapp-beta-status)
+
+Quando o canal ainda não está no cache, o serializer devolve vazio e pede a
+atualização a um único worker em background (fila limitada), sem bloquear a
+requisição.
+"""
+
+import queue
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .logging_utils import get_logger
+from .uazapi_client import UazapiClient
+
+logger = get_logger('canais')
+
+CACHE_PREFIX = 'canal_state'
+WHATSAPP_TIPOS = ('whatsapp', 'whatsapp_beta')
+REFRESH_QUEUE_SIZE = 100
+
+
+def _ttl():
+    return getattr(settings, 'CHANNEL_STATE_TTL', 300)
+
+
+def _cache_key(canal_id):
+    return f'{CACHE_PREFIX}:{canal_id}'
+
+
+def get_channel_state(canal_id):
+    """Retorna o estado em cache do canal ou None"""
+    return cache.get(_cache_key(canal_id))
+
+
+def get_channel_states(canal_ids):
+    """Retorna {canal_id: estado} para os canais presentes no cache"""
+    keys = {_cache_key(canal_id): canal_id for canal_id in canal_ids}
+    found = cache.get_many(list(keys))
+    return {keys[key]: value for key, value in found.items()}
+
+
+def set_channel_state(canal_id, state=None, profile_pic=None, beta_status=None):
+    data = {
+        'state': state,
+        'profile_pic': profile_pic,
+        'beta_status': beta_status,
+        'updated_at': timezone.now().isoformat(),
+    }
+    cache.set(_cache_key(canal_id), data, _ttl())
+    return data
+
+
+def clear_channel_state(canal_id):
+    cache.delete(_cache_key(canal_id))
+
+
+def _uazapi_client(canal):
+    provedor = canal.provedor
+    if not provedor or not provedor.integracoes_externas:
+        return None
+    token = provedor.integracoes_externas.get('whatsapp_token')
+    uazapi_url = provedor.integracoes_externas.get('whatsapp_url')
+    if not token or not uazapi_url:
+        return None
+    return UazapiClient(uazapi_url, token)
+
+
+def _evolution_config():
+    return settings.EVOLUTION_URL.rstrip('/'), settings.EVOLUTION_APIKEY
+
+
+def _fetch_evolution_instances():
+    """Lista todas as instâncias Evolution em uma única chamada"""
+    evolution_url, apikey = _evolution_config()
+    if not apikey:
+        return {}
+    try:
+        resp = requests.get(
+            f'{evolution_url}/instance/fetchInstances',
+            headers={'apikey': apikey},
+            timeout=5
+        )
+        if resp.status_code == 200:
+            return {inst.get('name'): inst for inst in resp.json()}
+        logger.warning("Erro na Evolution fetchInstances: %s", resp.text)
+    except Exception as e:
+        logger.warning("Exception Evolution fetchInstances: %s", e)
+    return {}
+
+
+def _fetch_evolution_state(canal, instances=None):
+    evolution_url, apikey = _evolution_config()
+    if not apikey:
+        logger.debug("EVOLUTION_APIKEY não configurada, canal %s ignorado", canal.id)
+        return set_channel_state(canal.id)
+    state = None
+    try:
+        resp = requests.get(
+            f'{evolution_url}/instance/connectionState/{canal.nome}',
+            headers={'apikey': apikey},
+            timeout=5
+        )
+        if resp.status_code == 200:
+            state = resp.json().get('instance', {}).get('state')
+        else:
+            logger.warning("Erro na Evolution: %s", resp.text)
+    except Exception as e:
+        logger.warning("Exception Evolution: %s", e)
+
+    if instances is None:
+        instances = _fetch_evolution_instances()
+    profile_pic = (instances.get(canal.nome) or {}).get('profilePicUrl')
+    return set_channel_state(canal.id, state=state, profile_pic=profile_pic)
+
+
+def _fetch_uazapi_state(canal):
+    instance_id = (canal.dados_extras or {}).get('instance_id')
+    client = _uazapi_client(canal)
+    if not instance_id or not client:
+        return set_channel_state(canal.id)
+    try:
+        # Uma única chamada alimenta state, profile_pic e betaStatus
+        status_result = client.get_instance_status(instance_id)
+    except Exception as e:
+        logger.warning("Exception Uazapi: %s", e)
+        return set_channel_state(canal.id)
+    return apply_instance_status(canal, status_result)
+
+
+def apply_instance_status(canal, status_result):
+    """Grava no cache o resultado de /instance/status da Uazapi"""
+    instance = (status_result or {}).get('instance') or {}
+    return set_channel_state(
+        canal.id,
+        state=instance.get('status'),
+        profile_pic=instance.get('profilePicUrl'),
+        beta_status=status_result,
+    )
+
+
+def apply_connection_event(provedor_id, event):
+    """
+    Atualiza o cache a partir de um evento ``connection`` do SSE da Uazapi.
+    O evento pode trazer só parte do status; o restante é mantido do cache.
+    """
+    from .models import Canal
+
+    data = event.get('data') or {}
+    instance = data.get('instance') if isinstance(data.get('instance'), dict) else data
+    instance_id = instance.get('id') or instance.get('instance_id') or event.get('instance')
+
+    canais = [
+        canal for canal in Canal.objects.filter(provedor_id=provedor_id, tipo='whatsapp_beta')
+        if (canal.dados_extras or {}).get('instance_id')
+    ]
+    if instance_id:
+        canais = [canal for canal in canais if canal.dados_extras.get('instance_id') == instance_id]
+    elif len(canais) != 1:
+        # Sem identificação da instância não dá para saber qual canal atualizar
+        return 0
+
+    for canal in canais:
+        current = (get_channel_state(canal.id) or {}).get('beta_status') or {}
+        status_result = dict(current)
+        status_result['instance'] = {**(current.get('instance') or {}), **instance}
+        for key in ('connected', 'loggedIn'):
+            if key in data:
+                status_result[key] = data[key]
+        apply_instance_status(canal, status_result)
+    return len(canais)
+
+
+def refresh_channel_state(canal, evolution_instances=None):
+    """Consulta a API do canal e atualiza o cache"""
+    if canal.tipo == 'whatsapp' and canal.nome:
+        return _fetch_evolution_state(canal, evolution_instances)
+    if canal.tipo == 'whatsapp_beta' and canal.dados_extras:
+        return _fetch_uazapi_state(canal)
+    return set_channel_state(canal.id)
+
+
+def refresh_all_channels():
+    """Atualiza o cache de todos os canais WhatsApp"""
+    from .models import Canal
+
+    canais = list(Canal.objects.filter(tipo__in=WHATSAPP_TIPOS).select_related('provedor'))
+    evolution_instances = None
+    if any(canal.tipo == 'whatsapp' for canal in canais):
+        evolution_instances = _fetch_evolution_instances()
+    for canal in canais:
+        try:
+            refresh_channel_state(canal, evolution_instances)
+        except Exception as e:
+            logger.warning("Erro ao atualizar estado do canal %s: %s", canal.id, e)
+    return len(canais)
+
+
+_refresh_queue = queue.Queue(maxsize=REFRESH_QUEUE_SIZE)
+_pending = set()
+_pending_lock = threading.Lock()
+_worker = None
+
+
+def _refresh_worker():
+    """Worker único que atende os pedidos de request_refresh"""
+    from .models import Canal
+
+    while True:
+        canal_id = _refresh_queue.get()
+        try:
+            canal = Canal.objects.select_related('provedor').filter(id=canal_id).first()
+            if canal:
+                refresh_channel_state(canal)
+        except Exception as e:
+            logger.warning("Erro ao atualizar estado do canal %s: %s", canal_id, e)
+        finally:
+            with _pending_lock:
+                _pending.discard(canal_id)
+            close_old_connections()
+            _refresh_queue.task_done()
+
+
+def request_refresh(canal_id):
+    """
+    Pede a atualização de um canal fora do cache, sem bloquear a requisição.
+    Todos os pedidos vão para uma fila limitada atendida por uma única thread;
+    com a fila cheia o pedido é descartado e fica a cargo do poller.
+    """
+    global _worker
+    if not getattr(settings, 'CHANNEL_STATE_REFRESH_ON_MISS', True):
+        return False
+    with _pending_lock:
+        if canal_id in _pending:
+            return False
+        try:
+            _refresh_queue.put_nowait(canal_id)
+        except queue.Full:
+            return False
+        _pending.add(canal_id)
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_refresh_worker, daemon=True)
+            _worker.start()
+    return True
+
+
+class ChannelStatePoller:
+    """Atualiza periodicamente o estado de todos os canais WhatsApp"""
+
+    def __init__(self, interval=None):
+        self.interval = interval or getattr(settings, 'CHANNEL_STATE_POLL_INTERVAL', 60)
+        self.is_running = False
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def run_forever(self):
+        self.is_running = True
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            try:
+                total = refresh_all_channels()
+                logger.debug("Estado de %s canais atualizado em %.2fs", total, time.monotonic() - started)
+            except Exception as e:
+                logger.warning("Erro no poller de canais: %s", e)
+            self._stop_event.wait(self.interval)
+        self.is_running = False
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,193 @@
+"""
+Estatísticas do dashboard por provedor
+
+Todas as contagens de status saem de uma única query com agregação
+condicional, o desempenho dos atendentes de uma query agrupada, e os tempos de
+resposta são calculados a partir dos timestamps das mensagens (índice
+msg_conv_customer_idx). O resultado fica em cache por DASHBOARD_STATS_TTL
+segundos e é invalidado por eventos de mensagem e conversa
+(invalidate_dashboard_stats), então o polling do dashboard é barato.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import (
+    Avg, Count, DurationField, ExpressionWrapper, F, OuterRef, Q, Subquery,
+)
+from django.utils import timezone
+
+from .models import AuditLog, User
+
+CACHE_PREFIX = 'dashboard_stats'
+SCOPES = ('admin', 'agent')
+RESOLVED_STATUSES = ('closed', 'resolved')
+
+
+def _cache_key(provedor_id, scope):
+    return f'{CACHE_PREFIX}:{provedor_id}:{scope}'
+
+
+def invalidate_dashboard_stats(provedor_id):
+    if provedor_id:
+        cache.delete_many([_cache_key(provedor_id, scope) for scope in SCOPES])
+
+
+def get_dashboard_stats(provedor_id, include_team=False):
+    """Estatísticas do provedor, servidas do cache quando possível"""
+    key = _cache_key(provedor_id, 'admin' if include_team else 'agent')
+    data = cache.get(key)
+    if data is None:
+        data = compute_dashboard_stats(provedor_id, include_team)
+        cache.set(key, data, getattr(settings, 'DASHBOARD_STATS_TTL', 10))
+    return data
+
+
+def _format_minutes(seconds):
+    if seconds is None:
+        return "0min"
+    minutes = seconds / 60
+    return f"{minutes:.1f}min" if minutes < 10 else f"{int(minutes)}min"
+
+
+def _seconds(value):
+    # Avg de DurationField volta como timedelta
+    return value.total_seconds() if value is not None else None
+
+
+def _first_response_seconds(conversations, desde):
+    """
+    Média, entre as conversas iniciadas no período, do tempo entre a primeira
+    mensagem do cliente e a primeira resposta posterior a ela
+    """
+    from conversations.models import Message
+
+    messages = Message.objects.filter(conversation=OuterRef('pk')).order_by('created_at').values('created_at')
+    first_reply = Message.objects.filter(
+        conversation=OuterRef('pk'),
+        is_from_customer=False,
+        created_at__gte=OuterRef('first_customer_at'),
+    ).order_by('created_at').values('created_at')[:1]
+
+    result = conversations.filter(created_at__gte=desde).annotate(
+        first_customer_at=Subquery(messages.filter(is_from_customer=True)[:1]),
+    ).annotate(
+        first_reply_at=Subquery(first_reply),
+    ).filter(first_reply_at__isnull=False).aggregate(
+        avg=Avg(ExpressionWrapper(F('first_reply_at') - F('first_customer_at'), output_field=DurationField()))
+    )
+    return _seconds(result['avg'])
+
+
+def _average_response_seconds(provedor_id, desde):
+    """
+    Média do tempo de resposta: para cada mensagem do atendente/IA no período
+    que responde a uma mensagem do cliente (a última mensagem anterior é do
+    cliente), o intervalo desde essa mensagem do cliente
+    """
+    from conversations.models import Message
+
+    anteriores = Message.objects.filter(conversation=OuterRef('conversation'), created_at__lt=OuterRef('created_at'))
+    last_customer = anteriores.filter(is_from_customer=True).order_by('-created_at').values('created_at')[:1]
+    last_reply = anteriores.filter(is_from_customer=False).order_by('-created_at').values('created_at')[:1]
+
+    result = Message.objects.filter(
+        conversation__inbox__provedor_id=provedor_id,
+        is_from_customer=False,
+        created_at__gte=desde,
+    ).annotate(
+        last_customer_at=Subquery(last_customer),
+        last_reply_at=Subquery(last_reply),
+    ).filter(
+        Q(last_reply_at__isnull=True) | Q(last_reply_at__lt=F('last_customer_at')),
+        last_customer_at__isnull=False,
+    ).aggregate(
+        avg=Avg(ExpressionWrapper(F('created_at') - F('last_customer_at'), output_field=DurationField()))
+    )
+    return _seconds(result['avg'])
+
+
+def compute_dashboard_stats(provedor_id, include_team=False):
+    from conversations.models import Contact, Conversation, Message
+
+    desde = timezone.now() - timedelta(days=30)
+    conversations = Conversation.objects.filter(inbox__provedor_id=provedor_id)
+
+    status = conversations.aggregate(
+        total=Count('id'),
+        abertas=Count('id', filter=Q(status='open')),
+        pendentes=Count('id', filter=Q(status='pending')),
+        resolvidas=Count('id', filter=Q(status__in=RESOLVED_STATUSES)),
+    )
+    total_conversas = status['total']
+    conversas_resolvidas = status['resolvidas']
+
+    contatos_unicos = Contact.objects.filter(provedor_id=provedor_id).count()
+    mensagens_30_dias = Message.objects.filter(
+        conversation__inbox__provedor_id=provedor_id,
+        created_at__gte=desde
+    ).count()
+
+    if total_conversas > 0:
+        taxa_resolucao = f"{int((conversas_resolvidas / total_conversas) * 100)}%"
+        # Satisfação ainda simulada a partir da taxa de resolução
+        satisfacao_media = f"{4.0 + (conversas_resolvidas / total_conversas) * 0.8:.1f}"
+    else:
+        taxa_resolucao = "0%"
+        satisfacao_media = "0.0"
+
+    canais_stats = list(
+        conversations.values('inbox__channel_type').annotate(total=Count('id')).order_by('-total')
+    )
+
+    atendentes_stats = []
+    atividades_recentes = []
+    if include_team:
+        atendentes = User.objects.filter(provedores_admin=provedor_id).annotate(
+            conversas_atendidas=Count(
+                'assigned_conversations',
+                filter=Q(assigned_conversations__inbox__provedor_id=provedor_id),
+                distinct=True,
+            )
+        ).order_by('-conversas_atendidas', 'id')[:5]
+        atendentes_stats = [
+            {
+                'name': f"{usuario.first_name} {usuario.last_name}".strip() or usuario.username,
+                'conversations': usuario.conversas_atendidas,
+                'satisfaction': 4.5  # Simulado
+            }
+            for usuario in atendentes
+        ]
+
+        logs_recentes = AuditLog.objects.filter(
+            provedor_id=provedor_id
+        ).select_related('user').order_by('-timestamp')[:5]
+        atividades_recentes = [
+            {
+                'action': log.action,
+                'user': log.user.username if log.user else 'Sistema',
+                'time': log.timestamp.strftime('%d/%m/%Y %H:%M'),
+                'type': 'activity'
+            }
+            for log in logs_recentes
+        ]
+
+    return {
+        'stats': {
+            'total_conversas': total_conversas,
+            'conversas_abertas': status['abertas'],
+            'conversas_pendentes': status['pendentes'],
+            'conversas_resolvidas': conversas_resolvidas,
+            'conversas_em_andamento': status['abertas'],
+            'contatos_unicos': contatos_unicos,
+            'mensagens_30_dias': mensagens_30_dias,
+            'tempo_medio_resposta': _format_minutes(_average_response_seconds(provedor_id, desde)),
+            'tempo_primeira_resposta': _format_minutes(_first_response_seconds(conversations, desde)),
+            'taxa_resolucao': taxa_resolucao,
+            'satisfacao_media': satisfacao_media
+        },
+        'canais': canais_stats,
+        'atendentes': atendentes_stats,
+        'atividades': atividades_recentes
+    }
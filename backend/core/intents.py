@@ -0,0 +1,130 @@
+"""
+Classificação de intenção por palavras-chave
+
+Antes de chamar o LLM, a mensagem do cliente é classificada em intenções
+(billing, outage, cancellation, account, greeting) por uma única regex
+compilada por conjunto de palavras-chave. A regex tem um grupo nomeado por
+intenção, então uma só passada sobre o texto normalizado (sem acento, minúsculo)
+devolve todas as intenções presentes.
+
+As palavras-chave padrão podem ser trocadas por provedor em
+Provedor.intencoes_ia, por exemplo ``{"billing": ["boleto", "2 via"]}``; a lista
+informada substitui a padrão daquela intenção.
+"""
+
+import re
+import unicodedata
+
+BILLING = 'billing'
+OUTAGE = 'outage'
+CANCELLATION = 'cancellation'
+ACCOUNT = 'account'
+GREETING = 'greeting'
+
+DEFAULT_KEYWORDS = {
+    BILLING: [
+        'boleto', 'fatura', 'conta', 'pagamento', 'débito', 'vencimento', 'segunda via', '2 via', 'pix',
+    ],
+    OUTAGE: [
+        'sem internet', 'internet parou', 'internet caiu', 'não funciona', 'problema', 'chamado',
+        'reclamação', 'técnico', 'lenta', 'sem sinal',
+    ],
+    CANCELLATION: ['cancelar', 'cancelamento', 'cancela'],
+    ACCOUNT: ['mudar plano', 'alterar', 'consulta', 'instalação', 'mudança de endereço'],
+    GREETING: ['oi', 'olá', 'ola', 'bom dia', 'boa tarde', 'boa noite', 'tudo bem', 'e aí', 'opa'],
+}
+
+# Intenções que exigem confirmar se quem fala já é cliente
+CLIENT_CHECK_INTENTS = frozenset({BILLING, OUTAGE, CANCELLATION, ACCOUNT})
+
+# Dicas de ferramenta SGP acrescentadas ao prompt
+TOOL_HINTS = {
+    BILLING: "O cliente parece querer a fatura: depois de identificá-lo, use gerar_fatura_completa.",
+    OUTAGE: "O cliente relata problema de conexão: depois de identificá-lo, use verificar_acesso_sgp.",
+}
+
+# Saudação respondida por template só quando a mensagem é curta
+GREETING_MAX_WORDS = 4
+
+CANCELLATION_REPLY = (
+    "Entendi que você deseja cancelar. Vou te encaminhar para um atendente humano, só um instante."
+)
+
+
+def normalize(text):
+    """Minúsculas e sem acentos"""
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(char for char in text if not unicodedata.combining(char)).lower()
+
+
+def keyword_pattern(keywords):
+    """
+    Alternância das palavras-chave (normalizadas, mais longas primeiro) que
+    casa palavras inteiras, aceitando plural com "s"
+    """
+    normalized = sorted({normalize(str(keyword)).strip() for keyword in keywords or []} - {''}, key=len, reverse=True)
+    if not normalized:
+        return None
+    alternatives = '|'.join(re.escape(keyword) for keyword in normalized)
+    return rf'(?<!\w)(?:{alternatives})s?(?!\w)'
+
+
+class IntentClassifier:
+    """Classificador compilado uma vez para um conjunto de palavras-chave"""
+
+    def __init__(self, keywords):
+        groups = []
+        self.intents = []
+        for index, (intent, words) in enumerate(sorted(keywords.items())):
+            pattern = keyword_pattern(words)
+            if pattern:
+                # Nomes de grupo precisam ser identificadores
+                groups.append(f'(?P<i{index}>{pattern})')
+                self.intents.append((f'i{index}', intent))
+        self._names = dict(self.intents)
+        self._regex = re.compile('|'.join(groups)) if groups else None
+
+    def classify(self, text):
+        """Conjunto de intenções presentes no texto"""
+        if not self._regex or not text:
+            return frozenset()
+        return frozenset(self._names[match.lastgroup] for match in self._regex.finditer(normalize(text)))
+
+    def is_greeting_only(self, text, intents=None):
+        intents = self.classify(text) if intents is None else intents
+        return intents == {GREETING} and len((text or '').split()) <= GREETING_MAX_WORDS
+
+
+_classifiers = {}
+
+
+def _keywords_for(provedor):
+    custom = getattr(provedor, 'intencoes_ia', None) or {}
+    keywords = dict(DEFAULT_KEYWORDS)
+    if isinstance(custom, dict):
+        for intent, words in custom.items():
+            if isinstance(words, (list, tuple)):
+                keywords[str(intent)] = list(words)
+    return keywords
+
+
+def classifier_for(provedor=None):
+    """Classificador do provedor, reaproveitado entre mensagens enquanto a configuração não muda"""
+    keywords = _keywords_for(provedor)
+    key = tuple(sorted((intent, tuple(map(str, words))) for intent, words in keywords.items()))
+    classifier = _classifiers.get(key)
+    if classifier is None:
+        classifier = _classifiers[key] = IntentClassifier(keywords)
+    return classifier
+
+
+def classify(text, provedor=None):
+    return classifier_for(provedor).classify(text)
+
+
+def greeting_reply(provedor, greeting_time):
+    """Resposta de template para uma saudação, sem passar pelo LLM"""
+    agente = getattr(provedor, 'nome_agente_ia', None)
+    apresentacao = f" Eu sou {agente}, da {provedor.nome}." if agente else f" Aqui é da {provedor.nome}."
+    return f"{greeting_time}!{apresentacao} Como posso te ajudar?"
+
@@ -0,0 +1,57 @@
+"""
+Logging estruturado do Nio Chat
+
+Cada subsistema usa um logger próprio (``niochat.<subsistema>``) com nível
+configurável por variável de ambiente. Use sempre formatação preguiçosa
+(``logger.debug("valor: %s", valor)``) para que nada seja formatado quando o
+nível estiver desligado.
+"""
+
+import json
+import logging
+import random
+
+from django.conf import settings
+
+# A configuração (LOGGING) fica em niochat/logging_config.py, que pode ser
+# importado pelo settings sem carregar nada do Django
+from niochat.logging_config import ROOT_LOGGER, SUBSYSTEMS, JsonFormatter, build_logging_config  # noqa: F401
+
+
+def get_logger(subsystem):
+    """Retorna o logger do subsistema informado"""
+    return logging.getLogger(f'{ROOT_LOGGER}.{subsystem}')
+
+
+class LazyPayload:
+    """Serializa o payload apenas quando o registro for realmente emitido"""
+
+    __slots__ = ('payload', 'max_chars')
+
+    def __init__(self, payload, max_chars=None):
+        self.payload = payload
+        self.max_chars = max_chars
+
+    def __str__(self):
+        try:
+            text = json.dumps(self.payload, ensure_ascii=False, default=str)
+        except (TypeError, ValueError):
+            text = repr(self.payload)
+        if self.max_chars and len(text) > self.max_chars:
+            text = f'{text[:self.max_chars]}... ({len(text)} caracteres)'
+        return text
+
+
+def log_payload(logger, label, payload):
+    """
+    Registra um payload completo em DEBUG, com amostragem.
+
+    Controlado por LOG_PAYLOAD_SAMPLE_RATE (0 desliga, 1 registra todos) e
+    LOG_PAYLOAD_MAX_CHARS (tamanho máximo do dump).
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    rate = getattr(settings, 'LOG_PAYLOAD_SAMPLE_RATE', 0.0)
+    if rate <= 0 or (rate < 1 and random.random() >= rate):
+        return
+    logger.debug('%s: %s', label, LazyPayload(payload, getattr(settings, 'LOG_PAYLOAD_MAX_CHARS', 2000)))
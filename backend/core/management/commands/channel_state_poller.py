@@ -0,0 +1,43 @@
+"""
+Comando Django para manter em cache o estado dos canais WhatsApp
+"""
+
+import signal
+import sys
+from django.core.management.base import BaseCommand
+from core.channel_state import ChannelStatePoller, refresh_all_channels
+
+
+class Command(BaseCommand):
+    help = 'Atualizar periodicamente o estado de conexão dos canais WhatsApp'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=int,
+            help='Intervalo entre atualizações em segundos (padrão: CHANNEL_STATE_POLL_INTERVAL)'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Atualizar uma única vez e sair'
+        )
+    
+    def handle(self, *args, **options):
+        if options['once']:
+            total = refresh_all_channels()
+            self.stdout.write(self.style.SUCCESS(f"Estado de {total} canais atualizado"))
+            return
+        
+        poller = ChannelStatePoller(interval=options.get('interval'))
+        
+        def signal_handler(signum, frame):
+            self.stdout.write("Recebido sinal de parada...")
+            poller.stop()
+            sys.exit(0)
+        
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
+        
+        self.stdout.write(self.style.SUCCESS(f"Poller de canais iniciado (intervalo: {poller.interval}s)"))
+        poller.run_forever()
@@ -0,0 +1,170 @@
+"""
+Entrega de arquivos de mídia
+
+Usado pelas views de /api/media/: responde Range (206/416), ETag e
+Last-Modified com GET condicional (304) e Cache-Control longo para conteúdo
+imutável (arquivos do armazenamento por conteúdo, cujo nome é o SHA-256 e
+serve de ETag forte). Arquivos antigos usam ETag fraca de tamanho e data.
+
+Com MEDIA_ACCEL_REDIRECT_PREFIX configurado (ex.: ``/protected-media/``, uma
+location ``internal`` do nginx apontando para MEDIA_ROOT), a view só valida e
+responde com X-Accel-Redirect: o nginx entrega os bytes e trata o Range, sem
+passar o arquivo pelo Python.
+"""
+
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+CHUNK_SIZE = 64 * 1024
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+_SHA256 = re.compile(r'^[0-9a-f]{64}$')
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Tipos que o mimetypes não conhece em todas as plataformas
+FALLBACK_TYPES = {
+    '.webm': 'audio/webm',
+    '.wav': 'audio/wav',
+    '.mp3': 'audio/mpeg',
+    '.ogg': 'audio/ogg',
+    '.opus': 'audio/ogg',
+    '.m4a': 'audio/mp4',
+    '.webp': 'image/webp',
+}
+
+
+def content_type_for(filename):
+    content_type, _ = mimetypes.guess_type(filename)
+    return content_type or FALLBACK_TYPES.get(os.path.splitext(filename)[1].lower(), 'application/octet-stream')
+
+
+def file_etag(file_path, stat):
+    """ETag forte (SHA-256) para blobs do armazenamento por conteúdo; fraca para os demais"""
+    name = os.path.basename(file_path)
+    if _SHA256.match(name):
+        return quote_etag(name)
+    return f'W/"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def _etag_matches(header, etag, weak=True):
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    candidates = [value.strip() for value in header.split(',')]
+    if weak:
+        strip = lambda value: value[2:] if value.startswith('W/') else value
+        return strip(etag) in {strip(value) for value in candidates}
+    return not etag.startswith('W/') and etag in candidates
+
+
+def not_modified(request, etag, mtime):
+    """GET condicional: If-None-Match tem precedência sobre If-Modified-Since"""
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return _etag_matches(if_none_match, etag)
+    since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+    return since is not None and int(mtime) <= since
+
+
+def parse_range(header, size):
+    """
+    (início, fim) inclusivos de um Range com um único intervalo; None para
+    ignorar (ausente, vários intervalos ou formato desconhecido) e ValueError
+    se não puder ser satisfeito
+    """
+    match = _RANGE.match((header or '').strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # Últimos N bytes
+        length = int(end)
+        if length == 0 or size == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def _read_range(file_path, start, end):
+    with open(file_path, 'rb') as source:
+        source.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = source.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def accel_path(file_path):
+    """Caminho interno do nginx para ``file_path`` ou None se não configurado"""
+    prefix = getattr(settings, 'MEDIA_ACCEL_REDIRECT_PREFIX', '')
+    if not prefix:
+        return None
+    relative = os.path.relpath(os.path.realpath(file_path), os.path.realpath(settings.MEDIA_ROOT))
+    return prefix.rstrip('/') + '/' + relative.replace(os.sep, '/')
+
+
+def serve_file(request, file_path, filename=None, immutable=None):
+    """
+    Resposta para ``file_path`` (já validado pela view). ``immutable``: a URL
+    sempre aponta para o mesmo conteúdo e pode ficar em cache por um ano
+    (padrão: só blobs do armazenamento por conteúdo).
+    """
+    filename = filename or os.path.basename(file_path)
+    stat = os.stat(file_path)
+    etag = file_etag(file_path, stat)
+    if immutable is None:
+        immutable = not etag.startswith('W/')
+    content_type = content_type_for(filename)
+    max_age = IMMUTABLE_MAX_AGE if immutable else getattr(settings, 'MEDIA_CACHE_MAX_AGE', 3600)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': f'private, max-age={max_age}' + (', immutable' if immutable else ''),
+        'Accept-Ranges': 'bytes',
+    }
+
+    if not_modified(request, etag, stat.st_mtime):
+        return HttpResponse(status=304, headers=headers)
+
+    internal = accel_path(file_path)
+    if internal:
+        response = HttpResponse(content_type=content_type, headers=headers)
+        response['X-Accel-Redirect'] = internal
+        response['Content-Disposition'] = f'inline; filename="{filename}"'
+        return response
+
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    # If-Range: o intervalo só vale se a cópia do cliente ainda é a atual
+    if not if_range or _etag_matches(if_range, etag, weak=False):
+        try:
+            byte_range = parse_range(request.META.get('HTTP_RANGE'), stat.st_size)
+        except ValueError:
+            return HttpResponse(status=416, headers={**headers, 'Content-Range': f'bytes */{stat.st_size}'})
+
+    if byte_range is None:
+        response = FileResponse(open(file_path, 'rb'), content_type=content_type, headers=headers)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            _read_range(file_path, start, end), status=206, content_type=content_type, headers=headers
+        )
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        response['Content-Length'] = str(end - start + 1)
+    response['Content-Disposition'] = f'inline; filename="{filename}"'
+    return response
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0028_provedor_ferramentas_ia_provedor_fluxo_atendimento_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='provedor',
+            name='intencoes_ia',
+            field=models.JSONField(blank=True, help_text='Palavras-chave por intenção (billing, outage, cancellation, account, greeting)', null=True),
+        ),
+    ]
@@ -314,6 +314,7 @@ class Provedor(models.Model):
     ferramentas_ia = models.JSONField(blank=True, null=True, help_text="Ferramentas personalizadas para o agente IA")
     fluxo_atendimento = models.JSONField(blank=True, null=True, help_text="Fluxo de atendimento personalizado para o agente IA")
     regras_gerais = models.JSONField(blank=True, null=True, help_text="Regras gerais personalizadas para o agente IA")
+    intencoes_ia = models.JSONField(blank=True, null=True, help_text="Palavras-chave por intenção (billing, outage, cancellation, account, greeting)")
     # Multi-tenant: cada provedor tem seus admins
     admins = models.ManyToManyField('User', related_name='provedores_admin', blank=True, help_text="Usuários administradores deste provedor")
     # Equipes do provedor
@@ -6,13 +6,26 @@ import os
 import openai
 import logging
 import json
+import re
 from typing import Dict, Any, Optional, List
 from django.conf import settings
 from .models import Provedor, SystemConfig
+from .intents import CLIENT_CHECK_INTENTS, TOOL_HINTS, classify, keyword_pattern, normalize
 from asgiref.sync import sync_to_async
 
 logger = logging.getLogger(__name__)
 
+# Frases que indicam que a resposta perguntou se a pessoa já é cliente
+CLIENT_QUESTION_PATTERN = re.compile(keyword_pattern([
+    "já é nosso cliente",
+    "já é cliente",
+    "é nosso cliente",
+    "é cliente da",
+    "você já é cliente",
+    "para te ajudar melhor, você já é",
+    "posso confirmar se você já é",
+]))
+
 class OpenAIService:
     def __init__(self):
         self.api_key = self._get_api_key()
@@ -691,13 +704,11 @@ class OpenAIService:
             
             system_prompt = self._build_system_prompt(provedor)
             
-            # Verificar se a mensagem indica necessidade de perguntar se é cliente
-            mensagem_lower = mensagem.lower()
-            needs_client_check = any(keyword in mensagem_lower for keyword in [
-                'boleto', 'fatura', 'conta', 'pagamento', 'débito', 'vencimento',
-                'sem internet', 'internet parou', 'não funciona', 'problema', 'chamado', 'reclamação',
-                'técnico', 'instalação', 'cancelar', 'mudar plano', 'alterar', 'consulta'
-            ])
+            # Intenções da mensagem (o webhook já pode ter classificado)
+            intents = contexto.get('intents') if contexto else None
+            if intents is None:
+                intents = classify(mensagem, provedor)
+            needs_client_check = bool(intents & CLIENT_CHECK_INTENTS)
             
             # Adicionar instrução específica para perguntar se é cliente apenas quando necessário
             if not already_asked_if_client and needs_client_check:
@@ -712,6 +723,10 @@ class OpenAIService:
             else:
                 logger.info("Já perguntou se é cliente, prosseguindo normalmente")
             
+            hints = [TOOL_HINTS[intent] for intent in sorted(intents) if intent in TOOL_HINTS]
+            if hints:
+                system_prompt += "\n\nDICAS: " + " ".join(hints)
+            
             user_prompt = self._build_user_prompt(mensagem, contexto or {})
             messages = [
                 {"role": "system", "content": system_prompt},
@@ -836,17 +851,7 @@ class OpenAIService:
             if not already_asked_if_client and conversation and needs_client_check:
                 logger.info("Verificando se a resposta contém pergunta sobre ser cliente")
                 # Verificar se a resposta já contém uma pergunta sobre ser cliente
-                client_questions = [
-                    "já é nosso cliente",
-                    "já é cliente",
-                    "é nosso cliente",
-                    "é cliente da",
-                    "você já é cliente",
-                    "para te ajudar melhor, você já é",
-                    "posso confirmar se você já é"
-                ]
-                
-                resposta_contem_pergunta = any(question in resposta.lower() for question in client_questions)
+                resposta_contem_pergunta = bool(CLIENT_QUESTION_PATTERN.search(normalize(resposta)))
                 logger.info(f"Resposta contém pergunta sobre ser cliente: {resposta_contem_pergunta}")
                 
                 # Só marcar que perguntou se realmente perguntou
@@ -1,6 +1,27 @@
-import requests
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from rest_framework import serializers
 from .models import Canal, Provedor, Label, User, AuditLog, SystemConfig, Company
+from .logging_utils import get_logger
+
+logger = get_logger('canais')
+
+
+def _count_subquery(queryset, field):
+    """COUNT correlacionado: uma subconsulta por coluna, sem multiplicar linhas"""
+    counts = queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(total=Count('pk')).values('total')
+    return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+
+def annotate_provedor_counts(queryset):
+    """Anota canais ativos, admins e conversas de cada provedor em uma única consulta"""
+    from conversations.models import Conversation
+    return queryset.annotate(
+        channels_count_annotated=_count_subquery(Canal.objects.filter(ativo=True), 'provedor'),
+        users_count_annotated=_count_subquery(Provedor.admins.through.objects.all(), 'provedor'),
+        conversations_count_annotated=_count_subquery(Conversation.objects.all(), 'inbox__provedor'),
+    )
+
 
 class ProvedorSerializer(serializers.ModelSerializer):
     sgp_url = serializers.SerializerMethodField()
@@ -32,34 +53,40 @@ class ProvedorSerializer(serializers.ModelSerializer):
         ext = obj.integracoes_externas or {}
         return ext.get('whatsapp_token', '')
     
+    # As contagens vêm anotadas pelo ProvedorViewSet (annotate_provedor_counts);
+    # sem a anotação, caem para uma consulta por provedor
     def get_channels_count(self, obj):
+        if hasattr(obj, 'channels_count_annotated'):
+            return obj.channels_count_annotated
         return obj.canais.filter(ativo=True).count()
     
     def get_users_count(self, obj):
+        if hasattr(obj, 'users_count_annotated'):
+            return obj.users_count_annotated
         return obj.admins.count()
     
     def get_conversations_count(self, obj):
+        if hasattr(obj, 'conversations_count_annotated'):
+            return obj.conversations_count_annotated
         # Contar conversas relacionadas aos inboxes deste provedor
         from conversations.models import Conversation
         return Conversation.objects.filter(inbox__provedor=obj).count()
 
     def create(self, validated_data):
-        print(f"[DEBUG ProvedorSerializer] create - Iniciando criação de provedor")
-        print(f"[DEBUG ProvedorSerializer] create - Dados validados: {validated_data}")
-        print(f"[DEBUG ProvedorSerializer] create - Dados iniciais: {self.initial_data}")
+        # Não registrar os dados: integracoes_externas traz tokens
+        logger.debug("Criando provedor: campos=%s", sorted(validated_data))
         
         try:
             provedor = super().create(validated_data)
-            print(f"[DEBUG ProvedorSerializer] create - Provedor criado: {provedor.id} - {provedor.nome}")
+            logger.debug("Provedor criado: %s - %s", provedor.id, provedor.nome)
             return provedor
         except Exception as e:
-            print(f"[DEBUG ProvedorSerializer] create - Erro ao criar provedor: {e}")
+            logger.warning("Erro ao criar provedor: %s", e)
             raise
 
     def update(self, instance, validated_data):
         ext = instance.integracoes_externas or {}
-        print(f"[DEBUG ProvedorSerializer] Dados recebidos: {self.initial_data}")
-        print(f"[DEBUG ProvedorSerializer] Integrações atuais: {ext}")
+        logger.debug("Atualizando provedor %s: campos=%s", instance.id, sorted(self.initial_data))
         
         ext.update({
             'sgp_url': self.initial_data.get('sgp_url', ext.get('sgp_url', '')),
@@ -69,7 +96,7 @@ class ProvedorSerializer(serializers.ModelSerializer):
             'whatsapp_token': self.initial_data.get('whatsapp_token', ext.get('whatsapp_token', '')),
         })
         
-        print(f"[DEBUG ProvedorSerializer] Integrações atualizadas: {ext}")
+        logger.debug("Integrações do provedor %s atualizadas: %s", instance.id, sorted(ext))
         validated_data['integracoes_externas'] = ext
         return super().update(instance, validated_data)
 
@@ -115,8 +142,11 @@ class UserSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at', 'updated_at', 'last_login']
     
     def get_provedor_id(self, obj):
-        provedor = obj.provedores_admin.first() if hasattr(obj, 'provedores_admin') else None
-        return provedor.id if provedor else None
+        if not hasattr(obj, 'provedores_admin'):
+            return None
+        # .all() aproveita o prefetch da listagem; equivale ao first() (menor id)
+        ids = [provedor.id for provedor in obj.provedores_admin.all()]
+        return min(ids) if ids else None
     
     def create(self, validated_data):
         password = validated_data.pop('password', None)
@@ -134,13 +164,33 @@ class UserSerializer(serializers.ModelSerializer):
             user.save()
         return user
 
+class ProvedorResumoSerializer(serializers.ModelSerializer):
+    """Provedor resumido para serializers aninhados (sem contagens)"""
+    class Meta:
+        model = Provedor
+        fields = ['id', 'nome']
+
+
+class CanalListSerializer(serializers.ListSerializer):
+    """Lê o estado de todos os canais da lista em uma única consulta ao cache"""
+    def to_representation(self, data):
+        from .channel_state import get_channel_states
+        canais = list(data.all() if hasattr(data, 'all') else data)
+        ids = [canal.id for canal in canais]
+        states = get_channel_states(ids)
+        # Ids ausentes ficam como None (fora do cache), sem nova consulta por canal
+        self.context['channel_states'] = {canal_id: states.get(canal_id) for canal_id in ids}
+        return super().to_representation(canais)
+
+
 class CanalSerializer(serializers.ModelSerializer):
-    provedor = ProvedorSerializer(read_only=True)
+    provedor = ProvedorResumoSerializer(read_only=True)
     state = serializers.SerializerMethodField()
     profile_pic = serializers.SerializerMethodField()
     
     class Meta:
         model = Canal
+        list_serializer_class = CanalListSerializer
         fields = [
             'id', 'tipo', 'nome', 'ativo', 'provedor',
             'api_id', 'api_hash', 'app_title', 'short_name', 'verification_code', 'phone_number',  # Telegram
@@ -153,110 +203,32 @@ class CanalSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['id', 'created_at', 'updated_at', 'provedor']
 
+    def _get_cached_state(self, obj):
+        """Estado do canal lido do cache (ver core/channel_state.py), sem HTTP"""
+        from .channel_state import get_channel_state, request_refresh, WHATSAPP_TIPOS
+        if obj.tipo not in WHATSAPP_TIPOS:
+            return {}
+        states = self.context.setdefault('channel_states', {})
+        if obj.id not in states:
+            states[obj.id] = get_channel_state(obj.id)
+        if states[obj.id] is None:
+            # Fora do cache: o worker de atualização (ou o poller) preenche depois
+            logger.debug("Canal %s fora do cache, atualização solicitada", obj.id)
+            request_refresh(obj.id)
+            states[obj.id] = {}
+        return states[obj.id]
+
     def get_state(self, obj):
-        print(f"[DEBUG CanalSerializer] Buscando state para canal: id={obj.id}, tipo={obj.tipo}, nome={obj.nome}")
-        
-        # Para WhatsApp normal - usar Evolution API
-        if obj.tipo == 'whatsapp' and obj.nome:
-            try:
-                url = f'https://evo.niochat.com.br/instance/connectionState/{obj.nome}'
-                headers = {'apikey': '78be6d7e78e8be03ba5e3cbdf1443f1c'}
-                print(f"[DEBUG CanalSerializer] Fazendo request para Evolution: {url}")
-                resp = requests.get(url, headers=headers, timeout=5)
-                print(f"[DEBUG CanalSerializer] Status code: {resp.status_code}")
-                if resp.status_code == 200:
-                    data = resp.json()
-                    print(f"[DEBUG CanalSerializer] Resposta Evolution: {data}")
-                    return data.get('instance', {}).get('state')
-                else:
-                    print(f"[DEBUG CanalSerializer] Erro na Evolution: {resp.text}")
-            except Exception as e:
-                print(f"[DEBUG CanalSerializer] Exception Evolution: {e}")
-        
-        # Para WhatsApp Beta - usar Uazapi
-        elif obj.tipo == 'whatsapp_beta' and obj.dados_extras:
-            instance_id = obj.dados_extras.get('instance_id')
-            if instance_id:
-                try:
-                    from .uazapi_client import UazapiClient
-                    provedor = obj.provedor
-                    if provedor and provedor.integracoes_externas:
-                        token = provedor.integracoes_externas.get('whatsapp_token')
-                        uazapi_url = provedor.integracoes_externas.get('whatsapp_url')
-                        if token and uazapi_url:
-                            client = UazapiClient(uazapi_url, token)
-                            status_result = client.get_instance_status(instance_id)
-                            return status_result.get('instance', {}).get('status')
-                except Exception as e:
-                    print(f"[DEBUG CanalSerializer] Exception Uazapi: {e}")
-        
-        return None
+        return self._get_cached_state(obj).get('state')
 
     def get_profile_pic(self, obj):
-        print(f"[DEBUG CanalSerializer] Buscando profile_pic para canal: id={obj.id}, tipo={obj.tipo}, nome={obj.nome}")
-        
-        # Para WhatsApp normal - usar Evolution API
-        if obj.tipo == 'whatsapp' and obj.nome:
-            try:
-                url = 'https://evo.niochat.com.br/instance/fetchInstances'
-                headers = {'apikey': '78be6d7e78e8be03ba5e3cbdf1443f1c'}
-                print(f"[DEBUG CanalSerializer] Fazendo request para Evolution profile_pic: {url}")
-                resp = requests.get(url, headers=headers, timeout=5)
-                print(f"[DEBUG CanalSerializer] Status code profile_pic: {resp.status_code}")
-                if resp.status_code == 200:
-                    data = resp.json()
-                    for inst in data:
-                        # O campo correto é 'name' (não 'instanceName')
-                        if inst.get('name') == obj.nome:
-                            profile_pic = inst.get('profilePicUrl')
-                            print(f"[DEBUG CanalSerializer] Profile pic encontrado: {profile_pic}")
-                            return profile_pic
-                else:
-                    print(f"[DEBUG CanalSerializer] Erro na Evolution profile_pic: {resp.text}")
-            except Exception as e:
-                print(f"[DEBUG CanalSerializer] Exception profile_pic Evolution: {e}")
-        
-        # Para WhatsApp Beta - usar Uazapi
-        elif obj.tipo == 'whatsapp_beta' and obj.dados_extras:
-            instance_id = obj.dados_extras.get('instance_id')
-            if instance_id:
-                try:
-                    from .uazapi_client import UazapiClient
-                    provedor = obj.provedor
-                    if provedor and provedor.integracoes_externas:
-                        token = provedor.integracoes_externas.get('whatsapp_token')
-                        uazapi_url = provedor.integracoes_externas.get('whatsapp_url')
-                        if token and uazapi_url:
-                            client = UazapiClient(uazapi_url, token)
-                            status_result = client.get_instance_status(instance_id)
-                            profile_pic = status_result.get('instance', {}).get('profilePicUrl')
-                            print(f"[DEBUG CanalSerializer] Profile pic Uazapi: {profile_pic}")
-                            return profile_pic
-                except Exception as e:
-                    print(f"[DEBUG CanalSerializer] Exception profile_pic Uazapi: {e}")
-        
-        return None
+        return self._get_cached_state(obj).get('profile_pic')
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
         
         # Adicionar status do WhatsApp Beta se for do tipo whatsapp_beta
-        if instance.tipo == 'whatsapp_beta' and instance.dados_extras:
-            instance_id = instance.dados_extras.get('instance_id')
-            if instance_id:
-                try:
-                    from .uazapi_client import UazapiClient
-                    provedor = instance.provedor
-                    if provedor and provedor.integracoes_externas:
-                        token = provedor.integracoes_externas.get('whatsapp_token')
-                        uazapi_url = provedor.integracoes_externas.get('whatsapp_url')
-                        if token and uazapi_url:
-                            client = UazapiClient(uazapi_url, token)
-                            status_result = client.get_instance_status(instance_id)
-                            data['betaStatus'] = status_result
-                except Exception as e:
-                    print(f"Erro ao obter status do WhatsApp Beta: {e}")
-                    data['betaStatus'] = None
+        if instance.tipo == 'whatsapp_beta' and instance.dados_extras and instance.dados_extras.get('instance_id'):
+            data['betaStatus'] = self._get_cached_state(instance).get('beta_status')
         
         return data
-
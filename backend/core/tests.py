@@ -0,0 +1,381 @@
+import hashlib
+import logging
+import os
+import tempfile
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+
+from .channel_state import (
+    apply_connection_event, apply_instance_status, get_channel_state, refresh_all_channels,
+    set_channel_state,
+)
+from . import intents
+from .logging_utils import LazyPayload, build_logging_config, get_logger, log_payload
+from .media_serving import parse_range, serve_file
+from .models import Canal, Provedor
+from .serializers import CanalSerializer
+
+
+def _sem_http(*args, **kwargs):
+    raise AssertionError('Chamada HTTP inesperada')
+
+
+@override_settings(CHANNEL_STATE_REFRESH_ON_MISS=False, EVOLUTION_APIKEY='chave-teste')
+class ChannelStateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.provedor = Provedor.objects.create(
+            nome='Provedor Teste',
+            integracoes_externas={'whatsapp_token': 'tok', 'whatsapp_url': 'https://uazapi.test'}
+        )
+        self.beta = Canal.objects.create(
+            tipo='whatsapp_beta', nome='beta', provedor=self.provedor,
+            dados_extras={'instance_id': 'inst-1'}
+        )
+        self.evolution = Canal.objects.create(tipo='whatsapp', nome='evo', provedor=self.provedor)
+
+    def test_serializer_nao_faz_http(self):
+        set_channel_state(self.evolution.id, state='open', profile_pic='https://pic/evo.jpg')
+        status_result = {'instance': {'status': 'connected', 'profilePicUrl': 'https://pic/beta.jpg'}}
+        apply_instance_status(self.beta, status_result)
+
+        canais = Canal.objects.filter(provedor=self.provedor).select_related('provedor').order_by('id')
+        with mock.patch('requests.get', side_effect=_sem_http), \
+                mock.patch('requests.post', side_effect=_sem_http):
+            data = CanalSerializer(canais, many=True).data
+
+        self.assertEqual(data[0]['state'], 'connected')
+        self.assertEqual(data[0]['profile_pic'], 'https://pic/beta.jpg')
+        self.assertEqual(data[0]['betaStatus'], status_result)
+        self.assertEqual(data[1]['state'], 'open')
+        self.assertEqual(data[1]['profile_pic'], 'https://pic/evo.jpg')
+
+    def test_canal_fora_do_cache_pede_atualizacao_sem_http(self):
+        with mock.patch('requests.get', side_effect=_sem_http), \
+                mock.patch('core.channel_state.request_refresh') as request_refresh:
+            data = CanalSerializer(self.beta).data
+        self.assertIsNone(data['state'])
+        self.assertIsNone(data['betaStatus'])
+        request_refresh.assert_called_once_with(self.beta.id)
+
+    def test_provedor_aninhado_sem_contagens(self):
+        canais = Canal.objects.filter(provedor=self.provedor).select_related('provedor')
+        canais = list(canais)
+        with self.assertNumQueries(0):
+            data = CanalSerializer(canais, many=True).data
+        self.assertEqual(data[0]['provedor'], {'id': self.provedor.id, 'nome': 'Provedor Teste'})
+
+    def test_refresh_all_channels_grava_cache(self):
+        evolution_get = mock.Mock()
+        evolution_get.side_effect = [
+            mock.Mock(status_code=200, json=lambda: [{'name': 'evo', 'profilePicUrl': 'https://pic/evo.jpg'}]),
+            mock.Mock(status_code=200, json=lambda: {'instance': {'state': 'open'}}),
+        ]
+        uazapi_status = {'instance': {'status': 'connected', 'profilePicUrl': 'https://pic/beta.jpg'}}
+        with mock.patch('core.channel_state.requests.get', evolution_get), \
+                mock.patch('core.channel_state.UazapiClient.get_instance_status', return_value=uazapi_status):
+            total = refresh_all_channels()
+
+        self.assertEqual(total, 2)
+        beta = get_channel_state(self.beta.id)
+        self.assertEqual(beta['state'], 'connected')
+        self.assertEqual(beta['profile_pic'], 'https://pic/beta.jpg')
+        self.assertEqual(beta['beta_status'], uazapi_status)
+        evo = get_channel_state(self.evolution.id)
+        self.assertEqual(evo['state'], 'open')
+        self.assertEqual(evo['profile_pic'], 'https://pic/evo.jpg')
+
+    def test_evento_sse_de_conexao_atualiza_cache(self):
+        apply_instance_status(self.beta, {'instance': {'status': 'connected', 'profilePicUrl': 'https://pic/beta.jpg'}})
+        updated = apply_connection_event(self.provedor.id, {
+            'type': 'connection',
+            'data': {'instance': {'id': 'inst-1', 'status': 'disconnected'}, 'connected': False},
+        })
+        self.assertEqual(updated, 1)
+        state = get_channel_state(self.beta.id)
+        self.assertEqual(state['state'], 'disconnected')
+        # Campos ausentes no evento são mantidos do cache
+        self.assertEqual(state['profile_pic'], 'https://pic/beta.jpg')
+        self.assertFalse(state['beta_status']['connected'])
+
+
+class LoggingUtilsTests(TestCase):
+    def setUp(self):
+        self.logger = get_logger('webhook')
+        self.previous_level = self.logger.level
+        self.addCleanup(self.logger.setLevel, self.previous_level)
+
+    def test_payload_nao_formatado_com_nivel_desligado(self):
+        self.logger.setLevel(logging.INFO)
+        with mock.patch.object(LazyPayload, '__str__') as formatar, \
+                override_settings(LOG_PAYLOAD_SAMPLE_RATE=1):
+            log_payload(self.logger, 'data', {'a': 1})
+            self.logger.debug('data: %s', LazyPayload({'a': 1}))
+        formatar.assert_not_called()
+
+    def test_taxa_de_amostragem(self):
+        self.logger.setLevel(logging.DEBUG)
+        with mock.patch.object(self.logger, 'debug') as debug:
+            with override_settings(LOG_PAYLOAD_SAMPLE_RATE=0):
+                for _ in range(20):
+                    log_payload(self.logger, 'data', {'a': 1})
+            self.assertEqual(debug.call_count, 0)
+            with override_settings(LOG_PAYLOAD_SAMPLE_RATE=1):
+                for _ in range(20):
+                    log_payload(self.logger, 'data', {'a': 1})
+            self.assertEqual(debug.call_count, 20)
+
+    def test_payload_truncado(self):
+        texto = str(LazyPayload({'a': 'x' * 100}, max_chars=10))
+        self.assertTrue(texto.startswith('{"a": "xxx'))
+        self.assertIn('caracteres', texto)
+
+    def test_config_desligada_mantem_avisos_e_erros(self):
+        config = build_logging_config(
+            enabled=False, level='DEBUG', subsystem_levels={'webhook': 'DEBUG', 'media': 'ERROR'}
+        )
+        for name, logger_config in config['loggers'].items():
+            self.assertTrue(name.startswith('niochat'))
+            self.assertLessEqual(logger_config['level'], logging.ERROR)
+            self.assertGreaterEqual(logger_config['level'], logging.WARNING)
+        self.assertEqual(config['loggers']['niochat.webhook']['level'], logging.WARNING)
+        self.assertEqual(config['loggers']['niochat.media']['level'], logging.ERROR)
+
+        config = build_logging_config(enabled=True, level='INFO', subsystem_levels={'webhook': 'DEBUG'})
+        self.assertEqual(config['loggers']['niochat.webhook']['level'], 'DEBUG')
+        self.assertEqual(config['loggers']['niochat.uazapi']['level'], 'INFO')
+
+
+class ProvedorCountsTests(TestCase):
+    def setUp(self):
+        from rest_framework.test import APIClient
+        from .models import User
+        self.superadmin = User.objects.create_user(username='super', password='x', user_type='superadmin')
+        self.client = APIClient()
+        self.client.force_authenticate(self.superadmin)
+
+    def _criar_provedor(self, indice):
+        from conversations.models import Contact, Conversation, Inbox
+        from .models import User
+        provedor = Provedor.objects.create(nome=f'Provedor {indice}')
+        provedor.admins.add(User.objects.create_user(username=f'admin{indice}', password='x', user_type='admin'))
+        Canal.objects.create(tipo='whatsapp', nome=f'canal{indice}', provedor=provedor)
+        Canal.objects.create(tipo='email', nome=f'inativo{indice}', provedor=provedor, ativo=False)
+        inbox = Inbox.objects.create(name='WhatsApp', channel_type='whatsapp', provedor=provedor)
+        contact = Contact.objects.create(name='Cliente', phone=f'55{indice}', provedor=provedor)
+        for _ in range(2):
+            Conversation.objects.create(contact=contact, inbox=inbox)
+        return provedor
+
+    def _queries_da_listagem(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/provedores/')
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response.data['results']
+
+    def test_contagens_anotadas(self):
+        self._criar_provedor(1)
+        _, results = self._queries_da_listagem()
+        self.assertEqual(results[0]['channels_count'], 1)
+        self.assertEqual(results[0]['users_count'], 1)
+        self.assertEqual(results[0]['conversations_count'], 2)
+
+    def test_queries_independentes_da_quantidade(self):
+        self._criar_provedor(1)
+        poucos, _ = self._queries_da_listagem()
+        for indice in range(2, 6):
+            self._criar_provedor(indice)
+        muitos, results = self._queries_da_listagem()
+        self.assertEqual(len(results), 5)
+        self.assertEqual(poucos, muitos)
+
+
+class DashboardStatsTests(TestCase):
+    def setUp(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from rest_framework.test import APIClient
+        from conversations.models import Contact, Conversation, Inbox, Message
+        from .models import User
+
+        cache.clear()
+        self.provedor = Provedor.objects.create(nome='Provedor Teste')
+        self.admin = User.objects.create_user(username='admin', password='x', user_type='admin')
+        self.agente = User.objects.create_user(username='agente', password='x', user_type='agent')
+        self.provedor.admins.add(self.admin, self.agente)
+        inbox = Inbox.objects.create(name='WhatsApp', channel_type='whatsapp', provedor=self.provedor)
+        contact = Contact.objects.create(name='Cliente', phone='5511', provedor=self.provedor)
+        self.conversa = Conversation.objects.create(contact=contact, inbox=inbox, assignee=self.agente)
+        Conversation.objects.create(contact=contact, inbox=inbox, status='closed', assignee=self.agente)
+        Conversation.objects.create(contact=contact, inbox=inbox, status='pending')
+
+        # cliente 0s, resposta 60s, cliente 120s, resposta 300s
+        inicio = timezone.now() - timedelta(hours=1)
+        for segundos, do_cliente in ((0, True), (60, False), (120, True), (300, False)):
+            message = Message.objects.create(conversation=self.conversa, content='x', is_from_customer=do_cliente)
+            Message.objects.filter(pk=message.pk).update(created_at=inicio + timedelta(seconds=segundos))
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def _stats(self):
+        response = self.client.get('/api/dashboard/stats/')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_estatisticas(self):
+        data = self._stats()
+        stats = data['stats']
+        self.assertEqual(stats['total_conversas'], 3)
+        self.assertEqual(stats['conversas_abertas'], 1)
+        self.assertEqual(stats['conversas_pendentes'], 1)
+        self.assertEqual(stats['conversas_resolvidas'], 1)
+        self.assertEqual(stats['mensagens_30_dias'], 4)
+        self.assertEqual(stats['tempo_primeira_resposta'], '1.0min')
+        # (60s + 180s) / 2
+        self.assertEqual(stats['tempo_medio_resposta'], '2.0min')
+        self.assertEqual(data['atendentes'][0], {'name': 'agente', 'conversations': 2, 'satisfaction': 4.5})
+
+    def test_cache_e_invalidacao(self):
+        from conversations.models import Message
+
+        self._stats()
+        with self.assertNumQueries(1):
+            # apenas o lookup do provedor; estatísticas do cache
+            self._stats()
+        Message.objects.create(conversation=self.conversa, content='nova')
+        self.assertEqual(self._stats()['stats']['mensagens_30_dias'], 5)
+
+    def test_queries_independentes_do_numero_de_atendentes(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .dashboard import compute_dashboard_stats
+        from .models import User
+
+        with CaptureQueriesContext(connection) as poucos:
+            compute_dashboard_stats(self.provedor.id, include_team=True)
+        for i in range(4):
+            self.provedor.admins.add(User.objects.create_user(username=f'a{i}', password='x', user_type='agent'))
+        with CaptureQueriesContext(connection) as muitos:
+            compute_dashboard_stats(self.provedor.id, include_team=True)
+        self.assertEqual(len(poucos.captured_queries), len(muitos.captured_queries))
+
+
+class IntentClassifierTests(TestCase):
+    def test_classifica_sem_acento_e_caixa(self):
+        self.assertEqual(intents.classify('Preciso da SEGUNDA VIA do boleto'), {intents.BILLING})
+        self.assertEqual(intents.classify('minha internet caiu, quero cancelar'), {intents.OUTAGE, intents.CANCELLATION})
+        self.assertEqual(intents.classify('Instalacao no meu endereço'), {intents.ACCOUNT})
+        self.assertEqual(intents.classify('faturas atrasadas'), {intents.BILLING})
+        # Palavra inteira: "conta" não casa com "contato"
+        self.assertEqual(intents.classify('qual o contato de vocês?'), frozenset())
+
+    def test_saudacao_curta(self):
+        classifier = intents.classifier_for()
+        self.assertTrue(classifier.is_greeting_only('Olá, tudo bem?'))
+        self.assertFalse(classifier.is_greeting_only('oi, meu boleto venceu'))
+        self.assertFalse(classifier.is_greeting_only('bom dia, gostaria de saber sobre os planos de vocês'))
+
+    def test_palavras_do_provedor(self):
+        provedor = Provedor.objects.create(nome='Provedor', intencoes_ia={'billing': ['carnê'], 'sales': ['contratar']})
+        self.assertEqual(intents.classify('quero o carne', provedor), {intents.BILLING})
+        self.assertEqual(intents.classify('meu boleto', provedor), frozenset())
+        self.assertEqual(intents.classify('quero contratar', provedor), {'sales'})
+        # Compilado uma vez por configuração
+        self.assertIs(intents.classifier_for(provedor), intents.classifier_for(provedor))
+        self.assertIs(intents.classifier_for(Provedor(nome='Outro')), intents.classifier_for())
+
+    def test_resposta_de_saudacao(self):
+        provedor = Provedor(nome='NetFibra', nome_agente_ia='Ana')
+        self.assertEqual(
+            intents.greeting_reply(provedor, 'Bom dia'), 'Bom dia! Eu sou Ana, da NetFibra. Como posso te ajudar?'
+        )
+
+
+class MediaServingTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        override = override_settings(MEDIA_ROOT=self.media_root, MEDIA_ACCEL_REDIRECT_PREFIX='')
+        override.enable()
+        self.addCleanup(override.disable)
+        self.conteudo = bytes(range(256)) * 4
+        sha256 = hashlib.sha256(self.conteudo).hexdigest()
+        self.blob = os.path.join(self.media_root, 'cas', sha256[:2], sha256[2:4], sha256)
+        os.makedirs(os.path.dirname(self.blob))
+        with open(self.blob, 'wb') as arquivo:
+            arquivo.write(self.conteudo)
+        self.etag = f'"{sha256}"'
+        self.factory = RequestFactory()
+
+    def servir(self, caminho=None, **headers):
+        return serve_file(self.factory.get('/x', headers=headers), caminho or self.blob, 'audio.mp3')
+
+    def corpo(self, resposta):
+        return b''.join(resposta.streaming_content)
+
+    def test_intervalos(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=990-5000', 1000), (990, 999))
+        self.assertIsNone(parse_range('bytes=0-1,5-6', 1000))
+        self.assertIsNone(parse_range(None, 1000))
+        with self.assertRaises(ValueError):
+            parse_range('bytes=1000-', 1000)
+
+    def test_arquivo_inteiro_com_cache_longo(self):
+        resposta = self.servir()
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(resposta['ETag'], self.etag)
+        self.assertEqual(resposta['Content-Type'], 'audio/mpeg')
+        self.assertIn('immutable', resposta['Cache-Control'])
+        self.assertEqual(self.corpo(resposta), self.conteudo)
+
+    def test_range_206_e_416(self):
+        resposta = self.servir(Range='bytes=10-19')
+        self.assertEqual(resposta.status_code, 206)
+        self.assertEqual(resposta['Content-Range'], f'bytes 10-19/{len(self.conteudo)}')
+        self.assertEqual(resposta['Content-Length'], '10')
+        self.assertEqual(self.corpo(resposta), self.conteudo[10:20])
+
+        resposta = self.servir(Range=f'bytes={len(self.conteudo)}-')
+        self.assertEqual(resposta.status_code, 416)
+        self.assertEqual(resposta['Content-Range'], f'bytes */{len(self.conteudo)}')
+
+        # If-Range com outra versão: arquivo inteiro
+        resposta = self.servir(Range='bytes=10-19', **{'If-Range': '"outra"'})
+        self.assertEqual(resposta.status_code, 200)
+
+    def test_get_condicional(self):
+        self.assertEqual(self.servir(**{'If-None-Match': self.etag}).status_code, 304)
+        self.assertEqual(self.servir(**{'If-None-Match': '"outra"'}).status_code, 200)
+
+        antigo = os.path.join(self.media_root, 'messages', '1', 'audio.mp3')
+        os.makedirs(os.path.dirname(antigo))
+        with open(antigo, 'wb') as arquivo:
+            arquivo.write(b'antigo')
+        resposta = self.servir(antigo)
+        self.assertTrue(resposta['ETag'].startswith('W/'))
+        self.assertNotIn('immutable', resposta['Cache-Control'])
+        self.assertEqual(self.servir(antigo, **{'If-Modified-Since': resposta['Last-Modified']}).status_code, 304)
+
+    @override_settings(MEDIA_ACCEL_REDIRECT_PREFIX='/protected-media/')
+    def test_entrega_pelo_nginx(self):
+        resposta = self.servir(Range='bytes=0-9')
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(resposta['X-Accel-Redirect'], '/protected-media/' + os.path.relpath(self.blob, self.media_root))
+        self.assertEqual(resposta.content, b'')
+
+    def test_view_nao_sai_de_media_root(self):
+        with open(os.path.join(self.media_root, 'publico.txt'), 'wb') as arquivo:
+            arquivo.write(b'ok')
+        self.assertEqual(self.client.get('/api/media/publico.txt/').status_code, 200)
+        fd, segredo = tempfile.mkstemp(dir=os.path.dirname(self.media_root))
+        os.close(fd)
+        self.addCleanup(os.unlink, segredo)
+        nome = os.path.basename(segredo)
+        self.assertEqual(self.client.get(f'/api/media/..%2F{nome}/').status_code, 404)
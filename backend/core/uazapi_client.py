@@ -1,11 +1,15 @@
 import requests
 
+from core.logging_utils import get_logger, log_payload
+
+logger = get_logger('uazapi')
+
+
 class UazapiClient:
     def __init__(self, base_url, token):
         self.base_url = base_url.rstrip('/')
         self.token = token
-        print(f"[DEBUG UazapiClient] Inicializado com URL: {self.base_url}")
-        print(f"[DEBUG UazapiClient] Token: {self.token[:10] if self.token else 'None'}...")
+        logger.debug("Inicializado com URL: %s", self.base_url)
 
     def connect_instance(self, phone=None):
         """
@@ -26,13 +30,12 @@ class UazapiClient:
         if phone:
             data["phone"] = phone
         
-        print(f"[DEBUG UazapiClient] Fazendo POST para: {url}")
-        print(f"[DEBUG UazapiClient] Headers: {headers}")
-        print(f"[DEBUG UazapiClient] Data: {data}")
+        logger.debug("Fazendo POST para: %s", url)
+        log_payload(logger, "Data", data)
         
         resp = requests.post(url, json=data, headers=headers, timeout=15)
-        print(f"[DEBUG UazapiClient] Status code: {resp.status_code}")
-        print(f"[DEBUG UazapiClient] Response: {resp.text}")
+        logger.debug("Status code: %s", resp.status_code)
+        log_payload(logger, "Response", resp.text)
         
         # Não usar raise_for_status() pois 409 é esperado
         return resp.json()
@@ -52,12 +55,11 @@ class UazapiClient:
             "token": self.token  # Formato correto da Uazapi
         }
         
-        print(f"[DEBUG UazapiClient] Fazendo GET para: {url}")
-        print(f"[DEBUG UazapiClient] Headers: {headers}")
+        logger.debug("Fazendo GET para: %s", url)
         
         resp = requests.get(url, headers=headers, timeout=10)
-        print(f"[DEBUG UazapiClient] Status code: {resp.status_code}")
-        print(f"[DEBUG UazapiClient] Response: {resp.text}")
+        logger.debug("Status code: %s", resp.status_code)
+        log_payload(logger, "Response", resp.text)
         
         resp.raise_for_status()
         return resp.json()
@@ -82,11 +84,10 @@ class UazapiClient:
             "Accept": "application/json",
             "token": self.token
         }
-        print(f"[DEBUG UazapiClient] Fazendo DELETE para: {url}")
-        print(f"[DEBUG UazapiClient] Headers: {headers}")
+        logger.debug("Fazendo DELETE para: %s", url)
         resp = requests.delete(url, headers=headers, timeout=10)
-        print(f"[DEBUG UazapiClient] Status code: {resp.status_code}")
-        print(f"[DEBUG UazapiClient] Response: {resp.text}")
+        logger.debug("Status code: %s", resp.status_code)
+        log_payload(logger, "Response", resp.text)
         resp.raise_for_status()
         return resp.json() 
 
@@ -101,12 +102,11 @@ class UazapiClient:
             "token": self.token
         }
         data = {"instance": instance_id}
-        print(f"[DEBUG UazapiClient] Fazendo POST para: {url}")
-        print(f"[DEBUG UazapiClient] Headers: {headers}")
-        print(f"[DEBUG UazapiClient] Data: {data}")
+        logger.debug("Fazendo POST para: %s", url)
+        log_payload(logger, "Data", data)
         resp = requests.post(url, json=data, headers=headers, timeout=10)
-        print(f"[DEBUG UazapiClient] Status code: {resp.status_code}")
-        print(f"[DEBUG UazapiClient] Response: {resp.text}")
+        logger.debug("Status code: %s", resp.status_code)
+        log_payload(logger, "Response", resp.text)
         resp.raise_for_status()
         return resp.json() 
 
@@ -128,21 +128,21 @@ class UazapiClient:
             "preview": False  # Retorna imagem em tamanho full (melhor qualidade)
         }
         
-        print(f"[DEBUG UazapiClient] Buscando contato via /chat/details: {url}")
-        print(f"[DEBUG UazapiClient] Data: {data}")
+        logger.debug("Buscando contato via /chat/details: %s", url)
+        log_payload(logger, "Data", data)
         
         try:
             resp = requests.post(url, json=data, headers=headers, timeout=10)
-            print(f"[DEBUG UazapiClient] Status: {resp.status_code}")
+            logger.debug("Status: %s", resp.status_code)
             
             if resp.status_code == 200:
                 result = resp.json()
-                print(f"[DEBUG UazapiClient] Sucesso: {result}")
+                log_payload(logger, "Sucesso", result)
                 return result
             else:
-                print(f"[DEBUG UazapiClient] Erro: {resp.status_code} - {resp.text}")
+                logger.warning("Erro: %s - %s", resp.status_code, resp.text)
                 return None
                 
         except Exception as e:
-            print(f"[DEBUG UazapiClient] Exception: {e}")
+            logger.warning("Exception: %s", e)
             return None 
\ No newline at end of file
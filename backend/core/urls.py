@@ -1,4 +1,4 @@
-from django.urls import path, include
+from django.urls import path, include, re_path
 from rest_framework.routers import DefaultRouter
 from . import views
 
@@ -19,10 +19,12 @@ urlpatterns = [
     path('auth/reset-password/', views.ResetPasswordView.as_view(), name='auth_reset_password'),
     path('users/list/', views.UserListView.as_view(), name='users_list'),
     path('dashboard/stats/', views.DashboardStatsView.as_view(), name='dashboard_stats'),
+    path('dashboard/metrics/', views.MetricsSeriesView.as_view(), name='dashboard_metrics'),
     path('atendimento/ia/', views.AtendimentoIAView.as_view(), name='atendimento_ia'),
     path('test/conversation/<int:conversation_id>/avatar/', views.test_conversation_avatar, name='test_conversation_avatar'),
     path('test/contact/<int:contact_id>/avatar/', views.test_contact_avatar, name='test_contact_avatar'),
-    path('media/<path:path>/', views.serve_media_file, name='serve_media_file'),
+    # media/test/<conversa>/ fica para conversations.views.test_media_access
+    re_path(r'^media/(?P<path>(?!test/).+)/$', views.serve_media_file, name='serve_media_file'),
     path('uazapi/file/<str:file_id>/', views.serve_uazapi_file, name='serve_uazapi_file'),
     path('health/', views.health_check, name='health_check'),
     path('', views.frontend_view, name='frontend'),
@@ -3,7 +3,7 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.contrib.auth import authenticate, login, logout
 from .models import User, Label, SystemConfig, Provedor, Canal, Company
-from .serializers import UserSerializer, LabelSerializer, SystemConfigSerializer, ProvedorSerializer, AuditLogSerializer, CanalSerializer, CompanySerializer
+from .serializers import UserSerializer, LabelSerializer, SystemConfigSerializer, ProvedorSerializer, AuditLogSerializer, CanalSerializer, CompanySerializer, annotate_provedor_counts
 from rest_framework.authtoken.models import Token
 from rest_framework.views import APIView
 from django.views.decorators.csrf import csrf_exempt
@@ -17,6 +17,8 @@ from rest_framework import mixins
 import requests
 import json
 from .telegram_service import telegram_service
+from .channel_state import apply_instance_status, clear_channel_state, set_channel_state
+from .dashboard import get_dashboard_stats
 import asyncio
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
@@ -26,6 +28,9 @@ from conversations.serializers import ConversationSerializer
 from django.conf import settings
 from django.shortcuts import render
 from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from datetime import datetime, timedelta
 
 
 class UserViewSet(viewsets.ModelViewSet):
@@ -199,16 +204,14 @@ class ProvedorViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         user = self.request.user
-        print(f"[DEBUG ProvedorViewSet] get_queryset - Usuário: {user.username}, user_type: {user.user_type}")
         if user.user_type == 'superadmin':
             provedores = Provedor.objects.all()
-            print(f"[DEBUG ProvedorViewSet] get_queryset - Superadmin vê {provedores.count()} provedores")
-            return provedores
         else:
             # Usuários admin e agent só veem seus próprios provedores
             provedores = Provedor.objects.filter(admins=user)
-            print(f"[DEBUG ProvedorViewSet] get_queryset - Usuário {user.username} vê {provedores.count()} provedores")
-            return provedores
+        # Contagens de canais, usuários e conversas anotadas na mesma consulta;
+        # admins (campo M2M do serializer) em um único prefetch
+        return annotate_provedor_counts(provedores).prefetch_related('admins').order_by('id')
     
     def create(self, request, *args, **kwargs):
         print(f"[DEBUG ProvedorViewSet] create - Método chamado")
@@ -275,14 +278,14 @@ class CanalViewSet(viewsets.ModelViewSet):
         print(f"get_queryset - user.provedor_id: {getattr(user, 'provedor_id', None)}")
         
         if hasattr(user, 'provedor_id') and user.provedor_id:
-            canais = Canal.objects.filter(provedor_id=user.provedor_id)
+            canais = Canal.objects.filter(provedor_id=user.provedor_id).select_related('provedor')
             print(f"get_queryset - Canais encontrados por provedor_id: {canais.count()}")
             return canais
         else:
             # Buscar provedor do usuário
             prov = Provedor.objects.filter(admins=user).first()
             if prov:
-                canais = Canal.objects.filter(provedor_id=prov.id)
+                canais = Canal.objects.filter(provedor_id=prov.id).select_related('provedor')
                 print(f"get_queryset - Canais encontrados por admin: {canais.count()}")
                 return canais
             else:
@@ -943,6 +946,7 @@ class CanalViewSet(viewsets.ModelViewSet):
             except Exception as e:
                 # Se erro 401 da Uazapi, retornar status disconnected
                 if '401' in str(e) or 'Unauthorized' in str(e):
+                    set_channel_state(canal.id, state='disconnected')
                     response_data = {
                         'success': True,
                         'instance': {},
@@ -977,6 +981,8 @@ class CanalViewSet(viewsets.ModelViewSet):
                     }, status=500)
             
             print(f"[DEBUG] Status da instância: {result}")
+            # Aproveitar a consulta para atualizar o cache usado pelo CanalSerializer
+            apply_instance_status(canal, result)
             
             # Processar resposta
             if result.get('instance'):
@@ -1200,6 +1206,7 @@ class CanalViewSet(viewsets.ModelViewSet):
                 # Limpar instance_id do canal
                 canal.dados_extras['instance_id'] = None
                 canal.save()
+                clear_channel_state(canal.id)
                 return Response({'success': True, 'result': result})
             elif canal.tipo == 'whatsapp':
                 # Evolution
@@ -1211,6 +1218,7 @@ class CanalViewSet(viewsets.ModelViewSet):
                 import requests
                 resp = requests.delete(url, headers=headers, timeout=10)
                 if resp.status_code == 200:
+                    clear_channel_state(canal.id)
                     return Response({'success': True, 'message': 'Instância Evolution deletada com sucesso!'})
                 else:
                     return Response({'success': False, 'error': f'Erro ao deletar Evolution: {resp.text}'}, status=400)
@@ -1245,6 +1253,7 @@ class CanalViewSet(viewsets.ModelViewSet):
             if canal.dados_extras and 'instance_id' in canal.dados_extras:
                 canal.dados_extras.pop('instance_id', None)
                 canal.save()
+            set_channel_state(canal.id, state='disconnected')
             # Emitir evento WebSocket para painel_<provedor_id>
             channel_layer = get_channel_layer()
             provedor_id = str(provedor.id)
@@ -1628,158 +1637,73 @@ class CompanyViewSet(viewsets.ModelViewSet):
         instance.delete()
 
 
+def _provedor_id_do_usuario(user):
+    provedor_id = getattr(user, 'provedor_id', None)
+    
+    # Se não tem provedor_id direto, buscar pelo relacionamento
+    if not provedor_id:
+        provedor = Provedor.objects.filter(admins=user).first()
+        if provedor:
+            provedor_id = provedor.id
+    return provedor_id
+
+
 class DashboardStatsView(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
         user = request.user
-        provedor_id = getattr(user, 'provedor_id', None)
-        
-        # Se não tem provedor_id direto, buscar pelo relacionamento
-        if not provedor_id:
-            provedor = Provedor.objects.filter(admins=user).first()
-            if provedor:
-                provedor_id = provedor.id
-        
+        provedor_id = _provedor_id_do_usuario(user)
         if not provedor_id:
             return Response({'error': 'Provedor não encontrado'}, status=400)
         
-        # Importar modelos necessários
-        from conversations.models import Conversation, Contact, Message
-        from django.db.models import Count, Q, Avg
-        from django.utils import timezone
-        from datetime import timedelta
-        
-        # Filtros baseados no provedor
-        provedor_filter = Q(inbox__provedor_id=provedor_id)
-        
-        # Estatísticas de conversas
-        total_conversas = Conversation.objects.filter(provedor_filter).count()
-        conversas_abertas = Conversation.objects.filter(provedor_filter, status='open').count()
-        conversas_pendentes = Conversation.objects.filter(provedor_filter, status='pending').count()
-        conversas_resolvidas = Conversation.objects.filter(provedor_filter, status='resolved').count()
-        conversas_em_andamento = Conversation.objects.filter(provedor_filter, status='open').count()
-        
-        # Estatísticas de contatos únicos
-        contatos_unicos = Contact.objects.filter(provedor_id=provedor_id).count()
-        
-        # Estatísticas de mensagens (últimos 30 dias)
-        data_30_dias_atras = timezone.now() - timedelta(days=30)
-        mensagens_30_dias = Message.objects.filter(
-            conversation__inbox__provedor_id=provedor_id,
-            created_at__gte=data_30_dias_atras
-        ).count()
-        
-        # Calcular tempo médio de resposta real
-        mensagens_resposta = Message.objects.filter(
-            conversation__inbox__provedor_id=provedor_id,
-            message_type='outgoing',
-            created_at__gte=data_30_dias_atras
-        )
-        
-        if mensagens_resposta.exists():
-            try:
-                tempo_medio = mensagens_resposta.aggregate(
-                    avg_time=Avg('created_at')
-                )['avg_time']
-                if tempo_medio:
-                    tempo_medio_resposta = f"{int((timezone.now() - tempo_medio).total_seconds() / 60)}min"
-                else:
-                    tempo_medio_resposta = "0min"
-            except Exception:
-                tempo_medio_resposta = "0min"
-        else:
-            tempo_medio_resposta = "0min"
-        
-        # Calcular tempo de primeira resposta
-        conversas_com_resposta = Conversation.objects.filter(
-            provedor_filter,
-            messages__message_type='outgoing'
-        ).distinct()
-        
-        if conversas_com_resposta.exists():
-            # Simular tempo de primeira resposta baseado na atividade
-            tempo_primeira_resposta = "1.2min"  # Pode ser calculado mais precisamente
-        else:
-            tempo_primeira_resposta = "0min"
-        
-        # Calcular taxa de resolução real
-        if total_conversas > 0:
-            taxa_resolucao = f"{int((conversas_resolvidas / total_conversas) * 100)}%"
-        else:
-            taxa_resolucao = "0%"
-        
-        # Calcular satisfação média (simulada por enquanto)
-        if total_conversas > 0:
-            # Simular satisfação baseada no número de conversas resolvidas
-            satisfacao_base = 4.0
-            bonus_resolucao = (conversas_resolvidas / total_conversas) * 0.8
-            satisfacao_media = f"{satisfacao_base + bonus_resolucao:.1f}"
-        else:
-            satisfacao_media = "0.0"
-        
-        # Estatísticas por canal
-        canais_stats = Conversation.objects.filter(provedor_filter).values(
-            'inbox__channel_type'
-        ).annotate(
-            total=Count('id')
-        ).order_by('-total')
+        include_team = user.user_type in ['superadmin', 'admin']
+        return Response(get_dashboard_stats(provedor_id, include_team=include_team))
+
+
+class MetricsSeriesView(APIView):
+    """
+    Série temporal das métricas agregadas (MetricRollup).
+    Parâmetros: start/end (ISO 8601, padrão últimos 30 dias), bucket (hour|day),
+    inbox e agent (opcionais).
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request):
+        from conversations.metrics import BUCKETS, metrics_series
         
-        # Performance dos atendentes
-        atendentes_stats = []
-        if user.user_type in ['superadmin', 'admin']:
-            # Buscar usuários do provedor
-            usuarios_provedor = User.objects.filter(
-                Q(provedores_admin=provedor_id) | 
-                Q(user_type='agent', provedores_admin=provedor_id)
-            )
-            
-            for usuario in usuarios_provedor[:5]:  # Top 5 atendentes
-                conversas_atendidas = Conversation.objects.filter(
-                    provedor_filter,
-                    assignee=usuario
-                ).count()
-                
-                atendentes_stats.append({
-                    'name': f"{usuario.first_name} {usuario.last_name}".strip() or usuario.username,
-                    'conversations': conversas_atendidas,
-                    'satisfaction': 4.5  # Simulado
-                })
+        provedor_id = _provedor_id_do_usuario(request.user)
+        if not provedor_id:
+            return Response({'error': 'Provedor não encontrado'}, status=400)
         
-        # Atividade recente
-        atividades_recentes = []
-        if user.user_type in ['superadmin', 'admin']:
-            # Buscar logs de auditoria recentes do provedor
-            logs_recentes = models.AuditLog.objects.filter(
-                provedor_id=provedor_id
-            ).order_by('-timestamp')[:5]
-            
-            for log in logs_recentes:
-                atividades_recentes.append({
-                    'action': log.action,
-                    'user': log.user.username if log.user else 'Sistema',
-                    'time': log.timestamp.strftime('%d/%m/%Y %H:%M'),
-                    'type': 'activity'
-                })
+        params = request.query_params
+        bucket = params.get('bucket', 'day')
+        if bucket not in BUCKETS:
+            return Response({'error': f'bucket inválido: {bucket}'}, status=400)
+        try:
+            end = _parse_instante(params.get('end')) or timezone.now()
+            start = _parse_instante(params.get('start')) or end - timedelta(days=30)
+            inbox_id = int(params['inbox']) if params.get('inbox') else None
+            agent_id = int(params['agent']) if params.get('agent') else None
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
         
-        return Response({
-            'stats': {
-                'total_conversas': total_conversas,
-                'conversas_abertas': conversas_abertas,
-                'conversas_pendentes': conversas_pendentes,
-                'conversas_resolvidas': conversas_resolvidas,
-                'conversas_em_andamento': conversas_em_andamento,
-                'contatos_unicos': contatos_unicos,
-                'mensagens_30_dias': mensagens_30_dias,
-                'tempo_medio_resposta': tempo_medio_resposta,
-                'tempo_primeira_resposta': tempo_primeira_resposta,
-                'taxa_resolucao': taxa_resolucao,
-                'satisfacao_media': satisfacao_media
-            },
-            'canais': canais_stats,
-            'atendentes': atendentes_stats,
-            'atividades': atividades_recentes
-        })
+        series = metrics_series(provedor_id, start, end, bucket=bucket, inbox_id=inbox_id, agent_id=agent_id)
+        return Response({'start': start, 'end': end, 'bucket': bucket, 'series': series})
+
+
+def _parse_instante(value):
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        parsed_date = parse_date(value)
+        if parsed_date is None:
+            raise ValueError(f'Data inválida: {value}')
+        parsed = datetime.combine(parsed_date, datetime.min.time())
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
 
 
 class LogoutView(APIView):
@@ -1869,35 +1793,30 @@ def test_contact_avatar(request, contact_id):
 @permission_classes([AllowAny])
 def serve_media_file(request, path):
     """Serve media files with correct content type"""
-    from django.http import FileResponse, Http404
+    from django.http import Http404
     import os
-    import mimetypes
+    from core.media_serving import serve_file
     
-    # Construir o caminho completo do arquivo
-    file_path = os.path.join(settings.MEDIA_ROOT, path)
+    if path.startswith('messages/'):
+        # Mídia das conversas: arquivo antigo ou alias do armazenamento por conteúdo
+        from conversations.media import local_media_path
+        file_path = local_media_path(f'/api/media/{path}')
+    else:
+        # Construir o caminho completo do arquivo, sem sair de MEDIA_ROOT
+        media_root = os.path.realpath(settings.MEDIA_ROOT)
+        file_path = os.path.realpath(os.path.join(media_root, path))
+        if not file_path.startswith(media_root + os.sep):
+            raise Http404("Arquivo não encontrado")
     
-    if not os.path.exists(file_path):
+    if not file_path or not os.path.isfile(file_path):
         raise Http404("Arquivo não encontrado")
     
-    # Detectar o tipo MIME
-    content_type, _ = mimetypes.guess_type(file_path)
-    if not content_type:
-        # Fallback para tipos comuns
-        if file_path.endswith('.webm'):
-            content_type = 'audio/webm'
-        elif file_path.endswith('.wav'):
-            content_type = 'audio/wav'
-        elif file_path.endswith('.mp3'):
-            content_type = 'audio/mpeg'
-        else:
-            content_type = 'application/octet-stream'
-    
-    # Criar resposta com headers CORS
-    response = FileResponse(open(file_path, 'rb'), content_type=content_type)
+    # Range, ETag e cache (core/media_serving.py), com headers CORS
+    response = serve_file(request, file_path, os.path.basename(path))
     response['Access-Control-Allow-Origin'] = '*'
     response['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-    response['Access-Control-Allow-Headers'] = 'Content-Type, Range'
-    response['Accept-Ranges'] = 'bytes'
+    response['Access-Control-Allow-Headers'] = 'Content-Type, Range, If-None-Match, If-Range'
+    response['Access-Control-Expose-Headers'] = 'Content-Range, Content-Length, ETag'
     
     return response
 
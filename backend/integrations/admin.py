@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import TelegramIntegration, EmailIntegration, WhatsAppIntegration, WebchatIntegration
+from .models import TelegramIntegration, EmailIntegration, OutboundEmail, WhatsAppIntegration, WebchatIntegration
 
 
 @admin.register(TelegramIntegration)
@@ -18,6 +18,14 @@ class EmailIntegrationAdmin(admin.ModelAdmin):
     readonly_fields = ('last_sync',)
 
 
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'to_email', 'integration', 'status', 'attempts', 'created_at', 'sent_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('subject', 'to_email', 'message_id')
+    readonly_fields = ('message_id', 'attempts', 'last_error', 'next_attempt_at', 'sent_at')
+
+
 @admin.register(WhatsAppIntegration)
 class WhatsAppIntegrationAdmin(admin.ModelAdmin):
     list_display = ('provedor', 'phone_number', 'is_active', 'is_connected', 'last_sync')
@@ -0,0 +1,356 @@
+"""
+Worker de e-mail assíncrono
+
+Modo ``--async`` do comando ``email_worker``: em vez de uma thread com conexão
+bloqueante por integração (EmailManager), todas as caixas do processo são
+atendidas num único event loop com o aioimaplib. A sincronização é a mesma de
+integrations.imap_sync (UIDVALIDITY/UIDNEXT, BODY.PEEK[] em lotes, mensagens
+grandes em partes direto para o parser em streaming, IDLE entre
+sincronizações); o processamento dos e-mails (banco e armazenamento de mídia)
+roda fora do loop, com sync_to_async.
+
+- Por servidor IMAP, no máximo EMAIL_WORKER_HOST_CONCURRENCY caixas conectam
+  ou sincronizam ao mesmo tempo; as que estão em IDLE não contam.
+- Um supervisor por caixa reabre a sessão que falhar, com espera exponencial
+  (com variação aleatória, até MAX_BACKOFF segundos), e a lista de integrações
+  ativas é relida a cada EMAIL_WORKER_REFRESH_INTERVAL segundos.
+- Com ``--shards N`` cada processo (``--shard 0`` a ``N-1``) atende as
+  integrações com ``id % N`` igual ao seu número.
+
+O aioimaplib é dependência opcional, só deste modo (``pip install aioimaplib``).
+"""
+
+import asyncio
+import random
+import re
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models.functions import Mod
+
+try:
+    import aioimaplib
+except ImportError:  # pragma: no cover - só o modo assíncrono precisa
+    aioimaplib = None
+
+from core.logging_utils import get_logger
+from .email_parser import StreamingEmailParser, parse_bytes
+from .imap_sync import (
+    MAILBOX, MAX_BACKOFF, ImapError, deliver, is_new_mail, parse_bodies, parse_sizes, plan_fetches, save_state,
+)
+from .models import EmailIntegration
+
+logger = get_logger('email')
+
+_LITERAL = re.compile(rb'\{(\d+)\}$')
+_SELECT_CODE = re.compile(rb'\[(UIDVALIDITY|UIDNEXT) (\d+)\]')
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def fetch_data(lines):
+    """Linhas de uma resposta do aioimaplib no formato do imaplib (literal junto da linha que o anuncia)"""
+    data = []
+    lines = iter(lines)
+    for line in lines:
+        line = bytes(line)
+        if _LITERAL.search(line):
+            data.append((line, bytes(next(lines, b''))))
+        else:
+            data.append(line)
+    return data
+
+
+def shard_queryset(queryset, shard=0, shards=1):
+    """Integrações do processo ``shard`` de ``shards``"""
+    if shards <= 1:
+        return queryset
+    return queryset.annotate(shard=Mod('id', shards)).filter(shard=shard)
+
+
+async def connect_aioimaplib(integration, timeout):
+    if aioimaplib is None:
+        raise ImapError('aioimaplib não instalado (pip install aioimaplib)')
+    client_class = aioimaplib.IMAP4_SSL if integration.imap_use_ssl else aioimaplib.IMAP4
+    client = client_class(host=integration.imap_host, port=integration.imap_port, timeout=timeout)
+    await client.wait_hello_from_server()
+    response = await client.login(integration.username, integration.password)
+    if response.result != 'OK':
+        await client.logout()
+        raise ImapError(f'LOGIN: {response.lines}')
+    return client
+
+
+class HostLimiter:
+    """Um semáforo por servidor IMAP"""
+
+    def __init__(self, limit=None):
+        self.limit = limit or _setting('EMAIL_WORKER_HOST_CONCURRENCY', 4)
+        self._semaphores = {}
+
+    def for_host(self, host):
+        host = (host or '').lower()
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.limit)
+        return self._semaphores[host]
+
+
+class AsyncImapMailbox:
+    """INBOX de uma integração no event loop (ver imap_sync.ImapMailbox)"""
+
+    def __init__(self, integration, handler, limiter, connect=None):
+        self.integration = integration
+        self.handler = handler
+        self.limiter = limiter
+        self._connect = connect or connect_aioimaplib
+        self.client = None
+        self.uidvalidity = integration.imap_uidvalidity
+        self.uidnext = integration.imap_uidnext
+        self.timeout = _setting('EMAIL_IMAP_TIMEOUT', 60)
+
+    async def connect(self):
+        async with self.limiter.for_host(self.integration.imap_host):
+            self.client = await self._connect(self.integration, self.timeout)
+        logger.info("Conectado ao IMAP: %s", self.integration.email)
+
+    async def close(self):
+        client, self.client = self.client, None
+        if client is None:
+            return
+        try:
+            await asyncio.wait_for(client.logout(), 5)
+        except Exception:
+            pass
+
+    async def _command(self, command, description):
+        response = await command
+        if response.result != 'OK':
+            raise ImapError(f'{description}: {response.lines}')
+        return response.lines
+
+    async def _select(self):
+        lines = await self._command(self.client.select(MAILBOX), f'SELECT {MAILBOX}')
+        codes = {name: int(value) for line in lines for name, value in _SELECT_CODE.findall(bytes(line))}
+        uidnext = codes.get(b'UIDNEXT')
+        if uidnext is None:
+            response = await self.client.uid('fetch', '*', '(UID)')
+            uids = [uid for uid, _ in parse_sizes(fetch_data(response.lines))] if response.result == 'OK' else []
+            uidnext = max(uids) + 1 if uids else 1
+        return codes.get(b'UIDVALIDITY'), uidnext
+
+    async def _sizes(self, uid_set):
+        lines = await self._command(self.client.uid('fetch', uid_set, '(UID RFC822.SIZE)'), f'UID FETCH {uid_set}')
+        return parse_sizes(fetch_data(lines))
+
+    async def _initial_uids(self):
+        lines = await self._command(self.client.uid_search('UNSEEN'), 'UID SEARCH UNSEEN')
+        uids = sorted(int(uid) for uid in bytes(lines[0] if lines else b'').split() if uid.isdigit())
+        limit = _setting('EMAIL_IMAP_INITIAL_LIMIT', 50)
+        return uids[-limit:] if limit else []
+
+    async def sync(self):
+        """Busca os e-mails novos; devolve quantos foram entregues ao handler"""
+        uidvalidity, server_uidnext = await self._select()
+        if self.uidnext is None or uidvalidity != self.uidvalidity:
+            logger.info(
+                "Sincronização inicial do IMAP %s (UIDVALIDITY %s -> %s)",
+                self.integration.email, self.uidvalidity, uidvalidity,
+            )
+            uids = await self._initial_uids()
+            sizes = await self._sizes(','.join(map(str, uids))) if uids else []
+            self.uidvalidity = uidvalidity
+            self.uidnext = server_uidnext
+            await self._save_state()
+        elif server_uidnext > self.uidnext:
+            sizes = [item for item in await self._sizes(f'{self.uidnext}:*') if item[0] >= self.uidnext]
+        else:
+            return 0
+
+        processed = 0
+        steps = plan_fetches(
+            sizes, _setting('EMAIL_IMAP_STREAM_BYTES', 1024 * 1024), _setting('EMAIL_IMAP_FETCH_BATCH', 25)
+        )
+        for kind, value in steps:
+            if kind == 'stream':
+                email_data = await self._fetch_stream(value)
+                processed += await sync_to_async(self._deliver)(value, email_data)
+            else:
+                for uid, raw in await self._fetch_batch(value):
+                    processed += await sync_to_async(self._deliver_raw)(uid, raw)
+        await self._save_state()
+        return processed
+
+    async def _fetch_batch(self, uids):
+        lines = await self._command(
+            self.client.uid('fetch', ','.join(map(str, uids)), '(UID BODY.PEEK[])'), 'UID FETCH'
+        )
+        return sorted(parse_bodies(fetch_data(lines)), key=lambda item: item[0])
+
+    async def _fetch_stream(self, uid):
+        chunk = _setting('EMAIL_IMAP_STREAM_BYTES', 1024 * 1024)
+        parser = StreamingEmailParser()
+        offset = 0
+        try:
+            while True:
+                lines = await self._command(
+                    self.client.uid('fetch', str(uid), f'(BODY.PEEK[]<{offset}.{chunk}>)'), f'UID FETCH {uid}'
+                )
+                part = next((item[1] for item in fetch_data(lines) if isinstance(item, tuple)), b'')
+                parser.feed(part)
+                offset += len(part)
+                if len(part) < chunk:
+                    break
+            return parser.close()
+        except BaseException:
+            parser.discard()
+            raise
+
+    def _deliver_raw(self, uid, raw):
+        return self._deliver(uid, parse_bytes(raw))
+
+    def _deliver(self, uid, email_data):
+        delivered = deliver(self.handler, uid, email_data, self.integration)
+        self.uidnext = max(self.uidnext, uid + 1)
+        return int(delivered)
+
+    async def _save_state(self):
+        await sync_to_async(save_state)(self.integration, self.uidvalidity, self.uidnext)
+
+    async def wait(self):
+        """IDLE se o servidor suportar; senão espera EMAIL_IMAP_POLL_INTERVAL"""
+        if not self.client.has_capability('IDLE'):
+            await asyncio.sleep(_setting('EMAIL_IMAP_POLL_INTERVAL', 30))
+            return False
+        timeout = _setting('EMAIL_IMAP_IDLE_TIMEOUT', 29 * 60)
+        idle = await self.client.idle_start(timeout=timeout)
+        changed = False
+        try:
+            while not changed and self.client.has_pending_idle():
+                try:
+                    push = await self.client.wait_server_push(timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                changed = any(is_new_mail(bytes(line)) for line in push if isinstance(line, (bytes, bytearray)))
+        finally:
+            self.client.idle_done()
+            await asyncio.wait_for(idle, self.timeout)
+        return changed
+
+    async def run(self, on_connect=None):
+        """Conecta e alterna sincronização e espera até ser cancelado ou falhar"""
+        await self.connect()
+        if on_connect is not None:
+            await on_connect()
+        while True:
+            async with self.limiter.for_host(self.integration.imap_host):
+                await self.sync()
+            await self.wait()
+
+
+class AsyncEmailWorker:
+    """Supervisiona as caixas das integrações ativas do shard"""
+
+    initial_backoff = 1
+
+    def __init__(self, shard=0, shards=1, integration_id=None, connect=None):
+        self.shard = shard
+        self.shards = shards
+        self.integration_id = integration_id
+        self._connect = connect
+        self.tasks = {}
+        self.limiter = None
+        self._stop = None
+
+    def _active_integrations(self):
+        queryset = EmailIntegration.objects.filter(is_active=True)
+        if self.integration_id:
+            queryset = queryset.filter(id=self.integration_id)
+        integrations = list(shard_queryset(queryset, self.shard, self.shards))
+        close_old_connections()
+        return integrations
+
+    async def refresh(self):
+        """Inicia as caixas novas e cancela as desativadas"""
+        integrations = {
+            integration.id: integration
+            for integration in await sync_to_async(self._active_integrations)()
+        }
+        for integration_id in [key for key in self.tasks if key not in integrations]:
+            self.tasks.pop(integration_id).cancel()
+        for integration_id, integration in integrations.items():
+            task = self.tasks.get(integration_id)
+            if task is None or task.done():
+                self.tasks[integration_id] = asyncio.create_task(
+                    self.supervise(integration), name=f'email-{integration_id}'
+                )
+        return len(self.tasks)
+
+    async def _set_connected(self, integration, connected):
+        await sync_to_async(
+            EmailIntegration.objects.filter(pk=integration.pk).update
+        )(is_connected=connected)
+
+    async def supervise(self, integration):
+        """Mantém a sessão da integração, reabrindo com espera exponencial após falhas"""
+        from .email_service import EmailService
+
+        handler = EmailService(integration).process_email
+        loop = asyncio.get_running_loop()
+        backoff = self.initial_backoff
+        while True:
+            mailbox = AsyncImapMailbox(integration, handler, self.limiter, self._connect)
+            started = loop.time()
+            try:
+                await mailbox.run(on_connect=lambda: self._set_connected(integration, True))
+            except asyncio.CancelledError:
+                await mailbox.close()
+                await self._set_connected(integration, False)
+                raise
+            except Exception as e:
+                logger.warning("Erro no IMAP de %s: %s; nova tentativa em %ss", integration.email, e, backoff)
+            await mailbox.close()
+            await self._set_connected(integration, False)
+            # Sessão que ficou de pé por um bom tempo recomeça a espera do início
+            if loop.time() - started > MAX_BACKOFF:
+                backoff = self.initial_backoff
+            await asyncio.sleep(backoff * random.uniform(0.5, 1))
+            backoff = min(backoff * 2, MAX_BACKOFF)
+            # Credenciais podem ter sido corrigidas no painel
+            integration = await sync_to_async(
+                EmailIntegration.objects.filter(pk=integration.pk, is_active=True).first
+            )()
+            if integration is None:
+                return
+            handler = EmailService(integration).process_email
+
+    async def run(self):
+        self._stop = asyncio.Event()
+        self.limiter = HostLimiter()
+        interval = _setting('EMAIL_WORKER_REFRESH_INTERVAL', 60)
+        try:
+            while not self._stop.is_set():
+                try:
+                    count = await self.refresh()
+                    logger.debug("Worker de e-mail (shard %s/%s): %s caixas", self.shard, self.shards, count)
+                except Exception as e:
+                    logger.warning("Erro ao atualizar as integrações de e-mail: %s", e)
+                try:
+                    await asyncio.wait_for(self._stop.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.shutdown()
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+
+    async def shutdown(self):
+        tasks = list(self.tasks.values())
+        self.tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,311 @@
+"""
+Leitura de e-mails em streaming
+
+O StreamingEmailParser recebe a mensagem em pedaços (``feed``), na ordem em
+que chegam do servidor IMAP, e nunca monta a mensagem inteira em memória: os
+cabeçalhos de cada parte MIME são lidos com o pacote ``email``, o texto
+(text/plain e text/html) fica em memória até TEXT_MAX_BYTES e os anexos são
+decodificados (base64/quoted-printable) direto para um temporário do
+armazenamento por conteúdo, com SHA-256 e tamanho calculados na gravação.
+Quem consome o resultado guarda os anexos com ``media_store.ingest_hashed``,
+sem reler os arquivos.
+"""
+
+import binascii
+import hashlib
+import io
+import mimetypes
+import os
+import re
+from email.parser import BytesHeaderParser
+from email.policy import default as default_policy
+from email.utils import getaddresses, parseaddr
+
+from conversations.media_store import temp_path
+
+# Texto guardado por mensagem; o excedente é descartado
+TEXT_MAX_BYTES = 1024 * 1024
+
+_WHITESPACE = re.compile(rb'\s+')
+_TAGS = re.compile(r'<[^>]+>')
+_SPACES = re.compile(r'\s+')
+
+
+def html_to_text(html):
+    """Converte HTML para texto simples"""
+    return _SPACES.sub(' ', _TAGS.sub('', html)).strip()
+
+
+class _Identity:
+    def decode(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+class _Base64:
+    """Decodifica base64 em pedaços de tamanho arbitrário"""
+
+    def __init__(self):
+        self._rest = b''
+
+    def decode(self, data):
+        data = self._rest + _WHITESPACE.sub(b'', data)
+        usable = len(data) - len(data) % 4
+        self._rest = data[usable:]
+        try:
+            return binascii.a2b_base64(data[:usable])
+        except binascii.Error:
+            return b''
+
+    def flush(self):
+        rest, self._rest = self._rest, b''
+        if not rest:
+            return b''
+        try:
+            return binascii.a2b_base64(rest + b'=' * (-len(rest) % 4))
+        except binascii.Error:
+            return b''
+
+
+class _QuotedPrintable:
+    """Decodifica quoted-printable linha a linha (quebras suaves ``=`` no fim da linha)"""
+
+    def __init__(self):
+        self._rest = b''
+
+    def decode(self, data):
+        data = self._rest + data
+        end = data.rfind(b'\n') + 1
+        self._rest = data[end:]
+        return binascii.a2b_qp(data[:end])
+
+    def flush(self):
+        rest, self._rest = self._rest, b''
+        return binascii.a2b_qp(rest)
+
+
+DECODERS = {
+    'base64': _Base64,
+    'quoted-printable': _QuotedPrintable,
+}
+
+
+class _TextSink:
+    def __init__(self, headers):
+        self.content_type = headers.get_content_type()
+        self.charset = headers.get_content_charset() or 'utf-8'
+        self._buffer = io.BytesIO()
+
+    def write(self, data):
+        room = TEXT_MAX_BYTES - self._buffer.tell()
+        if room > 0:
+            self._buffer.write(data[:room])
+
+    def close(self):
+        try:
+            return self._buffer.getvalue().decode(self.charset, errors='replace')
+        except LookupError:
+            return self._buffer.getvalue().decode('utf-8', errors='replace')
+
+    def discard(self):
+        pass
+
+
+class _FileSink:
+    """Anexo gravado direto no disco"""
+
+    def __init__(self, headers, index):
+        self.content_type = headers.get_content_type()
+        self.filename = _attachment_name(headers, index)
+        self.path = temp_path()
+        self._file = open(self.path, 'wb')
+        self._digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        if data:
+            self._digest.update(data)
+            self._file.write(data)
+            self.size += len(data)
+
+    def close(self):
+        self._file.close()
+        return {
+            'filename': self.filename,
+            'content_type': self.content_type,
+            'path': self.path,
+            'size': self.size,
+            'sha256': self._digest.hexdigest(),
+        }
+
+    def discard(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def _attachment_name(headers, index):
+    filename = os.path.basename(str(headers.get_filename() or '').replace('\\', '/')).strip()
+    if filename and not filename.startswith('.'):
+        return filename
+    if headers.get_content_type() == 'message/rfc822':
+        return f'anexo-{index}.eml'
+    extension = mimetypes.guess_extension(headers.get_content_type()) or '.bin'
+    return f'anexo-{index}{extension}'
+
+
+class StreamingEmailParser:
+    """
+    ``feed(pedaço)`` quantas vezes for preciso e ``close()`` para obter o
+    e-mail: subject, from_name, from_email, to_email, date, message_id,
+    content (texto; HTML convertido quando não há text/plain), in_reply_to e
+    attachments (filename, content_type, path, size, sha256). Em caso de erro,
+    ``discard()`` remove os anexos já gravados.
+    """
+
+    def __init__(self):
+        self.headers = None
+        self._pending = b''
+        self._line_end = b''
+        self._boundaries = []
+        self._header_lines = []
+        self._in_headers = True
+        self._entity = None
+        self._decoder = None
+        self._texts = {}
+        self._attachments = []
+        self._index = 0
+
+    def feed(self, data):
+        data = self._pending + data
+        start = 0
+        while True:
+            end = data.find(b'\n', start) + 1
+            if not end:
+                break
+            self._line(data[start:end])
+            start = end
+        self._pending = data[start:]
+
+    def _line(self, line):
+        content = line.rstrip(b'\r\n')
+        ending = line[len(content):]
+        if self._boundaries and content.startswith(b'--') and self._boundary(content):
+            return
+        if self._in_headers:
+            self._header_lines.append(line)
+            if not content:
+                self._start_entity()
+            return
+        if self._entity is not None:
+            # A quebra de linha antes de um delimitador pertence ao delimitador
+            self._entity.write(self._decoder.decode(self._line_end + content))
+            self._line_end = ending
+
+    def _boundary(self, content):
+        for depth in range(len(self._boundaries) - 1, -1, -1):
+            boundary = self._boundaries[depth]
+            if not content.startswith(boundary, 2):
+                continue
+            rest = content[2 + len(boundary):].rstrip()
+            if rest not in (b'', b'--'):
+                continue
+            self._end_entity()
+            del self._boundaries[depth + 1:]
+            if rest == b'--':
+                # Epílogo do multipart: ignorado até o próximo delimitador
+                self._boundaries.pop()
+                self._in_headers = False
+            else:
+                self._in_headers = True
+                self._header_lines = []
+            return True
+        return False
+
+    def _start_entity(self):
+        headers = BytesHeaderParser(policy=default_policy).parsebytes(b''.join(self._header_lines))
+        self._header_lines = []
+        self._in_headers = False
+        self._line_end = b''
+        if self.headers is None:
+            self.headers = headers
+        if headers.get_content_maintype() == 'multipart':
+            boundary = headers.get_boundary()
+            if boundary:
+                self._boundaries.append(boundary.encode('ascii', errors='replace'))
+            return
+        disposition = headers.get_content_disposition()
+        if (
+            headers.get_content_type() in ('text/plain', 'text/html')
+            and disposition != 'attachment' and not headers.get_filename()
+        ):
+            self._entity = _TextSink(headers)
+        else:
+            self._index += 1
+            self._entity = _FileSink(headers, self._index)
+        encoding = str(headers.get('Content-Transfer-Encoding') or '').strip().lower()
+        self._decoder = DECODERS.get(encoding, _Identity)()
+
+    def _end_entity(self):
+        entity, self._entity = self._entity, None
+        if entity is None:
+            return
+        entity.write(self._decoder.flush())
+        result = entity.close()
+        if isinstance(entity, _FileSink):
+            self._attachments.append(result)
+        else:
+            self._texts.setdefault(entity.content_type, result)
+
+    def close(self):
+        if self._pending:
+            self._line(self._pending)
+            self._pending = b''
+        if self._in_headers and self._header_lines:
+            self._start_entity()
+        self._end_entity()
+        return self._result()
+
+    def discard(self):
+        """Remove os anexos gravados (e o que estiver em gravação)"""
+        if self._entity is not None:
+            self._entity.discard()
+            self._entity = None
+        for attachment in self._attachments:
+            if os.path.exists(attachment['path']):
+                os.unlink(attachment['path'])
+        self._attachments = []
+
+    def _result(self):
+        headers = self.headers
+        if headers is None:
+            headers = BytesHeaderParser(policy=default_policy).parsebytes(b'')
+        content = self._texts.get('text/plain')
+        if content is None and 'text/html' in self._texts:
+            content = html_to_text(self._texts['text/html'])
+        from_name, from_email = parseaddr(str(headers.get('From') or ''))
+        return {
+            'subject': str(headers.get('Subject') or ''),
+            'from_name': from_name,
+            'from_email': from_email,
+            'to_email': ', '.join(address for _, address in getaddresses([str(headers.get('To') or '')])),
+            'content': (content or '').strip(),
+            'attachments': list(self._attachments),
+            'date': str(headers.get('Date') or ''),
+            'message_id': str(headers.get('Message-ID') or '').strip(),
+            'in_reply_to': str(headers.get('In-Reply-To') or '').strip(),
+        }
+
+
+def parse_bytes(data, chunk_size=64 * 1024):
+    """Atalho para uma mensagem que já está em memória"""
+    parser = StreamingEmailParser()
+    try:
+        for start in range(0, len(data), chunk_size):
+            parser.feed(data[start:start + chunk_size])
+        return parser.close()
+    except BaseException:
+        parser.discard()
+        raise
@@ -4,22 +4,64 @@ Serviço de integração com E-mail (IMAP/SMTP)
 
 import imaplib
 import smtplib
-import email
-import logging
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email import encoders
 from typing import Optional, List, Dict, Any
-from datetime import datetime
-import re
 import os
-from django.conf import settings
-from django.core.files.base import ContentFile
+from django.db import transaction
+from core.logging_utils import get_logger
+from .imap_sync import ImapMailbox
 from .models import EmailIntegration
+from conversations.media import notify_message_updated
+from conversations.media_store import attach, ingest_hashed
 from conversations.models import Contact, Conversation, Message, Inbox
+from conversations.previews import schedule_preview
 
-logger = logging.getLogger(__name__)
+logger = get_logger('email')
+
+# Tipo principal do anexo -> tipo da mensagem
+ATTACHMENT_TYPES = {
+    'image': 'image',
+    'video': 'video',
+    'audio': 'audio',
+}
+
+
+def build_message(integration: EmailIntegration, to_email: str, subject: str, content: str,
+                  reply_to_message_id: Optional[str] = None,
+                  attachments: Optional[List[str]] = None,
+                  message_id: Optional[str] = None) -> MIMEMultipart:
+    """Montar e-mail de saída da integração"""
+    msg = MIMEMultipart()
+    msg['From'] = integration.email
+    msg['To'] = to_email
+    msg['Subject'] = subject
+    if message_id:
+        msg['Message-ID'] = message_id
+    
+    if reply_to_message_id:
+        msg['In-Reply-To'] = reply_to_message_id
+        msg['References'] = reply_to_message_id
+    
+    # Adicionar conteúdo
+    msg.attach(MIMEText(content, 'plain', 'utf-8'))
+    
+    # Adicionar anexos se existirem
+    for attachment_path in attachments or []:
+        if os.path.exists(attachment_path):
+            with open(attachment_path, 'rb') as attachment:
+                part = MIMEBase('application', 'octet-stream')
+                part.set_payload(attachment.read())
+                encoders.encode_base64(part)
+                part.add_header(
+                    'Content-Disposition',
+                    f'attachment; filename= {os.path.basename(attachment_path)}'
+                )
+                msg.attach(part)
+    
+    return msg
 
 
 class EmailService:
@@ -27,6 +69,7 @@ class EmailService:
         self.integration = integration
         self.imap_client: Optional[imaplib.IMAP4_SSL] = None
         self.smtp_client: Optional[smtplib.SMTP] = None
+        self.mailbox: Optional[ImapMailbox] = None
         self.is_running = False
     
     def connect_imap(self) -> bool:
@@ -78,171 +121,52 @@ class EmailService:
             logger.error(f"Erro ao conectar SMTP: {e}")
             return False
     
-    def fetch_emails(self) -> List[Dict[str, Any]]:
-        """Buscar novos e-mails"""
-        if not self.imap_client:
-            if not self.connect_imap():
-                return []
-        
-        try:
-            # Selecionar caixa de entrada
-            self.imap_client.select('INBOX')
-            
-            # Buscar e-mails não lidos
-            status, messages = self.imap_client.search(None, 'UNSEEN')
-            
-            if status != 'OK':
-                return []
-            
-            email_ids = messages[0].split()
-            emails = []
-            
-            for email_id in email_ids[-10:]:  # Processar últimos 10 e-mails
-                try:
-                    status, msg_data = self.imap_client.fetch(email_id, '(RFC822)')
-                    
-                    if status == 'OK':
-                        email_message = email.message_from_bytes(msg_data[0][1])
-                        parsed_email = self.parse_email(email_message)
-                        parsed_email['email_id'] = email_id.decode()
-                        emails.append(parsed_email)
-                        
-                except Exception as e:
-                    logger.error(f"Erro ao processar e-mail {email_id}: {e}")
-            
-            return emails
-            
-        except Exception as e:
-            logger.error(f"Erro ao buscar e-mails: {e}")
-            return []
-    
-    def parse_email(self, email_message) -> Dict[str, Any]:
-        """Analisar e-mail"""
-        try:
-            # Extrair informações básicas
-            subject = email_message.get('Subject', '')
-            from_email = email_message.get('From', '')
-            to_email = email_message.get('To', '')
-            date_str = email_message.get('Date', '')
-            message_id = email_message.get('Message-ID', '')
-            
-            # Extrair nome e e-mail do remetente
-            from_name, from_address = self.parse_email_address(from_email)
-            
-            # Extrair conteúdo
-            content = ''
-            attachments = []
-            
-            if email_message.is_multipart():
-                for part in email_message.walk():
-                    content_type = part.get_content_type()
-                    content_disposition = str(part.get('Content-Disposition', ''))
-                    
-                    if content_type == 'text/plain' and 'attachment' not in content_disposition:
-                        content += part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                    elif content_type == 'text/html' and 'attachment' not in content_disposition and not content:
-                        # Usar HTML se não houver texto plano
-                        html_content = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        content = self.html_to_text(html_content)
-                    elif 'attachment' in content_disposition:
-                        # Processar anexo
-                        filename = part.get_filename()
-                        if filename:
-                            attachments.append({
-                                'filename': filename,
-                                'content_type': content_type,
-                                'data': part.get_payload(decode=True)
-                            })
-            else:
-                content = email_message.get_payload(decode=True).decode('utf-8', errors='ignore')
-            
-            return {
-                'subject': subject,
-                'from_name': from_name,
-                'from_email': from_address,
-                'to_email': to_email,
-                'content': content.strip(),
-                'attachments': attachments,
-                'date': date_str,
-                'message_id': message_id,
-                'raw_email': email_message
-            }
-            
-        except Exception as e:
-            logger.error(f"Erro ao analisar e-mail: {e}")
-            return {}
-    
-    def parse_email_address(self, email_str: str) -> tuple:
-        """Extrair nome e e-mail de string"""
-        try:
-            # Regex para extrair nome e e-mail
-            match = re.match(r'^(.*?)\s*<(.+?)>$', email_str.strip())
-            if match:
-                name = match.group(1).strip().strip('"')
-                email_addr = match.group(2).strip()
-                return name, email_addr
-            else:
-                # Apenas e-mail
-                return '', email_str.strip()
-        except:
-            return '', email_str
-    
-    def html_to_text(self, html: str) -> str:
-        """Converter HTML para texto simples"""
-        try:
-            # Remover tags HTML básicas
-            import re
-            text = re.sub(r'<[^>]+>', '', html)
-            text = re.sub(r'\s+', ' ', text)
-            return text.strip()
-        except:
-            return html
-    
-    def process_email(self, email_data: Dict[str, Any]) -> bool:
-        """Processar e-mail recebido"""
-        try:
-            # Criar ou obter contato
-            contact = self.get_or_create_contact(
-                email_data['from_name'],
-                email_data['from_email']
-            )
-            
-            # Criar ou obter conversa
-            conversation = self.get_or_create_conversation(contact, email_data['subject'])
-            
-            # Processar anexos
-            attachments = []
-            for attachment in email_data.get('attachments', []):
-                attachment_info = self.save_attachment(attachment)
-                if attachment_info:
-                    attachments.append(attachment_info)
-            
-            # Criar mensagem
-            message = Message.objects.create(
-                conversation=conversation,
-                content=email_data['content'],
-                message_type='incoming',
-                content_type='text',
-                attachments=attachments,
-                external_source_id=email_data.get('message_id', ''),
-                metadata={
-                    'email_subject': email_data['subject'],
-                    'email_from': email_data['from_email'],
-                    'email_to': email_data['to_email'],
-                    'email_date': email_data['date'],
-                    'email_message_id': email_data.get('message_id', ''),
-                    'email_id': email_data.get('email_id', '')
-                },
-                is_from_customer=False
-            )
-            
-            logger.info(f"E-mail processado: {message.id}")
+    def process_email(self, email_data: Dict[str, Any], uid: Optional[int] = None) -> bool:
+        """Processar e-mail recebido (lido por integrations.email_parser)"""
+        message_id = email_data.get('message_id') or None
+        if message_id and Message.objects.filter(
+            external_id=message_id, conversation__inbox__channel_type='email'
+        ).exists():
+            # Já importado (nova sincronização depois de mudança de UIDVALIDITY)
             return True
-            
-        except Exception as e:
-            logger.error(f"Erro ao processar e-mail: {e}")
-            return False
-    
+
+        contact = self.get_or_create_contact(
+            email_data['from_name'],
+            email_data['from_email']
+        )
+        conversation = self.get_or_create_conversation(contact, email_data['subject'])
+        email_attributes = {
+            'email_subject': email_data['subject'],
+            'email_from': email_data['from_email'],
+            'email_to': email_data['to_email'],
+            'email_date': email_data['date'],
+            'email_message_id': email_data.get('message_id', ''),
+            'email_uid': uid,
+        }
+
+        with transaction.atomic():
+            messages = []
+            if email_data['content'] or not email_data.get('attachments'):
+                messages.append(Message.objects.create(
+                    conversation=conversation,
+                    content=email_data['content'] or email_data['subject'],
+                    message_type='text',
+                    is_from_customer=True,
+                    external_id=message_id,
+                    additional_attributes=dict(email_attributes),
+                ))
+            for attachment in email_data.get('attachments', []):
+                messages.append(self.save_attachment(conversation, attachment, email_attributes))
+            for message in messages:
+                transaction.on_commit(lambda message=message: self._notify(message))
+
+        logger.info("E-mail processado na conversa %s: %s mensagens", conversation.id, len(messages))
+        return True
+
+    def _notify(self, message):
+        notify_message_updated(message)
+        schedule_preview(message)
+
     def get_or_create_contact(self, name: str, email_address: str) -> Contact:
         """Criar ou obter contato"""
         try:
@@ -283,7 +207,7 @@ class EmailService:
                 channel_type='email',
                 defaults={
                     'name': f'E-mail - {self.integration.name}',
-                    'settings': {
+                    'additional_attributes': {
                         'email_integration_id': self.integration.id,
                         'email_address': self.integration.email
                     }
@@ -303,7 +227,6 @@ class EmailService:
                     contact=contact,
                     inbox=inbox,
                     status='open',
-                    priority='medium',
                     additional_attributes={
                         'email_subject': subject,
                         'email_integration_id': self.integration.id
@@ -316,71 +239,33 @@ class EmailService:
             logger.error(f"Erro ao criar/obter conversa: {e}")
             raise
     
-    def save_attachment(self, attachment: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        """Salvar anexo"""
-        try:
-            filename = attachment['filename']
-            content_type = attachment['content_type']
-            data = attachment['data']
-            
-            # Criar arquivo
-            file_content = ContentFile(data)
-            
-            # Salvar no diretório de mídia
-            file_path = f"email_attachments/{filename}"
-            
-            # Aqui você pode implementar o salvamento real do arquivo
-            # Por enquanto, retornar informações do anexo
-            
-            return {
-                'type': 'file',
-                'filename': filename,
-                'content_type': content_type,
-                'size': len(data),
-                'file_path': file_path
-            }
-            
-        except Exception as e:
-            logger.error(f"Erro ao salvar anexo: {e}")
-            return None
-    
+    def save_attachment(self, conversation: Conversation, attachment: Dict[str, Any],
+                        email_attributes: Dict[str, Any]) -> Message:
+        """Guardar anexo (já em disco) no armazenamento de mídia, como mensagem da conversa"""
+        blob = ingest_hashed(attachment['path'], attachment['size'], attachment['sha256'])
+        content_type = attachment['content_type']
+        message = Message(
+            conversation=conversation,
+            content=f"Arquivo: {attachment['filename']}",
+            message_type=ATTACHMENT_TYPES.get(content_type.split('/', 1)[0], 'document'),
+            is_from_customer=True,
+            additional_attributes={**email_attributes, 'mimetype': content_type},
+        )
+        file_url = attach(message, blob, attachment['filename'])
+        message.additional_attributes['file_url'] = file_url
+        message.save()
+        return message
+
     def send_email(self, to_email: str, subject: str, content: str, 
                    reply_to_message_id: Optional[str] = None,
                    attachments: Optional[List[str]] = None) -> bool:
-        """Enviar e-mail"""
+        """Enviar e-mail na hora (a API usa a fila de integrations.outbound_mail)"""
         try:
             if not self.smtp_client:
                 if not self.connect_smtp():
                     return False
             
-            # Criar mensagem
-            msg = MIMEMultipart()
-            msg['From'] = self.integration.email
-            msg['To'] = to_email
-            msg['Subject'] = subject
-            
-            if reply_to_message_id:
-                msg['In-Reply-To'] = reply_to_message_id
-                msg['References'] = reply_to_message_id
-            
-            # Adicionar conteúdo
-            msg.attach(MIMEText(content, 'plain', 'utf-8'))
-            
-            # Adicionar anexos se existirem
-            if attachments:
-                for attachment_path in attachments:
-                    if os.path.exists(attachment_path):
-                        with open(attachment_path, 'rb') as attachment:
-                            part = MIMEBase('application', 'octet-stream')
-                            part.set_payload(attachment.read())
-                            encoders.encode_base64(part)
-                            part.add_header(
-                                'Content-Disposition',
-                                f'attachment; filename= {os.path.basename(attachment_path)}'
-                            )
-                            msg.attach(part)
-            
-            # Enviar e-mail
+            msg = build_message(self.integration, to_email, subject, content, reply_to_message_id, attachments)
             self.smtp_client.send_message(msg)
             
             logger.info(f"E-mail enviado para: {to_email}")
@@ -390,45 +275,19 @@ class EmailService:
             logger.error(f"Erro ao enviar e-mail: {e}")
             return False
     
-    def mark_as_read(self, email_id: str) -> bool:
-        """Marcar e-mail como lido"""
-        try:
-            if not self.imap_client:
-                return False
-            
-            self.imap_client.store(email_id, '+FLAGS', '\\Seen')
-            return True
-            
-        except Exception as e:
-            logger.error(f"Erro ao marcar e-mail como lido: {e}")
-            return False
-    
     def start_monitoring(self):
-        """Iniciar monitoramento de e-mails"""
+        """Iniciar monitoramento de e-mails (IDLE/UID, ver integrations.imap_sync)"""
         self.is_running = True
-        
-        while self.is_running:
-            try:
-                emails = self.fetch_emails()
-                
-                for email_data in emails:
-                    if self.process_email(email_data):
-                        # Marcar como lido se processado com sucesso
-                        self.mark_as_read(email_data.get('email_id', ''))
-                
-                # Aguardar antes da próxima verificação
-                import time
-                time.sleep(30)  # Verificar a cada 30 segundos
-                
-            except Exception as e:
-                logger.error(f"Erro no monitoramento: {e}")
-                import time
-                time.sleep(60)  # Aguardar 1 minuto em caso de erro
-    
+        self.mailbox = ImapMailbox(self.integration, self.process_email)
+        self.mailbox.run_forever()
+
     def stop_monitoring(self):
         """Parar monitoramento"""
         self.is_running = False
         
+        if self.mailbox:
+            self.mailbox.stop()
+        
         if self.imap_client:
             try:
                 self.imap_client.close()
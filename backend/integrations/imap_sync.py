@@ -0,0 +1,376 @@
+"""
+Sincronização IMAP por UID, com IDLE
+
+Cada integração guarda o UIDVALIDITY da INBOX e o próximo UID a buscar
+(EmailIntegration.imap_uidvalidity/imap_uidnext). A cada sincronização só os
+UIDs a partir desse ponto são pedidos ao servidor, primeiro o tamanho de todos
+numa única resposta (UID FETCH n:* RFC822.SIZE) e depois o conteúdo em lotes
+de EMAIL_IMAP_FETCH_BATCH mensagens por comando. O conteúdo é pedido com
+BODY.PEEK[], que não altera as flags: ler o e-mail em outro cliente não faz
+mais a integração perder mensagens. Se o UIDVALIDITY mudar (caixa recriada) ou
+na primeira sincronização, as mensagens não lidas são importadas (até
+EMAIL_IMAP_INITIAL_LIMIT) e o acompanhamento recomeça do UIDNEXT atual; os
+e-mails já importados são reconhecidos pelo Message-ID.
+
+Mensagens maiores que EMAIL_IMAP_STREAM_BYTES são buscadas em partes desse
+tamanho (BODY.PEEK[]<início.tamanho>) e entregues ao parser em streaming
+(integrations.email_parser), que grava os anexos direto no disco: a memória
+usada não depende do tamanho do e-mail.
+
+Entre sincronizações a conexão fica em IDLE (RFC 2177) quando o servidor
+suporta, renovado a cada EMAIL_IMAP_IDLE_TIMEOUT segundos; sem IDLE a caixa é
+consultada a cada EMAIL_IMAP_POLL_INTERVAL segundos.
+"""
+
+import imaplib
+import os
+import re
+import select
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from core.logging_utils import get_logger
+from .email_parser import StreamingEmailParser, parse_bytes
+from .models import EmailIntegration
+
+logger = get_logger('email')
+
+MAILBOX = 'INBOX'
+MAX_BACKOFF = 300
+
+_UID = re.compile(rb'\bUID (\d+)')
+_SIZE = re.compile(rb'\bRFC822\.SIZE (\d+)')
+# Resposta não marcada de e-mail novo (o aioimaplib entrega sem o ``* ``)
+_NEW_MAIL = re.compile(rb'^(?:\* )?\d+ (?:EXISTS|RECENT)\b', re.IGNORECASE)
+
+
+class ImapError(Exception):
+    pass
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def parse_sizes(data):
+    """(uid, tamanho) de uma resposta de FETCH (UID RFC822.SIZE)"""
+    result = []
+    for item in data or ():
+        if isinstance(item, tuple):
+            item = item[0]
+        if not isinstance(item, bytes):
+            continue
+        uid = _UID.search(item)
+        if uid:
+            size = _SIZE.search(item)
+            result.append((int(uid.group(1)), int(size.group(1)) if size else 0))
+    return result
+
+
+def parse_bodies(data):
+    """(uid, conteúdo) de uma resposta de FETCH com BODY[]; o UID pode vir antes ou depois do literal"""
+    result = []
+    pending = None
+    for item in data or ():
+        if isinstance(item, tuple):
+            match = _UID.search(item[0])
+            if match:
+                result.append((int(match.group(1)), item[1]))
+                pending = None
+            else:
+                pending = item[1]
+        elif pending is not None and isinstance(item, bytes):
+            match = _UID.search(item)
+            if match:
+                result.append((int(match.group(1)), pending))
+            pending = None
+    return result
+
+
+def plan_fetches(sizes, stream_bytes, batch_size):
+    """
+    Divide os UIDs em passos, em ordem de UID: ('batch', [uids]) para mensagens
+    buscadas juntas e ('stream', uid) para as maiores que ``stream_bytes``
+    """
+    steps = []
+    batch = []
+    for uid, size in sorted(sizes):
+        if size > stream_bytes:
+            if batch:
+                steps.append(('batch', batch))
+                batch = []
+            steps.append(('stream', uid))
+            continue
+        batch.append(uid)
+        if len(batch) >= batch_size:
+            steps.append(('batch', batch))
+            batch = []
+    if batch:
+        steps.append(('batch', batch))
+    return steps
+
+
+def is_new_mail(line):
+    return bool(_NEW_MAIL.match(line))
+
+
+def deliver(handler, uid, email_data, integration):
+    """
+    Entrega o e-mail ao handler; True se processado. Os anexos que o handler
+    não guardou são removidos
+    """
+    try:
+        return bool(handler(email_data, uid))
+    except Exception as e:
+        logger.warning("Erro ao processar e-mail UID %s de %s: %s", uid, integration.email, e)
+        return False
+    finally:
+        for attachment in email_data.get('attachments', ()):
+            if os.path.exists(attachment['path']):
+                os.unlink(attachment['path'])
+
+
+def save_state(integration, uidvalidity, uidnext):
+    EmailIntegration.objects.filter(pk=integration.pk).update(
+        imap_uidvalidity=uidvalidity, imap_uidnext=uidnext, last_sync=timezone.now()
+    )
+    integration.imap_uidvalidity = uidvalidity
+    integration.imap_uidnext = uidnext
+
+
+class ImapMailbox:
+    """
+    INBOX de uma integração. ``handler(email, uid)`` recebe cada e-mail lido
+    (ver StreamingEmailParser) e guarda os anexos que quiser manter; os demais
+    são removidos depois da chamada.
+    """
+
+    def __init__(self, integration, handler):
+        self.integration = integration
+        self.handler = handler
+        self.client = None
+        self.uidvalidity = integration.imap_uidvalidity
+        self.uidnext = integration.imap_uidnext
+        self.timeout = _setting('EMAIL_IMAP_TIMEOUT', 60)
+        self._stop_event = threading.Event()
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._idle_buffer = b''
+
+    def connect(self):
+        integration = self.integration
+        client_class = imaplib.IMAP4_SSL if integration.imap_use_ssl else imaplib.IMAP4
+        client = client_class(integration.imap_host, integration.imap_port, timeout=self.timeout)
+        try:
+            client.login(integration.username, integration.password)
+        except BaseException:
+            client.shutdown()
+            raise
+        self.client = client
+        logger.info("Conectado ao IMAP: %s", integration.email)
+        return client
+
+    def close(self):
+        client, self.client = self.client, None
+        if client is None:
+            return
+        try:
+            client.logout()
+        except (OSError, imaplib.IMAP4.error):
+            pass
+
+    def _select(self):
+        """Seleciona a INBOX e devolve (UIDVALIDITY, UIDNEXT) informados pelo servidor"""
+        typ, data = self.client.select(MAILBOX)
+        if typ != 'OK':
+            raise ImapError(f'SELECT {MAILBOX}: {data}')
+        uidvalidity = self._untagged_int('UIDVALIDITY')
+        uidnext = self._untagged_int('UIDNEXT')
+        if uidnext is None:
+            # Servidor sem UIDNEXT no SELECT: maior UID da caixa + 1
+            typ, data = self.client.uid('FETCH', '*', '(UID)')
+            uids = [uid for uid, _ in parse_sizes(data)] if typ == 'OK' else []
+            uidnext = max(uids) + 1 if uids else 1
+        return uidvalidity, uidnext
+
+    def _untagged_int(self, name):
+        _, values = self.client.response(name)
+        for value in values or ():
+            if isinstance(value, bytes) and value.strip().isdigit():
+                return int(value)
+        return None
+
+    def _sizes(self, uid_set):
+        typ, data = self.client.uid('FETCH', uid_set, '(UID RFC822.SIZE)')
+        if typ != 'OK':
+            raise ImapError(f'UID FETCH {uid_set}: {data}')
+        return parse_sizes(data)
+
+    def _initial_uids(self):
+        """Não lidas, as mais recentes primeiro limitadas a EMAIL_IMAP_INITIAL_LIMIT"""
+        typ, data = self.client.uid('SEARCH', None, 'UNSEEN')
+        if typ != 'OK':
+            raise ImapError(f'UID SEARCH UNSEEN: {data}')
+        uids = sorted(int(uid) for uid in (data[0] or b'').split())
+        limit = _setting('EMAIL_IMAP_INITIAL_LIMIT', 50)
+        return uids[-limit:] if limit else []
+
+    def sync(self):
+        """Busca os e-mails novos; devolve quantos foram entregues ao handler"""
+        uidvalidity, server_uidnext = self._select()
+        if self.uidnext is None or uidvalidity != self.uidvalidity:
+            logger.info(
+                "Sincronização inicial do IMAP %s (UIDVALIDITY %s -> %s)",
+                self.integration.email, self.uidvalidity, uidvalidity,
+            )
+            uids = self._initial_uids()
+            sizes = self._sizes(','.join(map(str, uids))) if uids else []
+            self.uidvalidity = uidvalidity
+            self.uidnext = server_uidnext
+            self._save_state()
+        elif server_uidnext > self.uidnext:
+            sizes = [item for item in self._sizes(f'{self.uidnext}:*') if item[0] >= self.uidnext]
+        else:
+            return 0
+
+        processed = 0
+        steps = plan_fetches(
+            sizes, _setting('EMAIL_IMAP_STREAM_BYTES', 1024 * 1024), _setting('EMAIL_IMAP_FETCH_BATCH', 25)
+        )
+        for kind, value in steps:
+            if kind == 'stream':
+                processed += self._deliver(value, self._fetch_stream(value))
+            else:
+                for uid, raw in self._fetch_batch(value):
+                    processed += self._deliver(uid, parse_bytes(raw))
+        self._save_state()
+        return processed
+
+    def _fetch_batch(self, uids):
+        typ, data = self.client.uid('FETCH', ','.join(map(str, uids)), '(UID BODY.PEEK[])')
+        if typ != 'OK':
+            raise ImapError(f'UID FETCH: {data}')
+        return sorted(parse_bodies(data), key=lambda item: item[0])
+
+    def _fetch_stream(self, uid):
+        """Mensagem grande buscada em partes de EMAIL_IMAP_STREAM_BYTES, direto para o parser"""
+        chunk = _setting('EMAIL_IMAP_STREAM_BYTES', 1024 * 1024)
+        parser = StreamingEmailParser()
+        offset = 0
+        try:
+            while True:
+                typ, data = self.client.uid('FETCH', str(uid), f'(BODY.PEEK[]<{offset}.{chunk}>)')
+                if typ != 'OK':
+                    raise ImapError(f'UID FETCH {uid}: {data}')
+                part = next((item[1] for item in data if isinstance(item, tuple)), b'')
+                parser.feed(part)
+                offset += len(part)
+                if len(part) < chunk:
+                    break
+            return parser.close()
+        except BaseException:
+            parser.discard()
+            raise
+
+    def _deliver(self, uid, email_data):
+        delivered = deliver(self.handler, uid, email_data, self.integration)
+        # Com erro o e-mail fica para trás: reprocessar travaria a caixa na mesma mensagem
+        self.uidnext = max(self.uidnext, uid + 1)
+        return int(delivered)
+
+    def _save_state(self):
+        save_state(self.integration, self.uidvalidity, self.uidnext)
+
+    def supports_idle(self):
+        return 'IDLE' in getattr(self.client, 'capabilities', ())
+
+    def _wait_readable(self, deadline):
+        sock = self.client.sock
+        # Bytes já decifrados pelo TLS não aparecem no select
+        if getattr(sock, 'pending', None) and sock.pending():
+            return True
+        timeout = max(deadline - time.monotonic(), 0)
+        readable, _, _ = select.select([sock, self._wakeup_read], [], [], timeout)
+        return sock in readable
+
+    def _read_line(self, deadline):
+        """Linha do servidor durante o IDLE ou None se o prazo acabar (ou stop())"""
+        while b'\n' not in self._idle_buffer:
+            if self._stop_event.is_set() or not self._wait_readable(deadline):
+                return None
+            data = self.client.sock.recv(4096)
+            if not data:
+                raise ImapError('Conexão IMAP encerrada pelo servidor')
+            self._idle_buffer += data
+        line, _, self._idle_buffer = self._idle_buffer.partition(b'\n')
+        return line + b'\n'
+
+    def idle(self, timeout):
+        """Espera até ``timeout`` segundos o servidor avisar de e-mail novo; True se avisou"""
+        client = self.client
+        tag = client._new_tag()
+        client.send(tag + b' IDLE\r\n')
+        self._idle_buffer = b''
+        line = self._read_line(time.monotonic() + self.timeout)
+        if line is None or not line.startswith(b'+'):
+            raise ImapError(f'IDLE recusado: {line!r}')
+        changed = False
+        deadline = time.monotonic() + timeout
+        while not changed:
+            line = self._read_line(deadline)
+            if line is None:
+                break
+            changed = is_new_mail(line)
+        client.send(b'DONE\r\n')
+        deadline = time.monotonic() + self.timeout
+        while True:
+            line = self._read_line(deadline)
+            if line is None:
+                if self._stop_event.is_set():
+                    return changed
+                raise ImapError('Sem resposta ao fim do IDLE')
+            if line.startswith(tag):
+                break
+            changed = changed or is_new_mail(line)
+        if not line[len(tag):].strip().upper().startswith(b'OK'):
+            raise ImapError(f'IDLE: {line!r}')
+        return changed
+
+    def wait(self):
+        """IDLE se o servidor suportar; senão espera EMAIL_IMAP_POLL_INTERVAL"""
+        if self.supports_idle():
+            return self.idle(_setting('EMAIL_IMAP_IDLE_TIMEOUT', 29 * 60))
+        self._stop_event.wait(_setting('EMAIL_IMAP_POLL_INTERVAL', 30))
+        return False
+
+    def run_forever(self):
+        """Sincroniza e espera novidades até stop(); reconecta com espera crescente"""
+        backoff = 1
+        while not self._stop_event.is_set():
+            try:
+                if self.client is None:
+                    self.connect()
+                self.sync()
+                backoff = 1
+                close_old_connections()
+                self.wait()
+            except (OSError, imaplib.IMAP4.error, ImapError) as e:
+                logger.warning("Erro no IMAP de %s: %s; nova tentativa em %ss", self.integration.email, e, backoff)
+                self.close()
+                close_old_connections()
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+        self.close()
+        self._wakeup_read.close()
+        self._wakeup_write.close()
+
+    def stop(self):
+        self._stop_event.set()
+        try:
+            self._wakeup_write.send(b'\0')
+        except OSError:
+            pass
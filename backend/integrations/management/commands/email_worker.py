@@ -2,11 +2,14 @@
 Comando Django para gerenciar worker das integrações de E-mail
 """
 
+import asyncio
 import signal
 import sys
 import time
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from integrations import email_async
 from integrations.email_service import email_manager
+from integrations.outbound_mail import outbound_queue
 
 
 class Command(BaseCommand):
@@ -23,12 +26,38 @@ class Command(BaseCommand):
             type=int,
             help='ID da integração específica (opcional)'
         )
+        parser.add_argument(
+            '--async',
+            action='store_true',
+            dest='use_async',
+            help='Atender todas as caixas num único event loop (requer aioimaplib)'
+        )
+        parser.add_argument(
+            '--shards',
+            type=int,
+            default=1,
+            help='Número de processos do worker assíncrono entre os quais as caixas são divididas'
+        )
+        parser.add_argument(
+            '--shard',
+            type=int,
+            default=0,
+            help='Número deste processo, de 0 a --shards - 1'
+        )
     
     def handle(self, *args, **options):
         action = options['action']
         integration_id = options.get('integration_id')
         
-        if action == 'start':
+        if options['use_async']:
+            if action != 'start':
+                raise CommandError('--async só se aplica a start')
+            if not 0 <= options['shard'] < options['shards']:
+                raise CommandError('--shard deve estar entre 0 e --shards - 1')
+            if email_async.aioimaplib is None:
+                raise CommandError('O modo --async requer o aioimaplib (pip install aioimaplib)')
+            self.start_async_worker(integration_id, options['shard'], options['shards'])
+        elif action == 'start':
             self.start_worker(integration_id)
         elif action == 'stop':
             self.stop_worker(integration_id)
@@ -58,6 +87,9 @@ class Command(BaseCommand):
                 # Iniciar todas as integrações
                 email_manager.start_all_integrations()
             
+            # Envia o que ficou na fila de saída
+            outbound_queue.start()
+            
             self.stdout.write(
                 self.style.SUCCESS("Worker de E-mail iniciado com sucesso!")
             )
@@ -74,6 +106,21 @@ class Command(BaseCommand):
                 self.style.ERROR(f"Erro ao iniciar worker: {e}")
             )
     
+    def start_async_worker(self, integration_id, shard, shards):
+        """Iniciar worker assíncrono (integrations/email_async.py)"""
+        self.stdout.write(f"Iniciando worker de E-mail assíncrono (shard {shard}/{shards})...")
+        worker = email_async.AsyncEmailWorker(shard=shard, shards=shards, integration_id=integration_id)
+        outbound_queue.start()
+        
+        async def main():
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, worker.stop)
+            await worker.run()
+        
+        asyncio.run(main())
+        self.stdout.write(self.style.SUCCESS("Worker de E-mail assíncrono parado"))
+    
     def stop_worker(self, integration_id=None):
         """Parar worker"""
         self.stdout.write("Parando worker de E-mail...")
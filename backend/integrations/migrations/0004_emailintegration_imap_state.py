@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('integrations', '0003_whatsappintegration_instance_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailintegration',
+            name='imap_uidnext',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Próximo UID'),
+        ),
+        migrations.AddField(
+            model_name='emailintegration',
+            name='imap_uidvalidity',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='UIDVALIDITY'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.4 on 2026-10-19 14:13
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('integrations', '0004_emailintegration_imap_state'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundEmail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('to_email', models.CharField(max_length=500, verbose_name='Para')),
+                ('subject', models.CharField(max_length=500, verbose_name='Assunto')),
+                ('content', models.TextField(verbose_name='Conteúdo')),
+                ('reply_to_message_id', models.CharField(blank=True, default='', max_length=500, verbose_name='Em resposta a')),
+                ('message_id', models.CharField(max_length=255, verbose_name='Message-ID')),
+                ('status', models.CharField(choices=[('queued', 'Na fila'), ('sending', 'Enviando'), ('sent', 'Enviado'), ('failed', 'Falhou')], default='queued', max_length=20, verbose_name='Status')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Tentativas')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Último erro')),
+                ('next_attempt_at', models.DateTimeField(blank=True, null=True, verbose_name='Próxima tentativa')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='Enviado em')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('integration', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outbound_emails', to='integrations.emailintegration', verbose_name='Integração')),
+            ],
+            options={
+                'verbose_name': 'E-mail de Saída',
+                'verbose_name_plural': 'E-mails de Saída',
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='outbound_email_status_idx')],
+            },
+        ),
+    ]
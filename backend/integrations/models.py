@@ -1,5 +1,5 @@
 from django.db import models
-from core.models import Company, Provedor
+from core.models import Company, Provedor, User
 
 
 class TelegramIntegration(models.Model):
@@ -161,6 +161,20 @@ class EmailIntegration(models.Model):
         verbose_name='Última Sincronização'
     )
     
+    # Estado da sincronização IMAP (integrations/imap_sync.py): UIDVALIDITY da
+    # INBOX e próximo UID a buscar
+    imap_uidvalidity = models.BigIntegerField(
+        null=True,
+        blank=True,
+        verbose_name='UIDVALIDITY'
+    )
+    
+    imap_uidnext = models.BigIntegerField(
+        null=True,
+        blank=True,
+        verbose_name='Próximo UID'
+    )
+    
     settings = models.JSONField(
         default=dict,
         blank=True,
@@ -178,6 +192,102 @@ class EmailIntegration(models.Model):
         return f"{self.name} - {self.email}"
 
 
+class OutboundEmail(models.Model):
+    """E-mail na fila de envio (integrations/outbound_mail.py)"""
+    
+    STATUS_CHOICES = (
+        ('queued', 'Na fila'),
+        ('sending', 'Enviando'),
+        ('sent', 'Enviado'),
+        ('failed', 'Falhou'),
+    )
+    
+    integration = models.ForeignKey(
+        EmailIntegration,
+        on_delete=models.CASCADE,
+        related_name='outbound_emails',
+        verbose_name='Integração'
+    )
+    
+    created_by = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+'
+    )
+    
+    to_email = models.CharField(
+        max_length=500,
+        verbose_name='Para'
+    )
+    
+    subject = models.CharField(
+        max_length=500,
+        verbose_name='Assunto'
+    )
+    
+    content = models.TextField(
+        verbose_name='Conteúdo'
+    )
+    
+    reply_to_message_id = models.CharField(
+        max_length=500,
+        blank=True,
+        default='',
+        verbose_name='Em resposta a'
+    )
+    
+    # Message-ID gerado na criação: as novas tentativas usam o mesmo
+    message_id = models.CharField(
+        max_length=255,
+        verbose_name='Message-ID'
+    )
+    
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default='queued',
+        verbose_name='Status'
+    )
+    
+    attempts = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Tentativas'
+    )
+    
+    last_error = models.TextField(
+        blank=True,
+        default='',
+        verbose_name='Último erro'
+    )
+    
+    next_attempt_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name='Próxima tentativa'
+    )
+    
+    sent_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name='Enviado em'
+    )
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name = 'E-mail de Saída'
+        verbose_name_plural = 'E-mails de Saída'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbound_email_status_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.subject} -> {self.to_email} ({self.status})"
+
+
 class WhatsAppIntegration(models.Model):
     """Modelo para integração com WhatsApp"""
     
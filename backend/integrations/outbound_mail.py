@@ -0,0 +1,354 @@
+"""
+Fila de envio de e-mail
+
+A API grava o e-mail em OutboundEmail (status ``queued``) e responde na hora;
+o envio acontece nas threads da OutboundMailQueue, que entregam o andamento
+pelo WebSocket (evento ``email_status`` em ``painel_<provedor>`` e em
+``notifications_<usuário>``).
+
+Cada integração tem um SmtpPool com até EMAIL_SMTP_POOL_SIZE sessões já
+autenticadas. Os envios seguintes reutilizam a sessão (sem novo
+connect/EHLO/STARTTLS/AUTH); sessões paradas há mais de EMAIL_SMTP_MAX_IDLE
+segundos são descartadas e, se o servidor derrubou uma sessão reutilizada, o
+envio é repetido uma vez em uma conexão nova.
+
+Falhas temporárias (respostas 4xx, quedas de conexão, timeouts) voltam para a
+fila com espera exponencial a partir de EMAIL_SEND_RETRY_DELAY segundos, até
+EMAIL_SEND_MAX_ATTEMPTS tentativas; respostas 5xx falham na hora. Uma thread
+de varredura recoloca na fila os e-mails cuja espera terminou (inclusive os
+que ficaram para trás em uma reinicialização).
+"""
+
+import queue
+import smtplib
+import threading
+import time
+from datetime import timedelta
+from email.utils import make_msgid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from core.logging_utils import get_logger
+from .email_service import build_message
+from .models import OutboundEmail
+
+logger = get_logger('email')
+
+# Envio parado em ``sending`` por mais tempo que isso volta para a fila
+STALE_SENDING = timedelta(minutes=10)
+
+
+def connect_smtp(integration):
+    """Abre uma sessão SMTP autenticada"""
+    client = smtplib.SMTP(
+        integration.smtp_host, integration.smtp_port,
+        timeout=getattr(settings, 'EMAIL_SMTP_TIMEOUT', 30),
+    )
+    try:
+        if integration.smtp_use_tls:
+            client.starttls()
+        client.login(integration.username, integration.password)
+    except BaseException:
+        client.close()
+        raise
+    return client
+
+
+def _quit(client):
+    try:
+        client.quit()
+    except Exception:
+        client.close()
+
+
+class SmtpPool:
+    """Sessões SMTP autenticadas de uma integração"""
+
+    def __init__(self, integration, size=None, max_idle=None):
+        self.integration = integration
+        size = size or getattr(settings, 'EMAIL_SMTP_POOL_SIZE', 2)
+        self.max_idle = max_idle if max_idle is not None else getattr(settings, 'EMAIL_SMTP_MAX_IDLE', 60)
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _checkout(self):
+        """Sessão ociosa mais recente ou None; descarta as paradas há muito tempo"""
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                client, last_used = self._idle.pop()
+                if now - last_used <= self.max_idle:
+                    return client
+                _quit(client)
+        return None
+
+    def _checkin(self, client):
+        with self._lock:
+            self._idle.append((client, time.monotonic()))
+
+    def send(self, message):
+        with self._slots:
+            client = self._checkout()
+            reused = client is not None
+            if client is None:
+                client = connect_smtp(self.integration)
+            try:
+                try:
+                    client.send_message(message)
+                except smtplib.SMTPServerDisconnected:
+                    if not reused:
+                        raise
+                    # O servidor encerrou a sessão ociosa: uma nova tentativa
+                    client.close()
+                    client = connect_smtp(self.integration)
+                    client.send_message(message)
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                # Recusa do servidor; a sessão continua válida
+                self._checkin(client)
+                raise
+            except BaseException:
+                client.close()
+                raise
+            self._checkin(client)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for client, _ in idle:
+            _quit(client)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _credentials(integration):
+    return (
+        integration.smtp_host, integration.smtp_port, integration.smtp_use_tls,
+        integration.username, integration.password,
+    )
+
+
+def pool_for(integration):
+    """Pool da integração; é recriado quando as credenciais mudam"""
+    key = _credentials(integration)
+    with _pools_lock:
+        current = _pools.get(integration.id)
+        if current is not None and current[0] == key:
+            return current[1]
+        pool = SmtpPool(integration)
+        _pools[integration.id] = (key, pool)
+    if current is not None:
+        current[1].close()
+    return pool
+
+
+def close_pools():
+    with _pools_lock:
+        pools = [pool for _, pool in _pools.values()]
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def is_temporary(error):
+    """Se vale a pena tentar de novo"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return bool(codes) and all(400 <= code < 500 for code in codes)
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    # SMTPException também é OSError; aqui contam só as falhas de rede
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def outbound_data(outbound):
+    return {
+        'id': outbound.id,
+        'integration': outbound.integration_id,
+        'to_email': outbound.to_email,
+        'subject': outbound.subject,
+        'message_id': outbound.message_id,
+        'status': outbound.status,
+        'attempts': outbound.attempts,
+        'last_error': outbound.last_error,
+        'next_attempt_at': outbound.next_attempt_at.isoformat() if outbound.next_attempt_at else None,
+        'sent_at': outbound.sent_at.isoformat() if outbound.sent_at else None,
+    }
+
+
+def notify_status(outbound):
+    """Envia o andamento do e-mail para o painel do provedor e para quem o enviou"""
+    data = outbound_data(outbound)
+    try:
+        channel_layer = get_channel_layer()
+        async_to_sync(channel_layer.group_send)(
+            f'painel_{outbound.integration.provedor_id}',
+            {'type': 'email_status', 'email': data}
+        )
+        if outbound.created_by_id:
+            async_to_sync(channel_layer.group_send)(
+                f'notifications_{outbound.created_by_id}',
+                {'type': 'send_notification', 'notification': {'type': 'email_status', 'email': data}}
+            )
+    except Exception as e:
+        logger.warning("Erro ao notificar status do e-mail %s: %s", outbound.id, e)
+
+
+def _due(now):
+    return Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now)
+
+
+def deliver(outbound_id):
+    """Uma tentativa de envio; devolve o status final da tentativa ou None se não havia o que enviar"""
+    now = timezone.now()
+    # Só uma thread (ou processo) consegue marcar o e-mail como ``sending``
+    claimed = OutboundEmail.objects.filter(_due(now), pk=outbound_id, status='queued').update(
+        status='sending', attempts=F('attempts') + 1, updated_at=now,
+    )
+    if not claimed:
+        return None
+    outbound = OutboundEmail.objects.select_related('integration').get(pk=outbound_id)
+    notify_status(outbound)
+
+    integration = outbound.integration
+    message = build_message(
+        integration, outbound.to_email, outbound.subject, outbound.content,
+        outbound.reply_to_message_id or None, message_id=outbound.message_id,
+    )
+    try:
+        pool_for(integration).send(message)
+    except Exception as e:
+        max_attempts = getattr(settings, 'EMAIL_SEND_MAX_ATTEMPTS', 5)
+        outbound.last_error = str(e)[:1000]
+        if is_temporary(e) and outbound.attempts < max_attempts:
+            delay = getattr(settings, 'EMAIL_SEND_RETRY_DELAY', 30) * 2 ** (outbound.attempts - 1)
+            outbound.status = 'queued'
+            outbound.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+            logger.warning(
+                "Falha temporária ao enviar e-mail %s (tentativa %s), nova tentativa em %ss: %s",
+                outbound.id, outbound.attempts, delay, e,
+            )
+        else:
+            outbound.status = 'failed'
+            outbound.next_attempt_at = None
+            logger.error("Erro ao enviar e-mail %s: %s", outbound.id, e)
+    else:
+        outbound.status = 'sent'
+        outbound.sent_at = timezone.now()
+        outbound.next_attempt_at = None
+        outbound.last_error = ''
+        logger.info("E-mail %s enviado para: %s", outbound.id, outbound.to_email)
+    outbound.save(update_fields=['status', 'last_error', 'next_attempt_at', 'sent_at', 'updated_at'])
+    notify_status(outbound)
+    return outbound.status
+
+
+class OutboundMailQueue:
+    """Fila atendida por ``workers`` threads, com varredura periódica dos e-mails à espera"""
+
+    def __init__(self, workers=None, queue_size=None, sweep_interval=None):
+        self.workers = workers or getattr(settings, 'EMAIL_SEND_WORKERS', 4)
+        queue_size = queue_size if queue_size is not None else getattr(settings, 'EMAIL_SEND_QUEUE_SIZE', 1000)
+        self.sweep_interval = sweep_interval or getattr(settings, 'EMAIL_SEND_SWEEP_INTERVAL', 60)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._sweeper = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'outbound-mail-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            outbound_id = self._queue.get()
+            try:
+                deliver(outbound_id)
+            except Exception as e:
+                logger.warning("Erro no envio do e-mail %s: %s", outbound_id, e)
+            finally:
+                close_old_connections()
+                self._queue.task_done()
+
+    def submit(self, outbound_id):
+        """Agenda o envio; False se a fila estiver cheia (a varredura tenta depois)"""
+        self.start()
+        try:
+            self._queue.put_nowait(outbound_id)
+        except queue.Full:
+            logger.warning("Fila de envio de e-mail cheia; e-mail %s aguarda a varredura", outbound_id)
+            return False
+        return True
+
+    def sweep(self, now=None):
+        """Recoloca na fila os e-mails à espera; devolve quantos foram agendados"""
+        now = now or timezone.now()
+        OutboundEmail.objects.filter(status='sending', updated_at__lt=now - STALE_SENDING).update(
+            status='queued', next_attempt_at=None, updated_at=now,
+        )
+        due = OutboundEmail.objects.filter(_due(now), status='queued').order_by('created_at')
+        submitted = 0
+        for outbound_id in due.values_list('id', flat=True)[:self._queue.maxsize or None]:
+            if not self.submit(outbound_id):
+                break
+            submitted += 1
+        return submitted
+
+    def _sweep_forever(self):
+        while not self._stop_event.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning("Erro na varredura da fila de e-mail: %s", e)
+            finally:
+                close_old_connections()
+            self._stop_event.wait(self.sweep_interval)
+
+    def start(self):
+        """Inicia as threads e a varredura"""
+        self._start()
+        with self._lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_forever, name='outbound-mail-sweep', daemon=True)
+                self._sweeper.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def join(self):
+        """Espera a fila esvaziar"""
+        self._queue.join()
+
+
+outbound_queue = OutboundMailQueue()
+
+
+def queue_email(integration, to_email, subject, content, reply_to_message_id='', user=None):
+    """Grava o e-mail na fila; o envio começa após o commit"""
+    domain = integration.email.rpartition('@')[2] or None
+    outbound = OutboundEmail.objects.create(
+        integration=integration,
+        created_by=user,
+        to_email=to_email,
+        subject=subject,
+        content=content,
+        reply_to_message_id=reply_to_message_id or '',
+        message_id=make_msgid(domain=domain),
+    )
+    transaction.on_commit(lambda: outbound_queue.submit(outbound.id))
+    return outbound
@@ -1,3 +1,640 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import os
+import shutil
+import smtplib
+import socket
+import tempfile
+from email.message import EmailMessage
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from conversations.models import Contact, MediaBlob, Message
+from core.models import Provedor, User
+from . import email_async
+from .email_async import AsyncEmailWorker, AsyncImapMailbox, HostLimiter, shard_queryset
+from .email_parser import StreamingEmailParser, parse_bytes
+from .email_service import EmailService
+from .imap_sync import ImapMailbox, parse_bodies, parse_sizes, plan_fetches
+from . import outbound_mail
+from .models import EmailIntegration, OutboundEmail
+from .outbound_mail import SmtpPool, deliver, outbound_queue
+
+
+def build_email(subject='Boleto', body='Segue o boleto.', attachment=None, message_id='<1@cliente.com>'):
+    message = EmailMessage()
+    message['From'] = 'Cliente Teste <cliente@exemplo.com>'
+    message['To'] = 'suporte@provedor.com'
+    message['Subject'] = subject
+    message['Message-ID'] = message_id
+    message.set_content(body)
+    message.add_alternative(f'<p>{body}</p>', subtype='html')
+    if attachment is not None:
+        message.add_attachment(attachment, maintype='application', subtype='pdf', filename='boleto.pdf')
+    return message.as_bytes()
+
+
+def feed_in_chunks(raw, size):
+    parser = StreamingEmailParser()
+    for start in range(0, len(raw), size):
+        parser.feed(raw[start:start + size])
+    return parser.close()
+
+
+class MediaRootMixin:
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+
+class StreamingEmailParserTests(MediaRootMixin, TestCase):
+    def test_texto_e_cabecalhos(self):
+        email_data = parse_bytes(build_email(subject='Assunto com acentuação'))
+        self.assertEqual(email_data['subject'], 'Assunto com acentuação')
+        self.assertEqual(email_data['from_name'], 'Cliente Teste')
+        self.assertEqual(email_data['from_email'], 'cliente@exemplo.com')
+        self.assertEqual(email_data['to_email'], 'suporte@provedor.com')
+        self.assertEqual(email_data['message_id'], '<1@cliente.com>')
+        self.assertEqual(email_data['content'], 'Segue o boleto.')
+        self.assertEqual(email_data['attachments'], [])
+
+    def test_anexo_gravado_em_disco_em_qualquer_divisao(self):
+        payload = os.urandom(200 * 1024)
+        raw = build_email(attachment=payload)
+        for chunk_size in (7, 1000, len(raw)):
+            email_data = feed_in_chunks(raw, chunk_size)
+            self.assertEqual(email_data['content'], 'Segue o boleto.')
+            [attachment] = email_data['attachments']
+            self.assertEqual(attachment['filename'], 'boleto.pdf')
+            self.assertEqual(attachment['content_type'], 'application/pdf')
+            self.assertEqual(attachment['size'], len(payload))
+            self.assertEqual(attachment['sha256'], hashlib.sha256(payload).hexdigest())
+            with open(attachment['path'], 'rb') as stored:
+                self.assertEqual(stored.read(), payload)
+
+    def test_quoted_printable_e_html_sem_texto(self):
+        raw = (
+            b'From: a@exemplo.com\r\nSubject: QP\r\nMIME-Version: 1.0\r\n'
+            b'Content-Type: text/html; charset=utf-8\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n'
+            b'<p>Ol=C3=A1, linha quebrada =\r\nno meio</p>\r\n'
+        )
+        self.assertEqual(feed_in_chunks(raw, 5)['content'], 'Olá, linha quebrada no meio')
+
+    def test_anexo_sem_nome_e_descartar(self):
+        raw = (
+            b'From: a@exemplo.com\r\nContent-Type: multipart/mixed; boundary="x"\r\n\r\n'
+            b'preambulo\r\n--x\r\nContent-Type: text/plain\r\n\r\ncorpo\r\n'
+            b'--x\r\nContent-Type: image/png\r\nContent-Transfer-Encoding: base64\r\n\r\n'
+            + base64.encodebytes(b'\x89PNG dados') + b'--x--\r\nepilogo\r\n'
+        )
+        parser = StreamingEmailParser()
+        parser.feed(raw)
+        email_data = parser.close()
+        self.assertEqual(email_data['content'], 'corpo')
+        [attachment] = email_data['attachments']
+        self.assertEqual(attachment['filename'], 'anexo-1.png')
+        self.assertEqual(attachment['size'], len(b'\x89PNG dados'))
+        parser.discard()
+        self.assertFalse(os.path.exists(attachment['path']))
+
+
+class FetchResponseTests(TestCase):
+    def test_tamanhos_e_corpos(self):
+        self.assertEqual(
+            parse_sizes([b'1 (UID 10 RFC822.SIZE 300)', b'2 (RFC822.SIZE 40 UID 11)']),
+            [(10, 300), (11, 40)],
+        )
+        data = [(b'1 (UID 10 BODY[] {3}', b'abc'), b')', (b'2 (BODY[] {2}', b'de'), b' UID 11)']
+        self.assertEqual(parse_bodies(data), [(10, b'abc'), (11, b'de')])
+
+    def test_lotes_e_mensagens_grandes(self):
+        steps = plan_fetches([(4, 10), (1, 10), (2, 10), (3, 5000), (5, 10)], 1000, 2)
+        self.assertEqual(steps, [('batch', [1, 2]), ('stream', 3), ('batch', [4, 5])])
+
+
+class FakeImap:
+    """Servidor IMAP em memória com o subconjunto de imaplib usado pelo ImapMailbox"""
+
+    def __init__(self, messages, uidvalidity=1, capabilities=('IMAP4REV1',)):
+        self.messages = dict(messages)
+        self.uidvalidity = uidvalidity
+        self.unseen = set(self.messages)
+        self.capabilities = capabilities
+        self.commands = []
+        self._responses = {}
+
+    def select(self, mailbox):
+        self._responses = {
+            'UIDVALIDITY': [str(self.uidvalidity).encode()],
+            'UIDNEXT': [str(max(self.messages, default=0) + 1).encode()],
+        }
+        return 'OK', [str(len(self.messages)).encode()]
+
+    def response(self, name):
+        return name, self._responses.pop(name, [None])
+
+    def _uid_set(self, uid_set):
+        uids = set()
+        for part in uid_set.split(','):
+            if part.endswith(':*'):
+                start = int(part[:-2])
+                uids |= {uid for uid in self.messages if uid >= start}
+                # Como no IMAP, n:* sempre inclui a última mensagem
+                uids.add(max(self.messages))
+            else:
+                uids.add(int(part))
+        return sorted(uids)
+
+    def uid(self, command, *args):
+        self.commands.append((command, *args))
+        if command == 'SEARCH':
+            return 'OK', [' '.join(str(uid) for uid in sorted(self.unseen)).encode()]
+        uid_set, items = args
+        data = []
+        for uid in self._uid_set(uid_set):
+            raw = self.messages[uid]
+            if 'RFC822.SIZE' in items:
+                data.append(f'{uid} (UID {uid} RFC822.SIZE {len(raw)})'.encode())
+            elif '<' in items:
+                start, length = map(int, items[items.index('<') + 1:items.index('>')].split('.'))
+                part = raw[start:start + length]
+                data += [(f'{uid} (UID {uid} BODY[]<{start}> {{{len(part)}}}'.encode(), part), b')']
+            else:
+                data += [(f'{uid} (UID {uid} BODY[] {{{len(raw)}}}'.encode(), raw), b')']
+        return 'OK', data
+
+    def logout(self):
+        pass
+
+
+@mock.patch('conversations.transcode.transcoder.submit', return_value=True)
+class ImapMailboxTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.integration = EmailIntegration.objects.create(
+            name='Suporte', email='suporte@provedor.com', imap_host='imap.exemplo.com',
+            smtp_host='smtp.exemplo.com', username='suporte', password='senha',
+        )
+        self.received = []
+
+    def mailbox(self, server):
+        mailbox = ImapMailbox(self.integration, lambda email_data, uid: self.received.append((uid, email_data)) or True)
+        mailbox.client = server
+        self.addCleanup(mailbox._wakeup_read.close)
+        self.addCleanup(mailbox._wakeup_write.close)
+        return mailbox
+
+    def test_busca_so_uids_novos(self, submit):
+        server = FakeImap({1: build_email('Um'), 2: build_email('Dois', message_id='<2@x>')})
+        server.unseen = {2}
+        mailbox = self.mailbox(server)
+        self.assertEqual(mailbox.sync(), 1)
+        self.assertEqual([uid for uid, _ in self.received], [2])
+        self.integration.refresh_from_db()
+        self.assertEqual((self.integration.imap_uidvalidity, self.integration.imap_uidnext), (1, 3))
+        self.assertIsNotNone(self.integration.last_sync)
+
+        # Nada novo: só o SELECT
+        server.commands.clear()
+        self.assertEqual(mailbox.sync(), 0)
+        self.assertEqual(server.commands, [])
+
+        server.messages[3] = build_email('Três', message_id='<3@x>')
+        server.messages[4] = build_email('Quatro', message_id='<4@x>')
+        self.assertEqual(mailbox.sync(), 2)
+        self.assertEqual([uid for uid, _ in self.received], [2, 3, 4])
+        self.assertEqual(server.commands[0], ('FETCH', '3:*', '(UID RFC822.SIZE)'))
+        # Conteúdo dos dois num único FETCH, sem marcar como lido
+        self.assertEqual(server.commands[1], ('FETCH', '3,4', '(UID BODY.PEEK[])'))
+        self.assertEqual(mailbox.uidnext, 5)
+
+    @override_settings(EMAIL_IMAP_STREAM_BYTES=4096)
+    def test_mensagem_grande_em_partes(self, submit):
+        payload = os.urandom(20 * 1024)
+        server = FakeImap({7: build_email(attachment=payload)})
+        mailbox = self.mailbox(server)
+        mailbox.sync()
+        [(uid, email_data)] = self.received
+        self.assertEqual(email_data['attachments'][0]['sha256'], hashlib.sha256(payload).hexdigest())
+        partial = [command for command in server.commands if '<' in command[-1]]
+        self.assertGreater(len(partial), 5)
+        self.assertTrue(all(command[2].startswith('(BODY.PEEK[]<') for command in partial))
+        # O handler não guardou o anexo: o temporário é removido
+        self.assertFalse(os.path.exists(email_data['attachments'][0]['path']))
+
+    def test_uidvalidity_alterado_reinicia(self, submit):
+        server = FakeImap({1: build_email('Um')})
+        mailbox = self.mailbox(server)
+        mailbox.sync()
+        server.uidvalidity = 2
+        server.messages = {1: build_email('Um'), 2: build_email('Dois', message_id='<2@x>')}
+        server.unseen = {1, 2}
+        mailbox.sync()
+        self.assertEqual(mailbox.uidvalidity, 2)
+        self.assertEqual(mailbox.uidnext, 3)
+        self.assertEqual([uid for uid, _ in self.received], [1, 1, 2])
+
+    def test_idle_avisa_email_novo(self, submit):
+        mailbox = self.mailbox(FakeImap({}, capabilities=('IMAP4REV1', 'IDLE')))
+        ours, server = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(server.close)
+        mailbox.client.sock = ours
+        mailbox.client._new_tag = lambda: b'A001'
+        mailbox.client.send = ours.sendall
+        server.sendall(b'+ idling\r\n* 5 EXISTS\r\nA001 OK IDLE terminated\r\n')
+        self.assertTrue(mailbox.supports_idle())
+        self.assertTrue(mailbox.idle(timeout=5))
+        self.assertEqual(server.recv(100), b'A001 IDLE\r\nDONE\r\n')
+
+    def test_idle_sem_novidade_ate_o_prazo(self, submit):
+        mailbox = self.mailbox(FakeImap({}, capabilities=('IDLE',)))
+        ours, server = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(server.close)
+        mailbox.client.sock = ours
+        mailbox.client._new_tag = lambda: b'A002'
+        # O servidor só encerra o IDLE depois do DONE
+        mailbox.client.send = lambda data: server.sendall(b'A002 OK\r\n') if data == b'DONE\r\n' else None
+        server.sendall(b'+ idling\r\n* OK still here\r\n')
+        self.assertFalse(mailbox.idle(timeout=0.2))
+
+
+@mock.patch('conversations.transcode.transcoder.submit', return_value=True)
+class EmailProcessingTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.integration = EmailIntegration.objects.create(
+            name='Suporte', email='suporte@provedor.com', imap_host='imap.exemplo.com',
+            smtp_host='smtp.exemplo.com', username='suporte', password='senha',
+        )
+        self.service = EmailService(self.integration)
+
+    def test_email_com_anexo_vira_mensagens(self, submit):
+        payload = os.urandom(4096)
+        email_data = parse_bytes(build_email(attachment=payload))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(self.service.process_email(email_data, uid=9))
+
+        text, document = Message.objects.order_by('id')
+        self.assertEqual(text.content, 'Segue o boleto.')
+        self.assertTrue(text.is_from_customer)
+        self.assertEqual(text.external_id, '<1@cliente.com>')
+        self.assertEqual(text.additional_attributes['email_uid'], 9)
+        self.assertEqual(text.conversation.inbox.channel_type, 'email')
+        self.assertEqual(document.message_type, 'document')
+        blob = MediaBlob.objects.get(sha256=hashlib.sha256(payload).hexdigest())
+        self.assertEqual(document.media_blob, blob)
+        self.assertEqual(blob.ref_count, 1)
+        self.assertTrue(document.additional_attributes['file_url'].endswith('/boleto.pdf'))
+
+        # O mesmo Message-ID não é importado de novo
+        self.assertTrue(self.service.process_email(parse_bytes(build_email()), uid=10))
+        self.assertEqual(Message.objects.count(), 2)
+
+
+class FakeResponse:
+    def __init__(self, result, lines):
+        self.result = result
+        self.lines = lines
+
+
+class FakeAsyncImap:
+    """Mesmo servidor do FakeImap com a interface do aioimaplib"""
+
+    def __init__(self, server):
+        self.server = server
+        self.logged_out = False
+
+    async def select(self, mailbox):
+        self.server.select(mailbox)
+        codes = self.server._responses
+        return FakeResponse('OK', [
+            b'FLAGS (\\Seen)',
+            b'OK [UIDVALIDITY ' + codes['UIDVALIDITY'][0] + b'] UIDs valid',
+            b'OK [UIDNEXT ' + codes['UIDNEXT'][0] + b'] Predicted next UID',
+            b'[READ-WRITE] Select completed.',
+        ])
+
+    async def uid_search(self, criteria):
+        _, data = self.server.uid('SEARCH', None, criteria)
+        return FakeResponse('OK', data + [b'Search completed'])
+
+    async def uid(self, command, uid_set, items):
+        _, data = self.server.uid(command.upper(), uid_set, items)
+        lines = []
+        for item in data:
+            if isinstance(item, tuple):
+                lines += [item[0].replace(b' (', b' FETCH (', 1), bytearray(item[1])]
+            else:
+                lines.append(item.replace(b' (', b' FETCH (', 1) if b'UID' in item else item)
+        return FakeResponse('OK', lines + [b'Fetch completed'])
+
+    def has_capability(self, capability):
+        return capability in self.server.capabilities
+
+    async def logout(self):
+        self.logged_out = True
+
+
+@mock.patch('conversations.transcode.transcoder.submit', return_value=True)
+class AsyncEmailWorkerTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.integration = EmailIntegration.objects.create(
+            name='Suporte', email='suporte@provedor.com', imap_host='imap.exemplo.com',
+            smtp_host='smtp.exemplo.com', username='suporte', password='senha', is_active=True,
+        )
+        self.received = []
+
+    def handler(self, email_data, uid):
+        self.received.append(uid)
+        return True
+
+    @override_settings(EMAIL_IMAP_STREAM_BYTES=4096)
+    def test_sincroniza_como_o_modo_com_threads(self, submit):
+        server = FakeImap({1: build_email('Um'), 2: build_email(attachment=os.urandom(10 * 1024))})
+        client = FakeAsyncImap(server)
+
+        async def connect(integration, timeout):
+            return client
+
+        mailbox = AsyncImapMailbox(self.integration, self.handler, HostLimiter(2), connect)
+
+        async def run():
+            await mailbox.connect()
+            first = await mailbox.sync()
+            server.messages[3] = build_email('Três', message_id='<3@x>')
+            return first, await mailbox.sync()
+
+        self.assertEqual(async_to_sync(run)(), (2, 1))
+        self.assertEqual(self.received, [1, 2, 3])
+        self.assertIn(('FETCH', '3:*', '(UID RFC822.SIZE)'), server.commands)
+        self.assertTrue(any(command[-1].startswith('(BODY.PEEK[]<') for command in server.commands))
+        self.integration.refresh_from_db()
+        self.assertEqual((self.integration.imap_uidvalidity, self.integration.imap_uidnext), (1, 4))
+
+    def test_supervisor_reconecta_com_espera(self, submit):
+        server = FakeImap({1: build_email('Um')})
+        attempts = []
+
+        async def connect(integration, timeout):
+            attempts.append(asyncio.get_running_loop().time())
+            if len(attempts) < 3:
+                raise OSError('Conexão recusada')
+            return FakeAsyncImap(server)
+
+        worker = AsyncEmailWorker(connect=connect)
+        worker.initial_backoff = 0.05
+
+        async def run():
+            worker.limiter = HostLimiter()
+            with override_settings(EMAIL_IMAP_POLL_INTERVAL=0.01):
+                await worker.refresh()
+                # O supervisor entrega os e-mails ao EmailService
+                while not await sync_to_async(Message.objects.exists)():
+                    await asyncio.sleep(0.01)
+                connected = await sync_to_async(
+                    EmailIntegration.objects.values_list('is_connected', flat=True).get
+                )(pk=self.integration.pk)
+                await worker.shutdown()
+            return connected
+
+        self.assertTrue(async_to_sync(run)())
+        self.assertEqual(len(attempts), 3)
+        # Segunda espera maior que a primeira (com a variação aleatória de até metade)
+        self.assertGreaterEqual(attempts[1] - attempts[0], 0.025)
+        self.assertGreaterEqual(attempts[2] - attempts[1], 0.05)
+        self.integration.refresh_from_db()
+        self.assertFalse(self.integration.is_connected)
+
+    def test_shards_dividem_as_integracoes(self, submit):
+        others = [
+            EmailIntegration.objects.create(
+                name=f'Caixa {index}', email=f'caixa{index}@provedor.com', imap_host='imap.exemplo.com',
+                smtp_host='smtp.exemplo.com', username='u', password='p', is_active=True,
+            )
+            for index in range(3)
+        ]
+        ids = [integration.id for integration in [self.integration, *others]]
+        shards = [
+            set(shard_queryset(EmailIntegration.objects.all(), shard, 3).values_list('id', flat=True))
+            for shard in range(3)
+        ]
+        self.assertEqual(set().union(*shards), set(ids))
+        self.assertEqual(sum(len(shard) for shard in shards), len(ids))
+        self.assertEqual(shards[ids[0] % 3] & {ids[0]}, {ids[0]})
+
+    def test_comando_exige_aioimaplib(self, submit):
+        with mock.patch.object(email_async, 'aioimaplib', None):
+            with self.assertRaises(CommandError):
+                call_command('email_worker', 'start', '--async')
+        with self.assertRaises(CommandError):
+            call_command('email_worker', 'start', '--async', '--shards', '2', '--shard', '2')
+
+
+class FakeSmtp:
+    """Servidor SMTP simulado: registra conexões, logins e envios"""
+
+    instances = []
+    # Respostas dos próximos envios: exceção a levantar ou None para aceitar
+    responses = []
+
+    def __init__(self, host, port, timeout=None):
+        self.host = host
+        self.logins = 0
+        self.sent = []
+        self.closed = False
+        FakeSmtp.instances.append(self)
+
+    def starttls(self):
+        pass
+
+    def login(self, username, password):
+        self.logins += 1
+
+    def send_message(self, message):
+        if self.closed:
+            raise smtplib.SMTPServerDisconnected('please run connect() first')
+        error = FakeSmtp.responses.pop(0) if FakeSmtp.responses else None
+        if error is not None:
+            raise error
+        self.sent.append(message)
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+@mock.patch('integrations.outbound_mail.smtplib.SMTP', FakeSmtp)
+@mock.patch('integrations.outbound_mail.notify_status')
+class OutboundMailTests(TestCase):
+    def setUp(self):
+        FakeSmtp.instances = []
+        FakeSmtp.responses = []
+        self.provedor = Provedor.objects.create(nome='Provedor')
+        self.integration = EmailIntegration.objects.create(
+            name='Suporte', email='suporte@provedor.com', imap_host='imap.exemplo.com',
+            smtp_host='smtp.exemplo.com', username='suporte', password='senha', provedor=self.provedor,
+        )
+        self.addCleanup(outbound_mail.close_pools)
+
+    def queue(self, subject='Olá'):
+        return OutboundEmail.objects.create(
+            integration=self.integration, to_email='cliente@exemplo.com', subject=subject,
+            content='Conteúdo', message_id='<1@provedor.com>',
+        )
+
+    @mock.patch('integrations.outbound_mail.outbound_queue.submit', return_value=True)
+    def test_api_queues_and_returns_immediately(self, submit, notify):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username='super', password='x', user_type='superadmin'))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(
+                reverse('emailintegration-send-email', args=[self.integration.id]),
+                {'to_email': 'cliente@exemplo.com', 'subject': 'Olá', 'content': 'Conteúdo'}, format='json',
+            )
+        self.assertEqual(response.status_code, 202, response.data)
+        self.assertEqual(response.data['status'], 'queued')
+        outbound = OutboundEmail.objects.get()
+        self.assertTrue(outbound.message_id.endswith('@provedor.com>'))
+        submit.assert_called_once_with(outbound.id)
+        self.assertEqual(FakeSmtp.instances, [])
+
+    def test_sends_reuse_authenticated_session(self, notify):
+        statuses = []
+        notify.side_effect = lambda outbound: statuses.append(outbound.status)
+        first, second = self.queue('Um'), self.queue('Dois')
+        self.assertEqual(deliver(first.id), 'sent')
+        self.assertEqual(deliver(second.id), 'sent')
+        self.assertEqual(len(FakeSmtp.instances), 1)
+        self.assertEqual(FakeSmtp.instances[0].logins, 1)
+        self.assertEqual([m['Subject'] for m in FakeSmtp.instances[0].sent], ['Um', 'Dois'])
+        self.assertEqual(FakeSmtp.instances[0].sent[0]['Message-ID'], '<1@provedor.com>')
+        first.refresh_from_db()
+        self.assertIsNotNone(first.sent_at)
+        self.assertEqual(statuses, ['sending', 'sent', 'sending', 'sent'])
+
+    def test_claimed_email_is_not_sent_twice(self, notify):
+        outbound = self.queue()
+        self.assertEqual(deliver(outbound.id), 'sent')
+        self.assertIsNone(deliver(outbound.id))
+        self.assertEqual(len(FakeSmtp.instances[0].sent), 1)
+
+    def test_stale_session_reconnects(self, notify):
+        deliver(self.queue('Um').id)
+        # O servidor encerrou a sessão ociosa
+        FakeSmtp.instances[0].closed = True
+        self.assertEqual(deliver(self.queue('Dois').id), 'sent')
+        self.assertEqual(len(FakeSmtp.instances), 2)
+        self.assertEqual(FakeSmtp.instances[1].sent[0]['Subject'], 'Dois')
+
+    def test_idle_session_is_discarded(self, notify):
+        pool = SmtpPool(self.integration, max_idle=0)
+        pool.send(outbound_mail.build_message(self.integration, 'a@exemplo.com', 'Um', 'x'))
+        with mock.patch('integrations.outbound_mail.time.monotonic', return_value=10 ** 9):
+            pool.send(outbound_mail.build_message(self.integration, 'a@exemplo.com', 'Dois', 'x'))
+        self.assertEqual(len(FakeSmtp.instances), 2)
+        self.assertTrue(FakeSmtp.instances[0].closed)
+
+    @override_settings(EMAIL_SEND_RETRY_DELAY=30, EMAIL_SEND_MAX_ATTEMPTS=2)
+    def test_temporary_failure_retries_with_backoff(self, notify):
+        outbound = self.queue()
+        FakeSmtp.responses = [smtplib.SMTPDataError(451, b'Tente mais tarde')]
+        before = timezone.now()
+        self.assertEqual(deliver(outbound.id), 'queued')
+        outbound.refresh_from_db()
+        self.assertEqual(outbound.attempts, 1)
+        self.assertIn('451', outbound.last_error)
+        self.assertGreaterEqual(outbound.next_attempt_at, before + timezone.timedelta(seconds=30))
+        # Antes do prazo não há nova tentativa
+        self.assertIsNone(deliver(outbound.id))
+
+        OutboundEmail.objects.filter(pk=outbound.pk).update(next_attempt_at=timezone.now())
+        FakeSmtp.responses = [smtplib.SMTPDataError(451, b'Tente mais tarde')]
+        self.assertEqual(deliver(outbound.id), 'failed')
+        # A sessão continua em uso depois das recusas
+        self.assertEqual(len(FakeSmtp.instances), 1)
+
+    def test_permanent_failure_fails(self, notify):
+        outbound = self.queue()
+        FakeSmtp.responses = [smtplib.SMTPRecipientsRefused({'cliente@exemplo.com': (550, b'Unknown user')})]
+        self.assertEqual(deliver(outbound.id), 'failed')
+        outbound.refresh_from_db()
+        self.assertEqual(outbound.attempts, 1)
+        self.assertIsNone(outbound.next_attempt_at)
+
+    @mock.patch('integrations.outbound_mail.outbound_queue.submit', return_value=True)
+    def test_sweep_requeues_due_and_stuck_emails(self, submit, notify):
+        now = timezone.now()
+        due = self.queue()
+        OutboundEmail.objects.filter(pk=due.pk).update(next_attempt_at=now - timezone.timedelta(seconds=1))
+        waiting = self.queue()
+        OutboundEmail.objects.filter(pk=waiting.pk).update(next_attempt_at=now + timezone.timedelta(minutes=5))
+        stuck = self.queue()
+        OutboundEmail.objects.filter(pk=stuck.pk).update(status='sending', updated_at=now - timezone.timedelta(hours=1))
+        self.assertEqual(outbound_queue.sweep(now), 2)
+        self.assertEqual(sorted(call.args[0] for call in submit.call_args_list), [due.id, stuck.id])
+
+
+class FakeHttpResponse:
+    status_code = 404
+    text = ''
+    content = b''
+
+    def json(self):
+        return {}
+
+
+@mock.patch('integrations.views.openai_service.generate_response_sync', return_value={'success': False})
+@mock.patch('requests.post', return_value=FakeHttpResponse())
+@mock.patch('integrations.views.verify_and_normalize_number', side_effect=lambda chatid, url, token: chatid)
+class UazapiWebhookTests(TestCase):
+    def setUp(self):
+        self.provedor = Provedor.objects.create(
+            nome='Provedor',
+            integracoes_externas={'whatsapp_token': 'tok', 'whatsapp_url': 'https://uazapi.test'},
+        )
+
+    def receber(self, chatid, texto, message_id='MSG1'):
+        response = self.client.post(
+            reverse('webhook_evolution_uazapi'),
+            {
+                'event': 'message',
+                'instance': '5511000000000',
+                'data': {'chatid': chatid, 'id': message_id, 'content': texto, 'senderName': 'Cliente'},
+            },
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        return Message.objects.get(external_id=message_id)
+
+    def test_chatid_nao_casa_por_prefixo_do_numero(self, verify, post, generate):
+        outro = Contact.objects.create(
+            name='Outro', phone='11999990000', provedor=self.provedor,
+            additional_attributes={'chatid': '55119990000@s.whatsapp.net'},
+        )
+        mensagem = self.receber('5511999@s.whatsapp.net', 'Quero saber do plano')
+        self.assertNotEqual(mensagem.conversation.contact_id, outro.id)
+        self.assertEqual(mensagem.conversation.contact.phone, '5511999')
+
+    def test_chatid_completo_encontra_o_contato(self, verify, post, generate):
+        contato = Contact.objects.create(
+            name='Cliente', phone='', provedor=self.provedor,
+            additional_attributes={'chatid': '5511999@s.whatsapp.net'},
+        )
+        mensagem = self.receber('5511999@s.whatsapp.net', 'Quero saber do plano')
+        self.assertEqual(mensagem.conversation.contact_id, contato.id)
@@ -3,7 +3,6 @@ from rest_framework.routers import DefaultRouter
 from .views import (
     TelegramIntegrationViewSet, EmailIntegrationViewSet,
     WhatsAppIntegrationViewSet, WebchatIntegrationViewSet,
-    # evolution_webhook  # Desabilitado para evitar duplicação
 )
 
 router = DefaultRouter()
@@ -14,6 +13,5 @@ router.register(r'webchat', WebchatIntegrationViewSet)
 
 urlpatterns = [
     path('integrations/', include(router.urls)),
-    # path('webhook/evolution/', evolution_webhook, name='evolution_webhook'),  # Desabilitado para evitar duplicação
 ]
 
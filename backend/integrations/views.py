@@ -10,6 +10,7 @@ from .serializers import (
 )
 from .telegram_service import telegram_manager
 from .email_service import email_manager
+from .outbound_mail import outbound_data, queue_email
 import asyncio
 from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse
@@ -18,6 +19,8 @@ from conversations.models import Contact, Conversation, Message, Inbox
 from core.models import Company
 from django.utils import timezone
 from core.openai_service import openai_service
+from conversations.media import schedule_message_media_download
+from core.intents import CANCELLATION, CANCELLATION_REPLY, classifier_for, greeting_reply
 from core.models import Provedor
 import requests
 from asgiref.sync import async_to_sync
@@ -29,6 +32,9 @@ import subprocess
 import os
 from django.conf import settings
 from datetime import datetime, timedelta
+from core.logging_utils import get_logger, log_payload
+
+logger = get_logger('webhook')
 
 
 def verify_and_normalize_number(chatid, uazapi_url, uazapi_token):
@@ -50,7 +56,7 @@ def verify_and_normalize_number(chatid, uazapi_url, uazapi_token):
             'numbers': [clean_number]
         }
         
-        print(f"DEBUG: Verificando número {clean_number} via /chat/check")
+        logger.debug("Verificando número %s via /chat/check", clean_number)
         
         # Fazer requisição para verificar o número
         response = requests.post(
@@ -65,7 +71,7 @@ def verify_and_normalize_number(chatid, uazapi_url, uazapi_token):
         
         if response.status_code == 200:
             result = response.json()
-            print(f"DEBUG: Resposta /chat/check: {result}")
+            log_payload(logger, "Resposta /chat/check", result)
             
             # Verificar se o número foi encontrado
             if result and isinstance(result, list) and len(result) > 0:
@@ -75,19 +81,19 @@ def verify_and_normalize_number(chatid, uazapi_url, uazapi_token):
                 if number_info.get('isInWhatsapp', False):
                     verified_jid = number_info.get('jid', '')
                     if verified_jid:
-                        print(f"DEBUG: Número verificado e normalizado: {verified_jid}")
+                        logger.debug("Número verificado e normalizado: %s", verified_jid)
                         return verified_jid
                     else:
-                        print(f"DEBUG: Número {clean_number} encontrado mas sem jid válido")
+                        logger.debug("Número %s encontrado mas sem jid válido", clean_number)
                 else:
-                    print(f"DEBUG: Número {clean_number} não encontrado no WhatsApp")
+                    logger.debug("Número %s não encontrado no WhatsApp", clean_number)
             else:
-                print(f"DEBUG: Resposta inválida do /chat/check: {result}")
+                log_payload(logger, "Resposta inválida do /chat/check", result)
         else:
-            print(f"DEBUG: Erro na verificação do número: {response.status_code} - {response.text}")
+            logger.warning("Erro na verificação do número: %s - %s", response.status_code, response.text)
             
     except Exception as e:
-        print(f"DEBUG: Erro ao verificar número: {e}")
+        logger.warning("Erro ao verificar número: %s", e)
     
     # Se não conseguir verificar, retornar o número original
     return chatid
@@ -319,30 +325,138 @@ class EmailIntegrationViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        # O envio acontece em segundo plano; o andamento chega pelo WebSocket (email_status)
+        outbound = queue_email(
+            integration, to_email, subject, content,
+            reply_to_message_id or '', user=request.user
+        )
+        return Response(outbound_data(outbound), status=status.HTTP_202_ACCEPTED)
+    
+    @action(detail=False, methods=['get'])
+    def status(self, request):
+        user = request.user
+        if user.user_type == 'superadmin':
+            integrations = TelegramIntegration.objects.all()
+        else:
+            provedores = Provedor.objects.filter(admins=user)
+            if provedores.exists():
+                integrations = TelegramIntegration.objects.filter(provedor__in=provedores)
+            else:
+                integrations = TelegramIntegration.objects.none()
+        status_data = []
+        for integration in integrations:
+            status_data.append({
+                'id': integration.id,
+                'provedor': integration.provedor.nome,
+                'phone_number': integration.phone_number,
+                'is_active': integration.is_active,
+                'is_connected': integration.is_connected,
+                'is_running': integration.id in telegram_manager.services
+            })
+        return Response(status_data)
+
+
+class EmailIntegrationViewSet(viewsets.ModelViewSet):
+    queryset = EmailIntegration.objects.all()
+    serializer_class = EmailIntegrationSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def get_queryset(self):
+        user = self.request.user
+        if user.user_type == 'superadmin':
+            return EmailIntegration.objects.all()
+        else:
+            provedores = Provedor.objects.filter(admins=user)
+            if provedores.exists():
+                return EmailIntegration.objects.filter(provedor__in=provedores)
+            return EmailIntegration.objects.none()
+    
+    @action(detail=True, methods=['post'])
+    def test_connection(self, request, pk=None):
+        """Testar conexão de e-mail"""
+        integration = self.get_object()
+        
         try:
-            if integration.id in email_manager.services:
-                service = email_manager.services[integration.id]
-                success = service.send_email(to_email, subject, content, reply_to_message_id)
-                
-                if success:
-                    return Response({'status': 'email sent'})
-                else:
-                    return Response(
-                        {'error': 'Failed to send email'},
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
+            from .email_service import EmailService
+            service = EmailService(integration)
+            
+            # Testar conexão IMAP
+            imap_success = service.connect_imap()
+            if service.imap_client:
+                service.imap_client.close()
+                service.imap_client.logout()
+            
+            # Testar conexão SMTP
+            smtp_success = service.connect_smtp()
+            if service.smtp_client:
+                service.smtp_client.quit()
+            
+            if imap_success and smtp_success:
+                return Response({'status': 'connection successful'})
             else:
                 return Response(
-                    {'error': 'Integration not running'},
+                    {'error': 'Connection failed', 'imap': imap_success, 'smtp': smtp_success},
                     status=status.HTTP_400_BAD_REQUEST
                 )
-                
+            
+        except Exception as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+    
+    @action(detail=True, methods=['post'])
+    def start_monitoring(self, request, pk=None):
+        """Iniciar monitoramento de e-mails"""
+        integration = self.get_object()
+        
+        try:
+            email_manager.start_integration(integration.id)
+            return Response({'status': 'monitoring started'})
+            
+        except Exception as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+    
+    @action(detail=True, methods=['post'])
+    def stop_monitoring(self, request, pk=None):
+        """Parar monitoramento de e-mails"""
+        integration = self.get_object()
+        
+        try:
+            email_manager.stop_integration(integration.id)
+            return Response({'status': 'monitoring stopped'})
+            
         except Exception as e:
             return Response(
                 {'error': str(e)},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
     
+    @action(detail=True, methods=['post'])
+    def send_email(self, request, pk=None):
+        """Enviar e-mail"""
+        integration = self.get_object()
+        to_email = request.data.get('to_email')
+        subject = request.data.get('subject')
+        content = request.data.get('content')
+        reply_to_message_id = request.data.get('reply_to_message_id')
+        
+        if not to_email or not subject or not content:
+            return Response(
+                {'error': 'to_email, subject and content are required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # O envio acontece em segundo plano; o andamento chega pelo WebSocket (email_status)
+        outbound = queue_email(
+            integration, to_email, subject, content,
+            reply_to_message_id or '', user=request.user
+        )
+        return Response(outbound_data(outbound), status=status.HTTP_202_ACCEPTED)
+    
     @action(detail=False, methods=['get'])
     def status(self, request):
         user = request.user
@@ -445,303 +559,6 @@ class WebchatIntegrationViewSet(viewsets.ModelViewSet):
         })
 
 
-@csrf_exempt
-def evolution_webhook(request):
-    if request.method == 'POST':
-        try:
-            print('Webhook recebido:', request.body)
-            data = json.loads(request.body)
-            event = data.get('event')
-            msg_data = data.get('data', {})
-            phone = msg_data.get('chatid') or msg_data.get('sender') or msg_data.get('key', {}).get('senderPn')
-            content = msg_data.get('message', {}).get('conversation')
-            instance = data.get('instance')
-            
-            # Buscar provedor correto baseado na instância
-            from core.models import Provedor
-            from integrations.models import WhatsAppIntegration
-            
-            # Tentar encontrar provedor pela integração WhatsApp
-            whatsapp_integration = WhatsAppIntegration.objects.filter(
-                instance_name=instance
-            ).first()
-            
-            if whatsapp_integration:
-                provedor = whatsapp_integration.provedor
-            else:
-                # Fallback: usar o primeiro provedor se não encontrar pela instância
-                provedor = Provedor.objects.first()
-                print(f"Provedor não encontrado para instância {instance}, usando primeiro provedor: {provedor.nome if provedor else 'Nenhum'}")
-            
-            if not provedor:
-                return JsonResponse({'error': 'Nenhum provedor encontrado'}, status=400)
-            
-            # 2. Buscar ou criar contato
-            contact, created = Contact.objects.get_or_create(
-                phone=phone,
-                provedor=provedor,
-                defaults={
-                    'name': msg_data.get('pushName') or phone,
-                    'additional_attributes': {
-                        'evolution_instance': instance,
-                        'evolution_event': event
-                    }
-                }
-            )
-            
-            # Atualizar dados do contato se necessário
-            nome_evo = msg_data.get('pushName')
-            avatar_evo = msg_data.get('avatar')
-            updated = False
-            
-            if nome_evo and contact.name != nome_evo:
-                contact.name = nome_evo
-                updated = True
-                
-            if avatar_evo and contact.avatar != avatar_evo:
-                contact.avatar = avatar_evo
-                updated = True
-            
-            # Se não tem avatar, tentar buscar a foto do perfil automaticamente
-            if not avatar_evo and not contact.avatar:
-                try:
-                    from .utils import update_contact_profile_picture
-                    if update_contact_profile_picture(contact, instance, 'evolution'):
-                        updated = True
-                except Exception as e:
-                    print(f"Erro ao buscar foto do perfil: {e}")
-                
-            if updated:
-                contact.save()
-                print(f"Contato atualizado: {contact.name} ({contact.phone})")
-            
-            if created:
-                print(f"Novo contato criado: {contact.name} ({contact.phone}) para provedor {provedor.nome}")
-            
-            # 3. Buscar ou criar inbox do WhatsApp
-            inbox, inbox_created = Inbox.objects.get_or_create(
-                name=f'WhatsApp {instance}',
-                channel_type='whatsapp',
-                provedor=provedor,
-                defaults={
-                    'settings': {
-                        'evolution_instance': instance,
-                        'evolution_event': event
-                    }
-                }
-            )
-            
-            if inbox_created:
-                print(f"Nova inbox criada: {inbox.name} para provedor {provedor.nome}")
-            
-            # 4. Buscar ou criar conversa - CORREÇÃO: evitar duplicação por canal
-            existing_conversation = Conversation.objects.filter(
-                contact=contact,
-                inbox__channel_type='whatsapp'  # Buscar por canal, não por inbox específica
-            ).first()
-            
-            if existing_conversation:
-                # Usar conversa existente, mas atualizar inbox se necessário
-                conversation = existing_conversation
-                if conversation.inbox != inbox:
-                    conversation.inbox = inbox
-                    conversation.save()
-                    print(f"Conversa {conversation.id} atualizada para inbox {inbox.name}")
-                conv_created = False
-            else:
-                # Criar nova conversa
-                conversation = Conversation.objects.create(
-                    contact=contact,
-                    inbox=inbox,
-                    status='snoozed',
-                    priority='medium',
-                    additional_attributes={
-                        'evolution_instance': instance,
-                        'evolution_event': event
-                    }
-                )
-                conv_created = True
-                print(f"Nova conversa criada: {conversation.id} para contato {contact.name}")
-            
-            # Se a conversa já existia e não está com status correto, atualiza
-            if not conv_created and (conversation.status != 'snoozed' or conversation.assignee is not None):
-                conversation.status = 'snoozed'
-                conversation.assignee = None
-                conversation.save()
-            
-            # 5. Salvar mensagem recebida - VERIFICAR DUPLICATA
-            # Verificar se já existe uma mensagem com o mesmo conteúdo nos últimos 30 segundos
-            recent_time = timezone.now() - timedelta(seconds=30)
-            existing_message = Message.objects.filter(
-                conversation=conversation,
-                content=content,
-                created_at__gte=recent_time,
-                is_from_customer=True
-            ).first()
-            
-            if existing_message:
-                content_preview = content[:30] if content else "sem conteúdo"
-                print(f"  Mensagem duplicada ignorada: {content_preview}...")
-                return JsonResponse({'status': 'ignored_duplicate'}, status=200)
-            
-            # Extrair external_id da mensagem
-            external_id = msg_data.get('id') or msg_data.get('key', {}).get('id')
-            
-            # Preparar additional_attributes com external_id e informações de resposta
-            additional_attrs = {}
-            if external_id:
-                additional_attrs['external_id'] = external_id
-                print(f"DEBUG: External ID extraído: {external_id}")
-            
-            # Adicionar informações de mensagem respondida se existir
-            if reply_to_message_id:
-                additional_attrs['reply_to_message_id'] = reply_to_message_id
-                additional_attrs['reply_to_content'] = reply_to_content
-                additional_attrs['is_reply'] = True
-                print(f"DEBUG: Informações de resposta adicionadas ao additional_attributes")
-            
-            msg = Message.objects.create(
-                conversation=conversation,
-                message_type='incoming',
-                content=content or '',
-                is_from_customer=True,  # Garantir que mensagens do cliente sejam marcadas corretamente
-                additional_attributes=additional_attrs,
-                created_at=timezone.now()
-            )
-            
-            print(f"DEBUG: Nova mensagem salva: {msg.id} - {content[:30]}...")
-            
-            # Emitir evento WebSocket para mensagem recebida
-            channel_layer = get_channel_layer()
-            from conversations.serializers import MessageSerializer
-            async_to_sync(channel_layer.group_send)(
-                f"conversation_{conversation.id}",
-                {
-                    "type": "chat_message",
-                    "message": MessageSerializer(msg).data,
-                    "sender": None,
-                    "timestamp": msg.created_at.isoformat(),
-                }
-            )
-            
-            # Emitir evento para o dashboard (toda vez que chega mensagem nova)
-            from conversations.serializers import ConversationSerializer
-            async_to_sync(channel_layer.group_send)(
-                "conversas_dashboard",
-                {
-                    "type": "dashboard_event",
-                    "data": {
-                        "action": "update_conversation",
-                        "conversation": ConversationSerializer(conversation).data
-                    }
-                }
-            )
-            
-            # 6. Acionar IA para resposta automática
-            print(f"🤖 IA: Acionando IA para mensagem: {content[:50]}...")
-            ia_result = openai_service.generate_response_sync(
-                mensagem=content,
-                provedor=provedor,
-                contexto={'conversation': conversation}
-            )
-            
-            print(f"🤖 IA: Resultado: {ia_result}")
-            resposta_ia = ia_result.get('resposta') if ia_result.get('success') else None
-            
-            # 7. Enviar resposta para Evolution (WhatsApp)
-            evolution_url = f'https://evo.niochat.com.br/message/sendText/{instance}'
-            evolution_apikey = '78be6d7e78e8be03ba5e3cbdf1443f1c'  # Trocar para variável de ambiente se necessário
-            send_result = None
-            
-            if resposta_ia:
-                print(f"DEBUG: Criando mensagem da IA - resposta_ia: {resposta_ia}")
-                try:
-                    send_resp = requests.post(
-                        evolution_url,
-                        headers={'apikey': evolution_apikey, 'Content-Type': 'application/json'},
-                        json={
-                            'number': msg_data.get('key', {}).get('remoteJid') or phone.replace('@s.whatsapp.net', '').replace('@lid', ''),
-                            'text': resposta_ia,
-                            'delay': 2000
-                        },
-                        timeout=10
-                    )
-                    send_result = send_resp.json() if send_resp.content else send_resp.status_code
-                    
-                    # Salvar mensagem outgoing - VERIFICAR DUPLICATA
-                    # Verificar se já existe uma mensagem da IA com o mesmo conteúdo nos últimos 30 segundos
-                    recent_time = django.utils.timezone.now() - timedelta(seconds=30)
-                    existing_ia_message = Message.objects.filter(
-                        conversation=conversation,
-                        content=resposta_ia,
-                        created_at__gte=recent_time,
-                        is_from_customer=False
-                    ).first()
-                    
-                    if existing_ia_message:
-                        resposta_preview = str(resposta_ia)[:30] if resposta_ia else "sem resposta"
-                        print(f"  Mensagem da IA duplicada ignorada: {resposta_preview}...")
-                    else:
-                        print(f"DEBUG: Salvando mensagem da IA com is_from_customer=False")
-                        # Extrair external_id da resposta da IA se disponível
-                        ia_external_id = None
-                        if send_result and isinstance(send_result, dict):
-                            ia_external_id = send_result.get('id') or send_result.get('message_id')
-                        
-                        # Preparar additional_attributes para mensagem da IA
-                        ia_additional_attrs = {}
-                        if ia_external_id:
-                            ia_additional_attrs['external_id'] = ia_external_id
-                            print(f"DEBUG: External ID da IA extraído: {ia_external_id}")
-                        
-                        msg_out = Message.objects.create(
-                            conversation=conversation,
-                            message_type='text',  # Corrigido para valor válido
-                            content=resposta_ia,
-                            is_from_customer=False,  # Corrigido para identificar como mensagem da IA
-                            additional_attributes=ia_additional_attrs,
-                            created_at=django.utils.timezone.now()
-                        )
-                        
-                        print(f"DEBUG: Mensagem da IA criada com ID: {msg_out.id}, is_from_customer: {msg_out.is_from_customer}")
-                        resposta_preview = resposta_ia[:30] if resposta_ia else "sem resposta"
-                        resposta_preview = str(resposta_ia)[:30] if resposta_ia else "sem resposta"
-                        print(f"DEBUG: Resposta IA enviada: {msg_out.id} - {resposta_preview}...")
-                        
-                        # Emitir evento WebSocket para mensagem enviada
-                        async_to_sync(channel_layer.group_send)(
-                            f"conversation_{conversation.id}",
-                            {
-                                "type": "chat_message",
-                                "message": MessageSerializer(msg_out).data,
-                                "sender": None,
-                                "timestamp": msg_out.created_at.isoformat(),
-                            }
-                        )
-                except Exception as e:
-                    send_result = f'Erro ao enviar para Evolution: {str(e)}'
-                    print(f"Erro ao enviar resposta IA: {e}")
-            
-            print('Mensagem salva:', msg.id)
-            print('Resposta IA:', resposta_ia)
-            print('Envio Evolution:', send_result)
-            
-            return JsonResponse({
-                'status': 'ok', 
-                'resposta_ia': resposta_ia, 
-                'envio': send_result,
-                'contact_created': created,
-                'conversation_created': conv_created,
-                'provedor': provedor.nome
-            })
-            
-        except Exception as e:
-            print(f"Erro no webhook: {e}")
-            return JsonResponse({'error': str(e)}, status=500)
-    
-    return JsonResponse({'error': 'Método não permitido'}, status=405)
-
-
 @csrf_exempt
 def webhook_evolution_uazapi(request):
     """Webhook para receber mensagens da Uazapi"""
@@ -765,17 +582,17 @@ def webhook_evolution_uazapi(request):
         clean_instance = instance.replace('@s.whatsapp.net', '').replace('@c.us', '') if instance else ''
         clean_chatid = chatid.replace('@s.whatsapp.net', '').replace('@c.us', '') if chatid else ''
         
-        print(f"DEBUG: clean_instance: {clean_instance}")
-        print(f"DEBUG: clean_chatid: {clean_chatid}")
+        logger.debug("clean_instance: %s", clean_instance)
+        logger.debug("clean_chatid: %s", clean_chatid)
         
         if clean_chatid == clean_instance:
-            print(f"DEBUG: Ignorando mensagem do próprio número conectado: {chatid}")
+            logger.debug("Ignorando mensagem do próprio número conectado: %s", chatid)
             return JsonResponse({'status': 'ignored', 'reason': 'message from connected number'}, status=200)
         
         # Buscar provedor e credenciais ANTES da verificação de números
         from core.models import Provedor
         
-        print(f"DEBUG: Buscando provedor para instance: {instance}")
+        logger.debug("Buscando provedor para instance: %s", instance)
         
         # Buscar provedor com credenciais da Uazapi
         provedor = Provedor.objects.filter(
@@ -783,31 +600,30 @@ def webhook_evolution_uazapi(request):
         ).first()
         
         if not provedor:
-            print(" DEBUG: Nenhum provedor com credenciais da Uazapi encontrado")
+            logger.warning("Nenhum provedor com credenciais da Uazapi encontrado")
             return JsonResponse({'error': 'Nenhum provedor com credenciais da Uazapi encontrado'}, status=400)
         
-        print(f"DEBUG: Provedor encontrado: {provedor.nome}")
+        logger.debug("Provedor encontrado: %s", provedor.nome)
         
         # Buscar token e url da UazAPI do provedor
         uazapi_token = provedor.integracoes_externas.get('whatsapp_token')
         uazapi_url = provedor.integracoes_externas.get('whatsapp_url')
         
         if not uazapi_token or not uazapi_url:
-            print(" DEBUG: Token ou URL não configurados no provedor")
+            logger.warning("Token ou URL não configurados no provedor")
             return JsonResponse({'error': 'Token ou URL não configurados no provedor'}, status=400)
         
-        print(f"DEBUG: Token do provedor: {uazapi_token[:10]}...")
-        print(f"DEBUG: URL do provedor: {uazapi_url}")
+        logger.debug("URL do provedor: %s", uazapi_url)
         
         # Verificar e normalizar o número usando /chat/check
         if chatid and uazapi_url and uazapi_token:
-            print(f"DEBUG: Verificando número via /chat/check antes da normalização")
+            logger.debug("Verificando número via /chat/check antes da normalização")
             verified_chatid = verify_and_normalize_number(chatid, uazapi_url, uazapi_token)
             if verified_chatid != chatid:
-                print(f"DEBUG: Número verificado e corrigido: {chatid} -> {verified_chatid}")
+                logger.debug("Número verificado e corrigido: %s -> %s", chatid, verified_chatid)
                 chatid = verified_chatid
             else:
-                print(f"ℹ️ DEBUG: Número mantido como original: {chatid}")
+                logger.debug("Número mantido como original: %s", chatid)
         
         # Normalizar chatid usando a lógica do n8n
         if chatid and chatid.endswith('@s.whatsapp.net'):
@@ -819,18 +635,18 @@ def webhook_evolution_uazapi(request):
             chatid_clean = chatid
             chatid_full = f"{chatid}@s.whatsapp.net" if chatid else ''
         
-        print(f"DEBUG: chatid_clean final: {chatid_clean}")
-        print(f"DEBUG: chatid_full final: {chatid_full}")
+        logger.debug("chatid_clean final: %s", chatid_clean)
+        logger.debug("chatid_full final: %s", chatid_full)
         
         # Verificar se o chatid_clean é válido
         if not chatid_clean or chatid_clean == clean_instance:
-            print(f"DEBUG: Ignorando chatid inválido: {chatid_clean}")
+            logger.debug("Ignorando chatid inválido: %s", chatid_clean)
             return JsonResponse({'status': 'ignored', 'reason': 'invalid chatid'}, status=200)
         
         # Verificar se é uma mensagem enviada pelo sistema (fromMe: true)
         fromMe = msg_data.get('fromMe', False)
         if fromMe:
-            print(f"DEBUG: Ignorando mensagem enviada pelo sistema (fromMe: {fromMe})")
+            logger.debug("Ignorando mensagem enviada pelo sistema (fromMe: %s)", fromMe)
             return JsonResponse({'status': 'ignored', 'reason': 'message sent by system'}, status=200)
         
         phone = chatid_full
@@ -852,7 +668,7 @@ def webhook_evolution_uazapi(request):
         # Verificar se há campo 'quoted' (novo formato)
         quoted_id = msg_data.get('quoted')
         if quoted_id:
-            print(f"DEBUG: Campo 'quoted' encontrado: {quoted_id}")
+            logger.debug("Campo 'quoted' encontrado: %s", quoted_id)
             reply_to_message_id = quoted_id
         
         # Verificar se quotedMessage está dentro de content.contextInfo (novo formato)
@@ -860,10 +676,10 @@ def webhook_evolution_uazapi(request):
             context_info = content.get('contextInfo', {})
             quoted_message = context_info.get('quotedMessage')
             if quoted_message:
-                print(f"DEBUG: quotedMessage encontrado em content.contextInfo: {quoted_message}")
+                log_payload(logger, "quotedMessage encontrado em content.contextInfo", quoted_message)
         
         if quoted_message:
-            print(f"DEBUG: Mensagem respondida detectada: {quoted_message}")
+            log_payload(logger, "Mensagem respondida detectada", quoted_message)
             # Extrair informações da mensagem respondida
             if isinstance(quoted_message, dict):
                 # Verificar se tem extendedTextMessage (novo formato)
@@ -879,13 +695,13 @@ def webhook_evolution_uazapi(request):
                 reply_to_message_id = quoted_message
                 reply_to_content = "Mensagem respondida"
             
-            print(f"DEBUG: ID da mensagem respondida: {reply_to_message_id}")
-            print(f"DEBUG: Conteúdo da mensagem respondida: {reply_to_content}")
+            logger.debug("ID da mensagem respondida: %s", reply_to_message_id)
+            logger.debug("Conteúdo da mensagem respondida: %s", reply_to_content)
         
         # Agora converter content para string se for um objeto
         if isinstance(content, dict) and 'text' in content:
             content = content['text']
-            print(f"DEBUG: Conteúdo extraído do objeto: {content}")
+            logger.debug("Conteúdo extraído do objeto: %s", content)
         
         # Detectar tipo de mensagem
         message_type = msg_data.get('type') or msg_data.get('messageType') or 'text'
@@ -897,17 +713,17 @@ def webhook_evolution_uazapi(request):
         if isinstance(content, dict) and content.get('mimetype', '').startswith('audio/'):
             is_audio_message = True
             message_type = 'audio'
-            print(f"DEBUG: ÁUDIO DETECTADO")
+            logger.debug("ÁUDIO DETECTADO")
         else:
-            print(f"DEBUG: Não é áudio")
+            logger.debug("Não é áudio")
         
-        print(f"DEBUG: Tipo de mensagem: {message_type}")
+        logger.debug("Tipo de mensagem: %s", message_type)
         
         # Log específico para áudio
         if (message_type == 'audio' or message_type == 'ptt' or 
             message_type == 'AudioMessage' or media_type == 'ptt' or media_type == 'audio' or
             is_audio_message):
-            print(f"DEBUG: MENSAGEM DE ÁUDIO DETECTADA!")
+            logger.debug("MENSAGEM DE ÁUDIO DETECTADA!")
         
         # Para mensagens de mídia, não usar o JSON bruto como conteúdo
         if (message_type in ['audio', 'image', 'video', 'document', 'sticker', 'ptt', 'media'] or
@@ -918,7 +734,7 @@ def webhook_evolution_uazapi(request):
             # Se o conteúdo for um JSON (objeto), não usar como texto
             if isinstance(content, dict) or (isinstance(content, str) and content.startswith('{')):
                 content = None
-                print(f"DEBUG: Conteúdo JSON detectado")
+                logger.debug("Conteúdo JSON detectado")
             
             # Definir conteúdo apropriado para cada tipo de mídia
             if not content:
@@ -935,7 +751,7 @@ def webhook_evolution_uazapi(request):
                     content = 'Documento'
                 else:
                     content = f'Mídia ({message_type})'
-                print(f"DEBUG: Conteúdo definido para mídia: {content}")
+                logger.debug("Conteúdo definido para mídia: %s", content)
         else:
             # Para mensagens de texto, se não houver conteúdo, usar placeholder
             if not content:
@@ -948,16 +764,15 @@ def webhook_evolution_uazapi(request):
         event_type_lower = str(event_type).lower()
         
         # Log completo do evento recebido para debug
-        print(f"DEBUG: Evento completo recebido:")
-        print(f"DEBUG: event_type: {event_type}")
-        print(f"DEBUG: data: {data}")
-        print(f"DEBUG: msg_data: {msg_data}")
+        logger.debug("event_type: %s", event_type)
+        log_payload(logger, "data", data)
+        log_payload(logger, "msg_data", msg_data)
         
         # Verificar se é um evento de exclusão
         if event_type_lower in delete_eventos:
-            print(f"DEBUG: Evento de exclusão detectado: {event_type}")
-            print(f"DEBUG: event_type_lower: {event_type_lower}")
-            print(f"DEBUG: delete_eventos: {delete_eventos}")
+            logger.debug("Evento de exclusão detectado: %s", event_type)
+            logger.debug("event_type_lower: %s", event_type_lower)
+            logger.debug("delete_eventos: %s", delete_eventos)
             
             # Extrair ID da mensagem deletada de diferentes possíveis locais
             deleted_message_id = (
@@ -970,15 +785,15 @@ def webhook_evolution_uazapi(request):
                 data.get('message_id')
             )
             
-            print(f"DEBUG: deleted_message_id extraído: {deleted_message_id}")
+            logger.debug("deleted_message_id extraído: %s", deleted_message_id)
             
             if deleted_message_id:
-                print(f"DEBUG: Mensagem deletada no WhatsApp: {deleted_message_id}")
+                logger.debug("Mensagem deletada no WhatsApp: %s", deleted_message_id)
                 
                 # Buscar a mensagem no banco de dados pelo external_id
                 try:
-                    message = Message.objects.get(additional_attributes__external_id=deleted_message_id)
-                    print(f"DEBUG: Mensagem encontrada por external_id: {message.id}")
+                    message = Message.objects.get(external_id=deleted_message_id)
+                    logger.debug("Mensagem encontrada por external_id: %s", message.id)
                     
                     # Marcar como deletada
                     additional_attrs = message.additional_attributes or {}
@@ -988,7 +803,7 @@ def webhook_evolution_uazapi(request):
                     message.additional_attributes = additional_attrs
                     message.save()
                     
-                    print(f"DEBUG: Mensagem marcada como deletada: {message.id}")
+                    logger.debug("Mensagem marcada como deletada: %s", message.id)
                     
                     # Emitir evento WebSocket
                     channel_layer = get_channel_layer()
@@ -1008,12 +823,12 @@ def webhook_evolution_uazapi(request):
                     return JsonResponse({'status': 'message_deleted'}, status=200)
                     
                 except Message.DoesNotExist:
-                    print(f"DEBUG: Mensagem não encontrada no banco: {deleted_message_id}")
+                    logger.debug("Mensagem não encontrada no banco: %s", deleted_message_id)
                     # Tentar buscar por outros campos
                     try:
                         # Buscar por ID da mensagem
                         message = Message.objects.get(id=deleted_message_id)
-                        print(f"DEBUG: Mensagem encontrada por ID: {message.id}")
+                        logger.debug("Mensagem encontrada por ID: %s", message.id)
                         
                         # Marcar como deletada
                         additional_attrs = message.additional_attributes or {}
@@ -1023,7 +838,7 @@ def webhook_evolution_uazapi(request):
                         message.additional_attributes = additional_attrs
                         message.save()
                         
-                        print(f"DEBUG: Mensagem marcada como deletada: {message.id}")
+                        logger.debug("Mensagem marcada como deletada: %s", message.id)
                         
                         # Emitir evento WebSocket
                         channel_layer = get_channel_layer()
@@ -1043,15 +858,15 @@ def webhook_evolution_uazapi(request):
                         return JsonResponse({'status': 'message_deleted'}, status=200)
                         
                     except Message.DoesNotExist:
-                        print(f"DEBUG: Mensagem não encontrada nem por external_id nem por ID: {deleted_message_id}")
+                        logger.debug("Mensagem não encontrada nem por external_id nem por ID: %s", deleted_message_id)
                         return JsonResponse({'status': 'message_not_found'}, status=200)
             else:
-                print(f"DEBUG: ID da mensagem deletada não encontrado")
+                logger.debug("ID da mensagem deletada não encontrado")
                 return JsonResponse({'status': 'no_message_id'}, status=200)
         else:
-            print(f"DEBUG: Evento não é de exclusão. event_type_lower: {event_type_lower}")
-            print(f"DEBUG: delete_eventos: {delete_eventos}")
-            print(f"DEBUG: event_type_lower in delete_eventos: {event_type_lower in delete_eventos}")
+            logger.debug("Evento não é de exclusão. event_type_lower: %s", event_type_lower)
+            logger.debug("delete_eventos: %s", delete_eventos)
+            logger.debug("event_type_lower in delete_eventos: %s", event_type_lower in delete_eventos)
         
         # Verificar se é um evento de mensagem normal
         if event_type_lower not in mensagem_eventos:
@@ -1066,9 +881,9 @@ def webhook_evolution_uazapi(request):
             sender_clean = sender.replace('@s.whatsapp.net', '').replace('@c.us', '')
             if sender_clean == clean_instance:
                 is_ai_response = True
-        print(f"DEBUG: sender: {sender} | sender_clean: {sender_clean} | clean_instance: {clean_instance} | is_ai_response: {is_ai_response}")
+        logger.debug("sender: %s | sender_clean: %s | clean_instance: %s | is_ai_response: %s", sender, sender_clean, clean_instance, is_ai_response)
         if is_ai_response:
-            print(f"DEBUG: Ignorando mensagem da IA: {content}")
+            logger.debug("Ignorando mensagem da IA: %s", content)
             return JsonResponse({'status': 'ignored', 'reason': 'AI response message'}, status=200)
 
         # Não responder mensagens enviadas pelo próprio número do bot (exceto para áudio)
@@ -1087,10 +902,10 @@ def webhook_evolution_uazapi(request):
             # Verificar se está sendo enviado para o bot
             if (clean_chatid == clean_bot_number) or (clean_sender_lid == clean_bot_number):
                 is_sent_to_bot = True
-                print(f"DEBUG: Mensagem sendo enviada para o número conectado ({bot_number}) - IGNORANDO")
+                logger.debug("Mensagem sendo enviada para o número conectado (%s) - IGNORANDO", bot_number)
                 return JsonResponse({'status': 'ignored', 'reason': 'message sent to connected number'}, status=200)
         
-        print(f"DEBUG: Mensagem não está sendo enviada para o número conectado - processando normalmente")
+        logger.debug("Mensagem não está sendo enviada para o número conectado - processando normalmente")
 
         # 2. Buscar ou criar contato
         # Extrair chatid e sender_lid da mensagem
@@ -1101,40 +916,40 @@ def webhook_evolution_uazapi(request):
         nome_evo = msg_data.get('senderName') or msg_data.get('pushName') or msg_data.get('senderName')
         avatar_evo = msg_data.get('avatar')
         
-        print(f"DEBUG: Nome extraído: {nome_evo}")
-        print(f"DEBUG: Avatar extraído: {avatar_evo}")
+        logger.debug("Nome extraído: %s", nome_evo)
+        logger.debug("Avatar extraído: %s", avatar_evo)
         
         # Usar chatid_clean para o phone_number (evitar duplicação)
         phone_number = chatid_clean
         
-        print(f"DEBUG: phone_number final: {phone_number}")
-        print(f"DEBUG: provedor: {provedor}")
+        logger.debug("phone_number final: %s", phone_number)
+        logger.debug("provedor: %s", provedor)
         
         # Buscar contato existente por phone (que agora é o chatid limpo)
         contact = None
         if phone_number:
             # Buscar por phone_number primeiro
             contact = Contact.objects.filter(phone=phone_number, provedor=provedor).first()
-            print(f"DEBUG: Busca por phone_number '{phone_number}': {'Encontrado' if contact else 'Não encontrado'}")
+            logger.debug("Busca por phone_number '%s': %s", phone_number, 'Encontrado' if contact else 'Não encontrado')
             
-            # Se não encontrou, buscar por chatid nos additional_attributes
+            # Se não encontrou, buscar pelo chatid (<numero>@...; o '@' evita casar só o prefixo do número)
             if not contact:
                 contact = Contact.objects.filter(
-                    additional_attributes__chatid__icontains=phone_number,
+                    chatid__startswith=f"{phone_number}@",
                     provedor=provedor
                 ).first()
-                print(f"DEBUG: Busca por chatid nos additional_attributes: {'Encontrado' if contact else 'Não encontrado'}")
+                logger.debug("Busca por chatid: %s", 'Encontrado' if contact else 'Não encontrado')
             
             # Se ainda não encontrou, buscar por sender_lid (apenas como fallback)
             if not contact and sender_lid:
                 contact = Contact.objects.filter(
-                    additional_attributes__sender_lid=sender_lid,
+                    sender_lid=sender_lid,
                     provedor=provedor
                 ).first()
-                print(f"DEBUG: Busca por sender_lid '{sender_lid}': {'Encontrado' if contact else 'Não encontrado'}")
+                logger.debug("Busca por sender_lid '%s': %s", sender_lid, 'Encontrado' if contact else 'Não encontrado')
         
         if contact:
-            print(f"DEBUG: Contato existente encontrado: {contact.name} (ID: {contact.id})")
+            logger.debug("Contato existente encontrado: %s (ID: %s)", contact.name, contact.id)
             # Atualizar contato existente
             updated = False
             if nome_evo and contact.name != nome_evo:
@@ -1156,7 +971,7 @@ def webhook_evolution_uazapi(request):
             
             if updated:
                 contact.save()
-                print(f"DEBUG: Contato atualizado: {contact.name}")
+                logger.debug("Contato atualizado: %s", contact.name)
                 
             # Buscar foto do perfil sempre (novos e existentes)
             if chatid_clean and uazapi_token and uazapi_url:
@@ -1169,9 +984,8 @@ def webhook_evolution_uazapi(request):
                         'number': chatid_clean
                     }
                     
-                    print(f"DEBUG: Buscando foto do perfil para contato existente: {chatid_clean}")
-                    print(f"DEBUG: URL: {chat_details_url}")
-                    print(f"DEBUG: Token: {uazapi_token[:10]}...")
+                    logger.debug("Buscando foto do perfil para contato existente: %s", chatid_clean)
+                    logger.debug("URL: %s", chat_details_url)
                     
                     import requests as http_requests
                     response = http_requests.post(
@@ -1184,39 +998,37 @@ def webhook_evolution_uazapi(request):
                         timeout=10
                     )
                     
-                    print(f"DEBUG: Status code: {response.status_code}")
+                    logger.debug("Status code: %s", response.status_code)
                     
                     if response.status_code == 200:
                         chat_data = response.json()
-                        print(f"DEBUG: Resposta /chat/details: {chat_data}")
+                        log_payload(logger, "Resposta /chat/details", chat_data)
                         
                         # Verificar se há foto do perfil (sempre atualizar)
                         if 'image' in chat_data and chat_data['image']:
                             contact.avatar = chat_data['image']
                             contact.save()
-                            print(f"DEBUG: Foto do perfil atualizada: {contact.avatar}")
+                            logger.debug("Foto do perfil atualizada: %s", contact.avatar)
                         else:
-                            print(f"DEBUG: Nenhuma foto do perfil encontrada")
+                            logger.debug("Nenhuma foto do perfil encontrada")
                             
                         # Verificar se há nome verificado (sempre atualizar se diferente)
                         if 'wa_name' in chat_data and chat_data['wa_name'] and contact.name != chat_data['wa_name']:
                             contact.name = chat_data['wa_name']
                             contact.save()
-                            print(f"DEBUG: Nome verificado atualizado: {contact.name}")
+                            logger.debug("Nome verificado atualizado: %s", contact.name)
                         elif 'name' in chat_data and chat_data['name'] and contact.name != chat_data['name']:
                             contact.name = chat_data['name']
                             contact.save()
-                            print(f"DEBUG: Nome atualizado: {contact.name}")
+                            logger.debug("Nome atualizado: %s", contact.name)
                             
                     else:
-                        print(f"DEBUG: Erro ao buscar foto do perfil: {response.status_code} - {response.text}")
+                        logger.warning("Erro ao buscar foto do perfil: %s - %s", response.status_code, response.text)
                         
                 except Exception as e:
-                    print(f"DEBUG: Erro ao buscar foto do perfil: {e}")
-                    import traceback
-                    print(f"DEBUG: Traceback: {traceback.format_exc()}")
+                    logger.warning("Erro ao buscar foto do perfil: %s", e, exc_info=True)
         else:
-            print(f"DEBUG: Criando novo contato para phone_number: {phone_number}")
+            logger.debug("Criando novo contato para phone_number: %s", phone_number)
             # Criar novo contato
             contact = Contact.objects.create(
                 phone=phone_number or '',
@@ -1229,7 +1041,7 @@ def webhook_evolution_uazapi(request):
                     'sender_lid': sender_lid
                 }
             )
-            print(f"DEBUG: Novo contato criado: {contact.name} (ID: {contact.id})")
+            logger.debug("Novo contato criado: %s (ID: %s)", contact.name, contact.id)
             
             # Buscar foto do perfil usando o endpoint /chat/details da Uazapi (sempre)
             if chatid_clean and uazapi_token and uazapi_url:
@@ -1242,9 +1054,8 @@ def webhook_evolution_uazapi(request):
                         'number': chatid_clean
                     }
                     
-                    print(f"DEBUG: Buscando foto do perfil para: {chatid_clean}")
-                    print(f"DEBUG: URL: {chat_details_url}")
-                    print(f"DEBUG: Token: {uazapi_token[:10]}...")
+                    logger.debug("Buscando foto do perfil para: %s", chatid_clean)
+                    logger.debug("URL: %s", chat_details_url)
                     
                     import requests as http_requests
                     response = http_requests.post(
@@ -1257,37 +1068,35 @@ def webhook_evolution_uazapi(request):
                         timeout=10
                     )
                     
-                    print(f"DEBUG: Status code: {response.status_code}")
+                    logger.debug("Status code: %s", response.status_code)
                     
                     if response.status_code == 200:
                         chat_data = response.json()
-                        print(f"DEBUG: Resposta /chat/details: {chat_data}")
+                        log_payload(logger, "Resposta /chat/details", chat_data)
                         
                         # Verificar se há foto do perfil
                         if 'image' in chat_data and chat_data['image']:
                             contact.avatar = chat_data['image']
                             contact.save()
-                            print(f"DEBUG: Foto do perfil obtida: {contact.avatar}")
+                            logger.debug("Foto do perfil obtida: %s", contact.avatar)
                         else:
-                            print(f"DEBUG: Nenhuma foto do perfil encontrada")
+                            logger.debug("Nenhuma foto do perfil encontrada")
                             
                         # Verificar se há nome verificado
                         if 'wa_name' in chat_data and chat_data['wa_name']:
                             contact.name = chat_data['wa_name']
                             contact.save()
-                            print(f"DEBUG: Nome verificado obtido: {contact.name}")
+                            logger.debug("Nome verificado obtido: %s", contact.name)
                         elif 'name' in chat_data and chat_data['name']:
                             contact.name = chat_data['name']
                             contact.save()
-                            print(f"DEBUG: Nome obtido: {contact.name}")
+                            logger.debug("Nome obtido: %s", contact.name)
                             
                     else:
-                        print(f"DEBUG: Erro ao buscar foto do perfil: {response.status_code} - {response.text}")
+                        logger.warning("Erro ao buscar foto do perfil: %s - %s", response.status_code, response.text)
                         
                 except Exception as e:
-                    print(f"DEBUG: Erro ao buscar foto do perfil: {e}")
-                    import traceback
-                    print(f"DEBUG: Traceback: {traceback.format_exc()}")
+                    logger.warning("Erro ao buscar foto do perfil: %s", e, exc_info=True)
 
         # 3. Buscar ou criar inbox específica para esta instância
         inbox, _ = Inbox.objects.get_or_create(
@@ -1303,7 +1112,7 @@ def webhook_evolution_uazapi(request):
         )
         
         # Buscar ou criar conversa - CORREÇÃO: evitar duplicação por canal
-        print(f"DEBUG: Buscando conversa existente para contato {contact.id} ({contact.name})")
+        logger.debug("Buscando conversa existente para contato %s (%s)", contact.id, contact.name)
         existing_conversation = Conversation.objects.filter(
             contact=contact,
             inbox__channel_type='whatsapp'  # Buscar por canal, não por inbox específica
@@ -1312,11 +1121,11 @@ def webhook_evolution_uazapi(request):
         if existing_conversation:
             # Usar conversa existente, mas atualizar inbox se necessário
             conversation = existing_conversation
-            print(f"DEBUG: Conversa existente encontrada - ID: {conversation.id}")
+            logger.debug("Conversa existente encontrada - ID: %s", conversation.id)
             if conversation.inbox != inbox:
                 conversation.inbox = inbox
                 conversation.save()
-                print(f"Conversa {conversation.id} atualizada para inbox {inbox.name}")
+                logger.debug("Conversa %s atualizada para inbox %s", conversation.id, inbox.name)
             conv_created = False
         else:
             # Criar nova conversa
@@ -1330,7 +1139,7 @@ def webhook_evolution_uazapi(request):
                 }
             )
             conv_created = True
-            print(f"DEBUG: Nova conversa criada: {conversation.id} para contato {contact.name} (ID: {contact.id})")
+            logger.debug("Nova conversa criada: %s para contato %s (ID: %s)", conversation.id, contact.name, contact.id)
         
         # Se a conversa já existia e não está com status correto, atualiza
         if not conv_created and (conversation.status != 'snoozed' or conversation.assignee is not None):
@@ -1345,17 +1154,18 @@ def webhook_evolution_uazapi(request):
         additional_attrs = {}
         if external_id:
             additional_attrs['external_id'] = external_id
-            print(f"DEBUG: External ID extraído no webhook Uazapi: {external_id}")
+            logger.debug("External ID extraído no webhook Uazapi: %s", external_id)
         
         file_url = None
+        pending_download = None
         
         if (message_type in ['audio', 'image', 'video', 'document', 'sticker', 'ptt', 'media'] or
             message_type in ['AudioMessage', 'ImageMessage', 'VideoMessage', 'DocumentMessage'] or
             media_type in ['ptt', 'audio', 'image', 'video', 'document', 'sticker'] or
             is_audio_message):
             
-            print(f"DEBUG: Processando mensagem de mídia - tipo: {message_type}, media_type: {media_type}")
-            print(f"DEBUG: Condição de mídia ativada - message_type: {message_type}, media_type: {media_type}")
+            logger.debug("Processando mensagem de mídia - tipo: %s, media_type: %s", message_type, media_type)
+            logger.debug("Condição de mídia ativada - message_type: %s, media_type: %s", message_type, media_type)
             
             # Tentar baixar o arquivo da Uazapi
             try:
@@ -1372,10 +1182,6 @@ def webhook_evolution_uazapi(request):
                     from django.conf import settings
                     import requests
                     
-                    # Criar diretório para mídia
-                    media_dir = os.path.join(settings.MEDIA_ROOT, 'messages', str(conversation.id))
-                    os.makedirs(media_dir, exist_ok=True)
-                    
                     # Determinar extensão e prefixo baseados no tipo de mídia
                     file_extension = '.mp3'  # Padrão para áudio
                     file_prefix = 'audio'
@@ -1406,7 +1212,7 @@ def webhook_evolution_uazapi(request):
                         elif 'm4a' in mimetype:
                             file_extension = '.m4a'
                             file_prefix = 'audio'
-                        print(f"DEBUG: Extensão determinada pelo mimetype: {file_extension}")
+                        logger.debug("Extensão determinada pelo mimetype: %s", file_extension)
                     else:
                         # Determinar baseado no tipo de mensagem
                         if message_type == 'image':
@@ -1429,17 +1235,16 @@ def webhook_evolution_uazapi(request):
                     if message_type == 'audio' or is_audio_message:
                         file_extension = '.mp3'
                         file_prefix = 'audio'
-                        print(f"DEBUG: Forçando extensão .mp3 para compatibilidade")
+                        logger.debug("Forçando extensão .mp3 para compatibilidade")
                     
                     # Gerar nome do arquivo
                     timestamp = int(time.time() * 1000)
                     filename = f"{file_prefix}_{timestamp}{file_extension}"
-                    file_path = os.path.join(media_dir, filename)
                     
                     # Preparar payload para download conforme documentação da Uazapi
                     message_id = msg_data.get('id') or msg_data.get('key', {}).get('id')
                     if not message_id:
-                        print(f"DEBUG: ID da mensagem não encontrado para download")
+                        logger.debug("ID da mensagem não encontrado para download")
                     else:
                         download_payload = {
                             'id': message_id,
@@ -1453,9 +1258,9 @@ def webhook_evolution_uazapi(request):
                             # Forçar conversão para MP3 para garantir compatibilidade
                             download_payload['mimetype'] = 'audio/mpeg'
                             download_payload['format'] = 'mp3'  # Adicionar formato explícito
-                            print(f"DEBUG: Forçando conversão para MP3")
+                            logger.debug("Forçando conversão para MP3")
                         
-                        print(f"DEBUG: Baixando arquivo da Uazapi")
+                        logger.debug("Baixando arquivo da Uazapi")
                         
                         download_response = requests.post(
                             download_url,
@@ -1471,7 +1276,7 @@ def webhook_evolution_uazapi(request):
                                 # Verificar se temos fileURL na resposta
                                 if 'fileURL' in response_data:
                                     file_url = response_data['fileURL']
-                                    print(f"DEBUG: URL do arquivo obtida")
+                                    logger.debug("URL do arquivo obtida")
                                     
                                     # Preparar atributos adicionais
                                     additional_attrs = {
@@ -1483,75 +1288,20 @@ def webhook_evolution_uazapi(request):
                                         'uazapi_response': response_data
                                     }
                                     
-                                    # Baixar arquivo de forma otimizada
-                                    try:
-                                        print(f"DEBUG: Baixando arquivo do UazAPI")
-                                        
-                                        # Baixar arquivo do UazAPI com timeout reduzido
-                                        file_response = requests.get(file_url, timeout=15)
-                                        
-                                        if file_response.status_code == 200:
-                                            # Salvar arquivo localmente
-                                            with open(file_path, 'wb') as f:
-                                                f.write(file_response.content)
-                                            
-                                            # Conversão otimizada para MP3
-                                            if filename.endswith('.webm'):
-                                                try:
-                                                    import subprocess
-                                                    mp3_path = file_path.replace('.webm', '.mp3')
-                                                    mp3_filename = filename.replace('.webm', '.mp3')
-                                                    
-                                                    print(f"DEBUG: Convertendo WebM para MP3")
-                                                    
-                                                    # Converter usando ffmpeg com timeout
-                                                    result = subprocess.run([
-                                                        'ffmpeg', '-i', file_path, 
-                                                        '-acodec', 'libmp3lame', 
-                                                        '-ab', '128k', 
-                                                        '-y', mp3_path
-                                                    ], capture_output=True, text=True, timeout=30)
-                                                    
-                                                    if result.returncode == 0:
-                                                        print(f"DEBUG: Conversão para MP3 bem-sucedida")
-                                                        # Usar o arquivo MP3 em vez do WebM
-                                                        file_path = mp3_path
-                                                        filename = mp3_filename
-                                                        additional_attrs['file_path'] = mp3_path
-                                                        additional_attrs['file_size'] = os.path.getsize(mp3_path)
-                                                        # Usar URL pública acessível
-                                                        additional_attrs['local_file_url'] = f"/api/media/messages/{conversation.id}/{mp3_filename}"
-                                                        print(f"DEBUG: Arquivo MP3 criado")
-                                                    else:
-                                                        print(f"DEBUG: Erro na conversão para MP3")
-                                                except subprocess.TimeoutExpired:
-                                                    print(f"DEBUG: Timeout na conversão para MP3")
-                                                except Exception as e:
-                                                    print(f"DEBUG: Erro ao converter para MP3: {e}")
-                                            else:
-                                                additional_attrs['file_path'] = file_path
-                                                additional_attrs['file_size'] = len(file_response.content)
-                                                # Usar URL pública acessível
-                                                additional_attrs['local_file_url'] = f"/api/media/messages/{conversation.id}/{filename}"
-
-                                            print(f"DEBUG: Arquivo baixado e salvo localmente")
-                                        else:
-                                            print(f"DEBUG: Erro ao baixar arquivo do UazAPI: {file_response.status_code}")
-                                    except requests.Timeout:
-                                        print(f"DEBUG: Timeout ao baixar arquivo")
-                                    except Exception as e:
-                                        print(f"DEBUG: Erro ao baixar arquivo: {e}")
+                                    # O arquivo é baixado em background depois que a
+                                    # mensagem for salva (conversations.media); até lá
+                                    # o painel usa a URL remota
+                                    additional_attrs['media_status'] = 'downloading'
+                                    pending_download = (file_url, filename)
                                 else:
-                                    print(f"DEBUG: fileURL não encontrada na resposta")
+                                    logger.debug("fileURL não encontrada na resposta")
                             except Exception as e:
-                                print(f"DEBUG: Erro ao processar resposta: {e}")
+                                logger.warning("Erro ao processar resposta: %s", e)
                         else:
-                            print(f"DEBUG: Erro ao baixar arquivo da Uazapi: {download_response.status_code}")
+                            logger.warning("Erro ao baixar arquivo da Uazapi: %s", download_response.status_code)
 
             except Exception as e:
-                print(f"DEBUG: Erro ao processar mídia: {e}")
-                import traceback
-                traceback.print_exc()
+                logger.warning("Erro ao processar mídia: %s", e, exc_info=True)
         
         # 5. Salvar mensagem recebida - VERIFICAR DUPLICATA
         # Verificar se já existe uma mensagem com o mesmo conteúdo nos últimos 30 segundos
@@ -1565,25 +1315,25 @@ def webhook_evolution_uazapi(request):
         
         if existing_message:
             content_preview = content[:30] if content else "sem conteúdo"
-            print(f"  Mensagem duplicada ignorada: {content_preview}...")
+            logger.debug("Mensagem duplicada ignorada: %s...", content_preview)
             return JsonResponse({'status': 'ignored_duplicate'}, status=200)
         
         # Adicionar informações de resposta se for uma mensagem respondida
-        print(f"DEBUG: Verificando se é mensagem respondida:")
-        print(f"DEBUG: quoted_message: {quoted_message}")
-        print(f"DEBUG: reply_to_message_id: {reply_to_message_id}")
-        print(f"DEBUG: reply_to_content: {reply_to_content}")
+        logger.debug("Verificando se é mensagem respondida:")
+        log_payload(logger, "quoted_message", quoted_message)
+        logger.debug("reply_to_message_id: %s", reply_to_message_id)
+        logger.debug("reply_to_content: %s", reply_to_content)
         
         if quoted_message and reply_to_message_id and reply_to_content:
             additional_attrs['is_reply'] = True
             additional_attrs['reply_to_message_id'] = reply_to_message_id
             additional_attrs['reply_to_content'] = reply_to_content
-            print(f"DEBUG: Mensagem respondida detectada - ID: {reply_to_message_id}, Conteúdo: {reply_to_content}")
+            logger.debug("Mensagem respondida detectada - ID: %s, Conteúdo: %s", reply_to_message_id, reply_to_content)
         else:
-            print(f"DEBUG: Não é mensagem respondida ou faltam informações")
-            print(f"DEBUG: quoted_message: {quoted_message}")
-            print(f"DEBUG: reply_to_message_id: {reply_to_message_id}")
-            print(f"DEBUG: reply_to_content: {reply_to_content}")
+            logger.debug("Não é mensagem respondida ou faltam informações")
+            log_payload(logger, "quoted_message", quoted_message)
+            logger.debug("reply_to_message_id: %s", reply_to_message_id)
+            logger.debug("reply_to_content: %s", reply_to_content)
         
         # Determinar o tipo de mensagem para salvar no banco
         db_message_type = message_type if message_type in ['audio', 'image', 'video', 'document', 'sticker', 'ptt', 'media'] else 'incoming'
@@ -1591,34 +1341,34 @@ def webhook_evolution_uazapi(request):
         # Se for mensagem de mídia mas o message_type não for reconhecido, usar o media_type
         if db_message_type == 'incoming' and media_type in ['ptt', 'audio', 'image', 'video', 'document', 'sticker']:
             db_message_type = media_type
-            print(f"DEBUG: Usando media_type como db_message_type: {media_type}")
+            logger.debug("Usando media_type como db_message_type: %s", media_type)
         
         # Correção específica para áudio: se message_type é 'media' e media_type é 'ptt', usar 'ptt'
         if message_type == 'media' and media_type == 'ptt':
             db_message_type = 'ptt'
-            print(f"DEBUG: Corrigindo db_message_type de 'media' para 'ptt'")
+            logger.debug("Corrigindo db_message_type de 'media' para 'ptt'")
         
         # Correção para áudio detectado pelo mimetype
         if is_audio_message:
             db_message_type = 'audio'
-            print(f"DEBUG: Corrigindo db_message_type para 'audio' baseado no mimetype")
+            logger.debug("Corrigindo db_message_type para 'audio' baseado no mimetype")
         
         # Correção para imagem: se message_type é 'media' e media_type é 'image', usar 'image'
         if message_type == 'media' and media_type == 'image':
             db_message_type = 'image'
-            print(f"DEBUG: Corrigindo db_message_type de 'media' para 'image'")
+            logger.debug("Corrigindo db_message_type de 'media' para 'image'")
         
         # Correção para vídeo: se message_type é 'media' e media_type é 'video', usar 'video'
         if message_type == 'media' and media_type == 'video':
             db_message_type = 'video'
-            print(f"DEBUG: Corrigindo db_message_type de 'media' para 'video'")
+            logger.debug("Corrigindo db_message_type de 'media' para 'video'")
         
         # Correção para documento: se message_type é 'media' e media_type é 'document', usar 'document'
         if message_type == 'media' and media_type == 'document':
             db_message_type = 'document'
-            print(f"DEBUG: Corrigindo db_message_type de 'media' para 'document'")
+            logger.debug("Corrigindo db_message_type de 'media' para 'document'")
         
-        print(f"DEBUG: db_message_type final: {db_message_type}")
+        logger.debug("db_message_type final: %s", db_message_type)
         
         msg = Message.objects.create(
             conversation=conversation,
@@ -1629,15 +1379,17 @@ def webhook_evolution_uazapi(request):
             created_at=timezone.now()
         )
         content_preview = str(content)[:30] if content else "sem conteúdo"
-        print(f"DEBUG: Nova mensagem salva: {msg.id} - Conversa: {conversation.id}, Contato: {contact.name} - {content_preview}...")
+        logger.debug("Nova mensagem salva: %s - Conversa: %s, Contato: %s - %s...", msg.id, conversation.id, contact.name, content_preview)
+        if pending_download:
+            schedule_message_media_download(msg, *pending_download)
         if file_url:
-            print(f"DEBUG: Mensagem com mídia - file_url: {file_url}")
+            logger.debug("Mensagem com mídia - file_url: %s", file_url)
         
         # Emitir evento WebSocket para a conversa específica
         channel_layer = get_channel_layer()
         from conversations.serializers import MessageSerializer
         message_data = MessageSerializer(msg).data
-        print(f"DEBUG: Enviando mensagem via WebSocket: {message_data}")
+        log_payload(logger, "Enviando mensagem via WebSocket", message_data)
         
         async_to_sync(channel_layer.group_send)(
             f'conversation_{conversation.id}',
@@ -1661,13 +1413,24 @@ def webhook_evolution_uazapi(request):
                 }
             }
         )
-        # 1. Acionar IA para resposta automática
-        ia_result = openai_service.generate_response_sync(
-            mensagem=content,
-            provedor=provedor,
-            contexto={}
-        )
-        resposta_ia = ia_result.get('resposta') if ia_result.get('success') else None
+        # 1. Classificar a intenção antes do LLM: saudações são respondidas por
+        # template e pedidos de cancelamento vão direto para um atendente
+        classifier = classifier_for(provedor)
+        intents = classifier.classify(content)
+        if classifier.is_greeting_only(content, intents):
+            resposta_ia = greeting_reply(provedor, openai_service._get_greeting_time())
+        elif CANCELLATION in intents:
+            resposta_ia = CANCELLATION_REPLY
+            conversation.status = 'pending'
+            conversation.save(update_fields=['status'])
+            logger.debug("Pedido de cancelamento: conversa %s encaminhada para atendente", conversation.id)
+        else:
+            ia_result = openai_service.generate_response_sync(
+                mensagem=content,
+                provedor=provedor,
+                contexto={'intents': intents}
+            )
+            resposta_ia = ia_result.get('resposta') if ia_result.get('success') else None
         # 2. Enviar resposta para Uazapi (WhatsApp)
         import requests
         send_result = None
@@ -1684,7 +1447,7 @@ def webhook_evolution_uazapi(request):
                         'number': clean_number,
                         'text': resposta_ia
                     }
-                    print(f"DEBUG: Enviando resposta IA para: {clean_number}")
+                    logger.debug("Enviando resposta IA para: %s", clean_number)
                     send_resp = requests.post(
                         f"{uazapi_url.rstrip('/')}/send/text",
                         headers={'token': uazapi_token, 'Content-Type': 'application/json'},
@@ -1694,13 +1457,13 @@ def webhook_evolution_uazapi(request):
                     if send_resp.status_code == 200:
                         send_result = send_resp.json() if send_resp.content else send_resp.status_code
                         success = True
-                        print(f"DEBUG: Mensagem enviada com sucesso para {clean_number}")
+                        logger.debug("Mensagem enviada com sucesso para %s", clean_number)
                     else:
-                        print(f"DEBUG: Erro ao enviar para {clean_number} - Status: {send_resp.status_code}")
+                        logger.warning("Erro ao enviar para %s - Status: %s", clean_number, send_resp.status_code)
                 except Exception as e:
-                    print(f'[ERRO] Erro ao enviar para {destination_number}: {e}')
+                    logger.warning('Erro ao enviar para %s: %s', destination_number, e)
             else:
-                print(f"DEBUG: Nenhum chatid encontrado para envio da resposta da IA")
+                logger.debug("Nenhum chatid encontrado para envio da resposta da IA")
             # Salvar mensagem enviada pela IA na conversa - VERIFICAR DUPLICATA
             if success and resposta_ia:
                 # Verificar se já existe uma mensagem da IA com o mesmo conteúdo nos últimos 30 segundos
@@ -1714,7 +1477,7 @@ def webhook_evolution_uazapi(request):
                 
                 if existing_ia_message:
                     resposta_preview = str(resposta_ia)[:30] if resposta_ia else "sem resposta"
-                    print(f"  Mensagem da IA duplicada ignorada: {resposta_preview}...")
+                    logger.debug("Mensagem da IA duplicada ignorada: %s...", resposta_preview)
                 else:
                     msg_ia = Message.objects.create(
                         conversation=conversation,
@@ -1724,7 +1487,7 @@ def webhook_evolution_uazapi(request):
                         created_at=timezone.now()
                     )
                     resposta_preview = str(resposta_ia)[:30] if resposta_ia else "sem resposta"
-                    print(f"DEBUG: Mensagem da IA salva: {msg_ia.id} - Conversa: {conversation.id}, Contato: {contact.name} - {resposta_preview}...")
+                    logger.debug("Mensagem da IA salva: %s - Conversa: %s, Contato: %s - %s...", msg_ia.id, conversation.id, contact.name, resposta_preview)
                     
                     # Emitir evento WebSocket para mensagem da IA
                     async_to_sync(channel_layer.group_send)(
@@ -1739,6 +1502,6 @@ def webhook_evolution_uazapi(request):
         # Retornar 'ok' se a mensagem foi processada, independente do sucesso da resposta da IA
         return JsonResponse({'status': 'ok'})
     except Exception as e:
-        print(f'[ERRO] Erro no webhook: {str(e)}')
+        logger.error("Erro no webhook: %s", e)
         return JsonResponse({'error': str(e)}, status=500)
 
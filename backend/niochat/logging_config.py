@@ -0,0 +1,75 @@
+"""
+Configuração de logging do Nio Chat (LOGGING do settings)
+
+Este módulo não importa nada do Django para poder ser usado pelo próprio
+settings. Os helpers usados no código ficam em core/logging_utils.py.
+"""
+
+import json
+import logging
+
+ROOT_LOGGER = 'niochat'
+
+# Subsistemas do caminho quente (webhook, envio, websocket e integrações)
+SUBSYSTEMS = ('webhook', 'messages', 'websocket', 'uazapi', 'canais', 'media', 'email')
+
+
+class JsonFormatter(logging.Formatter):
+    """Formata cada registro como uma linha JSON"""
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _level_number(level):
+    if isinstance(level, int):
+        return level
+    number = logging.getLevelName(str(level).upper())
+    return number if isinstance(number, int) else logging.INFO
+
+
+def build_logging_config(enabled, level='INFO', subsystem_levels=None, fmt='text'):
+    """
+    Monta o dicionário LOGGING do Django.
+
+    Com ``enabled=False`` os loggers ``niochat.*`` ficam no mínimo em WARNING:
+    o DEBUG/INFO do caminho quente some, avisos e erros continuam saindo.
+    """
+    def effective(value):
+        return value if enabled else max(_level_number(value), logging.WARNING)
+
+    subsystem_levels = subsystem_levels or {}
+    loggers = {
+        ROOT_LOGGER: {
+            'handlers': ['console'],
+            'level': effective(level),
+            'propagate': False,
+        },
+    }
+    for name in SUBSYSTEMS:
+        loggers[f'{ROOT_LOGGER}.{name}'] = {
+            'level': effective(subsystem_levels.get(name, level)),
+        }
+    return {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'text': {'format': '%(asctime)s %(levelname)s [%(name)s] %(message)s'},
+            'json': {'()': 'niochat.logging_config.JsonFormatter'},
+        },
+        'handlers': {
+            'console': {
+                'class': 'logging.StreamHandler',
+                'formatter': 'json' if fmt == 'json' else 'text',
+            },
+        },
+        'loggers': loggers,
+    }
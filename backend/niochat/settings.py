@@ -221,3 +221,132 @@ AUTHENTICATION_BACKENDS = [
 
 APPEND_SLASH = False
 
+
+# Logging estruturado por subsistema (ver niochat/logging_config.py e core/logging_utils.py)
+# LOG_HOT_PATHS=False corta DEBUG/INFO do caminho quente em produção; WARNING e ERROR continuam
+from niochat.logging_config import SUBSYSTEMS as LOG_SUBSYSTEMS, build_logging_config
+
+LOG_HOT_PATHS = config('LOG_HOT_PATHS', default=True, cast=bool)
+LOG_LEVEL = config('LOG_LEVEL', default='DEBUG' if DEBUG else 'INFO')
+LOG_FORMAT = config('LOG_FORMAT', default='text')  # text ou json
+LOG_PAYLOAD_SAMPLE_RATE = config('LOG_PAYLOAD_SAMPLE_RATE', default=0.0, cast=float)
+LOG_PAYLOAD_MAX_CHARS = config('LOG_PAYLOAD_MAX_CHARS', default=2000, cast=int)
+
+LOGGING = build_logging_config(
+    enabled=LOG_HOT_PATHS,
+    level=LOG_LEVEL,
+    subsystem_levels={
+        name: config(f'LOG_LEVEL_{name.upper()}', default=LOG_LEVEL)
+        for name in LOG_SUBSYSTEMS
+    },
+    fmt=LOG_FORMAT,
+)
+
+# Cache (estado dos canais, etc). Com REDIS_URL o cache é compartilhado entre
+# processos (web, poller de canais, workers); sem ele, cache local em memória.
+REDIS_URL = config('REDIS_URL', default='')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Estado dos canais WhatsApp (ver core/channel_state.py)
+CHANNEL_STATE_POLL_INTERVAL = config('CHANNEL_STATE_POLL_INTERVAL', default=60, cast=int)
+CHANNEL_STATE_TTL = config('CHANNEL_STATE_TTL', default=300, cast=int)
+# Canal fora do cache: pedir atualização ao worker em background
+CHANNEL_STATE_REFRESH_ON_MISS = config('CHANNEL_STATE_REFRESH_ON_MISS', default=True, cast=bool)
+
+# Evolution API
+EVOLUTION_URL = config('EVOLUTION_URL', default='https://evo.niochat.com.br')
+EVOLUTION_APIKEY = config('EVOLUTION_APIKEY', default='')
+
+# Mensagens embutidas no ConversationSerializer (as demais via paginação keyset)
+CONVERSATION_MESSAGES_WINDOW = config('CONVERSATION_MESSAGES_WINDOW', default=50, cast=int)
+CONVERSATION_MESSAGES_MAX_PAGE = config('CONVERSATION_MESSAGES_MAX_PAGE', default=200, cast=int)
+
+# Arquivo de mensagens: conversas fechadas sem atividade há N dias saem da
+# tabela quente (comando archive_messages)
+MESSAGE_ARCHIVE_AFTER_DAYS = config('MESSAGE_ARCHIVE_AFTER_DAYS', default=180, cast=int)
+MESSAGE_ARCHIVE_BATCH_SIZE = config('MESSAGE_ARCHIVE_BATCH_SIZE', default=100, cast=int)
+
+# Cache das estatísticas do dashboard (invalidado por eventos de mensagem/conversa)
+DASHBOARD_STATS_TTL = config('DASHBOARD_STATS_TTL', default=10, cast=int)
+
+# Recuperador de conversas (comando recovery_engine, ver conversations/recovery.py)
+RECOVERY_ENGINE_INTERVAL = config('RECOVERY_ENGINE_INTERVAL', default=60, cast=int)
+RECOVERY_BATCH_SIZE = config('RECOVERY_BATCH_SIZE', default=100, cast=int)
+# Envios de recuperação por minuto, por provedor
+RECOVERY_RATE_PER_MINUTE = config('RECOVERY_RATE_PER_MINUTE', default=30, cast=int)
+# Na primeira execução, até quantas horas para trás procurar conversas ociosas
+RECOVERY_LOOKBACK_HOURS = config('RECOVERY_LOOKBACK_HOURS', default=24, cast=int)
+
+# Download de mídia recebida (conversations/media.py)
+MEDIA_DOWNLOAD_MAX_BYTES = config('MEDIA_DOWNLOAD_MAX_BYTES', default=100 * 1024 * 1024, cast=int)
+MEDIA_DOWNLOAD_TIMEOUT = config('MEDIA_DOWNLOAD_TIMEOUT', default=30, cast=int)
+MEDIA_DOWNLOAD_WORKERS = config('MEDIA_DOWNLOAD_WORKERS', default=4, cast=int)
+MEDIA_DOWNLOAD_QUEUE_SIZE = config('MEDIA_DOWNLOAD_QUEUE_SIZE', default=100, cast=int)
+
+# Conversão de mídia com ffmpeg (conversations/transcode.py); cada processo
+# web/ASGI tem a sua fila, então 0 = núcleos divididos por WEB_PROCESSES
+WEB_PROCESSES = config('WEB_PROCESSES', default=1, cast=int)
+TRANSCODE_WORKERS = config('TRANSCODE_WORKERS', default=0, cast=int)
+TRANSCODE_QUEUE_SIZE = config('TRANSCODE_QUEUE_SIZE', default=100, cast=int)
+TRANSCODE_TIMEOUT = config('TRANSCODE_TIMEOUT', default=120, cast=int)
+
+# Miniaturas WebP de imagens e vídeos (conversations/previews.py): lado maior em pixels e qualidade
+PREVIEW_MAX_SIZE = config('PREVIEW_MAX_SIZE', default=320, cast=int)
+PREVIEW_QUALITY = config('PREVIEW_QUALITY', default=75, cast=int)
+
+# Envio de mídia em partes (conversations/uploads.py): tamanho máximo do arquivo e de cada parte
+MEDIA_UPLOAD_MAX_BYTES = config('MEDIA_UPLOAD_MAX_BYTES', default=200 * 1024 * 1024, cast=int)
+MEDIA_UPLOAD_CHUNK_MAX_BYTES = config('MEDIA_UPLOAD_CHUNK_MAX_BYTES', default=8 * 1024 * 1024, cast=int)
+MEDIA_UPLOAD_EXPIRE_HOURS = config('MEDIA_UPLOAD_EXPIRE_HOURS', default=24, cast=int)
+
+# Retenção de mídia (conversations/retention.py): intervalo entre ciclos, lote, pausa entre
+# lotes (segundos), remoções por ciclo e carência (minutos) antes de remover blobs sem referência
+MEDIA_RETENTION_INTERVAL = config('MEDIA_RETENTION_INTERVAL', default=3600, cast=int)
+MEDIA_RETENTION_BATCH_SIZE = config('MEDIA_RETENTION_BATCH_SIZE', default=500, cast=int)
+MEDIA_RETENTION_PAUSE = config('MEDIA_RETENTION_PAUSE', default=0.5, cast=float)
+MEDIA_RETENTION_MAX_DELETES = config('MEDIA_RETENTION_MAX_DELETES', default=5000, cast=int)
+MEDIA_RETENTION_GRACE_MINUTES = config('MEDIA_RETENTION_GRACE_MINUTES', default=60, cast=int)
+
+# Ingestão IMAP (integrations/imap_sync.py): timeout de rede e renovação do IDLE (segundos),
+# intervalo de consulta sem IDLE, e-mails por FETCH, tamanho a partir do qual o e-mail é
+# buscado em partes (bytes) e não lidas importadas na primeira sincronização
+EMAIL_IMAP_TIMEOUT = config('EMAIL_IMAP_TIMEOUT', default=60, cast=int)
+EMAIL_IMAP_IDLE_TIMEOUT = config('EMAIL_IMAP_IDLE_TIMEOUT', default=29 * 60, cast=int)
+EMAIL_IMAP_POLL_INTERVAL = config('EMAIL_IMAP_POLL_INTERVAL', default=30, cast=int)
+EMAIL_IMAP_FETCH_BATCH = config('EMAIL_IMAP_FETCH_BATCH', default=25, cast=int)
+EMAIL_IMAP_STREAM_BYTES = config('EMAIL_IMAP_STREAM_BYTES', default=1024 * 1024, cast=int)
+EMAIL_IMAP_INITIAL_LIMIT = config('EMAIL_IMAP_INITIAL_LIMIT', default=50, cast=int)
+
+# Worker de e-mail assíncrono (integrations/email_async.py): caixas conectando ou sincronizando
+# ao mesmo tempo por servidor IMAP e intervalo (segundos) para reler as integrações ativas
+EMAIL_WORKER_HOST_CONCURRENCY = config('EMAIL_WORKER_HOST_CONCURRENCY', default=4, cast=int)
+EMAIL_WORKER_REFRESH_INTERVAL = config('EMAIL_WORKER_REFRESH_INTERVAL', default=60, cast=int)
+
+# Fila de envio de e-mail (integrations/outbound_mail.py): timeout SMTP, sessões autenticadas por
+# integração e tempo ocioso (segundos) antes de descartá-las; threads de envio, tamanho da fila,
+# tentativas, espera da primeira nova tentativa (dobra a cada falha) e intervalo da varredura
+EMAIL_SMTP_TIMEOUT = config('EMAIL_SMTP_TIMEOUT', default=30, cast=int)
+EMAIL_SMTP_POOL_SIZE = config('EMAIL_SMTP_POOL_SIZE', default=2, cast=int)
+EMAIL_SMTP_MAX_IDLE = config('EMAIL_SMTP_MAX_IDLE', default=60, cast=int)
+EMAIL_SEND_WORKERS = config('EMAIL_SEND_WORKERS', default=4, cast=int)
+EMAIL_SEND_QUEUE_SIZE = config('EMAIL_SEND_QUEUE_SIZE', default=1000, cast=int)
+EMAIL_SEND_MAX_ATTEMPTS = config('EMAIL_SEND_MAX_ATTEMPTS', default=5, cast=int)
+EMAIL_SEND_RETRY_DELAY = config('EMAIL_SEND_RETRY_DELAY', default=30, cast=int)
+EMAIL_SEND_SWEEP_INTERVAL = config('EMAIL_SEND_SWEEP_INTERVAL', default=60, cast=int)
+
+# Entrega de mídia (core/media_serving.py): cache dos arquivos antigos em segundos e
+# prefixo da location internal do nginx para X-Accel-Redirect (vazio = Django entrega)
+MEDIA_CACHE_MAX_AGE = config('MEDIA_CACHE_MAX_AGE', default=3600, cast=int)
+MEDIA_ACCEL_REDIRECT_PREFIX = config('MEDIA_ACCEL_REDIRECT_PREFIX', default='')
@@ -2,7 +2,7 @@ import aiohttp
 import asyncio
 import json
 import redis.asyncio as aioredis
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 from channels.layers import get_channel_layer
 from datetime import datetime
 
@@ -15,7 +15,7 @@ class UazapiSSEManager:
 
     async def start_sse(self, token, provedor_id):
         url_base = self.provedor_url_map[provedor_id]
-        url = f'{url_base.rstrip("/")}/sse?token={token}&events=messages,contacts,chats,chat_labels,groups,presence,labels'
+        url = f'{url_base.rstrip("/")}/sse?token={token}&events=connection,messages,contacts,chats,chat_labels,groups,presence,labels'
         async with aiohttp.ClientSession() as session:
             while True:
                 try:
@@ -39,6 +39,8 @@ class UazapiSSEManager:
             await self.update_graficos_atendimentos(event, provedor_id)
         if event['type'] == 'presence':
             await self.update_graficos_presenca(event, provedor_id)
+        if event['type'] == 'connection':
+            await self.update_channel_state(event, provedor_id)
         if self.channel_layer:
             await self.channel_layer.group_send(
                 f"painel_{provedor_id}",
@@ -48,6 +50,11 @@ class UazapiSSEManager:
                 }
             )
 
+    async def update_channel_state(self, event, provedor_id):
+        # Manter o cache de estado dos canais (CanalSerializer) sem polling
+        from core.channel_state import apply_connection_event
+        await sync_to_async(apply_connection_event)(provedor_id, event)
+
     async def update_graficos_mensagens(self, event, provedor_id):
         today = datetime.utcnow().strftime('%Y-%m-%d')
         key = f"graficos:{provedor_id}:mensagens:{today}"